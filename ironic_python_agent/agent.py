@@ -20,6 +20,7 @@ import time
 
 from oslo_log import log
 import pkg_resources
+from six.moves import socketserver
 from stevedore import extension
 from wsgiref import simple_server
 
@@ -37,6 +38,17 @@ def _time():
     return time.time()
 
 
+class ThreadingWSGIServer(socketserver.ThreadingMixIn,
+                          simple_server.WSGIServer):
+    """WSGI server handling each request in its own thread.
+
+    Peers download shared images from the API, which must not keep it from
+    answering Ironic in the meantime.
+    """
+
+    daemon_threads = True
+
+
 class IronicPythonAgentStatus(encoding.Serializable):
     """Represents the status of an agent."""
 
@@ -299,7 +311,7 @@ class IronicPythonAgent(base.ExecuteCommandMixin):
             self.listen_address[0],
             self.listen_address[1],
             self.api,
-            server_class=simple_server.WSGIServer)
+            server_class=ThreadingWSGIServer)
 
         if not self.standalone:
             # Don't start heartbeating until the server is listening
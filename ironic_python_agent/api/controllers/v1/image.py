@@ -0,0 +1,59 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pecan
+from pecan import rest
+import webob
+
+from ironic_python_agent import peer
+
+
+class ImageController(rest.RestController):
+    """Controller serving the images shared with other agents."""
+
+    _custom_actions = {
+        'manifest': ['GET'],
+    }
+
+    def _get_image(self, image_id):
+        image = peer.get_shared(image_id)
+        if image is None:
+            pecan.abort(404, 'Image {0} is not shared'.format(image_id))
+        return image
+
+    @pecan.expose()
+    def get_one(self, image_id):
+        """Get the contents of a shared image, or a byte range of it."""
+        image = self._get_image(image_id)
+        resp = webob.Response(content_type='application/octet-stream')
+        resp.headers['Accept-Ranges'] = 'bytes'
+        start, end = 0, image.size
+        if pecan.request.range is not None:
+            bounds = pecan.request.range.range_for_length(image.size)
+            if bounds is None:
+                resp.status = 416
+                resp.headers['Content-Range'] = 'bytes */{0}'.format(
+                    image.size)
+                return resp
+            start, end = bounds
+            resp.status = 206
+            resp.content_range = (start, end, image.size)
+        resp.content_length = end - start
+        resp.app_iter = image.read(start, end)
+        return resp
+
+    @pecan.expose('json')
+    def manifest(self, image_id):
+        """Get the manifest of the pieces of a shared image."""
+        return self._get_image(image_id).pieces.to_dict()
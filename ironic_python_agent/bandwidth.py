@@ -0,0 +1,128 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bandwidth shaping of image downloads.
+
+When a whole rack is deployed at once, agents downloading at line rate
+saturate its uplink. Downloads take data from a token bucket shared by
+the agent, so that the node as a whole does not exceed the download rate,
+however many connections are used. The rate can be changed at any time and
+applies to the downloads in progress.
+"""
+
+import threading
+import time
+
+from oslo_log import log
+
+LOG = log.getLogger(__name__)
+
+# Seconds worth of data which can be received at once after an idle period
+DEFAULT_BURST = 1.0
+
+_MB = 1024 * 1024
+
+
+class TokenBucket(object):
+    """Token bucket limiting the rate at which data is received.
+
+    The bucket holds up to ``burst`` seconds worth of tokens. Taking more
+    tokens than it holds puts it in debt, and the caller sleeps until the
+    debt is paid back, so chunks of any size can be taken.
+    """
+
+    def __init__(self, rate=None, burst=DEFAULT_BURST):
+        """Construct an instance of TokenBucket.
+
+        :param rate: rate in bytes per second, None or 0 for no limit.
+        :param burst: seconds worth of tokens the bucket holds.
+        """
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._rate = None
+        self._tokens = 0.0
+        self._last = time.time()
+        self.set_rate(rate)
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def _refill(self, now):
+        if self._rate:
+            self._tokens = min(self._tokens + (now - self._last) * self._rate,
+                               self._rate * self.burst)
+        self._last = now
+
+    def set_rate(self, rate):
+        """Change the rate, taking effect for the next tokens taken.
+
+        :param rate: rate in bytes per second, None or 0 for no limit.
+        """
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            previous, self._rate = self._rate, rate or None
+            if not self._rate:
+                self._tokens = 0.0
+            elif not previous:
+                self._tokens = self._rate * self.burst
+            else:
+                # The debt taken at the previous rate is kept, so a rate
+                # lowered in the middle of a transfer applies right away
+                self._tokens = min(self._tokens, self._rate * self.burst)
+
+    def consume(self, amount):
+        """Take tokens for amount bytes, sleeping until they are available.
+
+        :param amount: number of bytes received.
+        :returns: the number of seconds slept.
+        """
+        with self._lock:
+            if not self._rate:
+                return 0
+            self._refill(time.time())
+            self._tokens -= amount
+            delay = -self._tokens / self._rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+_downloads = TokenBucket()
+
+
+def downloads():
+    """Get the bucket shared by the image downloads of the agent."""
+    return _downloads
+
+
+def get_download_rate():
+    """Get the download rate limit of the agent in MB/s, None if unset."""
+    rate = _downloads.rate
+    return round(rate / float(_MB), 2) if rate else None
+
+
+def set_download_rate(rate):
+    """Limit the download rate of the agent.
+
+    :param rate: rate in MB/s, None or 0 for no limit.
+    """
+    if rate == get_download_rate():
+        return
+    if rate:
+        LOG.info('Limiting image downloads to %s MB/s', rate)
+    else:
+        LOG.info('Not limiting the rate of image downloads')
+    _downloads.set_rate(int(rate * _MB) if rate else None)
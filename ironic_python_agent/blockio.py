@@ -0,0 +1,719 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for fast writes to block devices.
+
+Writing images through the page cache evicts the ramdisk's own memory and
+leaves gigabytes of dirty pages to be flushed at the end. The writers in
+this module use O_DIRECT with page-aligned buffers instead, and fall back
+to buffered I/O on targets which do not support it (e.g. tmpfs).
+
+Most of a disk image is usually zeros. The writers can detect all-zero
+blocks and, depending on ``zero_handling``, have the device zero them
+(BLKZEROOUT, offloaded to the device where supported), discard them
+(BLKDISCARD, only if the device guarantees discarded blocks read back as
+zeros) or simply skip them on a target known to be zeroed already. The
+same requests erase whole devices without writing them.
+"""
+
+import errno
+import fcntl
+import mmap
+import os
+import random
+import stat
+import struct
+import threading
+import time
+
+from oslo_log import log
+import six
+from six.moves import queue
+
+LOG = log.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 8 * 1024 * 1024  # 8MB
+
+# Number of buffers a ParallelWriter has in flight
+DEFAULT_QUEUE_DEPTH = 4
+
+# O_DIRECT requires buffers, offsets and lengths aligned to the logical block
+# size of the device. A page is a multiple of every block size in use.
+ALIGNMENT = mmap.PAGESIZE
+
+# Flag opening a file for direct I/O, 0 where not supported
+O_DIRECT = getattr(os, 'O_DIRECT', 0)
+
+# Ways of handling all-zero blocks
+ZERO_WRITE = 'write'
+ZERO_ZEROOUT = 'zeroout'
+ZERO_DISCARD = 'discard'
+ZERO_SKIP = 'skip'
+ZERO_HANDLING = (ZERO_WRITE, ZERO_ZEROOUT, ZERO_DISCARD, ZERO_SKIP)
+
+# Granularity of the zero detection
+ZERO_BLOCK_SIZE = 64 * 1024  # 64KB
+
+_ZEROS = b'\0' * ZERO_BLOCK_SIZE
+
+# From linux/fs.h
+_BLKDISCARD = 0x1277
+_BLKSECDISCARD = 0x127d
+_BLKZEROOUT = 0x127f
+
+# Number and size of the reads checking that a device was zeroed
+ZERO_CHECK_SAMPLES = 64
+ZERO_CHECK_SAMPLE_SIZE = 64 * 1024  # 64KB
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def align_up(value, alignment=ALIGNMENT):
+    """Round value up to a multiple of alignment."""
+    return -(-value // alignment) * alignment
+
+
+class BufferPool(object):
+    """A pool of reusable page-aligned buffers.
+
+    Anonymous mmaps are always page-aligned, which is what O_DIRECT needs.
+    Buffers are handed back to the pool once used instead of being freed, so
+    that repeated writes do not keep allocating large blocks of memory. If
+    ``max_buffers`` buffers are in use, :meth:`get` blocks until one of them
+    is released.
+    """
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, max_buffers=None):
+        self.buffer_size = align_up(buffer_size)
+        self.max_buffers = max_buffers
+        self._free = []
+        self._allocated = 0
+        self._cond = threading.Condition()
+
+    def get(self):
+        """Get a buffer from the pool, allocating it if needed."""
+        with self._cond:
+            while not self._free:
+                if (self.max_buffers is None
+                        or self._allocated < self.max_buffers):
+                    self._allocated += 1
+                    return mmap.mmap(-1, self.buffer_size)
+                self._cond.wait()
+            return self._free.pop()
+
+    def put(self, buf):
+        """Give a buffer back to the pool."""
+        with self._cond:
+            self._free.append(buf)
+            self._cond.notify()
+
+
+def get_buffer_pool(buffer_size=DEFAULT_BUFFER_SIZE):
+    """Get the shared buffer pool for buffers of a given size."""
+    buffer_size = align_up(buffer_size)
+    with _pools_lock:
+        if buffer_size not in _pools:
+            _pools[buffer_size] = BufferPool(buffer_size)
+        return _pools[buffer_size]
+
+
+if six.PY2:
+    def buffer_view(data, start=0, end=None):
+        """Get a slice of data, e.g. of an mmap, without copying it.
+
+        mmaps do not support memoryview on Python 2, a buffer is used there.
+        """
+        if isinstance(data, memoryview):
+            return data[start:end]
+        end = len(data) if end is None else min(end, len(data))
+        return buffer(data, start, max(end - start, 0))  # noqa
+else:
+    def buffer_view(data, start=0, end=None):
+        """Get a slice of data, e.g. of an mmap, without copying it."""
+        return memoryview(data)[start:end]
+
+
+def _write_all(fd, data):
+    view = buffer_view(data)
+    while len(view):
+        written = os.write(fd, view)
+        view = buffer_view(view, written)
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while len(view):
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def pwrite_all(fd, data, offset, lock=None):
+    """Write all of data at offset of a file descriptor.
+
+    Python 2 has no pwrite, there the descriptor is seeked then written to.
+    Threads writing to the same descriptor must then pass the same lock,
+    which is held around the seek and the write.
+
+    :param fd: file descriptor.
+    :param data: bytes or a buffer.
+    :param offset: offset in the file.
+    :param lock: a lock shared by all the writes to fd, only used if
+                 pwrite is not available.
+    """
+    if hasattr(os, 'pwrite'):
+        _pwrite_all(fd, data, offset)
+    elif lock is None:
+        os.lseek(fd, offset, os.SEEK_SET)
+        _write_all(fd, data)
+    else:
+        with lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            _write_all(fd, data)
+
+
+def _zero_runs(data, block_size=ZERO_BLOCK_SIZE):
+    """Split data into runs of all-zero and of other blocks.
+
+    The comparison with a block of zeros is done by memcmp, not in Python.
+
+    :returns: a list of (start, end, is_zero) tuples.
+    """
+    runs = []
+    for start in range(0, len(data), block_size):
+        end = min(start + block_size, len(data))
+        is_zero = data[start:end] == _ZEROS[:end - start]
+        if runs and runs[-1][2] == is_zero:
+            runs[-1] = (runs[-1][0], end, is_zero)
+        else:
+            runs.append((start, end, is_zero))
+    return runs
+
+
+def _queue_attribute(st, name):
+    """Read an attribute of the request queue of a block device.
+
+    :returns: the stripped value, None if not a block device or unknown.
+    """
+    if not stat.S_ISBLK(st.st_mode):
+        return None
+    base = '/sys/dev/block/{0}:{1}'.format(os.major(st.st_rdev),
+                                           os.minor(st.st_rdev))
+    # Partitions use the queue of their disk
+    for path in (os.path.join(base, 'queue'),
+                 os.path.join(base, '..', 'queue')):
+        try:
+            with open(os.path.join(path, name)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            continue
+    return None
+
+
+def _discard_zeroes_data(st):
+    """Whether discarded blocks of a block device read back as zeros."""
+    return _queue_attribute(st, 'discard_zeroes_data') == '1'
+
+
+def _ioctl_range(fd, request, offset, length):
+    fcntl.ioctl(fd, request, struct.pack('QQ', offset, length))
+
+
+def get_zeroing_support(path):
+    """Find out how a block device can be zeroed without writing to it.
+
+    :param path: path of the block device.
+    :returns: a dictionary with boolean values, ``discard`` if the device
+              supports discarding blocks, ``discard_zeroes_data`` if
+              discarded blocks read back as zeros and ``write_zeroes`` if
+              zeroing is offloaded to the device. All are False if the path
+              is not a block device.
+    """
+    st = os.stat(path)
+    return {
+        'discard': (_queue_attribute(st, 'discard_max_bytes')
+                    or '0') != '0',
+        'discard_zeroes_data': _discard_zeroes_data(st),
+        'write_zeroes': (_queue_attribute(st, 'write_zeroes_max_bytes')
+                         or '0') != '0',
+    }
+
+
+def discard_range(fd, offset, length, secure=False):
+    """Discard a range of a block device.
+
+    :param secure: whether to use a secure discard, which also erases any
+                   copy of the blocks the device may have kept.
+    :raises: OSError or IOError if the device does not support it.
+    """
+    _ioctl_range(fd, _BLKSECDISCARD if secure else _BLKDISCARD,
+                 offset, length)
+
+
+def zero_range(fd, offset, length):
+    """Zero a range of a block device, offloaded to the device if possible.
+
+    :raises: OSError or IOError on failure.
+    """
+    _ioctl_range(fd, _BLKZEROOUT, offset, length)
+
+
+def find_non_zero(path, size, samples=ZERO_CHECK_SAMPLES,
+                  sample_size=ZERO_CHECK_SAMPLE_SIZE):
+    """Check that samples of a device read as zeros.
+
+    The start and the end of the device are always read, the other samples
+    are taken at random offsets.
+
+    :param path: path of the device.
+    :param size: size of the device in bytes.
+    :returns: the offset of the first sample which is not all zeros, None
+              if all of them are.
+    """
+    sample_size = min(sample_size, size)
+    blocks = (size - sample_size) // ZERO_BLOCK_SIZE
+    offsets = [0, size - sample_size]
+    offsets.extend(random.randint(0, blocks) * ZERO_BLOCK_SIZE
+                   for _ in range(max(samples - 2, 0)))
+    with open(path, 'rb') as f:
+        for offset in sorted(set(offsets)):
+            f.seek(offset)
+            data = f.read(sample_size)
+            if data.count(b'\0') != len(data):
+                return offset
+    return None
+
+
+class _Writer(object):
+    """Common base of the writers: opening, falling back and zeroing.
+
+    The target must exist unless ``create`` is set, so that a wrong device
+    path is not silently written to a new file, e.g. in /dev.
+    """
+
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE, pool=None,
+                 zero_handling=None, create=False):
+        self.path = path
+        self._flags = os.O_RDWR | (os.O_CREAT if create else 0)
+        self.pool = pool or get_buffer_pool(buffer_size)
+        self.direct = bool(O_DIRECT)
+        self.zero_handling = zero_handling or ZERO_WRITE
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+        self.elapsed = None
+        self._start = time.time()
+        self._buf = None
+        self._fd = None
+        self._written_direct = False
+        # Held by every write to _fd, see pwrite_all
+        self._seek_lock = threading.Lock()
+
+        if self.direct:
+            try:
+                self._fd = os.open(path, self._flags | O_DIRECT)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                self._fall_back('opening with O_DIRECT failed')
+            else:
+                self._buf = self.pool.get()
+        if self._fd is None:
+            self._fd = os.open(path, self._flags)
+
+        if (self.zero_handling == ZERO_DISCARD
+                and not _discard_zeroes_data(os.fstat(self._fd))):
+            LOG.info('Discarded blocks of %s are not guaranteed to read as '
+                     'zeros, zeroing them instead', path)
+            self.zero_handling = ZERO_ZEROOUT
+
+    def _fall_back(self, reason):
+        LOG.info('%(path)s does not support direct I/O (%(reason)s), '
+                 'falling back to buffered I/O',
+                 {'path': self.path, 'reason': reason})
+        self.direct = False
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = os.open(self.path, self._flags)
+
+    def _pwrite(self, offset, data):
+        pwrite_all(self._fd, data, offset, self._seek_lock)
+
+    def _write_range(self, offset, data):
+        """Write data at offset, falling back on the first failure."""
+        if self.direct and (offset % ALIGNMENT or len(data) % ALIGNMENT):
+            self._fall_back('unaligned write')
+        try:
+            self._pwrite(offset, data)
+        except OSError as e:
+            if (not self.direct or e.errno != errno.EINVAL
+                    or self._written_direct):
+                raise
+            self._fall_back('first write failed')
+            self._pwrite(offset, data)
+        if self.direct:
+            self._written_direct = True
+
+    def _write_zeros(self, offset, length):
+        # An anonymous mmap is page-aligned and reads as zeros
+        zeros = mmap.mmap(-1, min(align_up(length), self.pool.buffer_size))
+        try:
+            end = offset + length
+            while offset < end:
+                n = min(len(zeros), end - offset)
+                self._write_range(offset, buffer_view(zeros, 0, n))
+                offset += n
+        finally:
+            zeros.close()
+
+    def _zero_range(self, offset, length):
+        """Make a range read as zeros according to zero_handling."""
+        if not length:
+            return
+        if self.zero_handling in (ZERO_ZEROOUT, ZERO_DISCARD):
+            request = (_BLKDISCARD if self.zero_handling == ZERO_DISCARD
+                       else _BLKZEROOUT)
+            try:
+                _ioctl_range(self._fd, request, offset, length)
+            except (IOError, OSError) as e:
+                LOG.info('Zeroing blocks of %(path)s with an ioctl failed '
+                         '(%(err)s), writing zeros instead',
+                         {'path': self.path, 'err': e})
+                self.zero_handling = ZERO_WRITE
+            else:
+                self.bytes_skipped += length
+                return
+        if self.zero_handling == ZERO_SKIP:
+            self.bytes_skipped += length
+            return
+        self._write_zeros(offset, length)
+        self.bytes_written += length
+
+    def _finish(self):
+        pass
+
+    def close(self, flush=True):
+        """Flush outstanding data to disk and close the file.
+
+        :param flush: if False, drop any buffered data, e.g. because the
+                      write already failed.
+        """
+        if self._fd is None:
+            return
+        try:
+            if flush:
+                self._finish()
+                os.fsync(self._fd)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+            if self._buf is not None:
+                self.pool.put(self._buf)
+                self._buf = None
+            self.elapsed = time.time() - self._start
+
+        if flush:
+            LOG.info('Wrote %(bytes)d bytes to %(path)s in %(time).2f '
+                     'seconds (%(rate)s MB/s, direct I/O: %(direct)s), '
+                     '%(skipped)d zero bytes were not written (%(zero)s)',
+                     {'bytes': self.bytes_written, 'path': self.path,
+                      'time': self.elapsed, 'rate': self.throughput,
+                      'direct': self.direct, 'skipped': self.bytes_skipped,
+                      'zero': self.zero_handling})
+
+    @property
+    def throughput(self):
+        """Achieved throughput in MB/s, once the writer is closed.
+
+        Zero blocks which were not written count towards the throughput.
+        """
+        if not self.elapsed:
+            return None
+        size = self.bytes_written + self.bytes_skipped
+        return round(size / self.elapsed / (1024 * 1024), 2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(flush=exc_type is None)
+
+
+class DirectWriter(_Writer):
+    """Sequentially write a stream of arbitrarily sized chunks to a file.
+
+    Incoming data is gathered in page-aligned buffers which are written with
+    O_DIRECT once full, bypassing the page cache. If the final block is
+    only partially filled it is padded with the data already on the device
+    (or zeros past the end of a regular file, which is then truncated), so
+    bytes after the end of the stream are left untouched.
+
+    If the target refuses O_DIRECT, either when opening it or on the first
+    write, the writer transparently falls back to buffered I/O.
+
+    The stream is written from ``offset`` on, e.g. the start of a partition
+    of the disk at path. It must be aligned for O_DIRECT to be used.
+    """
+
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE, pool=None,
+                 zero_handling=None, offset=0, create=False):
+        super(DirectWriter, self).__init__(path, buffer_size=buffer_size,
+                                           pool=pool,
+                                           zero_handling=zero_handling,
+                                           create=create)
+        if self._buf is None:
+            self._buf = self.pool.get()
+        self._fill = 0
+        self._offset = offset
+        # Zero blocks not handled yet, to be handled in one go
+        self._zero_start = None
+
+    def _flush_zeros(self):
+        if self._zero_start is not None:
+            self._zero_range(self._zero_start,
+                             self._offset - self._zero_start)
+            self._zero_start = None
+
+    def _flush_buffer(self, length):
+        if self.zero_handling == ZERO_WRITE:
+            runs = [(0, length, False)]
+        else:
+            runs = _zero_runs(self._buf[:length])
+        for start, end, is_zero in runs:
+            if is_zero:
+                if self._zero_start is None:
+                    self._zero_start = self._offset
+            else:
+                self._flush_zeros()
+                self._write_range(self._offset,
+                                  buffer_view(self._buf, start, end))
+                self.bytes_written += end - start
+            self._offset += end - start
+        return runs[-1][2]
+
+    def write(self, data):
+        """Write a chunk of data after the previously written ones."""
+        size = len(self._buf)
+        pos = 0
+        while pos < len(data):
+            n = min(len(data) - pos, size - self._fill)
+            self._buf[self._fill:self._fill + n] = data[pos:pos + n]
+            self._fill += n
+            pos += n
+            if self._fill == size:
+                self._flush_full()
+
+    def _flush_full(self):
+        self._flush_buffer(len(self._buf))
+        self._fill = 0
+
+    def _finish(self):
+        end = self._offset + self._fill
+        st = os.fstat(self._fd)
+        is_file = stat.S_ISREG(st.st_mode)
+        old_size = st.st_size
+        if self._fill:
+            length = self._fill
+            if self.direct:
+                length = align_up(self._fill)
+            if length > self._fill:
+                padding = b''
+                if not is_file or old_size > end:
+                    with open(self.path, 'rb') as f:
+                        f.seek(end)
+                        padding = f.read(length - self._fill)
+                padding += b'\0' * (length - self._fill - len(padding))
+                self._buf[self._fill:length] = padding
+            padding = length - self._fill
+            tail_is_zero = self._flush_buffer(length)
+            self._fill = 0
+            # Zeroing the padding is harmless: it already reads as zeros.
+            # It is not part of the stream though.
+            self._flush_zeros()
+            if tail_is_zero:
+                self.bytes_skipped -= padding
+            else:
+                self.bytes_written -= padding
+        self._flush_zeros()
+        if is_file:
+            # Also extends files whose end was skipped
+            os.ftruncate(self._fd, max(end, old_size))
+
+
+class ParallelWriter(DirectWriter):
+    """Sequentially write a stream, with several writes in flight.
+
+    Like DirectWriter, but full buffers are handed over to ``queue_depth``
+    threads which write them at their offset with pwrite. Devices like NVMe
+    drives only reach their bandwidth with many outstanding I/Os. At most
+    ``queue_depth`` buffers are in flight, plus the one being filled.
+
+    Buffers are written synchronously until one went through O_DIRECT, so
+    that whether to fall back to buffered I/O is decided before the threads
+    start, as falling back replaces the descriptor they write to. The end
+    of the stream is only written once all the buffers before it are.
+    Errors of the writer threads are raised by the next write or by close.
+    """
+
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE, pool=None,
+                 zero_handling=None, offset=0,
+                 queue_depth=DEFAULT_QUEUE_DEPTH, create=False):
+        self._threads = []
+        super(ParallelWriter, self).__init__(path, buffer_size=buffer_size,
+                                             pool=pool,
+                                             zero_handling=zero_handling,
+                                             offset=offset, create=create)
+        self.queue_depth = queue_depth
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(queue_depth)
+        self._queue = queue.Queue()
+        self._error = None
+
+    def _fall_back(self, reason):
+        if self._threads:
+            # Only possible with an unaligned write after a direct one
+            # succeeded, which the threads never do
+            raise OSError(errno.EINVAL, 'Cannot fall back to buffered I/O '
+                          'with writes in flight ({0})'.format(reason))
+        super(ParallelWriter, self)._fall_back(reason)
+
+    def _write_buffer(self, offset, buf):
+        if self.zero_handling == ZERO_WRITE:
+            runs = [(0, len(buf), False)]
+        else:
+            runs = _zero_runs(buf)
+        for start, end, is_zero in runs:
+            if is_zero:
+                with self._lock:
+                    self._zero_range(offset + start, end - start)
+            else:
+                self._pwrite(offset + start, buffer_view(buf, start, end))
+                with self._lock:
+                    self.bytes_written += end - start
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            offset, buf = item
+            try:
+                # Once a write failed, the remaining buffers are dropped
+                if self._error is None:
+                    self._write_buffer(offset, buf)
+            except Exception as e:
+                self._error = e
+            finally:
+                self.pool.put(buf)
+                self._slots.release()
+
+    def _flush_full(self):
+        if self._error is not None:
+            raise self._error
+        if self.direct and not self._written_direct:
+            super(ParallelWriter, self)._flush_full()
+            return
+        self._flush_zeros()
+        if not self._threads:
+            self._threads = [
+                threading.Thread(target=self._worker,
+                                 name='pwrite-{0}-{1}'.format(
+                                     os.path.basename(self.path), i))
+                for i in range(self.queue_depth)]
+            for thread in self._threads:
+                thread.daemon = True
+                thread.start()
+        self._slots.acquire()
+        self._queue.put((self._offset, self._buf))
+        self._offset += len(self._buf)
+        self._buf = self.pool.get()
+        self._fill = 0
+
+    def _drain(self):
+        """Wait for the buffers in flight to be written."""
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _finish(self):
+        self._drain()
+        if self._error is not None:
+            raise self._error
+        super(ParallelWriter, self)._finish()
+
+    def close(self, flush=True):
+        self._drain()
+        super(ParallelWriter, self).close(flush=flush)
+
+
+class PositionalWriter(_Writer):
+    """Write chunks of data at arbitrary offsets of a file.
+
+    Writes whose offset and length are aligned go through O_DIRECT from a
+    page-aligned buffer, the first unaligned write switches the writer to
+    buffered I/O. Safe to use from several threads.
+    """
+
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE, pool=None,
+                 zero_handling=None, create=False):
+        self._lock = threading.Lock()
+        self._end = 0
+        super(PositionalWriter, self).__init__(path, buffer_size=buffer_size,
+                                               pool=pool,
+                                               zero_handling=zero_handling,
+                                               create=create)
+
+    def _write_data(self, offset, data):
+        if not self.direct:
+            self._write_range(offset, data)
+            return
+        size = len(self._buf)
+        for pos in range(0, len(data), size):
+            piece = buffer_view(data, pos, pos + size)
+            self._buf[:len(piece)] = bytes(piece)
+            self._write_range(offset + pos,
+                              buffer_view(self._buf, 0, len(piece)))
+            if not self.direct:
+                self._write_range(offset + pos + len(piece),
+                                  buffer_view(data, pos + len(piece)))
+                return
+
+    def write_at(self, offset, data):
+        """Write data at the given offset."""
+        with self._lock:
+            self._end = max(self._end, offset + len(data))
+            if self.zero_handling == ZERO_WRITE:
+                runs = [(0, len(data), False)]
+            else:
+                runs = _zero_runs(data)
+            for start, end, is_zero in runs:
+                if is_zero:
+                    self._zero_range(offset + start, end - start)
+                else:
+                    self._write_data(offset + start, data[start:end])
+                    self.bytes_written += end - start
+
+    def write_zeroes(self, offset, length):
+        """Make a range of the file read as zeros."""
+        with self._lock:
+            self._end = max(self._end, offset + length)
+            self._zero_range(offset, length)
+
+    def _finish(self):
+        st = os.fstat(self._fd)
+        if stat.S_ISREG(st.st_mode) and st.st_size < self._end:
+            # The end of the file was skipped
+            os.ftruncate(self._fd, self._end)
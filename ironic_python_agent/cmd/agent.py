@@ -18,7 +18,9 @@ from oslo_config import cfg
 from oslo_log import log
 
 from ironic_python_agent import agent
+from ironic_python_agent import bandwidth
 from ironic_python_agent import inspector
+from ironic_python_agent import transport
 from ironic_python_agent import utils
 
 CONF = cfg.CONF
@@ -113,6 +115,32 @@ cli_opts = [
                help='Comma-separated list of plugins providing additional '
                     'hardware data for inspection, empty value gives '
                     'a minimum required set of plugins.'),
+
+    cfg.IntOpt('http_pool_size',
+               default=APARAMS.get('ipa-http-pool-size',
+                                   transport.DEFAULT_POOL_SIZE),
+               help='Number of HTTP connections kept alive per host. More '
+                    'are kept alive while downloading an image with more '
+                    'concurrent requests.'),
+
+    cfg.IntOpt('http_retries',
+               default=APARAMS.get('ipa-http-retries',
+                                   transport.DEFAULT_RETRIES),
+               help='Number of times an HTTP request is retried when the '
+                    'connection fails or the server is temporarily '
+                    'unavailable.'),
+
+    cfg.IntOpt('http_socket_buffer_size',
+               default=APARAMS.get('ipa-http-socket-buffer-size'),
+               help='Size in bytes of the send and receive buffers of HTTP '
+                    'connections. By default it is tuned by the kernel.'),
+
+    cfg.FloatOpt('max_download_rate',
+                 default=APARAMS.get('ipa-max-download-rate'),
+                 help='Maximum rate of image downloads in MB/s, for the node '
+                      'as a whole. It can be changed by the deploy or with '
+                      'the standby.set_download_rate command. By default '
+                      'downloads are not limited.'),
 ]
 
 CONF.register_cli_opts(cli_opts)
@@ -123,6 +151,10 @@ def run():
     log.register_options(CONF)
     CONF(args=sys.argv[1:])
     log.setup(CONF, 'ironic-python-agent')
+    transport.configure(pool_size=CONF.http_pool_size,
+                        retries=CONF.http_retries,
+                        socket_buffer_size=CONF.http_socket_buffer_size)
+    bandwidth.set_download_rate(CONF.max_download_rate)
     agent.IronicPythonAgent(CONF.api_url,
                             (CONF.advertise_host, CONF.advertise_port),
                             (CONF.listen_host, CONF.listen_port),
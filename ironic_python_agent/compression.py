@@ -0,0 +1,273 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incremental decompression of images while they are downloaded."""
+
+import bz2
+import zlib
+
+from oslo_log import log
+import six
+
+from ironic_python_agent import errors
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOG = log.getLogger(__name__)
+
+NONE = 'none'
+GZIP = 'gzip'
+BZIP2 = 'bzip2'
+XZ = 'xz'
+ZSTD = 'zstd'
+
+_MAGIC = (
+    (b'\x1f\x8b', GZIP),
+    (b'BZh', BZIP2),
+    (b'\xfd7zXZ\x00', XZ),
+    (b'\x28\xb5\x2f\xfd', ZSTD),
+)
+
+# Upper bound on the size of each decompressed piece, so that highly
+# compressible data (e.g. the long runs of zeros in disk images) does not
+# blow up into huge buffers.
+DEFAULT_MAX_OUTPUT = 1024 * 1024  # 1MB
+
+_ZSTD_INPUT_SLICE = 1024
+
+
+def _caps_output(decompressor):
+    """Whether a bz2 or lzma decompressor can cap the size of its output.
+
+    Only from Python 3.5 on, backports.lzma cannot either.
+    """
+    return hasattr(decompressor, 'needs_input')
+
+
+# Without a cap, a single chunk of a bzip2 stream of zeros can decompress to
+# gigabytes, so formats which cannot be decompressed with a cap are not
+# supported.
+_UNCAPPED = set()
+if not _caps_output(bz2.BZ2Decompressor()):
+    _UNCAPPED.add(BZIP2)
+if lzma is not None and not _caps_output(lzma.LZMADecompressor()):
+    _UNCAPPED.add(XZ)
+
+SUPPORTED = tuple(name for name in (NONE, GZIP, BZIP2, XZ, ZSTD)
+                  if name not in _UNCAPPED)
+
+# Exceptions raised by the decompressors on corrupt input
+_ERRORS = (zlib.error, IOError, EOFError, ValueError)
+if lzma is not None:
+    _ERRORS += (lzma.LZMAError,)
+if zstandard is not None:
+    _ERRORS += (zstandard.ZstdError,)
+
+
+def detect(data):
+    """Detect the compression format of a stream from its first bytes.
+
+    :param data: the beginning of the stream.
+    :returns: the name of the compression format, NONE if the data is not
+              compressed, or None if more data is needed to decide.
+    """
+    for magic, name in _MAGIC:
+        if data[:len(magic)] == magic[:len(data)]:
+            if len(data) >= len(magic):
+                return name
+            # Could still turn out to be this format
+            return None
+    return NONE
+
+
+class _Decompressor(object):
+    def __init__(self, factory, max_output):
+        self.factory = factory
+        self.max_output = max_output
+        self.obj = factory()
+        self.eof = False
+
+    def _restart(self):
+        # Concatenated streams, e.g. a multi-member gzip file
+        data = self.obj.unused_data
+        self.obj = self.factory()
+        self.eof = False
+        return data
+
+    def decompress(self, data):
+        try:
+            for out in self._decompress(data):
+                yield out
+        except _ERRORS as e:
+            raise errors.DecompressionError(
+                'Corrupt compressed stream: {0}'.format(e))
+
+    def flush(self):
+        # eof is None if the decompressor cannot tell (zlib on Python 2)
+        if self.eof is False:
+            raise errors.DecompressionError(
+                'Compressed stream ended unexpectedly')
+        return iter(())
+
+
+class _Zlib(_Decompressor):
+    def _decompress(self, data):
+        while data:
+            out = self.obj.decompress(data, self.max_output)
+            data = self.obj.unconsumed_tail
+            self.eof = getattr(self.obj, 'eof', None)
+            if out:
+                yield out
+            if self.obj.unused_data:
+                data = self._restart()
+
+
+class _Lzma(_Decompressor):
+    # lzma and bz2 decompressors keep unconsumed input internally and
+    # signal through needs_input when they want more.
+    def _decompress(self, data):
+        while True:
+            out = self.obj.decompress(data, self.max_output)
+            data = b''
+            self.eof = self.obj.eof
+            if out:
+                yield out
+            if self.eof and self.obj.unused_data:
+                data = self._restart()
+            elif self.eof or self.obj.needs_input:
+                return
+
+
+class _Zstd(_Decompressor):
+    # zstandard cannot cap the size of its output, so it is fed small slices
+    # of input and the output of each slice is split up.
+    def _decompress(self, data):
+        view = memoryview(data)
+        for pos in range(0, len(view), _ZSTD_INPUT_SLICE):
+            piece = view[pos:pos + _ZSTD_INPUT_SLICE].tobytes()
+            while piece:
+                if self.eof:
+                    self.obj = self.factory()
+                out = self.obj.decompress(piece)
+                self.eof = self.obj.eof
+                piece = self.obj.unused_data if self.eof else b''
+                for start in range(0, len(out), self.max_output):
+                    yield out[start:start + self.max_output]
+
+
+def _make_decompressor(name, max_output):
+    if name in _UNCAPPED:
+        raise errors.DecompressionError(
+            '{0} compressed images require Python 3.5 or newer'.format(name))
+    if name == GZIP:
+        # 16 + MAX_WBITS makes zlib expect a gzip header and trailer
+        return _Zlib(lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+                     max_output)
+    elif name == BZIP2:
+        return _Lzma(bz2.BZ2Decompressor, max_output)
+    elif name == XZ:
+        if lzma is None:
+            raise errors.DecompressionError(
+                'xz compressed images require the lzma module')
+        return _Lzma(lzma.LZMADecompressor, max_output)
+    elif name == ZSTD:
+        if zstandard is None:
+            raise errors.DecompressionError(
+                'zstd compressed images require the zstandard module')
+        return _Zstd(zstandard.ZstdDecompressor().decompressobj, max_output)
+    raise errors.DecompressionError(
+        'Unsupported compression format {0}'.format(name))
+
+
+class StreamDecompressor(object):
+    """Decompress a stream of chunks on the fly.
+
+    If no compression format is given it is detected from the magic bytes at
+    the start of the stream; data that is not compressed is passed through
+    untouched. :meth:`decompress` and :meth:`flush` return iterators of
+    decompressed pieces of at most ``max_output`` bytes each.
+    """
+
+    def __init__(self, compression=None, max_output=DEFAULT_MAX_OUTPUT):
+        self.compression = compression
+        self.max_output = max_output
+        self._decompressor = None
+        self._head = b''
+        if compression is not None:
+            self._setup(compression)
+
+    def _setup(self, compression):
+        self.compression = compression
+        if compression != NONE:
+            LOG.info('Decompressing %s compressed stream', compression)
+            self._decompressor = _make_decompressor(compression,
+                                                    self.max_output)
+
+    def _feed(self, data):
+        if self._decompressor is None:
+            return iter((data,)) if data else iter(())
+        return self._decompressor.decompress(data)
+
+    def decompress(self, chunk):
+        """Decompress a chunk of the stream.
+
+        :returns: an iterator of decompressed data.
+        """
+        if self.compression is None:
+            self._head += chunk
+            compression = detect(self._head)
+            if compression is None:
+                return iter(())
+            self._setup(compression)
+            chunk, self._head = self._head, b''
+        return self._feed(chunk)
+
+    def flush(self):
+        """Signal the end of the stream.
+
+        :returns: an iterator of any remaining decompressed data.
+        :raises: DecompressionError if the compressed stream is truncated.
+        """
+        if self.compression is None:
+            # Too short to be compressed at all
+            self._setup(NONE)
+            return self._feed(self._head)
+        if self._decompressor is None:
+            return iter(())
+        return self._decompressor.flush()
+
+
+def validate(compression):
+    """Check that a compression format name is supported.
+
+    :raises: InvalidCommandParamsError if it is not.
+    """
+    if compression is None:
+        return
+    if (not isinstance(compression, six.string_types)
+            or compression not in SUPPORTED):
+        raise errors.InvalidCommandParamsError(
+            'Image \'compression\' must be one of {0}.'.format(
+                ', '.join(SUPPORTED)))
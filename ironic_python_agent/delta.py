@@ -0,0 +1,240 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Block level delta imaging.
+
+When a device already holds an older build of an image, most of its blocks
+are usually identical to the new one. Comparing the device with the block
+manifest of the new image tells which blocks changed, and only those are
+fetched from the raw image with range requests and written.
+"""
+
+import hashlib
+import threading
+
+from oslo_log import log
+import requests
+
+from ironic_python_agent import download
+from ironic_python_agent import encoding
+from ironic_python_agent import errors
+from ironic_python_agent import transport
+
+LOG = log.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RETRIES = 3
+
+# Largest number of consecutive blocks fetched with a single request, so
+# that long runs of changed blocks are still spread over all workers.
+MAX_RANGE_BLOCKS = 16
+
+
+class DeltaStats(encoding.Serializable):
+    """What a delta write changed and how much data it saved."""
+
+    serializable_fields = ('blocks', 'blocks_changed', 'bytes_downloaded',
+                           'bytes_zeroed', 'bytes_saved')
+
+    def __init__(self, manifest):
+        self.size = manifest.size
+        self.blocks = len(manifest.blocks)
+        self.blocks_changed = 0
+        self.bytes_downloaded = 0
+        self.bytes_zeroed = 0
+
+    @property
+    def bytes_saved(self):
+        """Bytes of the image which did not have to be downloaded."""
+        return self.size - self.bytes_downloaded
+
+
+def _ranges(indexes, max_blocks=MAX_RANGE_BLOCKS):
+    """Coalesce sorted block indexes into (first, last + 1) ranges."""
+    ranges = []
+    for index in indexes:
+        if (ranges and ranges[-1][1] == index
+                and index - ranges[-1][0] < max_blocks):
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return [tuple(r) for r in ranges]
+
+
+class DeltaWriter(object):
+    """Bring a device up to date with an image, block by block.
+
+    Changed blocks whose manifest hash is that of a block of zeros are
+    zeroed by the writer without being downloaded. The others are fetched
+    by ``concurrency`` threads as coalesced byte ranges of the raw image,
+    checked against the manifest before being written, and retried on the
+    next URL if a request fails or returns the wrong data.
+    """
+
+    def __init__(self, manifest, urls, writer, concurrency=None,
+                 proxies=None, retries=None, session=None, progress=None,
+                 bucket=None):
+        """Construct an instance of DeltaWriter.
+
+        :param manifest: the Manifest of the new image.
+        :param urls: URLs serving the raw image.
+        :param writer: a blockio.PositionalWriter for the device.
+        :param concurrency: number of ranges to fetch in parallel.
+        :param proxies: proxies to pass to requests.
+        :param retries: number of failed requests tolerated per range.
+        :param session: requests session to fetch ranges with.
+        :param progress: a progress.Progress to report the transfer to.
+        :param bucket: a bandwidth.TokenBucket limiting the download rate.
+        """
+        self.manifest = manifest
+        self.urls = urls
+        self.writer = writer
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+        self.proxies = proxies or {}
+        self.retries = DEFAULT_RETRIES if retries is None else retries
+        self.session = session or transport.get_session(self.concurrency)
+        self.stats = DeltaStats(manifest)
+        self.progress = progress
+        self.bucket = bucket
+        self._lock = threading.Lock()
+        self._zero_digests = {}
+
+    def _is_zero_block(self, index):
+        start, end = self.manifest.block_range(index)
+        length = end - start
+        if length not in self._zero_digests:
+            self._zero_digests[length] = hashlib.new(
+                self.manifest.algorithm, b'\0' * length).hexdigest()
+        return self.manifest.blocks[index] == self._zero_digests[length]
+
+    def _fetch_from(self, url, first, last):
+        """Fetch blocks first to last from url, writing them as they come.
+
+        Yields the index of every block once it is written.
+        """
+        start = self.manifest.block_range(first)[0]
+        end = self.manifest.block_range(last - 1)[1]
+        resp = download.get_range(self.session, url, start, end,
+                                  proxies=self.proxies,
+                                  size=self.manifest.size)
+        index = first
+        buf = bytearray()
+        try:
+            for chunk in resp.iter_content(download.DEFAULT_CHUNK_SIZE):
+                if self.bucket is not None:
+                    self.bucket.consume(len(chunk))
+                buf += chunk
+                while index < last:
+                    block_start, block_end = self.manifest.block_range(index)
+                    length = block_end - block_start
+                    if len(buf) < length:
+                        break
+                    data = bytes(buf[:length])
+                    del buf[:length]
+                    digest = hashlib.new(self.manifest.algorithm,
+                                         data).hexdigest()
+                    if digest != self.manifest.blocks[index]:
+                        raise errors.DownloadError(
+                            'Block {0} received from {1} does not match the '
+                            'manifest'.format(index, url))
+                    self.writer.write_at(block_start, data)
+                    with self._lock:
+                        self.stats.bytes_downloaded += length
+                        if self.progress is not None:
+                            self.progress.add_downloaded(length)
+                            self.progress.add_written(length)
+                    yield index
+                    index += 1
+        finally:
+            resp.close()
+        if index < last:
+            raise errors.DownloadError(
+                'Connection to {0} closed before block {1}'.format(url, index))
+
+    def _fetch_range(self, worker, first, last):
+        failures = 0
+        index = first
+        while index < last:
+            # Workers start on different URLs to spread the load
+            url = self.urls[(worker + failures) % len(self.urls)]
+            try:
+                for written in self._fetch_from(url, index, last):
+                    index = written + 1
+            except (requests.RequestException, errors.DownloadError) as e:
+                failures += 1
+                if failures > self.retries:
+                    raise errors.DownloadError(
+                        'Unable to download blocks {0}-{1}: {2}'.format(
+                            index, last - 1, e))
+                LOG.warning('Failed to download blocks %(first)d-%(last)d '
+                            'from %(url)s, retrying: %(err)s',
+                            {'first': index, 'last': last - 1, 'url': url,
+                             'err': e})
+
+    def write(self, changed):
+        """Write the changed blocks of the image to the device.
+
+        :param changed: sorted indexes of the blocks which differ, as
+                        returned by Manifest.diff().
+        :returns: a DeltaStats object.
+        :raises: DownloadError if blocks cannot be downloaded, OSError if
+                 they cannot be written.
+        """
+        self.stats.blocks_changed = len(changed)
+        fetch = []
+        for index in changed:
+            if self._is_zero_block(index):
+                start, end = self.manifest.block_range(index)
+                self.writer.write_zeroes(start, end - start)
+                self.stats.bytes_zeroed += end - start
+            else:
+                fetch.append(index)
+        if self.progress is not None:
+            self.progress.start(sum(
+                end - start for start, end in (self.manifest.block_range(i)
+                                               for i in fetch)))
+
+        ranges = _ranges(fetch)
+        lock = threading.Lock()
+        failures = []
+
+        def _worker(worker):
+            try:
+                while not failures:
+                    with lock:
+                        if not ranges:
+                            return
+                        first, last = ranges.pop(0)
+                    self._fetch_range(worker, first, last)
+            except Exception as e:
+                failures.append(e)
+
+        threads = [threading.Thread(target=_worker, args=(i,),
+                                    name='delta-{0}'.format(i))
+                   for i in range(min(self.concurrency, len(ranges)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failures:
+            raise failures[0]
+
+        LOG.info('Delta write changed %(changed)d of %(blocks)d blocks, '
+                 'downloading %(downloaded)d bytes and saving %(saved)d',
+                 {'changed': self.stats.blocks_changed,
+                  'blocks': self.stats.blocks,
+                  'downloaded': self.stats.bytes_downloaded,
+                  'saved': self.stats.bytes_saved})
+        return self.stats
@@ -0,0 +1,513 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for downloading large files over HTTP.
+
+A single TCP stream rarely gets close to the bandwidth of a fast deploy
+network, so large images can be fetched as several byte ranges over a pool
+of keep-alive connections and reassembled in order on the fly. When an
+image is available from several mirrors they can be raced against each
+other, and ranges can be spread over all of them.
+"""
+
+import collections
+import hashlib
+import re
+import threading
+import time
+
+from oslo_log import log
+
+from ironic_python_agent import encoding
+from ironic_python_agent import errors
+from ironic_python_agent import transport
+
+LOG = log.getLogger(__name__)
+
+DEFAULT_SEGMENT_SIZE = 32 * 1024 * 1024  # 32MB
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # 1MB
+DEFAULT_PROBE_SIZE = 4 * 1024 * 1024  # 4MB
+DEFAULT_PROBE_TIMEOUT = 10  # seconds
+
+# Number of times a verified segment is fetched before giving up
+MAX_SEGMENT_ATTEMPTS = 3
+
+_CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+def parse_content_range(value):
+    """Parse the value of a Content-Range response header.
+
+    :param value: header value, e.g. 'bytes 0-1023/4096'
+    :returns: a tuple (first_byte, last_byte, total_size), where total_size
+              is None if the server did not report it.
+    :raises: DownloadError if the header cannot be parsed.
+    """
+    match = _CONTENT_RANGE_RE.match((value or '').strip())
+    if match is None:
+        raise errors.DownloadError(
+            'Invalid Content-Range header: {0!r}'.format(value))
+    first, last, total = match.groups()
+    total = None if total == '*' else int(total)
+    return int(first), int(last), total
+
+
+def _range_header(start, end):
+    return {'Range': 'bytes={0}-{1}'.format(start, end - 1)}
+
+
+def get_range(session, url, start, end, proxies=None, size=None):
+    """Request a byte range of a URL.
+
+    :param session: requests session to use.
+    :param url: URL to download from.
+    :param start: first byte of the range.
+    :param end: end of the range (exclusive).
+    :param proxies: proxies to pass to requests.
+    :param size: expected total size of the file, if known.
+    :returns: the streamed 206 response, holding exactly the range.
+    :raises: DownloadError if the server did not return the range.
+    """
+    resp = session.get(url, stream=True, proxies=proxies,
+                       headers=_range_header(start, end))
+    if resp.status_code != 206:
+        resp.close()
+        raise errors.DownloadError(
+            'Expected status code 206 for bytes {0}-{1} of {2}, got '
+            '{3}'.format(start, end - 1, url, resp.status_code))
+    try:
+        first, last, total = parse_content_range(
+            resp.headers.get('Content-Range'))
+    except errors.DownloadError:
+        resp.close()
+        raise
+    if first != start or last != end - 1:
+        resp.close()
+        raise errors.DownloadError(
+            'Server returned bytes {0}-{1} of {2} when bytes {3}-{4} '
+            'were requested'.format(first, last, url, start, end - 1))
+    if size is not None and total is not None and total != size:
+        resp.close()
+        raise errors.DownloadError(
+            'File at {0} is {1} bytes long, expected {2}'.format(
+                url, total, size))
+    return resp
+
+
+class _Segment(object):
+    """A byte range of the file and the chunks received for it so far."""
+
+    def __init__(self, index, start, end):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.chunks = collections.deque()
+        self.received = 0
+        self.done = False
+        self.attempts = 0
+
+    def reset(self):
+        self.chunks.clear()
+        self.received = 0
+
+
+class SegmentedDownload(object):
+    """Download a URL as concurrent byte ranges and yield it in order.
+
+    The file is split into segments of ``segment_size`` bytes which are
+    fetched by ``concurrency`` worker threads, each reusing a pooled
+    connection. At most ``concurrency * 2`` segments are buffered ahead of
+    the consumer, which bounds memory usage to roughly
+    ``2 * concurrency * segment_size`` bytes no matter how slowly the
+    consumer reads.
+
+    Workers can be spread over several mirrors of the file, in which case
+    each worker sticks to one mirror and the faster mirrors end up serving
+    more segments.
+
+    If a manifest of the file is given, segments are its blocks and each one
+    is checked against its hash before any of it is handed to the consumer.
+    A segment which fails is then fetched again by another worker, and the
+    worker whose mirror failed stops, so that untrusted sources (e.g. other
+    agents) can be used alongside the origin.
+
+    Instances quack like a streamed ``requests.Response`` as far as
+    :meth:`iter_content` is concerned, so they can be dropped in wherever
+    a response is iterated.
+    """
+
+    def __init__(self, url, size, concurrency, segment_size=None,
+                 proxies=None, session=None, first_response=None, start=0,
+                 mirrors=None, manifest=None):
+        """Construct an instance of SegmentedDownload.
+
+        :param url: URL to download from.
+        :param size: total size of the file in bytes.
+        :param concurrency: number of ranges to fetch in parallel.
+        :param segment_size: size of each range in bytes.
+        :param proxies: proxies to pass to requests.
+        :param session: requests session to fetch ranges with.
+        :param first_response: an already open 206 response for the first
+                               segment, as returned when probing the server.
+        :param start: offset to start downloading from, e.g. when resuming.
+        :param mirrors: other URLs serving the same file, in order of
+                        preference.
+        :param manifest: a manifest.Manifest of the file to verify the
+                         segments against. Overrides segment_size, and start
+                         must be a multiple of its block size.
+        """
+        self.url = url
+        self.urls = [url] + [m for m in mirrors or () if m != url]
+        self.size = size
+        self.start_offset = start
+        self.concurrency = max(1, concurrency)
+        self.manifest = manifest
+        if manifest is not None:
+            segment_size = manifest.block_size
+        self.segment_size = segment_size or DEFAULT_SEGMENT_SIZE
+        self.proxies = proxies or {}
+        self.session = session or transport.get_session(self.concurrency)
+        self.window = self.concurrency * 2
+
+        self._first_response = first_response
+        self._cond = threading.Condition()
+        self._segments = {}
+        self._retry = collections.deque()
+        self._next_segment = 0
+        self._consumed = 0
+        self._error = None
+        self._stopped = False
+        self._threads = []
+        self._workers = 0
+        # Segments claimed by a worker and not verified yet
+        self._in_flight = 0
+        self._nsegments = max(1, -(-(size - start) // self.segment_size))
+
+    def _segment_bounds(self, index):
+        start = self.start_offset + index * self.segment_size
+        return start, min(start + self.segment_size, self.size)
+
+    def _claim_segment(self):
+        """Claim the next segment to fetch.
+
+        Once every segment was claimed, a worker waits for the segments of
+        the other workers to be done, as one of them may still fail and
+        have to be fetched again.
+
+        :returns: a _Segment, None once there is nothing left to fetch or
+                  the download stopped or failed.
+        """
+        with self._cond:
+            while True:
+                if self._stopped or self._error is not None:
+                    return None
+                if self._retry:
+                    segment = self._retry.popleft()
+                    segment.reset()
+                    self._in_flight += 1
+                    return segment
+                if self._next_segment >= self._nsegments:
+                    if not self._in_flight:
+                        return None
+                elif self._next_segment < self._consumed + self.window:
+                    break
+                self._cond.wait()
+            index = self._next_segment
+            self._next_segment += 1
+            self._in_flight += 1
+            start, end = self._segment_bounds(index)
+            segment = _Segment(index, start, end)
+            self._segments[index] = segment
+            return segment
+
+    def _open_segment(self, segment, url):
+        if segment.index == 0 and self._first_response is not None:
+            resp, self._first_response = self._first_response, None
+            return resp
+        return get_range(self.session, url, segment.start, segment.end,
+                         proxies=self.proxies, size=self.size)
+
+    def _fetch_segment(self, segment, url):
+        expected = segment.end - segment.start
+        segment.attempts += 1
+        hasher = (hashlib.new(self.manifest.algorithm)
+                  if self.manifest is not None else None)
+        resp = self._open_segment(segment, url)
+        try:
+            for chunk in resp.iter_content(DEFAULT_CHUNK_SIZE):
+                if not chunk:
+                    continue
+                if hasher is not None:
+                    hasher.update(chunk)
+                with self._cond:
+                    if self._stopped:
+                        return
+                    segment.chunks.append(chunk)
+                    segment.received += len(chunk)
+                    self._cond.notify_all()
+        finally:
+            resp.close()
+
+        if segment.received != expected:
+            raise errors.DownloadError(
+                'Received {0} bytes instead of {1} for bytes {2}-{3} of '
+                '{4}'.format(segment.received, expected, segment.start,
+                             segment.end - 1, url))
+        if hasher is not None:
+            block = segment.start // self.segment_size
+            if hasher.hexdigest() != self.manifest.blocks[block]:
+                raise errors.DownloadError(
+                    'Bytes {0}-{1} received from {2} do not match the '
+                    'manifest'.format(segment.start, segment.end - 1, url))
+        with self._cond:
+            segment.done = True
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _worker(self, url):
+        segment = None
+        try:
+            while True:
+                segment = self._claim_segment()
+                if segment is None:
+                    break
+                self._fetch_segment(segment, url)
+        except Exception as e:
+            LOG.warning('Ranged download of %(url)s failed: %(err)s',
+                        {'url': url, 'err': e})
+            with self._cond:
+                self._workers -= 1
+                self._in_flight -= 1
+                if (self.manifest is not None and self._workers
+                        and segment.attempts < MAX_SEGMENT_ATTEMPTS):
+                    # Nothing of a verified segment reached the consumer
+                    # yet, another worker can start it over
+                    self._retry.append(segment)
+                elif self._error is None:
+                    self._error = e
+                self._cond.notify_all()
+            return
+        with self._cond:
+            self._workers -= 1
+            if not self._workers and self._retry and self._error is None:
+                self._error = errors.DownloadError(
+                    'All sources of {0} failed'.format(self.url))
+            self._cond.notify_all()
+
+    def start(self):
+        """Start the worker threads."""
+        self._workers = min(self.concurrency, self._nsegments)
+        for i in range(self._workers):
+            thread = threading.Thread(
+                target=self._worker, args=(self.urls[i % len(self.urls)],),
+                name='segmented-download-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def close(self):
+        """Stop the worker threads and drop any buffered data."""
+        with self._cond:
+            self._stopped = True
+            self._segments.clear()
+            self._retry.clear()
+            self._cond.notify_all()
+        if self._first_response is not None:
+            self._first_response.close()
+            self._first_response = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def iter_content(self, chunk_size=None):
+        """Yield the file contents in order.
+
+        :param chunk_size: ignored, chunks are yielded as they are received
+                           from the server. Present for compatibility with
+                           requests.Response.iter_content().
+        :raises: DownloadError if any range fails to download.
+        """
+        if not self._threads:
+            self.start()
+        try:
+            for index in range(self._nsegments):
+                while True:
+                    with self._cond:
+                        while True:
+                            if self._error is not None:
+                                raise self._error
+                            segment = self._segments.get(index)
+                            # Verified segments are held back until done
+                            if segment is not None and (
+                                    segment.done or (segment.chunks and
+                                                     self.manifest is None)):
+                                break
+                            self._cond.wait()
+                        if segment.chunks:
+                            chunk = segment.chunks.popleft()
+                        elif segment.done:
+                            del self._segments[index]
+                            self._consumed = index + 1
+                            self._cond.notify_all()
+                            break
+                    yield chunk
+        finally:
+            self.close()
+
+
+def open_ranged(url, concurrency, segment_size=None, proxies=None, start=0,
+                mirrors=None):
+    """Open a URL for download, using concurrent ranges when possible.
+
+    The first segment is requested with a Range header. If the server
+    answers with 206 Partial Content the rest of the file is fetched as
+    concurrent ranges, reusing the first response. Any other answer means
+    the server either does not support ranges or refused the request, and
+    that response is returned untouched so the caller can fall back to a
+    single stream (or report the error).
+
+    :param url: URL to download.
+    :param concurrency: number of ranges to fetch in parallel.
+    :param segment_size: size of each range in bytes.
+    :param proxies: proxies to pass to requests.
+    :param start: offset to start downloading from, e.g. when resuming.
+    :param mirrors: other URLs serving the same file, the ranges are spread
+                    over all of them.
+    :returns: either a started SegmentedDownload, or the requests.Response
+              object received for the probe request.
+    """
+    segment_size = segment_size or DEFAULT_SEGMENT_SIZE
+    session = transport.get_session(concurrency)
+    resp = session.get(url, stream=True, proxies=proxies,
+                       headers=_range_header(start, start + segment_size))
+    if resp.status_code != 206:
+        LOG.info('Server did not honour range request for %(url)s (status '
+                 '%(status)s), falling back to a single stream',
+                 {'url': url, 'status': resp.status_code})
+        return resp
+
+    try:
+        first, last, total = parse_content_range(
+            resp.headers.get('Content-Range'))
+    except errors.DownloadError:
+        resp.close()
+        raise
+    if first != start or total is None:
+        resp.close()
+        raise errors.DownloadError(
+            'Unusable Content-Range {0!r} returned by {1}'.format(
+                resp.headers.get('Content-Range'), url))
+
+    LOG.info('Downloading %(url)s (%(size)d bytes) as %(count)d concurrent '
+             'ranges', {'url': url, 'size': total, 'count': concurrency})
+    return SegmentedDownload(url, total, concurrency,
+                             segment_size=segment_size, proxies=proxies,
+                             session=session, first_response=resp,
+                             start=start, mirrors=mirrors).start()
+
+
+class MirrorProbe(encoding.Serializable):
+    """How fast a mirror answered a short sample request.
+
+    ``ttfb`` is the time to the first byte of the answer in seconds and
+    ``throughput`` the rate of the sample in MB/s. ``error`` is set instead
+    if the mirror could not be reached.
+    """
+
+    serializable_fields = ('url', 'ttfb', 'throughput', 'error')
+
+    def __init__(self, url):
+        self.url = url
+        self.ttfb = None
+        self.throughput = None
+        self.error = None
+        self.sample_bytes = 0
+        self.sample_time = None
+
+    def estimate(self, size):
+        """Estimate the time to download ``size`` bytes from the mirror."""
+        if self.error is not None:
+            return float('inf')
+        rate = self.sample_bytes / self.sample_time if self.sample_time else 0
+        return self.ttfb + (size / rate if rate else 0)
+
+
+def _probe(probe, sample_size, proxies, timeout):
+    start = time.time()
+    try:
+        resp = transport.get(probe.url, stream=True, proxies=proxies,
+                             timeout=timeout,
+                             headers=_range_header(0, sample_size))
+        try:
+            if resp.status_code not in (200, 206):
+                raise errors.DownloadError(
+                    'Received status code {0}'.format(resp.status_code))
+            probe.ttfb = time.time() - start
+            # Servers ignoring the Range header send the whole file
+            for chunk in resp.iter_content(DEFAULT_CHUNK_SIZE):
+                probe.sample_bytes += len(chunk)
+                if probe.sample_bytes >= sample_size:
+                    break
+            probe.sample_time = time.time() - start - probe.ttfb
+        finally:
+            resp.close()
+    except Exception as e:
+        probe.error = str(e)
+        LOG.warning('Probing mirror %(url)s failed: %(err)s',
+                    {'url': probe.url, 'err': e})
+        return
+    probe.ttfb = round(probe.ttfb, 3)
+    if probe.sample_time:
+        probe.throughput = round(
+            probe.sample_bytes / probe.sample_time / (1024 * 1024), 2)
+
+
+def rank_mirrors(urls, sample_size=None, proxies=None, timeout=None):
+    """Probe mirrors of a file concurrently and rank them by speed.
+
+    The first ``sample_size`` bytes are requested from every mirror at the
+    same time, measuring the time to the first byte and the throughput.
+    Mirrors are ranked by the estimated time to download the sample, so
+    both latency and bandwidth count. Mirrors which failed are ranked last
+    in their original order, as a last resort.
+
+    :param urls: list of URLs serving the same file.
+    :param sample_size: number of bytes to sample from each mirror.
+    :param proxies: proxies to pass to requests.
+    :param timeout: connection and read timeout of the probes, in seconds.
+    :returns: a list of MirrorProbe objects, fastest first.
+    """
+    sample_size = sample_size or DEFAULT_PROBE_SIZE
+    probes = [MirrorProbe(url) for url in urls]
+    threads = []
+    for i, probe in enumerate(probes):
+        thread = threading.Thread(
+            target=_probe,
+            args=(probe, sample_size, proxies,
+                  timeout or DEFAULT_PROBE_TIMEOUT),
+            name='mirror-probe-{0}'.format(i))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    ranked = sorted(probes, key=lambda p: p.estimate(sample_size))
+    summary = ', '.join(
+        '{0} ({1})'.format(p.url, p.error or '{0}s, {1} MB/s'.format(
+            p.ttfb, p.throughput))
+        for p in ranked)
+    LOG.info('Mirrors ranked by speed: %s', summary)
+    return ranked
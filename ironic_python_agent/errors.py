@@ -184,6 +184,17 @@ class ConfigDriveTooLargeError(RESTError):
         super(ConfigDriveTooLargeError, self).__init__(details)
 
 
+class ConfigDriveDownloadError(RESTError):
+    """Error raised when a configdrive cannot be downloaded."""
+
+    message = 'Error downloading configdrive'
+
+    def __init__(self, url, details):
+        details = 'Download of configdrive from {0} failed: {1}'.format(
+            url, details)
+        super(ConfigDriveDownloadError, self).__init__(details)
+
+
 class ConfigDriveWriteError(RESTError):
     """Error raised when a configdrive cannot be written to a device."""
 
@@ -196,6 +207,17 @@ class ConfigDriveWriteError(RESTError):
         super(ConfigDriveWriteError, self).__init__(details)
 
 
+class ConfigDrivePartitionError(RESTError):
+    """Error raised when the configdrive partition cannot be created."""
+
+    message = 'Error creating configdrive partition'
+
+    def __init__(self, device, details):
+        details = ('Finding or creating the configdrive partition of device '
+                   '{0} failed: {1}').format(device, details)
+        super(ConfigDrivePartitionError, self).__init__(details)
+
+
 class SystemRebootError(RESTError):
     """Error raised when a system cannot reboot."""
 
@@ -338,3 +360,33 @@ class DeviceNotFound(NotFound):
 # RESTError.
 class InspectionError(Exception):
     """Failure during inspection."""
+
+
+# This is not something we return to a user, so we don't inherit it from
+# RESTError.
+class DownloadError(Exception):
+    """Failure while transferring data over HTTP."""
+
+
+# This is not something we return to a user, so we don't inherit it from
+# RESTError.
+class DecompressionError(Exception):
+    """Failure while decompressing an image."""
+
+
+# This is not something we return to a user, so we don't inherit it from
+# RESTError.
+class ImageConversionError(Exception):
+    """Failure while converting an image to raw format."""
+
+
+# This is not something we return to a user, so we don't inherit it from
+# RESTError.
+class ManifestError(Exception):
+    """Invalid or unavailable block hash manifest."""
+
+
+# This is not something we return to a user, so we don't inherit it from
+# RESTError.
+class PartitionTableError(Exception):
+    """Invalid partition table, or no room for a new partition."""
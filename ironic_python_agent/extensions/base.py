@@ -23,9 +23,13 @@ import six
 
 from ironic_python_agent import encoding
 from ironic_python_agent import errors
+from ironic_python_agent import progress
 
 LOG = log.getLogger()
 
+# The command running in the current thread, see current_progress()
+_local = threading.local()
+
 
 class AgentCommandStatus(object):
     """Mapping of agent command statuses."""
@@ -39,7 +43,8 @@ class BaseCommandResult(encoding.SerializableComparable):
     """Base class for command result."""
 
     serializable_fields = ('id', 'command_name', 'command_params',
-                           'command_status', 'command_error', 'command_result')
+                           'command_status', 'command_error', 'command_result',
+                           'command_progress')
 
     def __init__(self, command_name, command_params):
         """Construct an instance of BaseCommandResult.
@@ -55,6 +60,11 @@ class BaseCommandResult(encoding.SerializableComparable):
         self.command_error = None
         self.command_result = None
 
+    @property
+    def command_progress(self):
+        """Progress of the command while it runs, if it reports any."""
+        return None
+
     def is_done(self):
         """Checks to see if command is still RUNNING.
 
@@ -110,11 +120,19 @@ class AsyncCommandResult(BaseCommandResult):
         self.agent = agent
         self.execute_method = execute_method
         self.command_state_lock = threading.Lock()
+        self.progress = progress.Progress()
 
         thread_name = 'agent-command-{0}'.format(self.id)
         self.execution_thread = threading.Thread(target=self.run,
                                                  name=thread_name)
 
+    @property
+    def command_progress(self):
+        # Updated on every chunk, without taking the state lock
+        if not self.progress.started:
+            return None
+        return self.progress.serialize()
+
     def serialize(self):
         """Serializes the AsyncCommandResult into a dict.
 
@@ -147,6 +165,7 @@ class AsyncCommandResult(BaseCommandResult):
 
     def run(self):
         """Run a command."""
+        _local.progress = self.progress
         try:
             result = self.execute_method(**self.command_params)
 
@@ -174,10 +193,20 @@ class AsyncCommandResult(BaseCommandResult):
                 self.command_error = e
                 self.command_status = AgentCommandStatus.FAILED
         finally:
+            _local.progress = None
             if self.agent:
                 self.agent.force_heartbeat()
 
 
+def current_progress():
+    """Get the progress of the command running in the current thread.
+
+    :returns: a progress.Progress, which is not reported anywhere if no
+              asynchronous command runs in this thread.
+    """
+    return getattr(_local, 'progress', None) or progress.Progress()
+
+
 class BaseAgentExtension(object):
     def __init__(self, agent=None):
         super(BaseAgentExtension, self).__init__()
@@ -224,6 +253,14 @@ class ExecuteCommandMixin(object):
 
         return (command_parts[0], command_parts[1])
 
+    def _is_concurrent(self, extension_name, command_name):
+        try:
+            ext = self.get_extension(extension_name)
+        except (KeyError, errors.ExtensionError):
+            return False
+        cmd = getattr(ext, 'command_map', {}).get(command_name)
+        return getattr(cmd, 'concurrent', False) is True
+
     def execute_command(self, command_name, **kwargs):
         """Execute an agent command."""
         with self.command_lock:
@@ -231,13 +268,15 @@ class ExecuteCommandMixin(object):
                       {'name': command_name, 'args': kwargs})
             extension_part, command_part = self.split_command(command_name)
 
-            if len(self.command_results) > 0:
-                last_command = list(self.command_results.values())[-1]
-                if not last_command.is_done():
-                    LOG.error('Tried to execute %(command)s, agent is still '
-                              'executing %(last)s', {'command': command_name,
-                                                     'last': last_command})
-                    raise errors.CommandExecutionError('agent is busy')
+            # Concurrent commands may have completed after the running one
+            running = [r for r in self.command_results.values()
+                       if not r.is_done()]
+            if running and not self._is_concurrent(extension_part,
+                                                   command_part):
+                LOG.error('Tried to execute %(command)s, agent is still '
+                          'executing %(last)s', {'command': command_name,
+                                                 'last': running[-1]})
+                raise errors.CommandExecutionError('agent is busy')
 
             try:
                 ext = self.get_extension(extension_part)
@@ -293,15 +332,19 @@ def async_command(command_name, validator=None):
     return async_decorator
 
 
-def sync_command(command_name, validator=None):
+def sync_command(command_name, validator=None, concurrent=False):
     """Decorate a method to wrap its return value in a SyncCommandResult.
 
     For consistency with @async_command() can also accept a
     validator which will be used to validate input, although a synchronous
     command can also choose to implement validation inline.
+
+    A concurrent command can be executed while an asynchronous command is
+    still running, e.g. to adjust it.
     """
     def sync_decorator(func):
         func.command_name = command_name
+        func.concurrent = concurrent
 
         @functools.wraps(func)
         def wrapper(self, **command_params):
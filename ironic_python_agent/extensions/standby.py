@@ -13,28 +13,97 @@
 # limitations under the License.
 
 import base64
-import gzip
 import hashlib
 import os
+import random
+import re
 import requests
 import six
+import stat
+import threading
 import time
 
 from oslo_concurrency import processutils
 from oslo_log import log
+import psutil
 
+from ironic_python_agent import bandwidth
+from ironic_python_agent import blockio
+from ironic_python_agent import compression
+from ironic_python_agent import delta
+from ironic_python_agent import download
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import base
 from ironic_python_agent import hardware
+from ironic_python_agent import manifest
+from ironic_python_agent import partitions
+from ironic_python_agent import peer
+from ironic_python_agent import pipeline
+from ironic_python_agent import qcow2
+from ironic_python_agent import transport
 from ironic_python_agent import utils
 
 LOG = log.getLogger(__name__)
 
 IMAGE_CHUNK_SIZE = 1024 * 1024  # 1MB
 
+DEFAULT_DOWNLOAD_RETRIES = 5
+DEFAULT_DOWNLOAD_RETRY_INTERVAL = 2  # seconds
+MAX_DOWNLOAD_RETRY_INTERVAL = 60  # seconds
 
-def _configdrive_location():
-    return '/tmp/configdrive'
+MIRROR_ORDERED = 'ordered'
+MIRROR_RACE = 'race'
+MIRROR_SELECTION = (MIRROR_ORDERED, MIRROR_RACE)
+
+# Seconds of receiving over which the throughput of a mirror is measured
+THROUGHPUT_WINDOW = 10
+
+# Errors after which an interrupted download is resumed. requests
+# exceptions (connection errors, timeouts, broken chunked encoding) are
+# IOErrors, DownloadError comes from ranged downloads.
+_RESUMABLE_ERRORS = (IOError, errors.DownloadError)
+
+# Size of the partition created for the configdrive
+MAX_CONFIGDRIVE_SIZE = 64 * 1024 * 1024  # 64MB
+# Largest configdrive downloaded: MAX_CONFIGDRIVE_SIZE bytes gzipped and
+# base64 encoded, with room for line breaks
+MAX_ENCODED_CONFIGDRIVE_SIZE = MAX_CONFIGDRIVE_SIZE * 3 // 2
+CONFIGDRIVE_CHUNK_SIZE = 256 * 1024  # 256KB
+CONFIGDRIVE_BUFFER_SIZE = 4 * 1024 * 1024  # 4MB
+
+_BASE64_IGNORED_RE = re.compile(b'[^A-Za-z0-9+/=]')
+
+# How images are written with stream_raw_images set to 'auto'
+WRITE_MODE_AUTO = 'auto'
+WRITE_MODE_STREAM = 'stream'
+WRITE_MODE_CACHE = 'cache'
+WRITE_MODE_SPILL = 'spill'
+
+# Algorithms accepted for os_hash_algo. Variable length ones (shake_*) are
+# not, their hexdigest() needs a length.
+HASH_ALGORITHMS = ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')
+
+# Disk formats which can be written to the device as they are downloaded.
+# qcow2 images are only streamed if image_info['stream_qcow2_images'] is
+# set: the converter cannot handle every qcow2 image qemu-img can (e.g.
+# internal snapshots, or data far ahead of the tables mapping it).
+STREAMABLE_FORMATS = ('raw',)
+
+# Disk formats which can be spilled to a scratch disk, with their qemu-img
+# name. The image is converted from the whole scratch disk, so only formats
+# whose header tells where the image ends can be: raw images (including
+# e.g. iso) would take the rest of the scratch disk with them.
+SPILLABLE_FORMATS = {'qcow2': 'qcow2', 'vmdk': 'vmdk', 'vhd': 'vpc',
+                     'vhdx': 'vhdx', 'vdi': 'vdi'}
+
+# Memory left to the agent and the rest of the ramdisk when caching images
+CACHE_RESERVE = 512 * 1024 * 1024  # 512MB
+
+_MEMORY_FILESYSTEMS = ('tmpfs', 'ramfs', 'rootfs')
+
+# Niceness of the thread prefetching an image, which also lowers its I/O
+# priority, so that cleaning steps running meanwhile go first
+PREFETCH_NICENESS = 19
 
 
 def _image_location(image_info):
@@ -46,12 +115,21 @@ def _path_to_script(script):
     return os.path.join(cwd, '..', script)
 
 
-def _write_image(image_info, device):
-    starttime = time.time()
-    image = _image_location(image_info)
+def _write_image(image_info, device, image=None):
+    """Convert the image to the device with qemu-img.
 
+    :param image: the scratch disk the image was spilled to, if not cached
+                  in /tmp. Its format is given to qemu-img rather than
+                  probed, see SPILLABLE_FORMATS.
+    """
+    starttime = time.time()
     script = _path_to_script('shell/write_image.sh')
-    command = ['/bin/bash', script, image, device]
+    if image is None:
+        command = ['/bin/bash', script, _image_location(image_info), device]
+    else:
+        command = ['/bin/bash', script, image, device,
+                   SPILLABLE_FORMATS[image_info['disk_format']]]
+    image = command[2]
     LOG.info('Writing image with command: {0}'.format(' '.join(command)))
     try:
         stdout, stderr = utils.execute(*command, check_exit_code=[0])
@@ -67,52 +145,154 @@ def _configdrive_is_url(configdrive):
             or configdrive.startswith('https://'))
 
 
-def _download_configdrive_to_file(configdrive, filename):
-    content = requests.get(configdrive).content
-    _write_configdrive_to_file(content, filename)
+class _Base64Decoder(object):
+    """Decode base64 data arriving in chunks of any size.
+
+    Like ``base64.b64decode``, characters outside of the base64 alphabet
+    (e.g. line breaks) are ignored.
+    """
 
+    def __init__(self):
+        self._tail = b''
 
-def _write_configdrive_to_file(configdrive, filename):
-    LOG.debug('Writing configdrive to {0}'.format(filename))
-    # configdrive data is base64'd, decode it first
-    data = six.StringIO(base64.b64decode(configdrive))
-    gunzipped = gzip.GzipFile('configdrive', 'rb', 9, data)
-    with open(filename, 'wb') as f:
-        f.write(gunzipped.read())
-    gunzipped.close()
+    def decode(self, chunk):
+        if isinstance(chunk, six.text_type):
+            chunk = chunk.encode('ascii')
+        data = self._tail + _BASE64_IGNORED_RE.sub(b'', chunk)
+        usable = len(data) - len(data) % 4
+        self._tail = data[usable:]
+        return base64.b64decode(data[:usable])
 
+    def flush(self):
+        """Decode what is left, failing if the input was truncated."""
+        tail, self._tail = self._tail, b''
+        return base64.b64decode(tail)
 
-def _write_configdrive_to_partition(configdrive, device):
-    filename = _configdrive_location()
-    if _configdrive_is_url(configdrive):
-        _download_configdrive_to_file(configdrive, filename)
-    else:
-        _write_configdrive_to_file(configdrive, filename)
 
-    # check configdrive size before writing it
-    filesize = os.stat(filename).st_size
-    if filesize > (64 * 1024 * 1024):
-        raise errors.ConfigDriveTooLargeError(filename, filesize)
+def _read_configdrive(configdrive):
+    """Get a configdrive, downloading it if given as a URL.
 
-    starttime = time.time()
-    script = _path_to_script('shell/copy_configdrive_to_disk.sh')
-    command = ['/bin/bash', script, filename, device]
-    LOG.info('copying configdrive to disk with command {0}'.format(
-             ' '.join(command)))
+    A downloaded configdrive is held in memory in its encoded form, at most
+    MAX_ENCODED_CONFIGDRIVE_SIZE bytes of it.
+
+    :returns: the base64 encoded gzipped configdrive.
+    """
+    if not _configdrive_is_url(configdrive):
+        return configdrive
 
     try:
-        stdout, stderr = utils.execute(*command, check_exit_code=[0])
-    except processutils.ProcessExecutionError as e:
-        raise errors.ConfigDriveWriteError(device,
-                                           e.exit_code,
-                                           e.stdout,
-                                           e.stderr)
+        resp = transport.get(configdrive, stream=True,
+                             timeout=manifest.DEFAULT_TIMEOUT)
+    except requests.RequestException as e:
+        raise errors.ConfigDriveDownloadError(configdrive, e)
+    try:
+        if resp.status_code != 200:
+            raise errors.ConfigDriveDownloadError(
+                configdrive, 'received status code {0}, expected '
+                '200'.format(resp.status_code))
+        chunks = []
+        size = 0
+        for chunk in resp.iter_content(CONFIGDRIVE_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_ENCODED_CONFIGDRIVE_SIZE:
+                raise errors.ConfigDriveTooLargeError(
+                    configdrive, 'more than {0} encoded bytes'.format(
+                        MAX_ENCODED_CONFIGDRIVE_SIZE))
+            chunks.append(chunk)
+    except requests.RequestException as e:
+        raise errors.ConfigDriveDownloadError(configdrive, e)
+    finally:
+        resp.close()
+    return b''.join(chunks)
+
+
+def _configdrive_chunks(data):
+    return (data[i:i + CONFIGDRIVE_CHUNK_SIZE]
+            for i in range(0, len(data), CONFIGDRIVE_CHUNK_SIZE))
+
+
+def _configdrive_size(data, name):
+    """Get the size of the ISO image of a configdrive without storing it.
+
+    The configdrive is decoded and decompressed, the output is dropped.
+
+    :param data: the base64 encoded gzipped configdrive.
+    :param name: name of the configdrive for errors.
+    :raises: ConfigDriveTooLargeError as soon as the image is known to be
+             larger than MAX_CONFIGDRIVE_SIZE.
+    :raises: DecompressionError if the configdrive is not gzipped.
+    """
+    decoder = _Base64Decoder()
+    decompressor = compression.StreamDecompressor(compression.GZIP)
+
+    def _pieces():
+        for chunk in _configdrive_chunks(data):
+            for piece in decompressor.decompress(decoder.decode(chunk)):
+                yield piece
+        for piece in decompressor.decompress(decoder.flush()):
+            yield piece
+        for piece in decompressor.flush():
+            yield piece
+
+    size = 0
+    for piece in _pieces():
+        size += len(piece)
+        if size > MAX_CONFIGDRIVE_SIZE:
+            raise errors.ConfigDriveTooLargeError(
+                name, 'at least {0}'.format(size))
+    return size
+
+
+def _configdrive_partition(device):
+    """Find the configdrive partition of a device, creating it if needed."""
+    try:
+        return partitions.find_or_create_configdrive(device)
+    except (EnvironmentError, errors.PartitionTableError) as e:
+        raise errors.ConfigDrivePartitionError(device, e)
+
+
+def _write_configdrive_to_partition(configdrive, device):
+    """Write a configdrive to its partition at the end of the device.
+
+    The configdrive, a base64 encoded gzipped ISO image, is decoded and
+    decompressed once to find the size of the image, so that one too
+    large is rejected before the partition table is touched. It is then
+    decoded and decompressed again as it is written to the partition. The
+    ISO image is never stored as a whole.
+    """
+    starttime = time.time()
+    data = _read_configdrive(configdrive)
+    size = _configdrive_size(data, configdrive if _configdrive_is_url(
+        configdrive) else 'configdrive')
+    partition = _configdrive_partition(device)
+    path = partitions.partition_path(device, partition.number)
+    if size > partition.size:
+        raise errors.ConfigDriveTooLargeError(path, size)
+
+    # Written through the disk, the kernel may not have created the device
+    # of a new partition yet
+    writer = blockio.DirectWriter(device, offset=partition.offset)
+    decoder = _Base64Decoder()
+    decompressor = compression.StreamDecompressor(compression.GZIP)
+    LOG.info('Writing configdrive to partition %s', path)
+    flush = False
+    try:
+        pipeline.Pipeline(
+            _configdrive_chunks(data),
+            [pipeline.Stage('decode', decoder.decode, finish=decoder.flush),
+             pipeline.Stage('decompress', decompressor.decompress,
+                            finish=decompressor.flush),
+             pipeline.Stage('write', writer.write)],
+            buffer_size=CONFIGDRIVE_BUFFER_SIZE,
+            chunk_size=CONFIGDRIVE_CHUNK_SIZE,
+            name='configdrive').run()
+        flush = True
+    finally:
+        writer.close(flush=flush)
 
     totaltime = time.time() - starttime
-    LOG.info('configdrive copied from {0} to {1} in {2} seconds'.format(
-             filename,
-             device,
-             totaltime))
+    LOG.info('configdrive written to {0} in {1} seconds'.format(
+             path, totaltime))
 
 
 class ImageDownload(object):
@@ -120,15 +300,80 @@ class ImageDownload(object):
 
     This class opens a HTTP connection to download an image from a URL
     and create an iterator so the image can be downloaded in chunks. The
-    MD5 hash of the image being downloaded is calculated on-the-fly.
+    hash of the image being downloaded is calculated on-the-fly, using the
+    algorithm from ``image_info['os_hash_algo']`` (MD5 if not given).
+
+    If ``image_info['download_concurrency']`` is greater than 1 and the
+    server supports range requests, the image is fetched as that many
+    concurrent byte ranges which are reassembled in order. Otherwise a
+    single stream is used.
+
+    If the connection drops partway through, the download is resumed from
+    the last byte received with a range request, first on the same URL and
+    then on the other ones. Only new bytes are passed on, so the hash keeps
+    being calculated where it stopped. ``image_info['download_retries']``
+    limits the number of attempts in a row which receive nothing, with an
+    exponential backoff starting at ``image_info['download_retry_interval']``
+    seconds between them.
+
+    With ``image_info['mirror_selection']`` set to ``race`` the URLs are
+    treated as mirrors: they are probed concurrently and tried fastest
+    first, ranged downloads spread their segments over all mirrors which
+    answered, and if the throughput drops below
+    ``image_info['min_download_throughput']`` MB/s the download moves on to
+    the next mirror which has not been found slow yet.
+
+    With ``image_info['peer_mode']`` set, the agents listed in
+    ``image_info['peers']`` are asked whether they share the image. If some
+    do, the image is downloaded from them and from the URL together, each
+    piece being checked against the manifest the peers serve. Should that
+    download fail as a whole, it is resumed from the URLs alone.
+
+    Data is received no faster than the download rate limit of the agent,
+    see the bandwidth module. ``throttled`` is the time spent waiting for
+    it, in seconds.
     """
 
     def __init__(self, image_info, time_obj=None):
-        self._md5checksum = hashlib.md5()
+        self.hash_algo = _checksum_info(image_info)[0]
+        self.resumes = 0
+        self.throttled = 0.0
+        self._bucket = bandwidth.downloads()
+        self._hash = _new_hash(self.hash_algo)
         self._time = time_obj or time.time()
+        self._image_info = image_info
         self._request = None
-
-        for url in image_info['urls']:
+        self._url_index = None
+        self._urls = list(image_info['urls'])
+        self._mirrors = []
+        self._slow_urls = set()
+        self.mirrors = None
+        # Throughput of the current request, measured over a window of
+        # time spent waiting for the network
+        self._window_bytes = 0
+        self._window_time = 0.0
+        # Bytes received so far, total size if known, and bytes to drop
+        # from the start of a response which ignored the Range header
+        self._offset = 0
+        self._size = None
+        self._skip = 0
+        self._resumable = True
+        # Manifest and URLs of the peers sharing the image, looked up on
+        # the first request
+        self._peers = None
+        self._from_peers = False
+        self.peers = None
+
+        if (image_info.get('mirror_selection') == MIRROR_RACE
+                and len(self._urls) > 1):
+            probes = download.rank_mirrors(
+                self._urls, proxies=image_info.get('proxies', {}))
+            self.mirrors = [probe.serialize() for probe in probes]
+            self._urls = [probe.url for probe in probes]
+            self._mirrors = [probe.url for probe in probes
+                             if probe.error is None]
+
+        for index, url in enumerate(self._urls):
             try:
                 LOG.info("Attempting to download image from {0}".format(url))
                 self._request = self._download_file(image_info, url)
@@ -139,67 +384,778 @@ class ImageDownload(object):
                 LOG.warning(log_msg.format(url, failtime, e.details))
                 continue
             else:
+                self._url_index = index
                 break
         else:
             msg = 'Image download failed for all URLs.'
             raise errors.ImageDownloadError(image_info['id'], msg)
 
-    def _download_file(self, image_info, url):
+    def _download_file(self, image_info, url, offset=0):
         no_proxy = image_info.get('no_proxy')
         if no_proxy:
             os.environ['no_proxy'] = no_proxy
         proxies = image_info.get('proxies', {})
-        resp = requests.get(url, stream=True, proxies=proxies)
+        concurrency = image_info.get('download_concurrency', 1)
+        if image_info.get('peer_mode') and image_info.get('peers'):
+            resp = self._open_peers(image_info, url, offset)
+            if resp is not None:
+                return resp
+        if concurrency > 1:
+            try:
+                resp = download.open_ranged(
+                    url, concurrency,
+                    segment_size=image_info.get('download_segment_size'),
+                    proxies=proxies, start=offset,
+                    mirrors=[m for m in self._mirrors
+                             if m != url and m not in self._slow_urls])
+            except errors.DownloadError as e:
+                raise errors.ImageDownloadError(image_info['id'], str(e))
+            if isinstance(resp, download.SegmentedDownload):
+                self._check_size(image_info, url, resp.size)
+                return resp
+        elif offset:
+            resp = transport.get(
+                url, stream=True, proxies=proxies,
+                headers={'Range': 'bytes={0}-'.format(offset)})
+        else:
+            resp = transport.get(url, stream=True, proxies=proxies)
+
+        if offset and resp.status_code == 206:
+            try:
+                first, _last, total = download.parse_content_range(
+                    resp.headers.get('Content-Range'))
+            except errors.DownloadError as e:
+                resp.close()
+                raise errors.ImageDownloadError(image_info['id'], str(e))
+            if first != offset:
+                resp.close()
+                msg = ('Server {0} resumed the download at byte {1} instead '
+                       'of {2}').format(url, first, offset)
+                raise errors.ImageDownloadError(image_info['id'], msg)
+            self._check_size(image_info, url, total)
+            return resp
+
         if resp.status_code != 200:
             msg = ('Received status code {0} from {1}, expected 200. Response '
                    'body: {2}').format(resp.status_code, url, resp.text)
             raise errors.ImageDownloadError(image_info['id'], msg)
+        if resp.headers.get('Content-Encoding', 'identity') != 'identity':
+            # iter_content() decodes the body, so the number of bytes
+            # received does not match the offsets in the file
+            LOG.info('Image at %s is sent with a content encoding, the '
+                     'download cannot be resumed', url)
+            self._resumable = False
+        else:
+            self._check_size(image_info, url,
+                             _content_length(resp.headers))
+        # The server ignored the Range header and sends the whole image
+        self._skip = offset
         return resp
 
+    def _open_peers(self, image_info, url, offset):
+        """Download the image from the peers sharing it and from url.
+
+        :returns: a SegmentedDownload, or None if no peer shares the image.
+        """
+        proxies = image_info.get('proxies', {})
+        if self._peers is None:
+            self._peers = peer.find_peers(image_info['peers'],
+                                          image_info['id'], proxies=proxies)
+        pieces, urls = self._peers
+        if pieces is None or not urls or offset % pieces.block_size:
+            return None
+        # Every agent picks different peers so that the load is spread
+        urls = random.sample(urls, min(len(urls), peer.MAX_PEERS))
+        self._check_size(image_info, url, pieces.size)
+        concurrency = max(image_info.get('download_concurrency', 1),
+                          len(urls) + 1)
+        LOG.info('Downloading image %(image)s from %(count)d peers and '
+                 '%(url)s', {'image': image_info['id'], 'count': len(urls),
+                             'url': url})
+        self.peers = urls
+        self._from_peers = True
+        return download.SegmentedDownload(url, pieces.size, concurrency,
+                                          proxies=proxies, start=offset,
+                                          mirrors=urls,
+                                          manifest=pieces).start()
+
+    @property
+    def size(self):
+        """Size of the image as downloaded, if the server told it."""
+        return self._size
+
+    def _check_size(self, image_info, url, size):
+        if size is None:
+            return
+        if self._size is not None and size != self._size:
+            msg = ('Image at {0} is {1} bytes long, expected {2} bytes as '
+                   'reported when the download started').format(
+                url, size, self._size)
+            raise errors.ImageDownloadError(image_info['id'], msg)
+        self._size = size
+
     def __iter__(self):
-        for chunk in self._request.iter_content(IMAGE_CHUNK_SIZE):
-            self._md5checksum.update(chunk)
+        for chunk in self.iter_chunks():
+            self.update_checksum(chunk)
             yield chunk
 
+    def _iter_request(self):
+        self._window_bytes = 0
+        self._window_time = 0.0
+        chunks = iter(self._request.iter_content(IMAGE_CHUNK_SIZE))
+        while True:
+            # Only the time spent waiting for the network counts, not the
+            # time the consumer takes before asking for the next chunk
+            start = time.time()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            self._window_time += time.time() - start
+            self._window_bytes += len(chunk)
+            self.throttled += self._bucket.consume(len(chunk))
+            if self._skip:
+                drop = min(self._skip, len(chunk))
+                self._skip -= drop
+                chunk = chunk[drop:]
+            if chunk:
+                self._offset += len(chunk)
+                yield chunk
+            self._check_throughput()
+
+    def _check_throughput(self):
+        if self._window_time < THROUGHPUT_WINDOW:
+            return
+        throughput = self._window_bytes / self._window_time / (1024 * 1024)
+        self._window_bytes = 0
+        self._window_time = 0.0
+        minimum = self._image_info.get('min_download_throughput')
+        if not minimum or throughput >= minimum or not self._resumable:
+            return
+        url = self._urls[self._url_index]
+        self._slow_urls.add(url)
+        for index, candidate in enumerate(self._urls):
+            if candidate not in self._slow_urls:
+                raise _SlowMirror(url, throughput, index)
+
+    def iter_chunks(self):
+        """Yield the image in chunks without updating the checksum.
+
+        Callers using this method are responsible for passing every chunk
+        to :meth:`update_checksum`, e.g. from a separate thread.
+
+        :raises: ImageDownloadError if the download was interrupted and
+                 could not be resumed.
+        """
+        attempts = 0
+        while True:
+            try:
+                for chunk in self._iter_request():
+                    attempts = 0
+                    yield chunk
+                if self._size is None or self._offset >= self._size:
+                    return
+                error = 'Connection closed after {0} of {1} bytes'.format(
+                    self._offset, self._size)
+            except _RESUMABLE_ERRORS as e:
+                error = e
+            except _SlowMirror as e:
+                error = e
+            self._close_request()
+
+            if isinstance(error, _SlowMirror):
+                # Switch right away, without waiting or using up retries
+                LOG.warning('%s, switching to %s', error,
+                            self._urls[error.next_index])
+                error = self._reopen(error.next_index)
+                if error is None:
+                    continue
+
+            # Reconnect to the same URL first, then go through the others
+            while True:
+                attempts += 1
+                self._wait_for_retry(error, attempts)
+                error = self._reopen(
+                    (self._url_index + attempts - 1) % len(self._urls))
+                if error is None:
+                    break
+
+    def _reopen(self, index):
+        """Resume the download from the URL at index.
+
+        :returns: None on success, the exception raised otherwise.
+        """
+        url = self._urls[index]
+        if self._from_peers:
+            # Failures of single peers are handled by the download itself,
+            # this one failed as a whole
+            LOG.warning('Download of image %s from peers failed, resuming '
+                        'without them', self._image_info['id'])
+            self._peers = (None, [])
+            self._from_peers = False
+        LOG.info('Resuming download of image %(image)s at byte %(offset)d '
+                 'from %(url)s', {'image': self._image_info['id'],
+                                  'offset': self._offset, 'url': url})
+        try:
+            self._request = self._download_file(self._image_info, url,
+                                                self._offset)
+        except (errors.ImageDownloadError,) + _RESUMABLE_ERRORS as e:
+            return e
+        self._url_index = index
+        self.resumes += 1
+
+    def _wait_for_retry(self, error, attempt):
+        retries = self._image_info.get('download_retries',
+                                       DEFAULT_DOWNLOAD_RETRIES)
+        if not self._resumable or attempt > retries:
+            msg = 'Download interrupted after {0} bytes: {1}'.format(
+                self._offset, error)
+            raise errors.ImageDownloadError(self._image_info['id'], msg)
+        interval = min(self._image_info.get('download_retry_interval',
+                                            DEFAULT_DOWNLOAD_RETRY_INTERVAL)
+                       * 2 ** (attempt - 1), MAX_DOWNLOAD_RETRY_INTERVAL)
+        LOG.warning('Download of image %(image)s interrupted after %(offset)d '
+                    'bytes: %(err)s. Retrying in %(interval)s seconds '
+                    '(attempt %(attempt)d of %(retries)d)',
+                    {'image': self._image_info['id'], 'offset': self._offset,
+                     'err': error, 'interval': interval, 'attempt': attempt,
+                     'retries': retries})
+        time.sleep(interval)
+
+    def _close_request(self):
+        try:
+            self._request.close()
+        except Exception as e:
+            LOG.debug('Failed to close interrupted download: %s', e)
+
+    def update_checksum(self, chunk):
+        # hashlib releases the GIL for large buffers, so hashing in another
+        # thread runs in parallel with receiving
+        self._hash.update(chunk)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
     def md5sum(self):
-        return self._md5checksum.hexdigest()
+        """Get the hash of the image, kept for compatibility.
+
+        The hash is only an MD5 if ``os_hash_algo`` was not given, use
+        :meth:`hexdigest` instead.
+        """
+        return self.hexdigest()
+
+
+class _Cancelled(Exception):
+    def __str__(self):
+        return 'download cancelled'
+
+
+class _SlowMirror(Exception):
+    def __init__(self, url, throughput, next_index):
+        super(_SlowMirror, self).__init__(
+            'Mirror {0} is too slow ({1:.2f} MB/s)'.format(url, throughput))
+        self.next_index = next_index
+
+
+def _content_length(headers):
+    try:
+        return int(headers['Content-Length'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _checksum_info(image_info):
+    """Get the hash algorithm and the expected hash value of an image.
+
+    ``os_hash_algo`` and ``os_hash_value`` take precedence over the MD5
+    ``checksum``.
+    """
+    if image_info.get('os_hash_algo'):
+        return image_info['os_hash_algo'], image_info.get('os_hash_value')
+    return 'md5', image_info.get('checksum')
+
+
+def _new_hash(algo):
+    if algo not in HASH_ALGORITHMS:
+        raise ValueError('Unsupported hash algorithm {0}'.format(algo))
+    return getattr(hashlib, algo)()
 
 
 def _verify_image(image_info, image_location, checksum):
-    LOG.debug('Verifying image at {0} against MD5 checksum '
-              '{1}'.format(image_location, checksum))
-    if checksum != image_info['checksum']:
+    algo, expected = _checksum_info(image_info)
+    LOG.debug('Verifying image at {0} against {1} checksum '
+              '{2}'.format(image_location, algo, checksum))
+    if checksum != expected:
         LOG.error(errors.ImageChecksumError.details_str.format(
-            image_location, image_info['id'],
-            image_info['checksum'], checksum))
+            image_location, image_info['id'], expected, checksum))
         raise errors.ImageChecksumError(image_location, image_info['id'],
-                                        image_info['checksum'], checksum)
+                                        expected, checksum)
+
+
+def _transfer_image(image_info, image_download, write_stage, target,
+                    pieces=None, raw_hash=None):
+    """Download an image through a pipeline ending with write_stage.
+
+    Receiving, hashing, decompressing and writing each run in their own
+    thread, so that the network, the CPU and the disk are busy at the same
+    time. Chunks are passed between the stages by reference, without being
+    copied. The compression format is detected from the data unless given,
+    the checksum is that of the image as downloaded.
+
+    :param write_stage: the Stage writing the image, or a pipeline.Fanout
+                        writing it to several devices, the first of which
+                        is reported in the progress of the command.
+    :param pieces: a manifest.Builder to feed the image as downloaded to,
+                   to share it with peers afterwards.
+    :param raw_hash: a hash object to feed the decompressed image to.
+    :returns: the statistics of the transfer, for the command result.
+    """
+    decompressor = compression.StreamDecompressor(
+        image_info.get('compression'))
+    progress = base.current_progress()
+    progress.start(image_download.size)
+
+    def _hash(chunk):
+        image_download.update_checksum(chunk)
+        progress.add_downloaded(len(chunk))
+        return chunk
+
+    def _counted(stage):
+        def _write(chunk):
+            data = stage.process(chunk)
+            progress.add_written(len(chunk))
+            return data
+        return pipeline.Stage(stage.name, _write, finish=stage.finish)
+
+    def _raw_hash(chunk):
+        raw_hash.update(chunk)
+        return chunk
+
+    def _add_piece(chunk):
+        pieces.update(chunk)
+        return chunk
+
+    chain = [pipeline.Stage('hash', _hash)]
+    if pieces is not None:
+        chain.append(pipeline.Stage('pieces', _add_piece))
+    chain.append(pipeline.Stage('decompress', decompressor.decompress,
+                                finish=decompressor.flush))
+    if raw_hash is not None:
+        chain.append(pipeline.Stage('hash-raw', _raw_hash))
+    if isinstance(write_stage, pipeline.Fanout):
+        chain.append(pipeline.Fanout(
+            write_stage.name,
+            [_counted(write_stage.branches[0])] + write_stage.branches[1:]))
+    else:
+        chain.append(_counted(write_stage))
+    stream = pipeline.Pipeline(
+        image_download.iter_chunks(), chain,
+        buffer_size=image_info.get('stream_buffer_size'),
+        chunk_size=IMAGE_CHUNK_SIZE,
+        name='stream-{0}'.format(image_info['id']))
+    try:
+        stages = stream.run()
+    except Exception as e:
+        msg = 'Unable to write image to {0}. Error: {1}'.format(
+              target, str(e))
+        raise errors.ImageDownloadError(image_info['id'], msg)
+
+    return {'hash_algo': image_download.hash_algo,
+            'download_resumes': image_download.resumes,
+            'throttled_time': round(image_download.throttled, 2),
+            'mirrors': image_download.mirrors,
+            'peers': image_download.peers,
+            'compression': decompressor.compression,
+            'stages': [stage.serialize() for stage in stages]}
+
+
+def _new_pieces(image_info):
+    """Get a manifest.Builder if the image is to be shared with peers."""
+    if not image_info.get('peer_mode'):
+        return None
+    return manifest.Builder(block_size=image_info.get('peer_piece_size',
+                                                      peer.DEFAULT_PIECE_SIZE))
+
+
+def _close_writers(writers, flush):
+    """Close all writers, raising the first error once all are closed."""
+    error = None
+    for writer in writers:
+        try:
+            writer.close(flush=flush)
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
 
 
-def _download_image(image_info):
-    starttime = time.time()
-    image_location = _image_location(image_info)
-    image_download = ImageDownload(image_info, time_obj=starttime)
+def _target_devices(image_info, device):
+    """Get the devices to write the image to, the install device first."""
+    devices = [device]
+    for extra in image_info.get('additional_devices') or ():
+        if extra not in devices:
+            devices.append(extra)
+    return devices
+
+
+def _zero_handling(image_info, device):
+    """Get how all-zero blocks of the image are written to the device.
+
+    Unless ``image_info['zero_handling']`` says otherwise, they are zeroed
+    by the device where it offloads zeroing and written everywhere else.
+    """
+    zero_handling = image_info.get('zero_handling')
+    if zero_handling is not None:
+        return zero_handling
+    if blockio.get_zeroing_support(device)['write_zeroes']:
+        return blockio.ZERO_ZEROOUT
+    return blockio.ZERO_WRITE
+
+
+def _verify_devices(image_info, devices, size, algo, expected):
+    """Check that every device holds the raw image, reading them back.
 
-    with open(image_location, 'wb') as f:
+    The devices are read in parallel.
+
+    :param size: size of the raw image.
+    :param algo: hash algorithm of ``expected``.
+    :param expected: hash of the raw image.
+    :raises: ImageChecksumError for the first device which does not match.
+    """
+    results = {}
+
+    def _check(device):
         try:
-            for chunk in image_download:
-                f.write(chunk)
-        except Exception as e:
-            msg = 'Unable to write image to {0}. Error: {1}'.format(
-                image_location, str(e))
-            raise errors.ImageDownloadError(image_info['id'], msg)
+            results[device] = manifest.hash_region(device, size, algo)
+        except EnvironmentError as e:
+            LOG.error('Unable to read back image from %(device)s: %(err)s',
+                      {'device': device, 'err': e})
+
+    threads = [threading.Thread(target=_check, args=(device,),
+                                name='verify-{0}'.format(device))
+               for device in devices]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for device in devices:
+        checksum = results.get(device)
+        if checksum != expected:
+            LOG.error(errors.ImageChecksumError.details_str.format(
+                device, image_info['id'], expected, checksum))
+            raise errors.ImageChecksumError(device, image_info['id'],
+                                            expected, checksum)
+    LOG.info('Image %(image)s verified on devices %(devices)s',
+             {'image': image_info['id'], 'devices': ', '.join(devices)})
+
+
+def _cancellable(write, cancel):
+    if cancel is None:
+        return write
+
+    def _write(chunk):
+        if cancel.is_set():
+            raise _Cancelled()
+        return write(chunk)
+    return _write
+
+
+def _download_image(image_info, location=None, cancel=None):
+    """Download an image to /tmp, or to a scratch device if given.
+
+    :param cancel: a threading.Event interrupting the download once set.
+    """
+    starttime = time.time()
+    image_location = location or _image_location(image_info)
+    peer.unshare(image_location)
+    image_download = ImageDownload(image_info, time_obj=starttime)
+    pieces = _new_pieces(image_info)
+
+    if location is None:
+        with open(image_location, 'wb') as f:
+            stats = _transfer_image(
+                image_info, image_download,
+                pipeline.Stage('write', _cancellable(f.write, cancel)),
+                image_location, pieces=pieces)
+    else:
+        with blockio.DirectWriter(image_location, create=True) as writer:
+            stats = _transfer_image(
+                image_info, image_download,
+                pipeline.Stage('write', _cancellable(writer.write, cancel)),
+                image_location, pieces=pieces)
 
     totaltime = time.time() - starttime
     LOG.info("Image downloaded from {0} in {1} seconds".format(image_location,
                                                                totaltime))
-    _verify_image(image_info, image_location, image_download.md5sum())
+    _verify_image(image_info, image_location, image_download.hexdigest())
+    # The manifest is of the image as served, which is only what was
+    # written if it was not decompressed
+    if pieces is not None and stats['compression'] == compression.NONE:
+        peer.share(image_info['id'], image_location, pieces.finish())
+    return stats
+
+
+def _image_size(image_info):
+    """Get the size of the image file from the server, if it tells."""
+    proxies = image_info.get('proxies', {})
+    for url in image_info['urls']:
+        try:
+            resp = transport.head(url, proxies=proxies, allow_redirects=True,
+                                  timeout=manifest.DEFAULT_TIMEOUT)
+        except requests.RequestException as e:
+            LOG.debug('HEAD request to %(url)s failed: %(err)s',
+                      {'url': url, 'err': e})
+            continue
+        if (resp.status_code == 200 and resp.headers.get(
+                'Content-Encoding', 'identity') == 'identity'):
+            size = _content_length(resp.headers)
+            if size is not None:
+                return size
+    return None
+
+
+def _cache_headroom(path):
+    """Get the number of bytes which can be stored in a directory.
+
+    Files on a memory backed filesystem, like /tmp of most ramdisks, take
+    memory which the agent and the rest of the ramdisk need to keep some
+    of. Such filesystems may also be larger than the memory available.
+    """
+    st = os.statvfs(path)
+    free = st.f_bavail * st.f_frsize
+    mounts = [p for p in psutil.disk_partitions(all=True)
+              if path == p.mountpoint
+              or path.startswith(p.mountpoint.rstrip('/') + '/')]
+    if mounts:
+        mount = max(mounts, key=lambda p: len(p.mountpoint))
+        if mount.fstype in _MEMORY_FILESYSTEMS:
+            available = psutil.virtual_memory().available
+            # ramfs has no size limit and reports no free space
+            free = min(free, available) if free else available
+    return free - CACHE_RESERVE
+
+
+def _scratch_device(image_info, device, size):
+    """Find a disk to spill an image to, other than the target devices.
+
+    The smallest disk large enough is used. Its contents are destroyed, so
+    this is only done with ``image_info['allow_scratch_disk']``, and only
+    for images of SPILLABLE_FORMATS.
+    """
+    if not image_info.get('allow_scratch_disk'):
+        return None
+    if image_info.get('disk_format') not in SPILLABLE_FORMATS:
+        LOG.info('Not spilling image %(image)s to a scratch disk, its disk '
+                 'format %(format)s does not tell where it ends',
+                 {'image': image_info['id'],
+                  'format': image_info.get('disk_format')})
+        return None
+    targets = _target_devices(image_info, device)
+    disks = [d for d in hardware.dispatch_to_managers('list_block_devices')
+             if d.name not in targets and d.size >= size]
+    if not disks:
+        return None
+    return min(disks, key=lambda d: d.size).name
+
+
+def _can_stream(image_info):
+    """Whether the disk format of an image allows streaming it."""
+    disk_format = image_info.get('disk_format')
+    return disk_format in STREAMABLE_FORMATS or (
+        disk_format == 'qcow2' and image_info.get('stream_qcow2_images'))
+
+
+def _choose_write_mode(image_info, device):
+    """Decide how to write an image with stream_raw_images set to 'auto'.
+
+    Images in a format which can be converted on the fly are streamed to
+    the device. Others are cached in /tmp if they fit next to what the
+    ramdisk needs, else spilled to a scratch disk if allowed. If the
+    size of the image cannot be told it is cached, as without 'auto'.
+
+    :returns: a dict with the chosen 'mode', the 'reason' for it and the
+              figures it is based on, for the command result.
+    """
+    decision = {'mode': WRITE_MODE_CACHE}
+    if _can_stream(image_info):
+        decision.update(mode=WRITE_MODE_STREAM,
+                        reason='disk format can be streamed')
+        return decision
+
+    # Compressed images are cached decompressed, of an unknown size
+    size = None
+    if image_info.get('compression', compression.NONE) == compression.NONE:
+        size = _image_size(image_info)
+    decision['image_size'] = size
+    if size is None:
+        decision['reason'] = 'image size is unknown'
+        return decision
+
+    headroom = _cache_headroom(os.path.dirname(_image_location(image_info)))
+    decision['cache_headroom'] = headroom
+    if size <= headroom:
+        decision['reason'] = 'image fits in the cache'
+        return decision
+
+    scratch = _scratch_device(image_info, device, size)
+    if scratch is not None:
+        decision.update(mode=WRITE_MODE_SPILL, scratch_device=scratch,
+                        reason='image does not fit in the cache')
+        return decision
+
+    LOG.warning('Image %(image)s of %(size)d bytes does not fit in the '
+                'cache (%(headroom)d bytes) and no scratch disk can be '
+                'used, caching it anyway',
+                {'image': image_info['id'], 'size': size,
+                 'headroom': headroom})
+    decision['reason'] = 'no room for the image anywhere'
+    return decision
+
+
+class _ImagePrefetch(object):
+    """Download of an image to /tmp before it is asked for.
+
+    The image is downloaded in a thread of its own, while the agent goes on
+    with other commands, e.g. cleaning steps. The thread runs with the
+    lowest priority so that they are not slowed down. Only memory is used:
+    the disks are erased while cleaning.
+    """
+
+    def __init__(self, image_info):
+        self.image_info = image_info
+        self.stats = None
+        self.error = None
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='prefetch-{0}'.format(image_info['id']))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            # Only affects the calling thread on Linux
+            os.nice(PREFETCH_NICENESS)
+        except OSError as e:
+            LOG.debug('Unable to lower the priority of the prefetch: %s', e)
+        try:
+            self.stats = _download_image(self.image_info, cancel=self._cancel)
+        except Exception as e:
+            self.error = e
+            if self._cancel.is_set():
+                LOG.info('Prefetch of image %s cancelled',
+                         self.image_info['id'])
+            else:
+                LOG.warning('Prefetch of image %(image)s failed: %(err)s',
+                            {'image': self.image_info['id'], 'err': e})
+            self._discard()
+        else:
+            LOG.info('Image %s prefetched', self.image_info['id'])
+
+    def matches(self, image_info):
+        """Whether the prefetched image is the one described."""
+        return (image_info['id'] == self.image_info['id']
+                and _checksum_info(image_info) ==
+                _checksum_info(self.image_info))
+
+    def wait(self):
+        """Wait for the prefetch to finish.
+
+        :returns: whether the image was prefetched successfully.
+        """
+        self._thread.join()
+        return self.error is None
+
+    def cancel(self):
+        """Stop the prefetch and remove what was downloaded."""
+        self._cancel.set()
+        self._thread.join()
+        if self.error is None:
+            self._discard()
+
+    def _discard(self):
+        location = _image_location(self.image_info)
+        peer.unshare(location)
+        try:
+            os.unlink(location)
+        except OSError:
+            pass
+
+
+def _image_present(image_info, device):
+    """Check whether the image is already written to the device.
+
+    The start of the device is hashed and compared with the image checksum,
+    which can only match for uncompressed raw images. If a block manifest
+    is published with the image, the device is compared with it first,
+    reading and hashing blocks in parallel and stopping at the first
+    difference, so that a device holding another image is told quickly.
+    The manifest alone is not trusted, it may be stale.
+
+    :returns: True if the image is on the device, False if it is not or
+              that cannot be told.
+    """
+    if (image_info.get('disk_format', 'raw') != 'raw'
+            or image_info.get('compression') not in (None,
+                                                     compression.NONE)):
+        LOG.info('Image %s is not an uncompressed raw image, it cannot be '
+                 'found on the device', image_info['id'])
+        return False
+
+    concurrency = image_info.get('verify_concurrency')
+    try:
+        if image_info.get('block_manifest'):
+            blocks = manifest.load(image_info['block_manifest'],
+                                   proxies=image_info.get('proxies', {}))
+            if blocks.diff(device, concurrency=concurrency,
+                           first_only=True):
+                return False
+            size = blocks.size
+        else:
+            size = _image_size(image_info)
+        if size is None:
+            LOG.info('Size of image %s is unknown, cannot check whether it '
+                     'is on the device', image_info['id'])
+            return False
+        algo, expected = _checksum_info(image_info)
+        return manifest.hash_region(device, size, algo) == expected
+    except (errors.ManifestError, EnvironmentError) as e:
+        LOG.warning('Unable to check whether image %(image)s is already on '
+                    '%(device)s: %(err)s',
+                    {'image': image_info['id'], 'device': device, 'err': e})
+        return False
+
+
+def _check_download_rate(rate, name):
+    if rate is not None and (
+            isinstance(rate, bool)
+            or not isinstance(rate, six.integer_types + (float,))
+            or rate < 0):
+        raise errors.InvalidCommandParamsError(
+            '{0} must be a non-negative number.'.format(name))
+
+
+def _validate_download_rate(ext, rate=None):
+    _check_download_rate(rate, 'Download rate')
+
+
+def _set_download_rate(image_info):
+    """Apply the download rate limit of the deploy, if it has one."""
+    if 'max_download_rate' in image_info:
+        bandwidth.set_download_rate(image_info['max_download_rate'])
 
 
 def _validate_image_info(ext, image_info=None, **kwargs):
     image_info = image_info or {}
 
-    for field in ['id', 'urls', 'checksum']:
+    # The MD5 checksum is not needed when another hash is given
+    checksum_field = ('os_hash_value' if image_info.get('os_hash_algo')
+                      else 'checksum')
+    for field in ['id', 'urls', checksum_field]:
         if field not in image_info:
             msg = 'Image is missing \'{0}\' field.'.format(field)
             raise errors.InvalidCommandParamsError(msg)
@@ -208,10 +1164,126 @@ def _validate_image_info(ext, image_info=None, **kwargs):
         raise errors.InvalidCommandParamsError(
             'Image \'urls\' must be a list with at least one element.')
 
-    if (not isinstance(image_info['checksum'], six.string_types)
-            or not image_info['checksum']):
+    if (not isinstance(image_info[checksum_field], six.string_types)
+            or not image_info[checksum_field]):
         raise errors.InvalidCommandParamsError(
-            'Image \'checksum\' must be a non-empty string.')
+            'Image \'{0}\' must be a non-empty string.'.format(
+                checksum_field))
+
+    if image_info.get('os_hash_algo'):
+        try:
+            _new_hash(image_info['os_hash_algo'])
+        except (TypeError, ValueError):
+            raise errors.InvalidCommandParamsError(
+                'Image \'os_hash_algo\' {0} is not supported.'.format(
+                    image_info['os_hash_algo']))
+
+    for field in ['download_concurrency', 'download_segment_size',
+                  'stream_buffer_size', 'verify_concurrency',
+                  'peer_piece_size', 'write_queue_depth', 'prefetch_budget']:
+        value = image_info.get(field)
+        if value is not None and (not isinstance(value, six.integer_types)
+                                  or value < 1):
+            raise errors.InvalidCommandParamsError(
+                'Image \'{0}\' must be a positive integer.'.format(field))
+
+    retries = image_info.get('download_retries')
+    if retries is not None and (not isinstance(retries, six.integer_types)
+                                or retries < 0):
+        raise errors.InvalidCommandParamsError(
+            'Image \'download_retries\' must be a non-negative integer.')
+
+    interval = image_info.get('download_retry_interval')
+    if interval is not None and (
+            not isinstance(interval, six.integer_types + (float,))
+            or interval < 0):
+        raise errors.InvalidCommandParamsError(
+            'Image \'download_retry_interval\' must be a non-negative '
+            'number.')
+
+    devices = image_info.get('additional_devices')
+    if devices is not None and (
+            not isinstance(devices, list)
+            or not all(isinstance(d, six.string_types) and d
+                       for d in devices)):
+        raise errors.InvalidCommandParamsError(
+            'Image \'additional_devices\' must be a list of device paths.')
+    for device in devices or ():
+        try:
+            is_device = stat.S_ISBLK(os.stat(device).st_mode)
+        except OSError:
+            is_device = False
+        if not is_device:
+            raise errors.InvalidCommandParamsError(
+                'Image \'additional_devices\' entry {0} is not a block '
+                'device.'.format(device))
+
+    if image_info.get('image_delta'):
+        if devices:
+            raise errors.InvalidCommandParamsError(
+                'Image \'image_delta\' cannot be used with '
+                '\'additional_devices\'.')
+        if not image_info.get('block_manifest'):
+            raise errors.InvalidCommandParamsError(
+                'Image \'image_delta\' requires a \'block_manifest\'.')
+        if (image_info.get('disk_format', 'raw') != 'raw'
+                or image_info.get('compression') not in (None,
+                                                         compression.NONE)):
+            raise errors.InvalidCommandParamsError(
+                'Image \'image_delta\' requires an uncompressed raw image.')
+
+    if image_info.get('mirror_selection', MIRROR_ORDERED) not in (
+            MIRROR_SELECTION):
+        raise errors.InvalidCommandParamsError(
+            'Image \'mirror_selection\' must be one of {0}.'.format(
+                ', '.join(MIRROR_SELECTION)))
+
+    peers = image_info.get('peers')
+    if peers is not None and (
+            not isinstance(peers, list)
+            or not all(isinstance(p, six.string_types) for p in peers)):
+        raise errors.InvalidCommandParamsError(
+            'Image \'peers\' must be a list of URLs.')
+
+    minimum = image_info.get('min_download_throughput')
+    if minimum is not None and (
+            not isinstance(minimum, six.integer_types + (float,))
+            or minimum < 0):
+        raise errors.InvalidCommandParamsError(
+            'Image \'min_download_throughput\' must be a non-negative '
+            'number.')
+
+    _check_download_rate(image_info.get('max_download_rate'),
+                         'Image \'max_download_rate\'')
+
+    if image_info.get('stream_raw_images') not in (None, True, False,
+                                                   WRITE_MODE_AUTO):
+        raise errors.InvalidCommandParamsError(
+            'Image \'stream_raw_images\' must be a boolean or '
+            '\'{0}\'.'.format(WRITE_MODE_AUTO))
+
+    if not isinstance(image_info.get('stream_qcow2_images', False), bool):
+        raise errors.InvalidCommandParamsError(
+            'Image \'stream_qcow2_images\' must be a boolean.')
+
+    compression.validate(image_info.get('compression'))
+
+    if image_info.get('zero_handling') not in (None,) + blockio.ZERO_HANDLING:
+        raise errors.InvalidCommandParamsError(
+            'Image \'zero_handling\' must be one of {0}.'.format(
+                ', '.join(blockio.ZERO_HANDLING)))
+
+
+def _command_result(command_name, msg, stats):
+    """Build a command result, including transfer statistics if any.
+
+    The 'result' key holds the same message as when a plain message is
+    returned, the statistics are only added next to it.
+    """
+    if not stats:
+        return msg
+    return {'result': '{0}: {1}'.format(command_name, msg),
+            'transfer_stats': stats}
 
 
 class StandbyExtension(base.BaseAgentExtension):
@@ -219,68 +1291,327 @@ class StandbyExtension(base.BaseAgentExtension):
         super(StandbyExtension, self).__init__(agent=agent)
 
         self.cached_image_id = None
+        self._prefetch = None
+
+    def _image_on_device(self, image_info, device):
+        """Whether writing the image to the device can be skipped.
+
+        Besides the image cached by this agent, the image can be found on
+        the device itself if ``image_info['skip_if_present']`` is set, e.g.
+        after the agent restarted or when deploying the same image again.
+        Only uncompressed raw images can be found, see _image_present.
+        """
+        if self.cached_image_id == image_info['id']:
+            return True
+        devices = _target_devices(image_info, device)
+        if image_info.get('skip_if_present') and all(
+                _image_present(image_info, target) for target in devices):
+            LOG.info('Image %(image)s is already on %(devices)s, not '
+                     'writing it again',
+                     {'image': image_info['id'],
+                      'devices': ', '.join(devices)})
+            self.cached_image_id = image_info['id']
+            return True
+        return False
+
+    def _prefetch_image(self, image_info):
+        """Start prefetching an image, if it fits in the memory budget.
+
+        The budget is what can be cached in /tmp, capped by
+        ``image_info['prefetch_budget']`` bytes. The size of compressed
+        images once decompressed is unknown, they are not prefetched.
+
+        :returns: the message of the command result.
+        """
+        if self._prefetch is not None:
+            if (self._prefetch.matches(image_info)
+                    and self._prefetch.error is None):
+                return 'image ({0}) is being prefetched'.format(
+                    image_info['id'])
+            self._prefetch.cancel()
+            self._prefetch = None
+
+        size = None
+        if image_info.get('compression',
+                          compression.NONE) == compression.NONE:
+            size = _image_size(image_info)
+        if size is None:
+            return 'image ({0}) not prefetched: size unknown'.format(
+                image_info['id'])
+        budget = _cache_headroom(
+            os.path.dirname(_image_location(image_info)))
+        if image_info.get('prefetch_budget') is not None:
+            budget = min(budget, image_info['prefetch_budget'])
+        if size > budget:
+            return ('image ({0}) not prefetched: {1} bytes do not fit in '
+                    'the budget of {2} bytes').format(image_info['id'], size,
+                                                      budget)
+
+        self._prefetch = _ImagePrefetch(image_info).start()
+        return 'image ({0}) is being prefetched'.format(image_info['id'])
+
+    def _write_prefetched(self, image_info, device):
+        """Write the image from its prefetch, if there is one.
+
+        A prefetch of another image is cancelled, one in progress is waited
+        for.
+
+        :returns: the statistics of the prefetch, or None if the image was
+                  not prefetched.
+        """
+        prefetch, self._prefetch = self._prefetch, None
+        if prefetch is None:
+            return None
+        if not prefetch.matches(image_info):
+            LOG.info('Cancelling the prefetch of image %s',
+                     prefetch.image_info['id'])
+            prefetch.cancel()
+            return None
+        LOG.info('Waiting for the prefetch of image %s', image_info['id'])
+        if not prefetch.wait():
+            return None
+
+        for target in _target_devices(image_info, device):
+            peer.unshare(target)
+            _write_image(image_info, target)
+        self.cached_image_id = image_info['id']
+        stats = dict(prefetch.stats, prefetched=True)
+        return stats
+
+    def _write_image_delta(self, image_info, device):
+        """Write only the blocks of the image which differ on the device.
+
+        The device is compared with the block manifest of the image and the
+        changed blocks are fetched with range requests, so the image must
+        be served raw. Every block written is checked against the manifest.
+        As the manifest may be stale, the device is then read back and
+        checked against the checksum of the image.
+
+        :returns: the statistics of the transfer, or None if the manifest
+                  is not available and the image has to be written in full.
+        :raises: ImageChecksumError if the device does not hold the image
+                 once written.
+        """
+        starttime = time.time()
+        peer.unshare(device)
+        try:
+            blocks = manifest.load(image_info['block_manifest'],
+                                   proxies=image_info.get('proxies', {}))
+        except errors.ManifestError as e:
+            LOG.warning('Cannot write image %(image)s as a delta, writing '
+                        'it in full: %(err)s',
+                        {'image': image_info['id'], 'err': e})
+            return None
+
+        try:
+            changed = blocks.diff(
+                device, concurrency=image_info.get('verify_concurrency'))
+            with blockio.PositionalWriter(
+                    device,
+                    zero_handling=_zero_handling(image_info,
+                                                 device)) as writer:
+                stats = delta.DeltaWriter(
+                    blocks, image_info['urls'], writer,
+                    concurrency=image_info.get('download_concurrency'),
+                    proxies=image_info.get('proxies', {}),
+                    retries=image_info.get('download_retries'),
+                    progress=base.current_progress(),
+                    bucket=bandwidth.downloads()).write(changed)
+            algo = _checksum_info(image_info)[0]
+            checksum = manifest.hash_region(device, blocks.size, algo)
+        except (errors.DownloadError, EnvironmentError) as e:
+            msg = 'Unable to write image delta to {0}. Error: {1}'.format(
+                device, e)
+            raise errors.ImageDownloadError(image_info['id'], msg)
+        _verify_image(image_info, device, checksum)
 
-    def _cache_and_write_image(self, image_info, device):
-        _download_image(image_info)
-        _write_image(image_info, device)
+        LOG.info('Image delta written onto device %(device)s in %(time)s '
+                 'seconds', {'device': device,
+                             'time': time.time() - starttime})
         self.cached_image_id = image_info['id']
+        return {'delta': stats.serialize(),
+                'bytes_written': writer.bytes_written,
+                'bytes_skipped': writer.bytes_skipped}
+
+    def _cache_and_write_image(self, image_info, device, location=None):
+        stats = _download_image(image_info, location=location)
+        for target in _target_devices(image_info, device):
+            peer.unshare(target)
+            _write_image(image_info, target, image=location)
+        self.cached_image_id = image_info['id']
+        return stats
+
+    def _write_image_auto(self, image_info, device):
+        """Stream, cache or spill an image, whichever suits it best."""
+        decision = _choose_write_mode(image_info, device)
+        LOG.info('Writing image %(image)s in %(mode)s mode: %(reason)s',
+                 {'image': image_info['id'], 'mode': decision['mode'],
+                  'reason': decision['reason']})
+        if decision['mode'] == WRITE_MODE_STREAM:
+            stats = self._stream_raw_image_onto_device(image_info, device)
+        else:
+            stats = self._cache_and_write_image(
+                image_info, device, location=decision.get('scratch_device'))
+        stats['write_mode'] = decision
+        return stats
 
     def _stream_raw_image_onto_device(self, image_info, device):
+        """Stream the image onto the device without staging it in /tmp.
+
+        With ``image_info['additional_devices']`` the same download is also
+        written to these devices. Every device has its own writer thread and
+        queue, so a slow one only holds the others back once its queue is
+        full. Raw images are then read back from every device and checked
+        against the hash of the data written.
+        """
         starttime = time.time()
+        devices = _target_devices(image_info, device)
+        for target in devices:
+            peer.unshare(target)
         image_download = ImageDownload(image_info, time_obj=starttime)
+        pieces = _new_pieces(image_info)
+        is_qcow2 = image_info.get('disk_format') == 'qcow2'
+
+        # Write with O_DIRECT so that the image does not go through (and
+        # evict everything else from) the page cache of the ramdisk.
+        # All-zero blocks are zeroed by the device itself where possible.
+        queue_depth = image_info.get('write_queue_depth', 1)
+        writers = []
+        write_stages = []
+        for target in devices:
+            zero_handling = _zero_handling(image_info, target)
+            if is_qcow2:
+                # Converted on the fly instead of being staged in /tmp
+                writer = blockio.PositionalWriter(target,
+                                                  zero_handling=zero_handling)
+                converter = qcow2.StreamConverter(writer)
+                stage = pipeline.Stage('convert', converter.feed,
+                                       finish=converter.finish)
+            elif queue_depth > 1:
+                # Several writes in flight, e.g. for NVMe devices
+                writer = blockio.ParallelWriter(target,
+                                                zero_handling=zero_handling,
+                                                queue_depth=queue_depth)
+                stage = pipeline.Stage('write', writer.write)
+            else:
+                writer = blockio.DirectWriter(target,
+                                              zero_handling=zero_handling)
+                stage = pipeline.Stage('write', writer.write)
+            writers.append(writer)
+            write_stages.append(stage)
+
+        raw_hash = None
+        if len(devices) == 1:
+            write_stage = write_stages[0]
+        else:
+            for target, stage in zip(devices, write_stages):
+                stage.name = '{0} {1}'.format(stage.name, target)
+            write_stage = pipeline.Fanout('tee', write_stages)
+            if not is_qcow2:
+                raw_hash = _new_hash(image_download.hash_algo)
 
-        with open(device, 'wb+') as f:
-            try:
-                for chunk in image_download:
-                    f.write(chunk)
-            except Exception as e:
-                msg = 'Unable to write image to device {0}. Error: {1}'.format(
-                      device, str(e))
-                raise errors.ImageDownloadError(image_info['id'], msg)
+        flush = False
+        try:
+            stats = _transfer_image(image_info, image_download, write_stage,
+                                    'device {0}'.format(', '.join(devices)),
+                                    pieces=pieces, raw_hash=raw_hash)
+            flush = True
+        finally:
+            _close_writers(writers, flush)
 
         totaltime = time.time() - starttime
         LOG.info("Image streamed onto device {0} in {1} "
-                 "seconds".format(device, totaltime))
+                 "seconds".format(', '.join(devices), totaltime))
         # Verify if the checksum of the streamed image is correct
-        _verify_image(image_info, device, image_download.md5sum())
+        _verify_image(image_info, device, image_download.hexdigest())
+        if raw_hash is not None:
+            _verify_devices(image_info, devices, stats['stages'][-1]['bytes'],
+                            image_download.hash_algo, raw_hash.hexdigest())
+        # Peers download the image as it is served, which is only what the
+        # device holds if it was neither converted nor decompressed
+        if (pieces is not None and not is_qcow2
+                and stats['compression'] == compression.NONE):
+            peer.share(image_info['id'], device, pieces.finish())
+        stats['bytes_written'] = writers[0].bytes_written
+        stats['bytes_skipped'] = writers[0].bytes_skipped
+        if len(devices) > 1:
+            stats['devices'] = [{'device': target,
+                                 'bytes_written': writer.bytes_written,
+                                 'bytes_skipped': writer.bytes_skipped,
+                                 'throughput': writer.throughput}
+                                for target, writer in zip(devices, writers)]
+        return stats
 
     @base.async_command('cache_image', _validate_image_info)
-    def cache_image(self, image_info=None, force=False):
+    def cache_image(self, image_info=None, force=False, prefetch=False):
+        """Download an image and write it to the install device.
+
+        With ``prefetch`` set the image is only downloaded to memory, in
+        the background, and the command returns right away. The next
+        cache_image or prepare_image command for the image writes it from
+        there.
+        """
         LOG.debug('Caching image %s', image_info['id'])
+        _set_download_rate(image_info)
         device = hardware.dispatch_to_managers('get_os_install_device')
 
+        if prefetch:
+            if self._image_on_device(image_info, device):
+                msg = 'image ({0}) already present on device {1}'.format(
+                    image_info['id'], device)
+            else:
+                msg = self._prefetch_image(image_info)
+            LOG.info(msg)
+            return msg
+
         result_msg = 'image ({0}) already present on device {1}'
+        stats = None
 
-        if self.cached_image_id != image_info['id'] or force:
+        if force or not self._image_on_device(image_info, device):
             LOG.debug('Already had %s cached, overwriting',
                       self.cached_image_id)
-            self._cache_and_write_image(image_info, device)
+            stats = self._write_prefetched(image_info, device)
+            if stats is None and image_info.get('image_delta'):
+                stats = self._write_image_delta(image_info, device)
+            if stats is None:
+                if image_info.get('stream_raw_images') == WRITE_MODE_AUTO:
+                    stats = self._write_image_auto(image_info, device)
+                else:
+                    stats = self._cache_and_write_image(image_info, device)
             result_msg = 'image ({0}) cached to device {1}'
 
         msg = result_msg.format(image_info['id'], device)
         LOG.info(msg)
-        return msg
+        return _command_result('cache_image', msg, stats)
 
     @base.async_command('prepare_image', _validate_image_info)
     def prepare_image(self,
                       image_info=None,
                       configdrive=None):
         LOG.debug('Preparing image %s', image_info['id'])
+        _set_download_rate(image_info)
         device = hardware.dispatch_to_managers('get_os_install_device')
 
-        disk_format = image_info.get('disk_format')
         stream_raw_images = image_info.get('stream_raw_images', False)
+        stats = None
         # don't write image again if already cached
-        if self.cached_image_id != image_info['id']:
+        if not self._image_on_device(image_info, device):
 
             if self.cached_image_id is not None:
                 LOG.debug('Already had %s cached, overwriting',
                           self.cached_image_id)
 
-            if stream_raw_images and disk_format == 'raw':
-                self._stream_raw_image_onto_device(image_info, device)
-            else:
-                self._cache_and_write_image(image_info, device)
+            stats = self._write_prefetched(image_info, device)
+            if stats is None and image_info.get('image_delta'):
+                stats = self._write_image_delta(image_info, device)
+            if stats is None:
+                if stream_raw_images == WRITE_MODE_AUTO:
+                    stats = self._write_image_auto(image_info, device)
+                elif stream_raw_images and _can_stream(image_info):
+                    stats = self._stream_raw_image_onto_device(image_info,
+                                                               device)
+                else:
+                    stats = self._cache_and_write_image(image_info, device)
 
         if configdrive is not None:
             _write_configdrive_to_partition(configdrive, device)
@@ -288,7 +1619,7 @@ class StandbyExtension(base.BaseAgentExtension):
         msg = ('image ({0}) written to device {1}'.format(
             image_info['id'], device))
         LOG.info(msg)
-        return msg
+        return _command_result('prepare_image', msg, stats)
 
     def _run_shutdown_script(self, parameter):
         script = _path_to_script('shell/shutdown.sh')
@@ -299,6 +1630,21 @@ class StandbyExtension(base.BaseAgentExtension):
         except processutils.ProcessExecutionError as e:
             raise errors.SystemRebootError(e.exit_code, e.stdout, e.stderr)
 
+    @base.sync_command('set_download_rate', _validate_download_rate,
+                       concurrent=True)
+    def set_download_rate(self, rate=None):
+        """Limit the rate of image downloads, including those in progress.
+
+        Can be used while an image is being downloaded. The limit applies
+        until it is changed again, by this command or by the
+        ``max_download_rate`` of an image.
+
+        :param rate: rate in MB/s, None or 0 for no limit.
+        :returns: the new limit.
+        """
+        bandwidth.set_download_rate(rate)
+        return {'max_download_rate': bandwidth.get_download_rate()}
+
     @base.async_command('run_image')
     def run_image(self):
         LOG.info('Rebooting system')
@@ -16,6 +16,8 @@ import abc
 import functools
 import os
 import shlex
+import threading
+import time
 
 import netifaces
 from oslo_concurrency import processutils
@@ -27,8 +29,10 @@ import pyudev
 import six
 import stevedore
 
+from ironic_python_agent import blockio
 from ironic_python_agent import encoding
 from ironic_python_agent import errors
+from ironic_python_agent import overwrite
 from ironic_python_agent import utils
 
 _global_managers = None
@@ -38,6 +42,9 @@ UNIT_CONVERTER = pint.UnitRegistry(filename=None)
 UNIT_CONVERTER.define('MB = []')
 UNIT_CONVERTER.define('GB = 1024 MB')
 
+# Number of block devices erased at the same time by default
+DEFAULT_ERASE_CONCURRENCY = 16
+
 
 def _get_device_vendor(dev):
     """Get the vendor name of a given device."""
@@ -217,10 +224,11 @@ class HardwareManager(object):
 
         Implementations should detect the type of device and erase it in the
         most appropriate way possible.  Generic implementations should support
-        common erase mechanisms such as ATA secure erase, or multi-pass random
-        writes. Operators with more specific needs should override this method
-        in order to detect and handle "interesting" cases, or delegate to the
-        parent class to handle generic cases.
+        common erase mechanisms such as ATA secure erase, discarding the
+        blocks of solid state devices, or multi-pass random writes. Operators
+        with more specific needs should override this method in order to
+        detect and handle "interesting" cases, or delegate to the parent class
+        to handle generic cases.
 
         For example: operators running ACME MagicStore (TM) cards alongside
         standard SSDs might check whether the device is a MagicStore and use a
@@ -245,16 +253,73 @@ class HardwareManager(object):
         erase additional hardware, although backwards-compatible upstream
         submissions are encouraged.
 
+        Block devices are erased in parallel, by up to
+        ``agent_erase_devices_concurrency`` threads as given in the
+        ``driver_internal_info`` of the node. Every device is attempted even
+        if erasing another one fails.
+
         :param node: Ironic node object
         :param ports: list of Ironic port objects
         :return: a dictionary in the form {device.name: erasure output}
+        :raises: InvalidCommandParamsError if the concurrency is not a
+                 positive integer.
+        :raises: the error raised erasing a device if only one failed,
+                 BlockDeviceEraseError listing the errors if several did.
         """
-        erase_results = {}
+        info = node.get('driver_internal_info', {})
+        concurrency = info.get('agent_erase_devices_concurrency',
+                               DEFAULT_ERASE_CONCURRENCY)
+        try:
+            concurrency = int(concurrency)
+        except (TypeError, ValueError):
+            concurrency = 0
+        if concurrency < 1:
+            raise errors.InvalidCommandParamsError(
+                'agent_erase_devices_concurrency must be a positive integer, '
+                'got {0!r}'.format(info['agent_erase_devices_concurrency']))
         block_devices = self.list_block_devices()
-        for block_device in block_devices:
-            result = dispatch_to_managers(
-                'erase_block_device', node=node, block_device=block_device)
-            erase_results[block_device.name] = result
+        pending = iter(block_devices)
+        lock = threading.Lock()
+        erase_results = {}
+        failures = []
+
+        def _worker():
+            while True:
+                with lock:
+                    block_device = next(pending, None)
+                if block_device is None:
+                    return
+                try:
+                    result = dispatch_to_managers(
+                        'erase_block_device', node=node,
+                        block_device=block_device)
+                except Exception as e:
+                    LOG.error('Failed to erase block device %(dev)s: '
+                              '%(err)s', {'dev': block_device.name,
+                                          'err': e})
+                    with lock:
+                        failures.append((block_device.name, e))
+                else:
+                    with lock:
+                        erase_results[block_device.name] = result
+
+        threads = [threading.Thread(target=_worker,
+                                    name='erase-devices-{0}'.format(i))
+                   for i in range(min(concurrency, len(block_devices)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if len(failures) == 1:
+            raise failures[0][1]
+        elif failures:
+            raise errors.BlockDeviceEraseError(
+                'Failed to erase {0} block devices: {1}'.format(
+                    len(failures), '; '.join(
+                        '{0}: {1}'.format(name, e)
+                        for name, e in sorted(failures,
+                                              key=lambda f: f[0]))))
         return erase_results
 
     def list_hardware_info(self):
@@ -495,6 +560,12 @@ class GenericHardwareManager(HardwareManager):
         if self._ata_erase(block_device):
             return
 
+        # Overwriting wears flash out, and takes hours, for nothing when
+        # the device can zero itself
+        if (not block_device.rotational
+                and self._discard_block_device(block_device)):
+            return
+
         if self._shred_block_device(node, block_device):
             return
 
@@ -504,7 +575,11 @@ class GenericHardwareManager(HardwareManager):
         raise errors.IncompatibleHardwareMethodError(msg)
 
     def _shred_block_device(self, node, block_device):
-        """Erase a block device using shred.
+        """Erase a block device by overwriting it.
+
+        The device is overwritten ``agent_erase_devices_iterations`` times
+        with random data and patterns, then with zeros, like ``shred
+        --zero`` would.
 
         :param node: Ironic node info.
         :param block_device: a BlockDevice object to be erased
@@ -513,14 +588,91 @@ class GenericHardwareManager(HardwareManager):
         info = node.get('driver_internal_info', {})
         npasses = info.get('agent_erase_devices_iterations', 1)
         try:
-            utils.execute('shred', '--force', '--zero', '--verbose',
-                          '--iterations', str(npasses), block_device.name)
-        except (processutils.ProcessExecutionError, OSError) as e:
-            msg = ("Erasing block device %(dev)s failed with error %(err)s ",
-                   {'dev': block_device.name, 'err': e})
-            LOG.error(msg)
+            passes = overwrite.overwrite(block_device.name,
+                                         iterations=npasses, zero=True)
+        except (EnvironmentError, errors.RESTError) as e:
+            # Anything else is a bug, not a device which cannot be erased
+            LOG.error("Erasing block device %(dev)s failed with error "
+                      "%(err)s", {'dev': block_device.name, 'err': e})
+            return False
+
+        LOG.info('Erased block device %(dev)s: %(passes)s',
+                 {'dev': block_device.name,
+                  'passes': ', '.join('{type} pass {throughput} MB/s'.format(
+                      **stats) for stats in passes)})
+        return True
+
+    def _discard_block_device(self, block_device):
+        """Erase a block device by having it discard or zero its blocks.
+
+        Only used if discarded blocks read back as zeros, or if the device
+        zeroes blocks itself. Blocks are discarded, securely if possible,
+        then zeroed by the device unless discarding zeroed them already.
+        Samples of the device are read back to check that it was zeroed.
+
+        :param block_device: a BlockDevice object to be erased
+        :returns: True if the erase succeeds, False if the device does not
+                  support it or it fails for any reason
+        """
+        try:
+            support = blockio.get_zeroing_support(block_device.name)
+        except EnvironmentError as e:
+            LOG.warning('Unable to check how block device %(dev)s can be '
+                        'zeroed: %(err)s', {'dev': block_device.name,
+                                            'err': e})
+            return False
+        if not (support['discard_zeroes_data'] or support['write_zeroes']):
+            return False
+
+        start = time.time()
+        methods = []
+        try:
+            fd = os.open(block_device.name, os.O_WRONLY)
+            try:
+                size = os.lseek(fd, 0, os.SEEK_END)
+                if support['discard']:
+                    for secure in (True, False):
+                        try:
+                            blockio.discard_range(fd, 0, size, secure=secure)
+                        except EnvironmentError as e:
+                            LOG.debug('%(method)s of block device %(dev)s '
+                                      'failed: %(err)s',
+                                      {'dev': block_device.name, 'err': e,
+                                       'method': ('Secure discard' if secure
+                                                  else 'Discard')})
+                        else:
+                            methods.append('secure discard' if secure
+                                           else 'discard')
+                            break
+                if not (methods and support['discard_zeroes_data']):
+                    if not support['write_zeroes']:
+                        LOG.info('Block device %s was not discarded and '
+                                 'cannot zero its blocks itself',
+                                 block_device.name)
+                        return False
+                    blockio.zero_range(fd, 0, size)
+                    methods.append('zeroing')
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            offset = blockio.find_non_zero(block_device.name, size)
+        except EnvironmentError as e:
+            LOG.warning('Erasing block device %(dev)s without writing to it '
+                        'failed with error %(err)s',
+                        {'dev': block_device.name, 'err': e})
+            return False
+
+        if offset is not None:
+            LOG.warning('Block device %(dev)s does not read as zeros at '
+                        'offset %(offset)d after %(method)s',
+                        {'dev': block_device.name, 'offset': offset,
+                         'method': ' and '.join(methods)})
             return False
 
+        LOG.info('Erased block device %(dev)s by %(method)s in %(time).2f '
+                 'seconds', {'dev': block_device.name,
+                             'method': ' and '.join(methods),
+                             'time': time.time() - start})
         return True
 
     def _is_virtual_media_device(self, block_device):
@@ -24,12 +24,12 @@ from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_utils import excutils
 from oslo_utils import units
-import requests
 import stevedore
 
 from ironic_python_agent import encoding
 from ironic_python_agent import errors
 from ironic_python_agent import hardware
+from ironic_python_agent import transport
 from ironic_python_agent import utils
 
 
@@ -113,7 +113,7 @@ def call_inspector(data, failures):
     encoder = encoding.RESTJSONEncoder()
     data = encoder.encode(data)
 
-    resp = requests.post(CONF.inspection_callback_url, data=data)
+    resp = transport.post(CONF.inspection_callback_url, data=data)
     if resp.status_code >= 400:
         LOG.error('inspector error %d: %s, proceeding with lookup',
                   resp.status_code, resp.content.decode('utf-8'))
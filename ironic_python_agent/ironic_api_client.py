@@ -21,6 +21,7 @@ import requests
 from ironic_python_agent import backoff
 from ironic_python_agent import encoding
 from ironic_python_agent import errors
+from ironic_python_agent import transport
 
 
 LOG = log.getLogger(__name__)
@@ -34,13 +35,8 @@ class APIClient(object):
         self.api_url = api_url.rstrip('/')
         self.driver_name = driver_name
 
-        # Only keep alive a maximum of 2 connections to the API. More will be
-        # opened if they are needed, but they will be closed immediately after
-        # use.
-        adapter = requests.adapters.HTTPAdapter(pool_connections=2,
-                                                pool_maxsize=2)
-        self.session = requests.Session()
-        self.session.mount(self.api_url, adapter)
+        # Heartbeats reuse a connection kept alive by the shared transport
+        self.session = transport.get_session()
 
         self.encoder = encoding.RESTJSONEncoder()
         self.log = log.getLogger(__name__)
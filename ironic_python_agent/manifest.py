@@ -0,0 +1,293 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Block hash manifests and verification of images already on disk.
+
+A manifest describes the raw contents an image leaves on a disk as the
+hashes of fixed size blocks, e.g.::
+
+    {"algorithm": "sha256", "block_size": 4194304, "size": 10737418240,
+     "blocks": ["9f86d08...", ...]}
+
+It is published next to the image, and lets the agent find out which parts
+of a device already hold the image without downloading anything.
+"""
+
+import hashlib
+import os
+import threading
+
+from oslo_log import log
+import requests
+import six
+
+from ironic_python_agent import errors
+from ironic_python_agent import pipeline
+from ironic_python_agent import transport
+
+LOG = log.getLogger(__name__)
+
+DEFAULT_ALGORITHM = 'sha256'
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024  # 4MB
+DEFAULT_CONCURRENCY = 4
+DEFAULT_TIMEOUT = 60  # seconds
+
+_READ_SIZE = 1024 * 1024  # 1MB
+
+
+def _read(fd, start, end):
+    """Yield the bytes between start and end of an open file."""
+    os.lseek(fd, start, os.SEEK_SET)
+    while start < end:
+        data = os.read(fd, min(_READ_SIZE, end - start))
+        if not data:
+            return
+        start += len(data)
+        yield data
+
+
+def _hash_range(fd, start, end, algorithm):
+    """Hash a range of an open file.
+
+    :returns: the hex digest, or None if the file ends before the range.
+    """
+    hasher = hashlib.new(algorithm)
+    received = 0
+    for data in _read(fd, start, end):
+        hasher.update(data)
+        received += len(data)
+    if received != end - start:
+        return None
+    return hasher.hexdigest()
+
+
+class Manifest(object):
+    """The hashes of the blocks of the raw contents of an image."""
+
+    def __init__(self, size, blocks, block_size=DEFAULT_BLOCK_SIZE,
+                 algorithm=DEFAULT_ALGORITHM):
+        self.size = size
+        self.blocks = blocks
+        self.block_size = block_size
+        self.algorithm = algorithm
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a manifest from its JSON representation.
+
+        :raises: ManifestError if the data is not a valid manifest.
+        """
+        try:
+            algorithm = data.get('algorithm', DEFAULT_ALGORITHM)
+            size = data['size']
+            block_size = data['block_size']
+            blocks = data['blocks']
+        except (AttributeError, KeyError) as e:
+            raise errors.ManifestError(
+                'Manifest is missing field {0}'.format(e))
+        if (not isinstance(size, six.integer_types) or size < 0
+                or not isinstance(block_size, six.integer_types)
+                or block_size < 1):
+            raise errors.ManifestError(
+                'Manifest size and block_size must be positive integers')
+        if (not isinstance(blocks, list)
+                or len(blocks) != -(-size // block_size)):
+            raise errors.ManifestError(
+                'Manifest of {0} bytes must list {1} blocks'.format(
+                    size, -(-size // block_size)))
+        try:
+            # Variable length digests (shake_*) have no digest_size
+            supported = hashlib.new(algorithm).digest_size > 0
+        except (TypeError, ValueError):
+            supported = False
+        if not supported:
+            raise errors.ManifestError(
+                'Unsupported manifest algorithm {0}'.format(algorithm))
+        return cls(size, blocks, block_size=block_size, algorithm=algorithm)
+
+    def to_dict(self):
+        return {'algorithm': self.algorithm, 'block_size': self.block_size,
+                'size': self.size, 'blocks': self.blocks}
+
+    def block_range(self, index):
+        """Get the (start, end) byte offsets of a block."""
+        start = index * self.block_size
+        return start, min(start + self.block_size, self.size)
+
+    def diff(self, path, concurrency=None, first_only=False):
+        """Find the blocks of a device or file which differ from the image.
+
+        Blocks are read and hashed by ``concurrency`` threads, each with its
+        own file descriptor; hashlib releases the GIL so this scales with
+        the number of CPUs until the device is the bottleneck.
+
+        :param path: device or file to compare with the manifest.
+        :param concurrency: number of blocks to hash in parallel.
+        :param first_only: stop as soon as a differing block is found.
+        :returns: sorted list of indexes of the blocks which differ. With
+                  first_only, at least one index if any block differs.
+        :raises: OSError if the device cannot be read.
+        """
+        concurrency = concurrency or DEFAULT_CONCURRENCY
+        indexes = iter(range(len(self.blocks)))
+        lock = threading.Lock()
+        stop = threading.Event()
+        differ = []
+        failures = []
+
+        def _worker():
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError as e:
+                failures.append(e)
+                stop.set()
+                return
+            try:
+                while not stop.is_set():
+                    with lock:
+                        index = next(indexes, None)
+                    if index is None:
+                        return
+                    start, end = self.block_range(index)
+                    if (_hash_range(fd, start, end, self.algorithm)
+                            != self.blocks[index]):
+                        with lock:
+                            differ.append(index)
+                        if first_only:
+                            stop.set()
+            except Exception as e:
+                failures.append(e)
+                stop.set()
+            finally:
+                os.close(fd)
+
+        threads = [threading.Thread(target=_worker,
+                                    name='manifest-diff-{0}'.format(i))
+                   for i in range(min(concurrency, len(self.blocks)) or 1)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failures:
+            raise failures[0]
+        return sorted(differ)
+
+
+class Builder(object):
+    """Build the manifest of an image from its data as it streams by."""
+
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE,
+                 algorithm=DEFAULT_ALGORITHM):
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self.size = 0
+        self._blocks = []
+        self._hash = hashlib.new(algorithm)
+        self._filled = 0
+
+    def update(self, data):
+        """Add the next chunk of the image."""
+        view = memoryview(data)
+        while len(view):
+            piece = view[:self.block_size - self._filled]
+            self._hash.update(piece)
+            self._filled += len(piece)
+            self.size += len(piece)
+            view = view[len(piece):]
+            if self._filled == self.block_size:
+                self._blocks.append(self._hash.hexdigest())
+                self._hash = hashlib.new(self.algorithm)
+                self._filled = 0
+
+    def finish(self):
+        """Get the manifest of all the data added.
+
+        :returns: a Manifest.
+        """
+        blocks = list(self._blocks)
+        if self._filled:
+            blocks.append(self._hash.hexdigest())
+        return Manifest(self.size, blocks, block_size=self.block_size,
+                        algorithm=self.algorithm)
+
+
+def generate(path, block_size=DEFAULT_BLOCK_SIZE, algorithm=DEFAULT_ALGORITHM,
+             size=None):
+    """Generate the manifest of a raw image.
+
+    :param path: raw image file or device.
+    :param block_size: size of the hashed blocks.
+    :param algorithm: hashlib algorithm to hash the blocks with.
+    :param size: size of the image, defaults to the size of the file.
+    :returns: a Manifest.
+    """
+    builder = Builder(block_size=block_size, algorithm=algorithm)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if size is None:
+            size = os.lseek(fd, 0, os.SEEK_END)
+        for data in _read(fd, 0, size):
+            builder.update(data)
+    finally:
+        os.close(fd)
+    if builder.size != size:
+        raise errors.ManifestError(
+            '{0} is shorter than {1} bytes'.format(path, size))
+    return builder.finish()
+
+
+def load(url, proxies=None):
+    """Download a manifest.
+
+    :param url: URL of the JSON manifest.
+    :param proxies: proxies to pass to requests.
+    :returns: a Manifest.
+    :raises: ManifestError if the manifest cannot be downloaded or is
+             invalid.
+    """
+    try:
+        resp = transport.get(url, proxies=proxies, timeout=DEFAULT_TIMEOUT)
+        if resp.status_code != 200:
+            raise errors.ManifestError(
+                'Received status code {0} from {1}, expected 200'.format(
+                    resp.status_code, url))
+        data = resp.json()
+    except (requests.RequestException, ValueError) as e:
+        raise errors.ManifestError(
+            'Unable to download manifest from {0}: {1}'.format(url, e))
+    return Manifest.from_dict(data)
+
+
+def hash_region(path, size, algorithm):
+    """Hash the first size bytes of a device or file.
+
+    Reading and hashing run in separate threads, so the device is read
+    while the previous chunk is hashed.
+
+    :returns: the hex digest, or None if the device is smaller than size.
+    """
+    hasher = hashlib.new(algorithm)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        stages = pipeline.Pipeline(
+            _read(fd, 0, size),
+            [pipeline.Stage('hash', hasher.update)],
+            chunk_size=_READ_SIZE,
+            name='verify-{0}'.format(os.path.basename(path))).run()
+    finally:
+        os.close(fd)
+    if stages[-1].bytes != size:
+        return None
+    return hasher.hexdigest()
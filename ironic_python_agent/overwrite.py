@@ -0,0 +1,295 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Overwriting of whole block devices.
+
+A replacement for ``shred``, which writes through the page cache in small
+buffered writes, one at a time. Each pass here is written by several
+threads with large page-aligned buffers and O_DIRECT, keeping a write in
+flight per thread. Like ``shred --zero``, the given number of random and
+pattern passes is followed by a pass of zeros.
+
+Random data is generated by the writing threads themselves, so that the
+generation scales with the number of writes in flight. The buffers of the
+pattern and zero passes are filled once per pass.
+"""
+
+import errno
+import mmap
+import os
+import threading
+import time
+
+from oslo_log import log
+from six import moves
+
+from ironic_python_agent import blockio
+
+LOG = log.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = blockio.DEFAULT_BUFFER_SIZE
+# Number of writes in flight
+DEFAULT_QUEUE_DEPTH = 8
+
+# Seconds between two progress messages
+PROGRESS_INTERVAL = 30
+
+PASS_RANDOM = 'random'
+PASS_PATTERN = 'pattern'
+PASS_ZERO = 'zero'
+
+# The patterns used by shred, repeating bit sequences which together flip
+# every bit of the device a few times
+PATTERNS = (b'\x55', b'\xaa', b'\x92\x49\x24', b'\x49\x24\x92',
+            b'\x24\x92\x49', b'\x6d\xb6\xdb', b'\xb6\xdb\x6d',
+            b'\xdb\x6d\xb6', b'\x00', b'\xff')
+
+_MB = 1024 * 1024
+
+
+def get_passes(iterations, zero=True):
+    """Get the passes overwriting a device.
+
+    The first and the last of the iterations write random data, the ones
+    in between cycle through PATTERNS.
+
+    :param iterations: number of random and pattern passes.
+    :param zero: whether to finish with a pass of zeros.
+    :returns: a list of (pass type, pattern) tuples, the pattern being None
+              unless the type is PASS_PATTERN.
+    """
+    passes = []
+    for i in range(iterations):
+        if i in (0, iterations - 1):
+            passes.append((PASS_RANDOM, None))
+        else:
+            passes.append((PASS_PATTERN, PATTERNS[(i - 1) % len(PATTERNS)]))
+    if zero:
+        passes.append((PASS_ZERO, None))
+    return passes
+
+
+def _open(path):
+    """Open path for writing, with O_DIRECT if supported.
+
+    :returns: a tuple (file descriptor, whether O_DIRECT is used).
+    """
+    if blockio.O_DIRECT:
+        try:
+            return os.open(path, os.O_WRONLY | blockio.O_DIRECT), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            LOG.info('%s does not support direct I/O, falling back to '
+                     'buffered I/O', path)
+    return os.open(path, os.O_WRONLY), False
+
+
+class Overwriter(object):
+    """Overwrite a block device, or a file, from start to end.
+
+    Each pass is split into buffers of ``buffer_size`` bytes, written at
+    their offset by ``queue_depth`` threads. A pass is synced to the device
+    before the next one starts. The size of a file is unchanged.
+    """
+
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE,
+                 queue_depth=DEFAULT_QUEUE_DEPTH):
+        self.path = path
+        self.buffer_size = blockio.align_up(buffer_size)
+        self.queue_depth = queue_depth
+        self._fd, self.direct = _open(path)
+        try:
+            # Works for block devices as well as for files
+            self.size = os.lseek(self._fd, 0, os.SEEK_END)
+        except Exception:
+            os.close(self._fd)
+            raise
+        self._lock = threading.Lock()
+        # Held by every write to the descriptors, see blockio.pwrite_all
+        self._seek_lock = threading.Lock()
+        self._written_direct = False
+        # Descriptors replaced when falling back, which other threads may
+        # still be writing to
+        self._closed_fds = []
+
+    def close(self):
+        if self._fd is not None:
+            for fd in self._closed_fds + [self._fd]:
+                os.close(fd)
+            self._closed_fds = []
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write(self, data, offset):
+        if self.direct and len(data) % blockio.ALIGNMENT:
+            # The end of a device whose size is not a multiple of a page
+            fd = os.open(self.path, os.O_WRONLY)
+            try:
+                # Not shared with other threads
+                blockio.pwrite_all(fd, data, offset)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            return
+        fd = self._fd
+        try:
+            blockio.pwrite_all(fd, data, offset, self._seek_lock)
+        except OSError as e:
+            if (not self.direct or e.errno != errno.EINVAL
+                    or self._written_direct):
+                raise
+            with self._lock:
+                # Another thread may have fallen back already
+                if self._fd == fd:
+                    LOG.info('%s does not support direct I/O writes, '
+                             'falling back to buffered I/O', self.path)
+                    self._closed_fds.append(fd)
+                    self._fd = os.open(self.path, os.O_WRONLY)
+                    self.direct = False
+            blockio.pwrite_all(self._fd, data, offset, self._seek_lock)
+        else:
+            self._written_direct = self.direct
+
+    def _pattern_buffers(self, pattern):
+        """Fill a buffer per phase of the pattern.
+
+        The pattern goes on across buffers, so a buffer at offset starts
+        with the byte offset % len(pattern) of the pattern. The buffers are
+        not closed explicitly, as an error raised by a write may still
+        reference them.
+        """
+        repeated = pattern * (self.buffer_size // len(pattern) + 2)
+        buffers = []
+        for phase in range(len(pattern)):
+            buf = mmap.mmap(-1, self.buffer_size)
+            buf[:] = repeated[phase:phase + self.buffer_size]
+            buffers.append(buf)
+        return buffers
+
+    def run_pass(self, number, pass_type, pattern=None, total=1):
+        """Write one pass over the whole device.
+
+        :param number: number of the pass, for logging.
+        :param pass_type: one of PASS_RANDOM, PASS_PATTERN or PASS_ZERO.
+        :param pattern: bytes repeated over the device for PASS_PATTERN.
+        :param total: total number of passes, for logging.
+        :returns: a dictionary with the statistics of the pass.
+        """
+        if pass_type == PASS_PATTERN:
+            buffers = self._pattern_buffers(pattern)
+        elif pass_type == PASS_ZERO:
+            # An anonymous mmap reads as zeros
+            buffers = [mmap.mmap(-1, self.buffer_size)]
+        else:
+            buffers = []
+
+        offsets = iter(moves.range(0, self.size, self.buffer_size))
+        state = {'written': 0, 'error': None, 'reported': time.time()}
+        start = time.time()
+
+        def _worker():
+            buf = (mmap.mmap(-1, self.buffer_size)
+                   if pass_type == PASS_RANDOM else None)
+            try:
+                while True:
+                    with self._lock:
+                        offset = next(offsets, None)
+                    if offset is None or state['error'] is not None:
+                        return
+                    length = min(self.buffer_size, self.size - offset)
+                    if pass_type == PASS_RANDOM:
+                        buf[:length] = os.urandom(length)
+                        data = buf
+                    else:
+                        data = buffers[offset % len(buffers)]
+                    self._write(blockio.buffer_view(data, 0, length), offset)
+                    with self._lock:
+                        state['written'] += length
+                        self._report(number, total, state)
+            except Exception as e:
+                with self._lock:
+                    if state['error'] is None:
+                        state['error'] = e
+
+        threads = [threading.Thread(target=_worker,
+                                    name='overwrite-{0}-{1}'.format(
+                                        os.path.basename(self.path), i))
+                   for i in range(self.queue_depth)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if state['error'] is not None:
+            raise state['error']
+        os.fsync(self._fd)
+
+        elapsed = time.time() - start
+        stats = {'pass': number, 'type': pass_type,
+                 'bytes': state['written'],
+                 'seconds': round(elapsed, 2),
+                 'throughput': (round(state['written'] / elapsed / _MB, 2)
+                                if elapsed else None)}
+        if pattern is not None:
+            stats['pattern'] = ''.join('{0:02x}'.format(c)
+                                       for c in bytearray(pattern))
+        LOG.info('Pass %(number)d/%(total)d (%(type)s) over %(path)s took '
+                 '%(seconds).2f seconds (%(throughput)s MB/s)',
+                 {'number': number, 'total': total, 'type': pass_type,
+                  'path': self.path, 'seconds': elapsed,
+                  'throughput': stats['throughput']})
+        return stats
+
+    def _report(self, number, total, state):
+        now = time.time()
+        if now - state['reported'] >= PROGRESS_INTERVAL:
+            state['reported'] = now
+            LOG.info('Overwriting %(path)s: pass %(number)d/%(total)d is '
+                     '%(percent)d%% done',
+                     {'path': self.path, 'number': number, 'total': total,
+                      'percent': 100 * state['written'] // self.size})
+
+    def overwrite(self, iterations=1, zero=True):
+        """Overwrite the device, see get_passes.
+
+        :returns: a list of the statistics of each pass.
+        """
+        passes = get_passes(iterations, zero=zero)
+        LOG.info('Overwriting %(path)s (%(size)d bytes) in %(passes)d '
+                 'passes, direct I/O: %(direct)s',
+                 {'path': self.path, 'size': self.size,
+                  'passes': len(passes), 'direct': self.direct})
+        return [self.run_pass(number, pass_type, pattern, len(passes))
+                for number, (pass_type, pattern) in enumerate(passes, 1)]
+
+
+def overwrite(path, iterations=1, zero=True, buffer_size=DEFAULT_BUFFER_SIZE,
+              queue_depth=DEFAULT_QUEUE_DEPTH):
+    """Overwrite a block device or a file.
+
+    :param path: path of the device.
+    :param iterations: number of random and pattern passes.
+    :param zero: whether to finish with a pass of zeros.
+    :param buffer_size: bytes per write.
+    :param queue_depth: number of writes in flight.
+    :returns: a list of the statistics of each pass.
+    """
+    with Overwriter(path, buffer_size=buffer_size,
+                    queue_depth=queue_depth) as overwriter:
+        return overwriter.overwrite(iterations, zero=zero)
@@ -0,0 +1,479 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reading and editing of MBR and GPT partition tables.
+
+Finding or creating the config drive partition used to take a dozen
+processes (partx, partprobe, blkid, sgdisk, parted, ...), most of which
+made the kernel rescan the disk. Partition tables are simple enough to be
+read and updated here instead; the kernel is then told about the one
+partition which was added with a single BLKPG ioctl.
+
+Everything works on regular files as well as on block devices, so disk
+images can stand in for disks.
+"""
+
+import ctypes
+import errno
+import fcntl
+import os
+import stat
+import struct
+import uuid
+import zlib
+
+from oslo_log import log
+
+from ironic_python_agent import errors
+
+LOG = log.getLogger(__name__)
+
+CONFIGDRIVE_LABEL = 'config-2'
+CONFIGDRIVE_SIZE = 64 * 1024 * 1024  # 64MB
+
+# New partitions start on a MB boundary, like with parted and sgdisk
+ALIGNMENT = 1024 * 1024  # 1MB
+
+DEFAULT_SECTOR_SIZE = 512
+
+# MBR partition tables address sectors with 32 bits
+_MBR_MAX_SECTORS = 1 << 32
+
+_MBR_SIGNATURE = b'\x55\xaa'
+_MBR_TABLE_OFFSET = 446
+_MBR_ENTRY = struct.Struct('<B3sB3sII')
+_MBR_EXTENDED = (0x05, 0x0f, 0x85)
+_MBR_GPT_PROTECTIVE = 0xee
+_MBR_LINUX = 0x83
+# CHS address telling to use the LBA fields instead
+_MBR_NO_CHS = b'\xfe\xff\xff'
+
+_GPT_SIGNATURE = b'EFI PART'
+_GPT_REVISION = 0x00010000
+_GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+_GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+_GPT_UNUSED = b'\0' * 16
+LINUX_FILESYSTEM_GUID = uuid.UUID('0fc63daf-8483-4772-8e79-3d69d8477de4')
+
+# Primary volume descriptor of an ISO9660 filesystem
+_ISO_DESCRIPTOR_OFFSET = 16 * 2048
+
+# From linux/fs.h and linux/blkpg.h
+_BLKSSZGET = 0x1268
+_BLKPG = 0x1269
+_BLKPG_ADD_PARTITION = 1
+_BLKPG_DEL_PARTITION = 2
+
+
+class _BlkpgPartition(ctypes.Structure):
+    _fields_ = [('start', ctypes.c_longlong),
+                ('length', ctypes.c_longlong),
+                ('pno', ctypes.c_int),
+                ('devname', ctypes.c_char * 64),
+                ('volname', ctypes.c_char * 64)]
+
+
+class _BlkpgIoctlArg(ctypes.Structure):
+    _fields_ = [('op', ctypes.c_int),
+                ('flags', ctypes.c_int),
+                ('datalen', ctypes.c_int),
+                ('data', ctypes.c_void_p)]
+
+
+def _crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def partition_path(device, number):
+    """Get the path of a partition of a disk, e.g. /dev/nvme0n1p2."""
+    if device[-1:].isdigit():
+        return '{0}p{1}'.format(device, number)
+    return '{0}{1}'.format(device, number)
+
+
+class Partition(object):
+    """A partition of a disk, with its offset and size in bytes."""
+
+    def __init__(self, number, offset, size):
+        self.number = number
+        self.offset = offset
+        self.size = size
+
+    def __repr__(self):
+        return 'Partition({0}, offset={1}, size={2})'.format(
+            self.number, self.offset, self.size)
+
+
+class _Disk(object):
+    """A disk or disk image, addressed in bytes or in sectors."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR)
+        self.is_block = stat.S_ISBLK(os.fstat(self.fd).st_mode)
+        self.sector_size = DEFAULT_SECTOR_SIZE
+        if self.is_block:
+            self.sector_size = struct.unpack('i', fcntl.ioctl(
+                self.fd, _BLKSSZGET, struct.pack('i', 0)))[0]
+        self.size = os.lseek(self.fd, 0, os.SEEK_END)
+        self.sectors = self.size // self.sector_size
+
+    def read(self, offset, length):
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        data = b''
+        while len(data) < length:
+            chunk = os.read(self.fd, length - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def read_sector(self, lba, count=1):
+        return self.read(lba * self.sector_size, count * self.sector_size)
+
+    def write(self, offset, data):
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        view = memoryview(data)
+        while len(view):
+            view = view[os.write(self.fd, view):]
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _filesystem_label(disk, partition):
+    """Get the label of the ISO9660 or FAT filesystem on a partition.
+
+    :returns: the label, or None if there is no such filesystem.
+    """
+    descriptor = disk.read(partition.offset + _ISO_DESCRIPTOR_OFFSET, 72)
+    if descriptor[:6] == b'\x01CD001':
+        label = descriptor[40:72]
+    else:
+        boot = disk.read(partition.offset, 512)
+        if boot[510:512] != _MBR_SIGNATURE:
+            return None
+        # An extended boot signature tells the volume label is valid
+        if boot[82:87] == b'FAT32' and boot[66:67] == b'\x29':
+            label = boot[71:82]
+        elif boot[54:57] == b'FAT' and boot[38:39] == b'\x29':
+            label = boot[43:54]
+        else:
+            return None
+    return label.rstrip(b' \0').decode('ascii', 'replace').lower()
+
+
+class _MBR(object):
+    """An MBR partition table, with its logical partitions."""
+
+    def __init__(self, disk, sector):
+        self.disk = disk
+        self.entries = [
+            list(_MBR_ENTRY.unpack_from(sector, _MBR_TABLE_OFFSET + 16 * i))
+            for i in range(4)]
+        self.partitions = []
+        for i, (_, _, kind, _, start, count) in enumerate(self.entries):
+            if not kind or not count:
+                continue
+            if kind in _MBR_EXTENDED:
+                self.partitions.extend(self._logical_partitions(start))
+            else:
+                self.partitions.append(self._partition(i + 1, start, count))
+
+    def _partition(self, number, start, count):
+        ss = self.disk.sector_size
+        return Partition(number, start * ss, count * ss)
+
+    def _logical_partitions(self, extended):
+        """Follow the chain of extended boot records."""
+        found = []
+        ebr = extended
+        seen = set()
+        while ebr not in seen:
+            seen.add(ebr)
+            sector = self.disk.read_sector(ebr)
+            if sector[510:512] != _MBR_SIGNATURE:
+                break
+            _, _, kind, _, start, count = _MBR_ENTRY.unpack_from(
+                sector, _MBR_TABLE_OFFSET)
+            if kind and count:
+                found.append(self._partition(5 + len(found), ebr + start,
+                                             count))
+            _, _, kind, _, start, count = _MBR_ENTRY.unpack_from(
+                sector, _MBR_TABLE_OFFSET + 16)
+            if kind not in _MBR_EXTENDED or not count:
+                break
+            ebr = extended + start
+        return found
+
+    def fix_backup(self):
+        return False
+
+    def add(self, size):
+        """Add a partition at the end of the disk.
+
+        Partitions cannot end past 2TB (with 512 bytes sectors), on larger
+        disks the partition ends there.
+        """
+        index = next((i for i, entry in enumerate(self.entries)
+                      if not entry[2]), None)
+        if index is None:
+            raise errors.PartitionTableError(
+                'No free primary partition on {0}'.format(self.disk.path))
+        ss = self.disk.sector_size
+        limit = min(self.disk.sectors, _MBR_MAX_SECTORS)
+        align = max(ALIGNMENT // ss, 1)
+        start = (limit - -(-size // ss)) // align * align
+        used = max([entry[4] + entry[5] for entry in self.entries
+                    if entry[2] and entry[5]] + [1])
+        if start < used:
+            raise errors.PartitionTableError(
+                'No space for a partition of {0} bytes at the end of '
+                '{1}'.format(size, self.disk.path))
+        self.entries[index] = [0, _MBR_NO_CHS, _MBR_LINUX, _MBR_NO_CHS,
+                               start, limit - start]
+        return self._partition(index + 1, start, limit - start)
+
+    def write(self):
+        sector = bytearray(self.disk.read_sector(0))
+        for i, entry in enumerate(self.entries):
+            _MBR_ENTRY.pack_into(sector, _MBR_TABLE_OFFSET + 16 * i, *entry)
+        self.disk.write(0, bytes(sector))
+
+
+class _GPT(object):
+    """A GPT partition table.
+
+    Both the primary and the backup table are always written, the backup
+    one at the very end of the disk.
+    """
+
+    def __init__(self, disk):
+        self.disk = disk
+        # Images written to a larger disk have their backup table in the
+        # middle of the disk, which is found through the primary header
+        table = self._read(1)
+        if table is None:
+            LOG.warning('Primary GPT of %s is invalid, using the backup GPT',
+                        disk.path)
+            table = self._read(disk.sectors - 1)
+            if table is None:
+                raise errors.PartitionTableError(
+                    'No valid GPT on {0}'.format(disk.path))
+        header, self.entries = table
+        (self.alternate, self.first_usable, self.last_usable,
+         self.disk_guid, self.entries_lba, self.entry_size) = (
+            header[6], header[7], header[8], header[9], header[10],
+            header[12])
+        self._from_backup = header[5] != 1
+        if self._from_backup:
+            self.alternate = header[5]
+            self.entries_lba = 2
+
+        ss = disk.sector_size
+        self.partitions = []
+        for i, entry in enumerate(self.entries):
+            kind, _, first, last, _, _ = _GPT_ENTRY.unpack_from(entry)
+            if kind != _GPT_UNUSED:
+                self.partitions.append(
+                    Partition(i + 1, first * ss, (last - first + 1) * ss))
+
+    @property
+    def _entries_sectors(self):
+        size = len(self.entries) * self.entry_size
+        return -(-size // self.disk.sector_size)
+
+    def _read(self, lba):
+        """Read and check a GPT header and its entries.
+
+        :returns: a tuple (header fields, entries), or None if invalid.
+        """
+        sector = self.disk.read_sector(lba)
+        if len(sector) < _GPT_HEADER.size:
+            return None
+        header = _GPT_HEADER.unpack_from(sector)
+        size = header[2]
+        if (header[0] != _GPT_SIGNATURE or header[5] != lba
+                or not _GPT_HEADER.size <= size <= len(sector)
+                or header[12] < _GPT_ENTRY.size):
+            return None
+        data = bytearray(sector[:size])
+        data[16:20] = b'\0' * 4
+        if _crc32(bytes(data)) != header[3]:
+            return None
+        count, entry_size = header[11], header[12]
+        entries = self.disk.read(header[10] * self.disk.sector_size,
+                                 count * entry_size)
+        if _crc32(entries) != header[13]:
+            return None
+        return header, [entries[i:i + entry_size]
+                        for i in range(0, len(entries), entry_size)]
+
+    def fix_backup(self):
+        """Move the backup table to the end of the disk if needed.
+
+        :returns: True if the table has to be written.
+        """
+        last = self.disk.sectors - 1
+        if self.alternate == last:
+            # The primary table is rewritten if it was invalid
+            return self._from_backup
+        if self.alternate > last:
+            raise errors.PartitionTableError(
+                'GPT of {0} is for a disk of at least {1} sectors, the disk '
+                'has {2}'.format(self.disk.path, self.alternate + 1,
+                                 last + 1))
+        LOG.info('Moving the backup GPT of %(disk)s from sector %(old)d to '
+                 'the end of the disk', {'disk': self.disk.path,
+                                         'old': self.alternate})
+        self.alternate = last
+        self.last_usable = last - self._entries_sectors - 1
+        return True
+
+    def add(self, size):
+        """Add a partition at the end of the disk."""
+        index = next((i for i, entry in enumerate(self.entries)
+                      if entry[:16] == _GPT_UNUSED), None)
+        if index is None:
+            raise errors.PartitionTableError(
+                'No free partition entry on {0}'.format(self.disk.path))
+        ss = self.disk.sector_size
+        align = max(ALIGNMENT // ss, 1)
+        start = (self.last_usable + 1 - -(-size // ss)) // align * align
+        used = max([(p.offset + p.size) // ss for p in self.partitions]
+                   + [self.first_usable])
+        if start < used:
+            raise errors.PartitionTableError(
+                'No space for a partition of {0} bytes at the end of '
+                '{1}'.format(size, self.disk.path))
+        name = CONFIGDRIVE_LABEL.encode('utf-16-le')
+        entry = _GPT_ENTRY.pack(LINUX_FILESYSTEM_GUID.bytes_le,
+                                uuid.uuid4().bytes_le, start,
+                                self.last_usable, 0, name)
+        self.entries[index] = entry + b'\0' * (self.entry_size - len(entry))
+        return Partition(index + 1, start * ss,
+                         (self.last_usable - start + 1) * ss)
+
+    def _header(self, lba, alternate, entries_lba, entries_crc):
+        fields = [_GPT_SIGNATURE, _GPT_REVISION, _GPT_HEADER.size, 0, 0,
+                  lba, alternate, self.first_usable, self.last_usable,
+                  self.disk_guid, entries_lba, len(self.entries),
+                  self.entry_size, entries_crc]
+        fields[3] = _crc32(_GPT_HEADER.pack(*fields))
+        header = _GPT_HEADER.pack(*fields)
+        return header + b'\0' * (self.disk.sector_size - len(header))
+
+    def _write_protective_mbr(self):
+        sector = bytearray(self.disk.read_sector(0))
+        for i in range(4):
+            offset = _MBR_TABLE_OFFSET + 16 * i
+            entry = list(_MBR_ENTRY.unpack_from(sector, offset))
+            if entry[2] == _MBR_GPT_PROTECTIVE and entry[4] == 1:
+                entry[5] = min(self.disk.sectors - 1, _MBR_MAX_SECTORS - 1)
+                _MBR_ENTRY.pack_into(sector, offset, *entry)
+        self.disk.write(0, bytes(sector))
+
+    def write(self):
+        ss = self.disk.sector_size
+        entries = b''.join(self.entries)
+        crc = _crc32(entries)
+        backup_entries_lba = self.alternate - self._entries_sectors
+        self.disk.write(backup_entries_lba * ss, entries)
+        self.disk.write(self.alternate * ss,
+                        self._header(self.alternate, 1, backup_entries_lba,
+                                     crc))
+        self.disk.write(self.entries_lba * ss, entries)
+        self.disk.write(ss, self._header(1, self.alternate,
+                                         self.entries_lba, crc))
+        self._write_protective_mbr()
+
+
+def _read_table(disk):
+    sector = disk.read_sector(0)
+    if sector[510:512] != _MBR_SIGNATURE:
+        raise errors.PartitionTableError(
+            'No partition table on {0}'.format(disk.path))
+    kinds = [_MBR_ENTRY.unpack_from(sector, _MBR_TABLE_OFFSET + 16 * i)[2]
+             for i in range(4)]
+    if _MBR_GPT_PROTECTIVE in kinds:
+        return _GPT(disk)
+    return _MBR(disk, sector)
+
+
+def _add_to_kernel(disk, partition):
+    """Tell the kernel about a new partition without rescanning the disk.
+
+    A partition of the same number the kernel still knows from a previous
+    partition table is replaced. Failures are only logged: the partition
+    is found by the next rescan anyway.
+    """
+    part = _BlkpgPartition(start=partition.offset, length=partition.size,
+                           pno=partition.number)
+    arg = _BlkpgIoctlArg(op=_BLKPG_ADD_PARTITION,
+                         datalen=ctypes.sizeof(part),
+                         data=ctypes.addressof(part))
+    try:
+        try:
+            fcntl.ioctl(disk.fd, _BLKPG, arg)
+        except (IOError, OSError) as e:
+            if e.errno != errno.EBUSY:
+                raise
+            fcntl.ioctl(disk.fd, _BLKPG,
+                        _BlkpgIoctlArg(op=_BLKPG_DEL_PARTITION,
+                                       datalen=ctypes.sizeof(part),
+                                       data=ctypes.addressof(part)))
+            fcntl.ioctl(disk.fd, _BLKPG, arg)
+    except (IOError, OSError) as e:
+        LOG.warning('Unable to add partition %(part)d of %(disk)s to the '
+                    'kernel: %(err)s', {'part': partition.number,
+                                        'disk': disk.path, 'err': e})
+
+
+def find_or_create_configdrive(path, size=CONFIGDRIVE_SIZE):
+    """Find the config drive partition of a disk, creating it if needed.
+
+    The config drive is the partition with an ISO9660 or FAT filesystem
+    labeled ``config-2``. If there is none, a partition is added at the end
+    of the disk. A GPT whose backup is not at the end of the disk, e.g.
+    because the image was smaller than the disk, is fixed first.
+
+    :param path: disk or disk image.
+    :param size: size of the partition to create.
+    :returns: a Partition.
+    :raises: PartitionTableError if the partition table cannot be read or
+             the partition cannot be created.
+    :raises: OSError if the disk cannot be read or written.
+    """
+    disk = _Disk(path)
+    try:
+        table = _read_table(disk)
+        changed = table.fix_backup()
+        partition = next((p for p in table.partitions
+                          if _filesystem_label(disk, p) == CONFIGDRIVE_LABEL),
+                         None)
+        if partition is not None:
+            LOG.info('Found existing config drive partition %(part)d on '
+                     '%(disk)s', {'part': partition.number, 'disk': path})
+        else:
+            partition = table.add(size)
+            LOG.info('Adding config drive partition %(part)d to %(disk)s',
+                     {'part': partition.number, 'disk': path})
+        if changed or partition not in table.partitions:
+            table.write()
+            os.fsync(disk.fd)
+        if disk.is_block and partition not in table.partitions:
+            _add_to_kernel(disk, partition)
+        return partition
+    finally:
+        disk.close()
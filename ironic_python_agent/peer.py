@@ -0,0 +1,198 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Distribution of images between agents.
+
+When many agents deploy the same image at the same time, the image
+endpoint becomes the bottleneck. An agent which downloaded an image can
+share it: the image and a manifest of the hashes of its pieces are then
+served by the agent API under ``/v1/images/<image id>``. Other agents fetch
+pieces from these peers and from the origin together, verifying every
+piece against the manifest.
+"""
+
+import os
+import threading
+
+from oslo_log import log
+import requests
+
+from ironic_python_agent import errors
+from ironic_python_agent import manifest
+from ironic_python_agent import transport
+
+LOG = log.getLogger(__name__)
+
+# Pieces are held in memory until verified, keep them small enough for
+# all the peers fetching at once
+DEFAULT_PIECE_SIZE = 8 * 1024 * 1024  # 8MB
+DEFAULT_TIMEOUT = 5  # seconds
+
+# Largest number of peers a single download fetches from
+MAX_PEERS = 8
+
+_READ_SIZE = 1024 * 1024  # 1MB
+
+
+class SharedImage(object):
+    """An image which this agent serves to its peers."""
+
+    def __init__(self, image_id, path, pieces):
+        """Construct an instance of SharedImage.
+
+        :param image_id: ID of the image.
+        :param path: file or device holding the image, from offset 0.
+        :param pieces: manifest.Manifest of the image.
+        """
+        self.image_id = image_id
+        self.path = path
+        self.pieces = pieces
+
+    @property
+    def size(self):
+        return self.pieces.size
+
+    def read(self, start, end):
+        """Yield the bytes between start and end of the image."""
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.lseek(fd, start, os.SEEK_SET)
+            while start < end:
+                data = os.read(fd, min(_READ_SIZE, end - start))
+                if not data:
+                    raise IOError('{0} ends before byte {1}'.format(
+                        self.path, start))
+                start += len(data)
+                yield data
+        finally:
+            os.close(fd)
+
+
+_shared = {}
+_lock = threading.Lock()
+
+
+def share(image_id, path, pieces):
+    """Start serving an image to peers.
+
+    :param image_id: ID of the image.
+    :param path: file or device holding the image.
+    :param pieces: manifest.Manifest of the image.
+    """
+    with _lock:
+        _unshare(path)
+        _shared[image_id] = SharedImage(image_id, path, pieces)
+    LOG.info('Sharing image %(image)s (%(size)d bytes) from %(path)s with '
+             'peers', {'image': image_id, 'size': pieces.size, 'path': path})
+
+
+def _unshare(path):
+    for image_id, image in list(_shared.items()):
+        if image.path == path:
+            LOG.info('No longer sharing image %s', image_id)
+            del _shared[image_id]
+
+
+def unshare(path):
+    """Stop serving the images stored at path, e.g. before overwriting it."""
+    with _lock:
+        _unshare(path)
+
+
+def get_shared(image_id):
+    """Get a shared image.
+
+    :returns: a SharedImage, or None if the image is not shared.
+    """
+    return _shared.get(image_id)
+
+
+def image_url(peer, image_id):
+    """Get the URL of an image served by a peer."""
+    return '{0}/v1/images/{1}'.format(peer.rstrip('/'), image_id)
+
+
+def _get_pieces(url, proxies):
+    try:
+        resp = transport.get(url + '/manifest', proxies=proxies,
+                             timeout=DEFAULT_TIMEOUT)
+        if resp.status_code != 200:
+            return None
+        return manifest.Manifest.from_dict(resp.json())
+    except (requests.RequestException, ValueError,
+            errors.ManifestError) as e:
+        LOG.debug('Peer %(url)s cannot serve the image: %(err)s',
+                  {'url': url, 'err': e})
+        return None
+
+
+def find_peers(peers, image_id, proxies=None):
+    """Find the peers which share an image.
+
+    All peers are asked for the manifest of the image at the same time.
+    It cannot be checked against the checksum of the image without
+    downloading the image, so it is only used if more than half of the
+    peers which have the image agree on it. Peers whose manifest disagrees
+    are ignored, and without a majority no peer is used at all.
+
+    A bad manifest served by a lone peer, or by most of them, is only
+    caught by the checksum of the whole image, which then fails to deploy.
+
+    :param peers: base URLs of the APIs of other agents.
+    :param image_id: ID of the image.
+    :param proxies: proxies to pass to requests.
+    :returns: a tuple (manifest, list of image URLs of the peers having
+              it), with manifest None if no peer has the image or the peers
+              do not agree on it.
+    """
+    urls = [image_url(peer, image_id) for peer in peers]
+    results = [None] * len(urls)
+
+    def _probe(i):
+        results[i] = _get_pieces(urls[i], proxies)
+
+    threads = [threading.Thread(target=_probe, args=(i,),
+                                name='peer-probe-{0}'.format(i))
+               for i in range(len(urls))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # (manifest as a dict, manifest, URLs of the peers serving it)
+    candidates = []
+    for url, result in zip(urls, results):
+        if result is None:
+            continue
+        data = result.to_dict()
+        for candidate in candidates:
+            if candidate[0] == data:
+                candidate[2].append(url)
+                break
+        else:
+            candidates.append((data, result, [url]))
+    if not candidates:
+        return None, []
+
+    answered = sum(len(candidate[2]) for candidate in candidates)
+    _, pieces, found = max(candidates, key=lambda c: len(c[2]))
+    if len(found) * 2 <= answered:
+        LOG.warning('The %(count)d peers sharing image %(image)s do not '
+                    'agree on its manifest, not downloading it from peers',
+                    {'count': answered, 'image': image_id})
+        return None, []
+    LOG.info('Image %(image)s is shared by %(count)d of %(total)d peers',
+             {'image': image_id, 'count': len(found), 'total': len(urls)})
+    return pieces, found
@@ -0,0 +1,296 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A threaded producer/consumer pipeline for streaming data.
+
+Each stage runs in its own thread and stages are joined by bounded queues,
+so that e.g. the network, the CPU (hashing) and the disk can all be kept
+busy at the same time instead of taking turns.
+"""
+
+import threading
+import time
+
+from oslo_log import log
+import six
+from six.moves import queue
+
+from ironic_python_agent import encoding
+
+LOG = log.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 64 * 1024 * 1024  # 64MB
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# How often blocked stages wake up to check whether the pipeline failed.
+_POLL_INTERVAL = 0.1
+
+_EOF = object()
+
+_CHUNK_TYPES = (six.binary_type, six.text_type, bytearray, memoryview)
+
+
+class Stage(encoding.Serializable):
+    """A single step of a Pipeline and its throughput counters.
+
+    ``process`` is called with every chunk and returns the data to hand to
+    the next stage; returning an empty value forwards nothing, and
+    returning an iterator forwards every chunk it yields. ``finish`` is
+    called once the input is exhausted and may return trailing data in the
+    same way.
+
+    ``busy_time`` is the time spent doing actual work and ``wait_time`` the
+    time spent blocked on the neighbouring stages. The stage with the
+    highest busy time is the bottleneck of the pipeline.
+    """
+
+    serializable_fields = ('name', 'bytes', 'busy_time', 'wait_time',
+                           'throughput')
+
+    def __init__(self, name, process=None, finish=None):
+        self.name = name
+        self.process = process
+        self.finish = finish
+        self.bytes = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+
+    @property
+    def throughput(self):
+        """Throughput of the stage in MB/s, measured over its busy time."""
+        if not self.busy_time:
+            return None
+        return round(self.bytes / self.busy_time / (1024 * 1024), 2)
+
+
+class Fanout(Stage):
+    """A last stage handing every chunk to several branches.
+
+    Each branch is a Stage with its own queue and thread, so a slow branch
+    only holds the others back once its queue is full. Chunks are shared
+    by reference between the branches, which must not modify them.
+    """
+
+    def __init__(self, name, branches):
+        super(Fanout, self).__init__(name)
+        self.branches = list(branches)
+
+    def serialize(self):
+        data = super(Fanout, self).serialize()
+        data['branches'] = [branch.serialize() for branch in self.branches]
+        return data
+
+
+class Pipeline(object):
+    """Run a source iterable through a chain of threaded stages.
+
+    The source is consumed by an implicit 'receive' stage. Queues between
+    stages are bounded so that the data buffered in the pipeline never
+    exceeds ``buffer_size`` bytes (assuming chunks of ``chunk_size``). The
+    queues of the branches of a Fanout share chunks, together they count as
+    one queue.
+    """
+
+    def __init__(self, source, stages, buffer_size=None, chunk_size=None,
+                 name='pipeline'):
+        self.source = source
+        self.name = name
+        self.stages = [Stage('receive')] + list(stages)
+        if any(isinstance(stage, Fanout) for stage in self.stages[:-1]):
+            raise ValueError('Only the last stage can be a Fanout')
+        buffer_size = buffer_size or DEFAULT_BUFFER_SIZE
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        nqueues = len(self.stages) - 1
+        if isinstance(self.stages[-1], Fanout):
+            nqueues += 1
+        nqueues = max(1, nqueues)
+        self.queue_depth = max(1, buffer_size // (chunk_size * nqueues))
+        self._failed = threading.Event()
+        self._error = None
+        self._error_lock = threading.Lock()
+
+    def _fail(self, stage, error):
+        with self._error_lock:
+            if self._error is None:
+                LOG.error('Stage %(stage)s of %(name)s failed: %(err)s',
+                          {'stage': stage.name, 'name': self.name,
+                           'err': error})
+                self._error = error
+        self._failed.set()
+
+    def _put(self, stage, q, item):
+        start = time.time()
+        try:
+            while not self._failed.is_set():
+                try:
+                    q.put(item, timeout=_POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            stage.wait_time += time.time() - start
+
+    def _get(self, stage, q):
+        start = time.time()
+        try:
+            while not self._failed.is_set():
+                try:
+                    return q.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+            return None
+        finally:
+            stage.wait_time += time.time() - start
+
+    def _forward(self, stage, outq, data):
+        if outq is None or data is None:
+            return True
+        if isinstance(data, _CHUNK_TYPES):
+            return not data or self._put(stage, outq, data)
+
+        # Lazily produced output, the work happens while iterating
+        iterator = iter(data)
+        while True:
+            start = time.time()
+            try:
+                piece = next(iterator)
+            except StopIteration:
+                return True
+            finally:
+                stage.busy_time += time.time() - start
+            if piece and not self._put(stage, outq, piece):
+                return False
+
+    def _run_source(self, stage, outq):
+        iterator = None
+        try:
+            iterator = iter(self.source)
+            while not self._failed.is_set():
+                start = time.time()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    stage.busy_time += time.time() - start
+                if not chunk:
+                    continue
+                stage.bytes += len(chunk)
+                if not self._forward(stage, outq, chunk):
+                    return
+            if outq is not None:
+                self._put(stage, outq, _EOF)
+        except Exception as e:
+            self._fail(stage, e)
+        finally:
+            # Release e.g. the HTTP response when stopping early
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                try:
+                    close()
+                except Exception as e:
+                    LOG.warning('Failed to close the source of pipeline '
+                                '%(name)s: %(err)s',
+                                {'name': self.name, 'err': e})
+
+    def _run_fanout(self, stage, inq, outqs):
+        try:
+            while True:
+                chunk = self._get(stage, inq)
+                if chunk is None:
+                    return
+                if chunk is not _EOF:
+                    stage.bytes += len(chunk)
+                for outq in outqs:
+                    if not self._put(stage, outq, chunk):
+                        return
+                if chunk is _EOF:
+                    return
+        except Exception as e:
+            self._fail(stage, e)
+
+    def _run_stage(self, stage, inq, outq):
+        try:
+            while True:
+                chunk = self._get(stage, inq)
+                if chunk is None:
+                    return
+                start = time.time()
+                if chunk is _EOF:
+                    data = stage.finish() if stage.finish else None
+                else:
+                    stage.bytes += len(chunk)
+                    data = stage.process(chunk)
+                stage.busy_time += time.time() - start
+                if not self._forward(stage, outq, data):
+                    return
+                if chunk is _EOF:
+                    break
+            if outq is not None:
+                self._put(stage, outq, _EOF)
+        except Exception as e:
+            self._fail(stage, e)
+
+    def run(self):
+        """Run the pipeline to completion.
+
+        :returns: the list of stages, including the receive stage, with
+                  their counters filled in.
+        :raises: the first exception raised by any stage.
+        """
+        queues = [queue.Queue(self.queue_depth)
+                  for _ in range(len(self.stages) - 1)]
+        threads = [threading.Thread(
+            target=self._run_source,
+            args=(self.stages[0], queues[0] if queues else None),
+            name='{0}-{1}'.format(self.name, self.stages[0].name))]
+        for i, stage in enumerate(self.stages[1:]):
+            outq = queues[i + 1] if i + 1 < len(queues) else None
+            if isinstance(stage, Fanout):
+                branchqs = [queue.Queue(self.queue_depth)
+                            for _ in stage.branches]
+                threads.append(threading.Thread(
+                    target=self._run_fanout,
+                    args=(stage, queues[i], branchqs),
+                    name='{0}-{1}'.format(self.name, stage.name)))
+                for branch, branchq in zip(stage.branches, branchqs):
+                    threads.append(threading.Thread(
+                        target=self._run_stage, args=(branch, branchq, None),
+                        name='{0}-{1}'.format(self.name, branch.name)))
+                continue
+            threads.append(threading.Thread(
+                target=self._run_stage, args=(stage, queues[i], outq),
+                name='{0}-{1}'.format(self.name, stage.name)))
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+        stages = []
+        for stage in self.stages:
+            stages.extend(getattr(stage, 'branches', [stage]))
+        bottleneck = max(stages, key=lambda s: s.busy_time)
+        LOG.info('%(name)s finished: %(stats)s; bottleneck: %(bottleneck)s',
+                 {'name': self.name,
+                  'stats': ', '.join('{0} {1} MB/s'.format(s.name,
+                                                           s.throughput)
+                                     for s in stages),
+                  'bottleneck': bottleneck.name})
+        return self.stages
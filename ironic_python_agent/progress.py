@@ -0,0 +1,128 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Live progress of long running commands.
+
+Counters are updated for every chunk of data, from the threads doing the
+work, and read by API requests at any time. Neither side takes a lock:
+every counter has a single writer, and what the readers need to be
+consistent is kept in attributes which are replaced as a whole.
+"""
+
+import time
+
+from ironic_python_agent import encoding
+
+# Period over which the current throughput is measured
+DEFAULT_WINDOW = 5  # seconds
+
+_MB = 1024 * 1024
+
+
+def _mb_per_second(size, duration):
+    if duration <= 0:
+        return None
+    return round(max(size, 0) / float(duration) / _MB, 2)
+
+
+class Progress(encoding.Serializable):
+    """Bytes transferred by a command, how fast and how long is left.
+
+    ``add_downloaded`` and ``add_written`` must each be called by one
+    thread at a time. The current throughput is that of the last complete
+    window, or of the window in progress once it is overdue, so that a
+    stalled download shows a throughput dropping to zero.
+    """
+
+    serializable_fields = ('bytes_total', 'bytes_downloaded',
+                           'bytes_written', 'elapsed', 'current_throughput',
+                           'average_throughput', 'eta')
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self.bytes_total = None
+        self.bytes_downloaded = 0
+        self.bytes_written = 0
+        self.started_at = None
+        # (time, bytes downloaded) at the start of the current window
+        self._mark = None
+        self._rate = None
+
+    @property
+    def started(self):
+        return self.started_at is not None
+
+    def start(self, total=None):
+        """Start counting, possibly again for a new transfer.
+
+        :param total: number of bytes to download, if known.
+        """
+        now = time.time()
+        self.bytes_total = total
+        self.bytes_downloaded = 0
+        self.bytes_written = 0
+        self._rate = None
+        self._mark = (now, 0)
+        self.started_at = now
+
+    def add_downloaded(self, size):
+        self.bytes_downloaded += size
+        now = time.time()
+        mark_time, mark_bytes = self._mark
+        if now - mark_time >= self.window:
+            self._rate = _mb_per_second(self.bytes_downloaded - mark_bytes,
+                                        now - mark_time)
+            self._mark = (now, self.bytes_downloaded)
+
+    def add_written(self, size):
+        self.bytes_written += size
+
+    @property
+    def elapsed(self):
+        if not self.started:
+            return None
+        return round(time.time() - self.started_at, 2)
+
+    @property
+    def average_throughput(self):
+        """Average download throughput in MB/s."""
+        if not self.started:
+            return None
+        return _mb_per_second(self.bytes_downloaded,
+                              time.time() - self.started_at)
+
+    @property
+    def current_throughput(self):
+        """Download throughput over the last window in MB/s."""
+        if not self.started:
+            return None
+        now = time.time()
+        mark_time, mark_bytes = self._mark
+        if now - mark_time >= 2 * self.window or self._rate is None:
+            return _mb_per_second(self.bytes_downloaded - mark_bytes,
+                                  now - mark_time)
+        return self._rate
+
+    @property
+    def eta(self):
+        """Seconds left until the download completes, at current speed."""
+        if self.bytes_total is None:
+            return None
+        left = max(self.bytes_total - self.bytes_downloaded, 0)
+        if not left:
+            return 0
+        throughput = self.current_throughput
+        if not throughput:
+            return None
+        return int(round(left / (throughput * _MB)))
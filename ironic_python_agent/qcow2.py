@@ -0,0 +1,379 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Conversion of qcow2 images to raw while they are being downloaded.
+
+A qcow2 file maps guest clusters to host clusters through a two level table
+(L1 and L2 tables). The file is read strictly sequentially: as each host
+cluster arrives it is either parsed as metadata or written to the guest
+offsets the already known L2 tables map it to. Tools like ``qemu-img``
+allocate an L2 table before the data it describes, so in practice almost
+nothing needs to be kept in memory. Clusters which are not yet known to be
+referenced by anything are held back in a bounded buffer until they are.
+
+Only standalone images are supported: no backing files, encryption,
+external data files or extended L2 entries. Internal snapshots are ignored,
+only the active state of the image is written.
+"""
+
+import struct
+import zlib
+
+from oslo_log import log
+
+from ironic_python_agent import errors
+
+LOG = log.getLogger(__name__)
+
+MAGIC = b'QFI\xfb'
+
+# Upper bound on the memory used to hold clusters which arrive before the
+# tables referencing them.
+DEFAULT_MAX_PENDING = 256 * 1024 * 1024  # 256MB
+
+_HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+_HEADER_V3 = struct.Struct('>QQQII')
+_HEADER_SIZE = _HEADER.size + _HEADER_V3.size + 1
+
+_OFFSET_MASK = 0x00fffffffffffe00
+_COMPRESSED = 1 << 62
+_ZERO = 1
+
+# Incompatible features we can cope with: the dirty bit (only refcounts may
+# be stale) and a compression type field, provided it says zlib.
+_INCOMPAT_DIRTY = 1
+_INCOMPAT_COMPRESSION = 1 << 3
+
+
+def _error(msg, *args):
+    return errors.ImageConversionError(msg.format(*args))
+
+
+class Header(object):
+    """The fields of a qcow2 header which matter for conversion."""
+
+    def __init__(self, data):
+        (magic, self.version, backing_file_offset, _backing_file_size,
+         self.cluster_bits, self.size, crypt_method, self.l1_size,
+         self.l1_table_offset, self.refcount_table_offset,
+         self.refcount_table_clusters, _nb_snapshots,
+         _snapshots_offset) = _HEADER.unpack_from(data)
+
+        if magic != MAGIC:
+            raise _error('Image is not in qcow2 format')
+        if self.version not in (2, 3):
+            raise _error('Unsupported qcow2 version {0}', self.version)
+        if backing_file_offset:
+            raise _error('qcow2 images with a backing file are not supported')
+        if crypt_method:
+            raise _error('Encrypted qcow2 images are not supported')
+        if not 9 <= self.cluster_bits <= 21:
+            raise _error('Invalid qcow2 cluster size 2^{0}', self.cluster_bits)
+
+        if self.version == 3:
+            incompatible = _HEADER_V3.unpack_from(data, _HEADER.size)[0]
+            supported = _INCOMPAT_DIRTY | _INCOMPAT_COMPRESSION
+            unknown = incompatible & ~supported
+            if unknown:
+                raise _error('Unsupported qcow2 incompatible features {0:#x}',
+                             unknown)
+            if (incompatible & _INCOMPAT_COMPRESSION
+                    and data[_HEADER_SIZE - 1:_HEADER_SIZE] != b'\0'):
+                raise _error('Only zlib compressed qcow2 images are '
+                             'supported')
+
+        self.cluster_size = 1 << self.cluster_bits
+        self.l2_entries = self.cluster_size // 8
+
+
+class _Extent(object):
+    """A compressed cluster, which may straddle host clusters."""
+
+    def __init__(self, start, length, guest):
+        self.start = start
+        self.end = start + length
+        self.guest = guest
+        self.data = bytearray(length)
+        self.missing = length
+
+    def feed(self, offset, data):
+        """Copy the part of a host cluster at ``offset`` that is ours."""
+        start = max(self.start, offset)
+        end = min(self.end, offset + len(data))
+        if start < end:
+            self.data[start - self.start:end - self.start] = (
+                data[start - offset:end - offset])
+            self.missing -= end - start
+
+
+class StreamConverter(object):
+    """Convert a qcow2 image fed in chunks into a raw image.
+
+    :param writer: an object with ``write_at(offset, data)`` and
+                   ``write_zeroes(offset, length)`` methods, e.g. a
+                   :class:`ironic_python_agent.blockio.PositionalWriter`.
+    :param max_pending: maximum number of bytes of clusters held back
+                        because nothing referencing them was seen yet.
+    """
+
+    def __init__(self, writer, max_pending=None):
+        self.writer = writer
+        self.max_pending = max_pending or DEFAULT_MAX_PENDING
+        self.header = None
+        self._buf = bytearray()
+        # Index of the next host cluster to arrive
+        self._next = 0
+        # Host cluster index -> list of (kind, argument) to process it with
+        self._roles = {}
+        # Compressed extents by the host clusters they touch
+        self._extents = {}
+        self._pending = {}
+        self._pending_bytes = 0
+        # Host cluster index -> (offset, data) of the last sector of
+        # clusters which may contain the start of another compressed cluster
+        self._tails = {}
+        self._written = None
+
+    def _parse_header(self):
+        self.header = header = Header(bytes(self._buf[:_HEADER_SIZE]))
+        LOG.info('Converting qcow2 image: virtual size %(size)d, cluster '
+                 'size %(cluster)d', {'size': header.size,
+                                      'cluster': header.cluster_size})
+        cs = header.cluster_size
+        # One byte per guest cluster, set once the cluster was written
+        self._written = bytearray(-(-header.size // cs))
+        self._roles[0] = [('skip', None)]
+        self._add_table('l1', header.l1_table_offset, header.l1_size * 8)
+        self._add_table('refcount', header.refcount_table_offset,
+                        header.refcount_table_clusters * cs)
+
+    def _add_table(self, kind, offset, length):
+        cs = self.header.cluster_size
+        if offset % cs:
+            raise _error('Misaligned qcow2 {0} table', kind)
+        entries = cs // 8
+        for i in range(-(-length // cs)):
+            self._add_role(offset // cs + i, kind, i * entries)
+
+    def _add_role(self, index, kind, arg):
+        self._roles.setdefault(index, []).append((kind, arg))
+        if index in self._pending:
+            self._process(self._pop_pending(index), [(kind, arg)])
+        elif index < self._next and kind != 'skip':
+            raise _error('qcow2 host cluster {0} is referenced after it was '
+                         'received; this image cannot be streamed', index)
+
+    def _add_extent(self, entry, guest):
+        cs = self.header.cluster_size
+        shift = 62 - (self.header.cluster_bits - 8)
+        start = entry & ((1 << shift) - 1)
+        sector_mask = (1 << (self.header.cluster_bits - 8)) - 1
+        sectors = ((entry >> shift) & sector_mask) + 1
+        extent = _Extent(start, sectors * 512 - (start & 511), guest)
+        for index in range(start // cs, (extent.end - 1) // cs + 1):
+            self._extents.setdefault(index, []).append(extent)
+            if index in self._pending:
+                self._feed_extent(extent, index, self._pending[index])
+                if self._covered(index, self._pending[index]):
+                    self._pop_pending(index)
+            elif index in self._tails and start >= self._tails[index][0]:
+                tail_offset, tail = self._tails[index]
+                extent.feed(tail_offset, tail)
+                if not extent.missing:
+                    self._decompress(extent)
+            elif index < self._next:
+                raise _error('Compressed qcow2 cluster at {0} is referenced '
+                             'after it was received; this image cannot be '
+                             'streamed', start)
+
+    def _covered(self, index, data):
+        """Whether the known compressed extents account for a cluster.
+
+        The length of a compressed cluster is rounded up to a sector, so the
+        last extent may really end up to 511 bytes earlier than it claims.
+        In that case the end of the cluster is kept around in case another
+        compressed cluster turns out to start there.
+        """
+        cs = self.header.cluster_size
+        pos = index * cs
+        end = pos + cs
+        for extent in sorted(self._extents.get(index, ()),
+                             key=lambda e: e.start):
+            if extent.start > pos:
+                return False
+            pos = max(pos, extent.end)
+        if pos < end:
+            return False
+        if pos - 511 < end:
+            self._tails[index] = (end - 512, data[-512:])
+        return True
+
+    def _pop_pending(self, index):
+        data = self._pending.pop(index)
+        self._pending_bytes -= len(data)
+        return data
+
+    def _write(self, guest, data):
+        end = min(guest + len(data), self.header.size)
+        if end <= guest:
+            return
+        self.writer.write_at(guest, data[:end - guest])
+        cs = self.header.cluster_size
+        self._written[guest // cs:-(-end // cs)] = (
+            b'\1' * (-(-end // cs) - guest // cs))
+
+    def _feed_extent(self, extent, index, data):
+        extent.feed(index * self.header.cluster_size, data)
+        if not extent.missing:
+            self._decompress(extent)
+
+    def _decompress(self, extent):
+        cs = self.header.cluster_size
+        try:
+            data = zlib.decompressobj(-12).decompress(bytes(extent.data), cs)
+        except zlib.error as e:
+            raise _error('Corrupt compressed qcow2 cluster at {0}: {1}',
+                         extent.start, e)
+        if len(data) < min(cs, self.header.size - extent.guest):
+            raise _error('Corrupt compressed qcow2 cluster at {0}',
+                         extent.start)
+        self._write(extent.guest, data)
+        extent.data = None
+
+    def _parse_l1(self, first, data):
+        header = self.header
+        cs = header.cluster_size
+        count = min(len(data) // 8, header.l1_size - first)
+        span = header.l2_entries * cs
+        for i, entry in enumerate(struct.unpack_from('>%dQ' % count, data)):
+            offset = entry & _OFFSET_MASK
+            if offset:
+                if offset % cs:
+                    raise _error('Misaligned qcow2 L2 table at {0}', offset)
+                # An L2 table is processed knowing the guest offset it maps
+                self._add_role(offset // cs, 'l2', (first + i) * span)
+
+    def _parse_l2(self, guest, data):
+        header = self.header
+        cs = header.cluster_size
+        count = min(header.l2_entries, -(-(header.size - guest) // cs))
+        for i, entry in enumerate(struct.unpack_from('>%dQ' % count, data)):
+            if entry & _COMPRESSED:
+                self._add_extent(entry, guest + i * cs)
+                continue
+            offset = entry & _OFFSET_MASK
+            if entry & _ZERO and header.version >= 3:
+                # Reads as zeros, which is what unwritten clusters become
+                continue
+            if offset:
+                if offset % cs:
+                    raise _error('Misaligned qcow2 data cluster at {0}',
+                                 offset)
+                self._add_role(offset // cs, 'data', guest + i * cs)
+
+    def _parse_refcount(self, _first, data):
+        cs = self.header.cluster_size
+        for entry in struct.unpack('>%dQ' % (len(data) // 8), data):
+            offset = entry & _OFFSET_MASK
+            if offset:
+                self._add_role(offset // cs, 'skip', None)
+
+    def _process(self, data, roles):
+        for kind, arg in roles:
+            if kind == 'l1':
+                self._parse_l1(arg, data)
+            elif kind == 'l2':
+                self._parse_l2(arg, data)
+            elif kind == 'refcount':
+                self._parse_refcount(arg, data)
+            elif kind == 'data':
+                self._write(arg, data)
+
+    def _receive(self, index, data):
+        roles = self._roles.get(index)
+        extents = self._extents.get(index)
+        if roles:
+            self._process(data, roles)
+        for extent in extents or ():
+            self._feed_extent(extent, index, data)
+        if roles or (extents and self._covered(index, data)):
+            return
+
+        # Nothing known refers to this cluster (yet)
+        self._pending[index] = data
+        self._pending_bytes += len(data)
+        if self._pending_bytes > self.max_pending:
+            raise _error('More than {0} bytes of the qcow2 image arrived '
+                         'before the tables referencing them; this image '
+                         'cannot be streamed', self.max_pending)
+
+    def _consume(self, final=False):
+        cs = self.header.cluster_size
+        pos = 0
+        while len(self._buf) - pos >= cs or (final and pos < len(self._buf)):
+            data = bytes(self._buf[pos:pos + cs])
+            pos += cs
+            self._receive(self._next, data)
+            self._next += 1
+        del self._buf[:pos]
+
+    def feed(self, chunk):
+        """Feed the next chunk of the qcow2 image."""
+        self._buf += chunk
+        if self.header is None:
+            if len(self._buf) < _HEADER_SIZE:
+                return
+            self._parse_header()
+        self._consume()
+
+    def finish(self):
+        """Process the end of the image and fill the holes with zeros.
+
+        :raises: ImageConversionError if the image is truncated.
+        """
+        if self.header is None:
+            if not self._buf.startswith(MAGIC):
+                raise _error('Image is not in qcow2 format')
+            raise _error('qcow2 image is truncated')
+        self._consume(final=True)
+
+        # A compressed cluster's length is an upper bound and may run past
+        # the end of the file
+        end = self._next * self.header.cluster_size
+        for extents in self._extents.values():
+            for extent in extents:
+                if extent.data is not None and extent.end > end:
+                    self._decompress(extent)
+
+        missing = [i for i in self._roles if i >= self._next]
+        if missing:
+            raise _error('qcow2 image is truncated, host cluster {0} is '
+                         'missing', min(missing))
+        if self._pending:
+            LOG.debug('Ignored %d unreferenced qcow2 clusters',
+                      len(self._pending))
+
+        self._fill_holes()
+
+    def _fill_holes(self):
+        cs = self.header.cluster_size
+        pos = self._written.find(b'\0')
+        while pos != -1:
+            end = self._written.find(b'\1', pos)
+            if end == -1:
+                end = len(self._written)
+            offset = pos * cs
+            self.writer.write_zeroes(offset,
+                                     min(end * cs, self.header.size) - offset)
+            pos = self._written.find(b'\0', end)
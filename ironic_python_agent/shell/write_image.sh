@@ -22,15 +22,18 @@ log() {
 
 usage() {
   [[ -z "$1" ]] || echo -e "USAGE ERROR: $@\n"
-  echo "`basename $0`: IMAGEFILE DEVICE"
+  echo "`basename $0`: IMAGEFILE DEVICE [FORMAT]"
   echo "  - This script images DEVICE with IMAGEFILE"
+  echo "  - FORMAT is the qemu-img format of IMAGEFILE, probed if not given"
   exit 1
 }
 
 IMAGEFILE="$1"
 DEVICE="$2"
+FORMAT="$3"
 
-[[ -f $IMAGEFILE ]] || usage "$IMAGEFILE (IMAGEFILE) is not a file"
+# IMAGEFILE is a block device when the image was spilled to a scratch disk
+[[ -f $IMAGEFILE || -b $IMAGEFILE ]] || usage "$IMAGEFILE (IMAGEFILE) is not a file"
 [[ -b $DEVICE ]] || usage "$DEVICE (DEVICE) is not a block device"
 
 # In production this will be replaced with secure erasing the drives
@@ -39,7 +42,7 @@ log "Erasing existing mbr from ${DEVICE}"
 dd if=/dev/zero of=$DEVICE bs=512 count=10
 
 log "Imaging $IMAGEFILE to $DEVICE"
-qemu-img convert -t directsync -O host_device $IMAGEFILE $DEVICE
+qemu-img convert -t directsync ${FORMAT:+-f "$FORMAT"} -O host_device $IMAGEFILE $DEVICE
 sync
 
 log "${DEVICE} imaged successfully!"
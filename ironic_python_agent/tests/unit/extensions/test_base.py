@@ -47,10 +47,21 @@ class FakeExtension(base.BaseAgentExtension):
     def second_async_command(self):
         pass
 
+    @base.async_command('fake_progress_command')
+    def fake_progress_command(self):
+        progress = base.current_progress()
+        progress.start(10)
+        progress.add_downloaded(4)
+        progress.add_written(3)
+
     @base.sync_command('other_sync_name')
     def second_sync_command(self):
         pass
 
+    @base.sync_command('fake_concurrent_command', concurrent=True)
+    def fake_concurrent_command(self):
+        return 'adjusted'
+
 
 class FakeAgent(base.ExecuteCommandMixin):
     def __init__(self):
@@ -116,6 +127,26 @@ class TestExecuteCommandMixin(test_base.BaseTestCase):
                          result.command_status)
         self.assertEqual(exc, result.command_error)
 
+    def _start_running_command(self):
+        running = mock.Mock(spec=base.AsyncCommandResult)
+        running.is_done.return_value = False
+        self.agent.command_results['running'] = running
+
+    def test_execute_command_busy(self):
+        self._start_running_command()
+        self.assertRaises(errors.CommandExecutionError,
+                          self.agent.execute_command,
+                          'fake.other_sync_name')
+
+    def test_execute_concurrent_command_busy(self):
+        self._start_running_command()
+        result = self.agent.execute_command('fake.fake_concurrent_command')
+        self.assertEqual('adjusted', result.command_result['result'])
+        # The command still running keeps the agent busy
+        self.assertRaises(errors.CommandExecutionError,
+                          self.agent.execute_command,
+                          'fake.other_sync_name')
+
 
 class TestExtensionDecorators(test_base.BaseTestCase):
     def setUp(self):
@@ -170,6 +201,22 @@ class TestExtensionDecorators(test_base.BaseTestCase):
         self.assertEqual(None, result.command_result)
         self.agent.force_heartbeat.assert_called_once_with()
 
+    def test_async_command_progress(self):
+        result = self.extension.execute('fake_progress_command')
+        result.join()
+        progress = result.serialize()['command_progress']
+        self.assertEqual(10, progress['bytes_total'])
+        self.assertEqual(4, progress['bytes_downloaded'])
+        self.assertEqual(3, progress['bytes_written'])
+
+    def test_async_command_no_progress(self):
+        result = self.extension.execute('fake_async_command', param='v1')
+        result.join()
+        self.assertIsNone(result.serialize()['command_progress'])
+
+    def test_current_progress_outside_command(self):
+        self.assertFalse(base.current_progress().started)
+
     def test_async_command_name(self):
         self.assertEqual(
             'other_async_name',
@@ -212,7 +259,10 @@ class TestExtensionDecorators(test_base.BaseTestCase):
         expected_map = {
             'fake_async_command': self.extension.fake_async_command,
             'fake_sync_command': self.extension.fake_sync_command,
+            'fake_progress_command': self.extension.fake_progress_command,
             'other_async_name': self.extension.second_async_command,
             'other_sync_name': self.extension.second_sync_command,
+            'fake_concurrent_command':
+                self.extension.fake_concurrent_command,
         }
         self.assertEqual(expected_map, self.extension.command_map)
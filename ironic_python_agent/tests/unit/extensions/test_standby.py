@@ -12,15 +12,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import errno
+import gzip
+import hashlib
+import io
+import itertools
 import os
+import stat
+import tempfile
 
 import mock
 from oslo_concurrency import processutils
+from oslo_utils import units
 from oslotest import base as test_base
+import requests
 import six
 
+from ironic_python_agent import bandwidth
+from ironic_python_agent import blockio
+from ironic_python_agent import download
 from ironic_python_agent import errors
+from ironic_python_agent.extensions import base
 from ironic_python_agent.extensions import standby
+from ironic_python_agent import hardware
+from ironic_python_agent import manifest
+from ironic_python_agent import partitions
+from ironic_python_agent import peer
+from ironic_python_agent import progress
+from ironic_python_agent import transport
 
 if six.PY2:
     OPEN_FUNCTION_NAME = '__builtin__.open'
@@ -42,6 +62,13 @@ class TestStandbyExtension(test_base.BaseTestCase):
     def setUp(self):
         super(TestStandbyExtension, self).setUp()
         self.agent_extension = standby.StandbyExtension()
+        zeroing_patcher = mock.patch.object(blockio, 'get_zeroing_support',
+                                            autospec=True)
+        self.zeroing_mock = zeroing_patcher.start()
+        self.addCleanup(zeroing_patcher.stop)
+        self.zeroing_mock.return_value = {'discard': False,
+                                          'discard_zeroes_data': False,
+                                          'write_zeroes': True}
 
     def test_validate_image_info_success(self):
         standby._validate_image_info(None, _build_fake_image_info())
@@ -79,6 +106,148 @@ class TestStandbyExtension(test_base.BaseTestCase):
                           standby._validate_image_info,
                           invalid_info)
 
+    def test_validate_image_info_invalid_download_concurrency(self):
+        for value in (0, -1, 'many'):
+            invalid_info = _build_fake_image_info()
+            invalid_info['download_concurrency'] = value
+
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              standby._validate_image_info,
+                              None, invalid_info)
+
+    def test_validate_image_info_invalid_download_retries(self):
+        for field, value in (('download_retries', -1),
+                             ('download_retries', 1.5),
+                             ('download_retry_interval', -1),
+                             ('download_retry_interval', 'soon')):
+            invalid_info = _build_fake_image_info()
+            invalid_info[field] = value
+
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              standby._validate_image_info,
+                              None, invalid_info)
+
+    def test_validate_image_info_invalid_mirror_selection(self):
+        for field, value in (('mirror_selection', 'random'),
+                             ('min_download_throughput', -1),
+                             ('min_download_throughput', 'fast')):
+            invalid_info = _build_fake_image_info()
+            invalid_info[field] = value
+
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              standby._validate_image_info,
+                              None, invalid_info)
+
+    @mock.patch('os.stat', autospec=True)
+    def test_validate_image_info_additional_devices(self, stat_mock):
+        stat_mock.return_value.st_mode = stat.S_IFBLK | 0o660
+        image_info = _build_fake_image_info()
+        image_info['additional_devices'] = ['/dev/sdb', '/dev/sdc']
+        standby._validate_image_info(None, image_info)
+        stat_mock.assert_has_calls([mock.call('/dev/sdb'),
+                                    mock.call('/dev/sdc')])
+
+    @mock.patch('os.stat', autospec=True)
+    def test_validate_image_info_invalid_additional_devices(self, stat_mock):
+        stat_mock.return_value.st_mode = stat.S_IFBLK | 0o660
+        for value in ('/dev/sdb', [''], [None]):
+            invalid_info = _build_fake_image_info()
+            invalid_info['additional_devices'] = value
+
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              standby._validate_image_info,
+                              None, invalid_info)
+
+        # A mistyped device would be written to a new file in /dev
+        for error in (None, OSError(errno.ENOENT, 'No such file')):
+            stat_mock.return_value.st_mode = stat.S_IFREG | 0o644
+            stat_mock.side_effect = error
+            invalid_info = _build_fake_image_info()
+            invalid_info['additional_devices'] = ['/dev/sdb', '/dev/sbc']
+            self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                    'not a block device',
+                                    standby._validate_image_info,
+                                    None, invalid_info)
+        stat_mock.side_effect = None
+
+        stat_mock.return_value.st_mode = stat.S_IFBLK | 0o660
+        invalid_info = _build_fake_image_info()
+        invalid_info['additional_devices'] = ['/dev/sdb']
+        invalid_info['image_delta'] = True
+        invalid_info['block_manifest'] = 'http://example.org/manifest'
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                'additional_devices',
+                                standby._validate_image_info,
+                                None, invalid_info)
+
+    def test_validate_image_info_invalid_peers(self):
+        for field, value in (('peers', 'http://peer'),
+                             ('peers', [1]),
+                             ('peer_piece_size', 0)):
+            invalid_info = _build_fake_image_info()
+            invalid_info[field] = value
+
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              standby._validate_image_info,
+                              None, invalid_info)
+
+    def test_validate_image_info_invalid_write_queue_depth(self):
+        for value in (0, '4'):
+            invalid_info = _build_fake_image_info()
+            invalid_info['write_queue_depth'] = value
+            self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                    'write_queue_depth',
+                                    standby._validate_image_info,
+                                    None, invalid_info)
+
+    def test_validate_image_info_invalid_max_download_rate(self):
+        for value in (-1, '10', True):
+            invalid_info = _build_fake_image_info()
+            invalid_info['max_download_rate'] = value
+            self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                    'max_download_rate',
+                                    standby._validate_image_info,
+                                    None, invalid_info)
+
+    def test_validate_image_info_invalid_image_delta(self):
+        invalid_info = _build_fake_image_info()
+        invalid_info['image_delta'] = True
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                'block_manifest',
+                                standby._validate_image_info,
+                                None, invalid_info)
+
+        invalid_info['block_manifest'] = 'http://example.org/manifest'
+        invalid_info['disk_format'] = 'qcow2'
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                'uncompressed raw',
+                                standby._validate_image_info,
+                                None, invalid_info)
+
+    def test_validate_image_info_invalid_stream_qcow2_images(self):
+        invalid_info = _build_fake_image_info()
+        invalid_info['stream_qcow2_images'] = 'yes'
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                'stream_qcow2_images',
+                                standby._validate_image_info,
+                                None, invalid_info)
+
+    def test_validate_image_info_invalid_compression(self):
+        invalid_info = _build_fake_image_info()
+        invalid_info['compression'] = 'rar'
+
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info,
+                          None, invalid_info)
+
+    def test_validate_image_info_invalid_zero_handling(self):
+        invalid_info = _build_fake_image_info()
+        invalid_info['zero_handling'] = 'shred'
+
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info,
+                          None, invalid_info)
+
     def test_validate_image_info_empty_checksum(self):
         invalid_info = _build_fake_image_info()
         invalid_info['checksum'] = ''
@@ -87,6 +256,35 @@ class TestStandbyExtension(test_base.BaseTestCase):
                           standby._validate_image_info,
                           invalid_info)
 
+    def test_validate_image_info_os_hash(self):
+        image_info = _build_fake_image_info()
+        del image_info['checksum']
+        image_info['os_hash_algo'] = 'sha512'
+        image_info['os_hash_value'] = 'fake-sha512'
+        standby._validate_image_info(None, image_info)
+
+    def test_validate_image_info_os_hash_invalid(self):
+        image_info = _build_fake_image_info()
+        image_info['os_hash_algo'] = 'sha512'
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                'os_hash_value',
+                                standby._validate_image_info,
+                                None, image_info)
+
+        image_info['os_hash_algo'] = 'crc1'
+        image_info['os_hash_value'] = 'fake'
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                'crc1 is not supported',
+                                standby._validate_image_info,
+                                None, image_info)
+
+        # Variable length digests are not supported
+        image_info['os_hash_algo'] = 'shake_128'
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                'shake_128 is not supported',
+                                standby._validate_image_info,
+                                None, image_info)
+
     def test_cache_image_invalid_image_list(self):
         self.assertRaises(errors.InvalidCommandParamsError,
                           self.agent_extension.cache_image,
@@ -121,92 +319,32 @@ class TestStandbyExtension(test_base.BaseTestCase):
 
         execute_mock.assert_called_once_with(*command, check_exit_code=[0])
 
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_write_image_spilled(self, execute_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'vhd'
+        execute_mock.return_value = ('', '')
+
+        standby._write_image(image_info, '/dev/sda', image='/dev/sdb')
+        # The format of the scratch disk is not probed
+        execute_mock.assert_called_once_with(
+            '/bin/bash', standby._path_to_script('shell/write_image.sh'),
+            '/dev/sdb', '/dev/sda', 'vpc', check_exit_code=[0])
+
     def test_configdrive_is_url(self):
         self.assertTrue(standby._configdrive_is_url('http://some/url'))
         self.assertTrue(standby._configdrive_is_url('https://some/url'))
         self.assertFalse(standby._configdrive_is_url('ftp://some/url'))
         self.assertFalse(standby._configdrive_is_url('binary-blob'))
 
-    @mock.patch.object(standby, '_write_configdrive_to_file')
-    @mock.patch('requests.get', autospec=True)
-    def test_download_configdrive_to_file(self, get_mock, write_mock):
-        url = 'http://swift/configdrive'
-        get_mock.return_value.content = 'data'
-        standby._download_configdrive_to_file(url, 'filename')
-        get_mock.assert_called_once_with(url)
-        write_mock.assert_called_once_with('data', 'filename')
-
-    @mock.patch('gzip.GzipFile', autospec=True)
-    @mock.patch(OPEN_FUNCTION_NAME, autospec=True)
-    @mock.patch('base64.b64decode', autospec=True)
-    def test_write_configdrive_to_file(self, b64_mock, open_mock, gzip_mock):
-        open_mock.return_value.__enter__ = lambda s: s
-        open_mock.return_value.__exit__ = mock.Mock()
-        write_mock = open_mock.return_value.write
-        gzip_read_mock = gzip_mock.return_value.read
-        gzip_read_mock.return_value = 'ungzipped'
-        b64_mock.return_value = 'configdrive_data'
-        filename = standby._configdrive_location()
-
-        standby._write_configdrive_to_file('b64data', filename)
-        open_mock.assert_called_once_with(filename, 'wb')
-        gzip_read_mock.assert_called_once_with()
-        write_mock.assert_called_once_with('ungzipped')
-
-    @mock.patch('os.stat', autospec=True)
-    @mock.patch(('ironic_python_agent.extensions.standby.'
-                 '_write_configdrive_to_file'),
-                autospec=True)
-    @mock.patch(OPEN_FUNCTION_NAME, autospec=True)
-    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
-    def test_write_configdrive_to_partition(self, execute_mock, open_mock,
-                                            configdrive_mock, stat_mock):
-        device = '/dev/sda'
-        configdrive = standby._configdrive_location()
-        script = standby._path_to_script('shell/copy_configdrive_to_disk.sh')
-        command = ['/bin/bash', script, configdrive, device]
-        execute_mock.return_value = ('', '')
-        stat_mock.return_value.st_size = 5
-
-        standby._write_configdrive_to_partition(configdrive, device)
-        execute_mock.assert_called_once_with(*command, check_exit_code=[0])
-
-        execute_mock.reset_mock()
-        execute_mock.return_value = ('', '')
-        execute_mock.side_effect = processutils.ProcessExecutionError
-
-        self.assertRaises(errors.ConfigDriveWriteError,
-                          standby._write_configdrive_to_partition,
-                          configdrive,
-                          device)
-
-        execute_mock.assert_called_once_with(*command, check_exit_code=[0])
-
-    @mock.patch('os.stat', autospec=True)
-    @mock.patch(('ironic_python_agent.extensions.standby.'
-                 '_write_configdrive_to_file'),
-                autospec=True)
-    @mock.patch(OPEN_FUNCTION_NAME, autospec=True)
-    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
-    def test_write_configdrive_too_large(self, execute_mock, open_mock,
-                                         configdrive_mock, stat_mock):
-        device = '/dev/sda'
-        configdrive = standby._configdrive_location()
-        stat_mock.return_value.st_size = 65 * 1024 * 1024
-
-        self.assertRaises(errors.ConfigDriveTooLargeError,
-                          standby._write_configdrive_to_partition,
-                          configdrive,
-                          device)
-
     @mock.patch('hashlib.md5')
     @mock.patch(OPEN_FUNCTION_NAME)
-    @mock.patch('requests.get')
+    @mock.patch.object(transport, 'get')
     def test_download_image(self, requests_mock, open_mock, md5_mock):
         image_info = _build_fake_image_info()
         response = requests_mock.return_value
         response.status_code = 200
-        response.iter_content.return_value = ['some', 'content']
+        response.iter_content.return_value = [b'some', b'content']
         file_mock = mock.Mock()
         open_mock.return_value.__enter__.return_value = file_mock
         file_mock.read.return_value = None
@@ -217,13 +355,42 @@ class TestStandbyExtension(test_base.BaseTestCase):
         requests_mock.assert_called_once_with(image_info['urls'][0],
                                               stream=True, proxies={})
         write = file_mock.write
-        write.assert_any_call('some')
-        write.assert_any_call('content')
+        write.assert_any_call(b'some')
+        write.assert_any_call(b'content')
         self.assertEqual(write.call_count, 2)
 
+    @mock.patch.object(peer, 'share', autospec=True)
+    @mock.patch.object(transport, 'get')
+    def test_download_image_compressed_not_shared(self, requests_mock,
+                                                  share_mock):
+        out = io.BytesIO()
+        with gzip.GzipFile(fileobj=out, mode='wb') as f:
+            f.write(b'some content')
+        compressed = out.getvalue()
+        image_info = _build_fake_image_info()
+        image_info['peer_mode'] = True
+        image_info['checksum'] = hashlib.md5(compressed).hexdigest()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [compressed]
+        fd, location = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, location)
+
+        with mock.patch.object(standby, '_image_location', autospec=True,
+                               return_value=location):
+            stats = standby._download_image(image_info)
+        self.assertEqual('gzip', stats['compression'])
+        with open(location, 'rb') as f:
+            self.assertEqual(b'some content', f.read())
+        # Peers would get the decompressed file under a manifest of the
+        # compressed one
+        self.assertFalse(share_mock.called)
+
     @mock.patch('hashlib.md5')
     @mock.patch(OPEN_FUNCTION_NAME)
-    @mock.patch('requests.get')
+    @mock.patch.object(transport, 'get')
     @mock.patch.dict(os.environ, {})
     def test_download_image_proxy(
             self, requests_mock, open_mock, md5_mock):
@@ -235,7 +402,7 @@ class TestStandbyExtension(test_base.BaseTestCase):
         image_info['no_proxy'] = no_proxy
         response = requests_mock.return_value
         response.status_code = 200
-        response.iter_content.return_value = ['some', 'content']
+        response.iter_content.return_value = [b'some', b'content']
         file_mock = mock.Mock()
         open_mock.return_value.__enter__.return_value = file_mock
         file_mock.read.return_value = None
@@ -247,11 +414,11 @@ class TestStandbyExtension(test_base.BaseTestCase):
         requests_mock.assert_called_once_with(image_info['urls'][0],
                                               stream=True, proxies=proxies)
         write = file_mock.write
-        write.assert_any_call('some')
-        write.assert_any_call('content')
+        write.assert_any_call(b'some')
+        write.assert_any_call(b'content')
         self.assertEqual(write.call_count, 2)
 
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(transport, 'get', autospec=True)
     def test_download_image_bad_status(self, requests_mock):
         image_info = _build_fake_image_info()
         response = requests_mock.return_value
@@ -262,7 +429,7 @@ class TestStandbyExtension(test_base.BaseTestCase):
 
     @mock.patch('hashlib.md5', autospec=True)
     @mock.patch(OPEN_FUNCTION_NAME, autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(transport, 'get', autospec=True)
     def test_download_image_verify_fails(self, requests_mock, open_mock,
                                          md5_mock):
         image_info = _build_fake_image_info()
@@ -302,8 +469,8 @@ class TestStandbyExtension(test_base.BaseTestCase):
         dispatch_mock.return_value = 'manager'
         async_result = self.agent_extension.cache_image(image_info=image_info)
         async_result.join()
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, location=None)
+        write_mock.assert_called_once_with(image_info, 'manager', image=None)
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertEqual(self.agent_extension.cached_image_id,
                          image_info['id'])
@@ -313,6 +480,51 @@ class TestStandbyExtension(test_base.BaseTestCase):
                       ).format(image_info['id'], 'manager')
         self.assertEqual(cmd_result, async_result.command_result['result'])
 
+    @mock.patch('ironic_python_agent.extensions.standby._image_present',
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_cache_image_present(self, download_mock, write_mock,
+                                 dispatch_mock, present_mock):
+        image_info = _build_fake_image_info()
+        image_info['skip_if_present'] = True
+        dispatch_mock.return_value = 'manager'
+        present_mock.return_value = True
+        async_result = self.agent_extension.cache_image(image_info=image_info)
+        async_result.join()
+        present_mock.assert_called_once_with(image_info, 'manager')
+        self.assertFalse(download_mock.called)
+        self.assertFalse(write_mock.called)
+        self.assertEqual(image_info['id'],
+                         self.agent_extension.cached_image_id)
+        cmd_result = ('cache_image: image ({0}) already present on device '
+                      '{1}').format(image_info['id'], 'manager')
+        self.assertEqual(cmd_result, async_result.command_result['result'])
+
+    @mock.patch('ironic_python_agent.extensions.standby._image_present',
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_cache_image_not_present(self, download_mock, write_mock,
+                                     dispatch_mock, present_mock):
+        image_info = _build_fake_image_info()
+        image_info['skip_if_present'] = True
+        dispatch_mock.return_value = 'manager'
+        download_mock.return_value = None
+        present_mock.return_value = False
+        async_result = self.agent_extension.cache_image(image_info=image_info)
+        async_result.join()
+        download_mock.assert_called_once_with(image_info, location=None)
+        write_mock.assert_called_once_with(image_info, 'manager', image=None)
+
     @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
                 autospec=True)
     @mock.patch('ironic_python_agent.extensions.standby._write_image',
@@ -330,8 +542,8 @@ class TestStandbyExtension(test_base.BaseTestCase):
             image_info=image_info, force=True
         )
         async_result.join()
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, location=None)
+        write_mock.assert_called_once_with(image_info, 'manager', image=None)
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertEqual(self.agent_extension.cached_image_id,
                          image_info['id'])
@@ -376,17 +588,14 @@ class TestStandbyExtension(test_base.BaseTestCase):
                 autospec=True)
     @mock.patch('ironic_python_agent.extensions.standby._download_image',
                 autospec=True)
-    @mock.patch('ironic_python_agent.extensions.standby._configdrive_location',
-                autospec=True)
     def test_prepare_image(self,
-                           location_mock,
                            download_mock,
                            write_mock,
                            dispatch_mock,
                            configdrive_copy_mock):
         image_info = _build_fake_image_info()
-        location_mock.return_value = '/tmp/configdrive'
-        download_mock.return_value = None
+        stats = {'hash_algo': 'md5', 'stages': []}
+        download_mock.return_value = stats
         write_mock.return_value = None
         dispatch_mock.return_value = 'manager'
         configdrive_copy_mock.return_value = None
@@ -397,8 +606,8 @@ class TestStandbyExtension(test_base.BaseTestCase):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, location=None)
+        write_mock.assert_called_once_with(image_info, 'manager', image=None)
         dispatch_mock.assert_called_once_with('get_os_install_device')
         configdrive_copy_mock.assert_called_once_with('configdrive_data',
                                                       'manager')
@@ -408,6 +617,8 @@ class TestStandbyExtension(test_base.BaseTestCase):
         cmd_result = ('prepare_image: image ({0}) written to device {1}'
                       ).format(image_info['id'], 'manager')
         self.assertEqual(cmd_result, async_result.command_result['result'])
+        self.assertEqual(stats,
+                         async_result.command_result['transfer_stats'])
 
         download_mock.reset_mock()
         write_mock.reset_mock()
@@ -456,8 +667,8 @@ class TestStandbyExtension(test_base.BaseTestCase):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, location=None)
+        write_mock.assert_called_once_with(image_info, 'manager', image=None)
         dispatch_mock.assert_called_once_with('get_os_install_device')
 
         self.assertEqual(configdrive_copy_mock.call_count, 0)
@@ -478,7 +689,7 @@ class TestStandbyExtension(test_base.BaseTestCase):
                 '._stream_raw_image_onto_device', autospec=True)
     def _test_prepare_image_raw(self, image_info, stream_mock,
                                 cache_write_mock, dispatch_mock,
-                                configdrive_copy_mock):
+                                configdrive_copy_mock, streamed=None):
         dispatch_mock.return_value = '/dev/foo'
         configdrive_copy_mock.return_value = None
 
@@ -492,7 +703,9 @@ class TestStandbyExtension(test_base.BaseTestCase):
         self.assertFalse(configdrive_copy_mock.called)
 
         # Assert we've streamed the image or not
-        if image_info['stream_raw_images']:
+        if streamed is None:
+            streamed = image_info['stream_raw_images']
+        if streamed:
             stream_mock.assert_called_once_with(mock.ANY, image_info,
                                                 '/dev/foo')
             self.assertFalse(cache_write_mock.called)
@@ -513,6 +726,20 @@ class TestStandbyExtension(test_base.BaseTestCase):
         image_info['stream_raw_images'] = False
         self._test_prepare_image_raw(image_info)
 
+    def test_prepare_image_qcow2_stream_true(self):
+        # qcow2 images are only streamed on request
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'qcow2'
+        image_info['stream_raw_images'] = True
+        self._test_prepare_image_raw(image_info, streamed=False)
+
+    def test_prepare_image_qcow2_stream_qcow2_images(self):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'qcow2'
+        image_info['stream_raw_images'] = True
+        image_info['stream_qcow2_images'] = True
+        self._test_prepare_image_raw(image_info)
+
     @mock.patch('ironic_python_agent.utils.execute', autospec=True)
     def test_run_image(self, execute_mock):
         script = standby._path_to_script('shell/shutdown.sh')
@@ -561,6 +788,56 @@ class TestStandbyExtension(test_base.BaseTestCase):
         execute_mock.assert_called_once_with(*command, check_exit_code=[0])
         self.assertEqual('FAILED', failed_result.command_status)
 
+    @mock.patch.object(bandwidth, 'set_download_rate', autospec=True)
+    def test_set_download_rate(self, set_mock):
+        with mock.patch.object(bandwidth, 'get_download_rate',
+                               autospec=True, return_value=12.5):
+            result = self.agent_extension.set_download_rate(rate=12.5)
+        set_mock.assert_called_once_with(12.5)
+        self.assertEqual('SUCCEEDED', result.command_status)
+        self.assertEqual({'max_download_rate': 12.5}, result.command_result)
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                'Download rate',
+                                self.agent_extension.set_download_rate,
+                                rate=-1)
+        # Only the parameters of the command are accepted
+        self.assertRaises(TypeError, self.agent_extension.set_download_rate,
+                          rate=-1, name='x')
+        self.assertEqual(1, set_mock.call_count)
+        self.assertTrue(
+            self.agent_extension.command_map['set_download_rate'].concurrent)
+
+    @mock.patch.object(bandwidth, 'set_download_rate', autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch.object(standby.StandbyExtension, '_cache_and_write_image',
+                       autospec=True)
+    def test_cache_image_download_rate(self, cache_mock, dispatch_mock,
+                                       set_mock):
+        image_info = _build_fake_image_info()
+        cache_mock.return_value = None
+        self.agent_extension.cache_image(image_info=image_info).join()
+        self.assertFalse(set_mock.called)
+
+        image_info['max_download_rate'] = 0
+        self.agent_extension.cache_image(image_info=image_info,
+                                         force=True).join()
+        set_mock.assert_called_once_with(0)
+
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_cache_and_write_image_additional_devices(self, download_mock,
+                                                      write_mock):
+        image_info = _build_fake_image_info()
+        image_info['additional_devices'] = ['/dev/bar', '/dev/foo']
+        self.agent_extension._cache_and_write_image(image_info, '/dev/foo')
+        download_mock.assert_called_once_with(image_info, location=None)
+        self.assertEqual([mock.call(image_info, '/dev/foo', image=None),
+                          mock.call(image_info, '/dev/bar', image=None)],
+                         write_mock.call_args_list)
+
     @mock.patch('ironic_python_agent.extensions.standby._write_image',
                 autospec=True)
     @mock.patch('ironic_python_agent.extensions.standby._download_image',
@@ -569,42 +846,136 @@ class TestStandbyExtension(test_base.BaseTestCase):
         image_info = _build_fake_image_info()
         device = '/dev/foo'
         self.agent_extension._cache_and_write_image(image_info, device)
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, device)
+        download_mock.assert_called_once_with(image_info, location=None)
+        write_mock.assert_called_once_with(image_info, device, image=None)
 
     @mock.patch('hashlib.md5')
-    @mock.patch(OPEN_FUNCTION_NAME)
-    @mock.patch('requests.get')
-    def test_stream_raw_image_onto_device(self, requests_mock, open_mock,
+    @mock.patch('ironic_python_agent.blockio.DirectWriter', autospec=True)
+    @mock.patch.object(transport, 'get')
+    def test_stream_raw_image_onto_device_progress(self, requests_mock,
+                                                   writer_mock, md5_mock):
+        image_info = _build_fake_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Content-Length': '11'}
+        response.iter_content.return_value = [b'some', b'content']
+        writer_mock.return_value.bytes_written = 11
+        writer_mock.return_value.bytes_skipped = 0
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+        tracker = progress.Progress()
+
+        with mock.patch.object(base, 'current_progress', autospec=True,
+                               return_value=tracker):
+            self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                               '/dev/foo')
+        self.assertEqual(11, tracker.bytes_total)
+        self.assertEqual(11, tracker.bytes_downloaded)
+        self.assertEqual(11, tracker.bytes_written)
+        self.assertEqual(0, tracker.eta)
+
+    @mock.patch.object(peer, 'share', autospec=True)
+    @mock.patch('hashlib.md5')
+    @mock.patch('ironic_python_agent.blockio.DirectWriter', autospec=True)
+    @mock.patch.object(transport, 'get')
+    def test_stream_raw_image_onto_device_peer_mode(self, requests_mock,
+                                                    writer_mock, md5_mock,
+                                                    share_mock):
+        image_info = _build_fake_image_info()
+        image_info['peer_mode'] = True
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'some', b'content']
+        writer_mock.return_value.bytes_written = 11
+        writer_mock.return_value.bytes_skipped = 0
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+
+        stats = self.agent_extension._stream_raw_image_onto_device(
+            image_info, '/dev/foo')
+        self.assertEqual(['receive', 'hash', 'pieces', 'decompress',
+                          'write'],
+                         [stage['name'] for stage in stats['stages']])
+        self.assertEqual('none', stats['compression'])
+        share_mock.assert_called_once_with('fake_id', '/dev/foo', mock.ANY)
+        pieces = share_mock.call_args[0][2]
+        self.assertEqual(11, pieces.size)
+
+    @mock.patch('hashlib.md5')
+    @mock.patch('ironic_python_agent.blockio.DirectWriter', autospec=True)
+    @mock.patch.object(transport, 'get')
+    def test_stream_raw_image_onto_device(self, requests_mock, writer_mock,
                                           md5_mock):
         image_info = _build_fake_image_info()
         response = requests_mock.return_value
         response.status_code = 200
-        response.iter_content.return_value = ['some', 'content']
-        file_mock = mock.Mock()
-        open_mock.return_value.__enter__.return_value = file_mock
-        file_mock.read.return_value = None
+        response.iter_content.return_value = [b'some', b'content']
+        file_mock = writer_mock.return_value
+        file_mock.bytes_written = 11
+        file_mock.bytes_skipped = 0
         hexdigest_mock = md5_mock.return_value.hexdigest
         hexdigest_mock.return_value = image_info['checksum']
 
-        self.agent_extension._stream_raw_image_onto_device(image_info,
-                                                           '/dev/foo')
+        stats = self.agent_extension._stream_raw_image_onto_device(
+            image_info, '/dev/foo')
         requests_mock.assert_called_once_with(image_info['urls'][0],
                                               stream=True, proxies={})
-        expected_calls = [mock.call('some'), mock.call('content')]
+        writer_mock.assert_called_once_with('/dev/foo',
+                                            zero_handling='zeroout')
+        expected_calls = [mock.call(b'some'), mock.call(b'content')]
         file_mock.write.assert_has_calls(expected_calls)
+        self.assertEqual('md5', stats['hash_algo'])
+        self.assertEqual(['receive', 'hash', 'decompress', 'write'],
+                         [stage['name'] for stage in stats['stages']])
+        self.assertEqual(11, stats['stages'][1]['bytes'])
+        self.assertEqual(11, stats['bytes_written'])
+
+    def test_zero_handling(self):
+        image_info = _build_fake_image_info()
+        self.assertEqual(blockio.ZERO_ZEROOUT,
+                         standby._zero_handling(image_info, '/dev/foo'))
+        self.zeroing_mock.assert_called_once_with('/dev/foo')
+
+        self.zeroing_mock.return_value['write_zeroes'] = False
+        self.assertEqual(blockio.ZERO_WRITE,
+                         standby._zero_handling(image_info, '/dev/foo'))
+
+        image_info['zero_handling'] = blockio.ZERO_DISCARD
+        self.assertEqual(blockio.ZERO_DISCARD,
+                         standby._zero_handling(image_info, '/dev/foo'))
+        self.assertEqual(2, self.zeroing_mock.call_count)
 
     @mock.patch('hashlib.md5')
-    @mock.patch(OPEN_FUNCTION_NAME)
-    @mock.patch('requests.get')
+    @mock.patch('ironic_python_agent.blockio.DirectWriter', autospec=True)
+    @mock.patch.object(transport, 'get')
+    def test_stream_raw_image_onto_device_no_write_zeroes(self,
+                                                          requests_mock,
+                                                          writer_mock,
+                                                          md5_mock):
+        self.zeroing_mock.return_value['write_zeroes'] = False
+        image_info = _build_fake_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'some', b'content']
+        writer_mock.return_value.bytes_written = 11
+        writer_mock.return_value.bytes_skipped = 0
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           '/dev/foo')
+        writer_mock.assert_called_once_with('/dev/foo',
+                                            zero_handling='write')
+
+    @mock.patch('hashlib.md5')
+    @mock.patch('ironic_python_agent.blockio.DirectWriter', autospec=True)
+    @mock.patch.object(transport, 'get')
     def test_stream_raw_image_onto_device_write_error(self, requests_mock,
-                                                      open_mock, md5_mock):
+                                                      writer_mock, md5_mock):
         image_info = _build_fake_image_info()
         response = requests_mock.return_value
         response.status_code = 200
-        response.iter_content.return_value = ['some', 'content']
-        file_mock = mock.Mock()
-        open_mock.return_value.__enter__.return_value = file_mock
+        response.iter_content.return_value = [b'some', b'content']
+        file_mock = writer_mock.return_value
+        file_mock.bytes_written = 11
+        file_mock.bytes_skipped = 0
         file_mock.write.side_effect = Exception('Surprise!!!1!')
         hexdigest_mock = md5_mock.return_value.hexdigest
         hexdigest_mock.return_value = image_info['checksum']
@@ -615,13 +986,293 @@ class TestStandbyExtension(test_base.BaseTestCase):
         requests_mock.assert_called_once_with(image_info['urls'][0],
                                               stream=True, proxies={})
         # Assert write was only called once and failed!
-        file_mock.write.assert_called_once_with('some')
+        file_mock.write.assert_called_once_with(b'some')
+
+    @mock.patch('hashlib.md5')
+    @mock.patch('ironic_python_agent.blockio.DirectWriter', autospec=True)
+    @mock.patch.object(transport, 'get')
+    def test_stream_raw_image_onto_device_compressed(self, requests_mock,
+                                                     writer_mock, md5_mock):
+        image_info = _build_fake_image_info()
+        out = io.BytesIO()
+        with gzip.GzipFile(fileobj=out, mode='wb') as f:
+            f.write(b'some content')
+        compressed = out.getvalue()
+        chunks = [compressed[:1], compressed[1:]]
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = chunks
+        file_mock = writer_mock.return_value
+        file_mock.bytes_written = 11
+        file_mock.bytes_skipped = 0
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           '/dev/foo')
+        # The checksum is computed on the compressed data
+        md5_mock.return_value.update.assert_has_calls(
+            [mock.call(c) for c in chunks])
+        written = b''.join(c[0][0] for c in file_mock.write.call_args_list)
+        self.assertEqual(b'some content', written)
+
+    @mock.patch('hashlib.md5')
+    @mock.patch('ironic_python_agent.qcow2.StreamConverter', autospec=True)
+    @mock.patch('ironic_python_agent.blockio.PositionalWriter', autospec=True)
+    @mock.patch.object(transport, 'get')
+    def test_stream_qcow2_image_onto_device(self, requests_mock, writer_mock,
+                                            converter_mock, md5_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'qcow2'
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'QFI\xfb', b'content']
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+        converter = converter_mock.return_value
+        writer_mock.return_value.bytes_written = 11
+        writer_mock.return_value.bytes_skipped = 0
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           '/dev/foo')
+        writer_mock.assert_called_once_with('/dev/foo',
+                                            zero_handling='zeroout')
+        converter_mock.assert_called_once_with(writer_mock.return_value)
+        converter.feed.assert_has_calls([mock.call(b'QFI\xfb'),
+                                         mock.call(b'content')])
+        converter.finish.assert_called_once_with()
+        writer_mock.return_value.close.assert_called_once_with(flush=True)
+
+
+@mock.patch.object(partitions, 'find_or_create_configdrive', autospec=True)
+class TestWriteConfigdrive(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestWriteConfigdrive, self).setUp()
+        fd, self.disk = tempfile.mkstemp()
+        os.write(fd, b'x' * 300000)
+        os.close(fd)
+        self.addCleanup(os.unlink, self.disk)
+        self.partition = partitions.Partition(2, 65536, 200000)
+        self.iso = os.urandom(100000)
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+            f.write(self.iso)
+        self.configdrive = base64.encodestring(compressed.getvalue()) \
+            if six.PY2 else base64.encodebytes(compressed.getvalue())
+        self.configdrive = self.configdrive.decode('ascii')
+
+    def _check_partition(self):
+        with open(self.disk, 'rb') as f:
+            data = f.read()
+        self.assertEqual(b'x' * 65536 + self.iso + b'x' * 134464, data)
+
+    def test_base64_decoder(self, find_mock):
+        decoder = standby._Base64Decoder()
+        data = b''.join(decoder.decode(self.configdrive[i:i + 7])
+                        for i in range(0, len(self.configdrive), 7))
+        data += decoder.flush()
+        self.assertEqual(base64.b64decode(self.configdrive), data)
+
+    @mock.patch.object(standby, 'CONFIGDRIVE_CHUNK_SIZE', 1000)
+    def test_write_configdrive_to_partition(self, find_mock):
+        find_mock.return_value = self.partition
+
+        standby._write_configdrive_to_partition(self.configdrive, self.disk)
+        find_mock.assert_called_once_with(self.disk)
+        self._check_partition()
+
+    @mock.patch.object(transport, 'get', autospec=True)
+    def test_write_configdrive_from_url(self, get_mock, find_mock):
+        find_mock.return_value = self.partition
+        get_mock.return_value = _response(
+            200, [self.configdrive[i:i + 4096].encode('ascii')
+                  for i in range(0, len(self.configdrive), 4096)])
+
+        standby._write_configdrive_to_partition('http://swift/configdrive',
+                                                self.disk)
+        get_mock.assert_called_once_with('http://swift/configdrive',
+                                         stream=True, timeout=mock.ANY)
+        self._check_partition()
+
+    @mock.patch.object(transport, 'get', autospec=True)
+    def test_write_configdrive_url_error(self, get_mock, find_mock):
+        get_mock.return_value = _response(404, [])
+
+        self.assertRaises(errors.ConfigDriveDownloadError,
+                          standby._write_configdrive_to_partition,
+                          'http://swift/configdrive', self.disk)
+        # No partition was created
+        self.assertFalse(find_mock.called)
+
+    def test_write_configdrive_partition_error(self, find_mock):
+        find_mock.side_effect = errors.PartitionTableError('no room')
+
+        self.assertRaises(errors.ConfigDrivePartitionError,
+                          standby._write_configdrive_to_partition,
+                          self.configdrive, self.disk)
+
+    @mock.patch.object(standby, 'MAX_CONFIGDRIVE_SIZE', 50000)
+    def test_write_configdrive_too_large(self, find_mock):
+        find_mock.return_value = self.partition
+
+        self.assertRaises(errors.ConfigDriveTooLargeError,
+                          standby._write_configdrive_to_partition,
+                          self.configdrive, self.disk)
+        # Rejected before the partition table was touched
+        self.assertFalse(find_mock.called)
+        with open(self.disk, 'rb') as f:
+            self.assertEqual(b'x' * 300000, f.read())
+
+    @mock.patch.object(standby, 'MAX_ENCODED_CONFIGDRIVE_SIZE', 10000)
+    @mock.patch.object(transport, 'get', autospec=True)
+    def test_write_configdrive_from_url_too_large(self, get_mock, find_mock):
+        get_mock.return_value = _response(
+            200, [self.configdrive[i:i + 4096].encode('ascii')
+                  for i in range(0, len(self.configdrive), 4096)])
+
+        self.assertRaises(errors.ConfigDriveTooLargeError,
+                          standby._write_configdrive_to_partition,
+                          'http://swift/configdrive', self.disk)
+        self.assertFalse(find_mock.called)
+        get_mock.return_value.close.assert_called_once_with()
+
+    def test_write_configdrive_larger_than_partition(self, find_mock):
+        find_mock.return_value = partitions.Partition(2, 65536, 50000)
+
+        self.assertRaises(errors.ConfigDriveTooLargeError,
+                          standby._write_configdrive_to_partition,
+                          self.configdrive, self.disk)
+
+    def test_write_configdrive_invalid(self, find_mock):
+        find_mock.return_value = self.partition
+
+        self.assertRaises(errors.DecompressionError,
+                          standby._write_configdrive_to_partition,
+                          base64.b64encode(b'not gzipped').decode('ascii'),
+                          self.disk)
+        self.assertFalse(find_mock.called)
+
+
+class TestStreamAdditionalDevices(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestStreamAdditionalDevices, self).setUp()
+        self.agent_extension = standby.StandbyExtension()
+        self.devices = []
+        for _i in range(3):
+            fd, path = tempfile.mkstemp()
+            os.close(fd)
+            self.addCleanup(os.unlink, path)
+            self.devices.append(path)
+        self.data = os.urandom(3 * 1024 * 1024 + 5)
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+            f.write(self.data)
+        self.compressed = compressed.getvalue()
+        self.image_info = _build_fake_image_info()
+        self.image_info['checksum'] = hashlib.md5(
+            self.compressed).hexdigest()
+        self.image_info['additional_devices'] = self.devices[1:]
+
+    @mock.patch.object(transport, 'get', autospec=True)
+    def test_stream(self, get_mock):
+        get_mock.return_value = _response(
+            200, [self.compressed[i:i + 65536]
+                  for i in range(0, len(self.compressed), 65536)])
+
+        stats = self.agent_extension._stream_raw_image_onto_device(
+            self.image_info, self.devices[0])
+        for device in self.devices:
+            with open(device, 'rb') as f:
+                self.assertEqual(self.data, f.read())
+        self.assertEqual(['receive', 'hash', 'decompress', 'hash-raw',
+                          'tee'],
+                         [stage['name'] for stage in stats['stages']])
+        self.assertEqual(['write {0}'.format(d) for d in self.devices],
+                         [b['name'] for b in stats['stages'][-1]['branches']])
+        self.assertEqual(self.devices,
+                         [d['device'] for d in stats['devices']])
+
+    @mock.patch.object(transport, 'get', autospec=True)
+    def test_stream_queue_depth(self, get_mock):
+        get_mock.return_value = _response(
+            200, [self.compressed[i:i + 65536]
+                  for i in range(0, len(self.compressed), 65536)])
+        self.image_info['write_queue_depth'] = 4
+
+        with mock.patch.object(standby, '_close_writers',
+                               wraps=standby._close_writers) as close_mock:
+            self.agent_extension._stream_raw_image_onto_device(
+                self.image_info, self.devices[0])
+        writers = close_mock.call_args[0][0]
+        self.assertEqual([blockio.ParallelWriter] * 3,
+                         [type(writer) for writer in writers])
+        self.assertEqual([4] * 3, [w.queue_depth for w in writers])
+        for device in self.devices:
+            with open(device, 'rb') as f:
+                self.assertEqual(self.data, f.read())
+
+    @mock.patch.object(manifest, 'hash_region', autospec=True)
+    @mock.patch.object(transport, 'get', autospec=True)
+    def test_stream_verify_failure(self, get_mock, hash_mock):
+        get_mock.return_value = _response(200, [self.compressed])
+        good = hashlib.md5(self.data).hexdigest()
+        hash_mock.side_effect = lambda device, size, algo: (
+            'bad' if device == self.devices[2] else good)
+
+        self.assertRaisesRegexp(
+            errors.ImageChecksumError, self.devices[2],
+            self.agent_extension._stream_raw_image_onto_device,
+            self.image_info, self.devices[0])
+        self.assertEqual(3, hash_mock.call_count)
 
 
 class TestImageDownload(test_base.BaseTestCase):
 
+    @mock.patch.object(transport, 'get', autospec=True)
+    def test_download_image_os_hash(self, requests_mock):
+        content = [b'SpongeBob', b'SquarePants']
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = content
+
+        image_info = _build_fake_image_info()
+        image_info['os_hash_algo'] = 'sha256'
+        image_info['os_hash_value'] = hashlib.sha256(
+            b'SpongeBobSquarePants').hexdigest()
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, list(image_download))
+        self.assertEqual('sha256', image_download.hash_algo)
+        self.assertEqual(image_info['os_hash_value'],
+                         image_download.hexdigest())
+        standby._verify_image(image_info, '/dev/foo',
+                              image_download.hexdigest())
+        # Kept for compatibility
+        self.assertEqual(image_info['os_hash_value'],
+                         image_download.md5sum())
+
+    @mock.patch.object(bandwidth, 'downloads', autospec=True)
+    @mock.patch.object(transport, 'get', autospec=True)
+    def test_download_image_throttled(self, requests_mock, downloads_mock):
+        bucket = downloads_mock.return_value
+        bucket.consume.return_value = 0.25
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'SpongeBob', b'SquarePants']
+
+        image_download = standby.ImageDownload(_build_fake_image_info())
+        self.assertEqual(b'SpongeBobSquarePants', b''.join(image_download))
+        self.assertEqual([mock.call(9), mock.call(11)],
+                         bucket.consume.call_args_list)
+        self.assertEqual(0.5, image_download.throttled)
+
+    def test_verify_image_os_hash_mismatch(self):
+        image_info = _build_fake_image_info()
+        image_info['os_hash_algo'] = 'sha512'
+        image_info['os_hash_value'] = 'expected'
+        self.assertRaises(errors.ImageChecksumError, standby._verify_image,
+                          image_info, '/dev/foo', image_info['checksum'])
+
     @mock.patch('hashlib.md5', autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(transport, 'get', autospec=True)
     def test_download_image(self, requests_mock, md5_mock):
         content = ['SpongeBob', 'SquarePants']
         response = requests_mock.return_value
@@ -635,4 +1286,730 @@ class TestImageDownload(test_base.BaseTestCase):
         self.assertEqual(content, list(image_download))
         requests_mock.assert_called_once_with(image_info['urls'][0],
                                               stream=True, proxies={})
-        self.assertEqual(image_info['checksum'], image_download.md5sum())
+        self.assertEqual(image_info['checksum'], image_download.hexdigest())
+
+    @mock.patch('ironic_python_agent.download.open_ranged', autospec=True)
+    def test_download_image_ranged(self, open_mock):
+        content = [b'SpongeBob', b'SquarePants']
+        segmented = mock.Mock(spec=download.SegmentedDownload)
+        segmented.iter_content.return_value = content
+        segmented.size = 20
+        open_mock.return_value = segmented
+
+        image_info = _build_fake_image_info()
+        image_info['download_concurrency'] = 4
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, list(image_download))
+        open_mock.assert_called_once_with(image_info['urls'][0], 4,
+                                          segment_size=None, proxies={},
+                                          start=0, mirrors=[])
+
+    @mock.patch('ironic_python_agent.download.open_ranged', autospec=True)
+    def test_download_image_ranged_fallback(self, open_mock):
+        content = [b'SpongeBob', b'SquarePants']
+        response = open_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = content
+
+        image_info = _build_fake_image_info()
+        image_info['download_concurrency'] = 4
+        image_info['download_segment_size'] = 1024
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, list(image_download))
+        open_mock.assert_called_once_with(image_info['urls'][0], 4,
+                                          segment_size=1024, proxies={},
+                                          start=0, mirrors=[])
+
+    @mock.patch('ironic_python_agent.download.open_ranged', autospec=True)
+    def test_download_image_ranged_resume(self, open_mock):
+        def _chunks():
+            yield b'SpongeBob'
+            raise errors.DownloadError('boom')
+
+        first = mock.Mock(spec=download.SegmentedDownload)
+        first.iter_content.return_value = _chunks()
+        first.size = 19
+        second = mock.Mock(spec=download.SegmentedDownload)
+        second.iter_content.return_value = [b'SquarePant']
+        second.size = 19
+        open_mock.side_effect = [first, second]
+
+        image_info = _build_fake_image_info()
+        image_info['download_concurrency'] = 4
+        image_info['download_retry_interval'] = 0
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual([b'SpongeBob', b'SquarePant'], list(image_download))
+        open_mock.assert_called_with(image_info['urls'][0], 4,
+                                     segment_size=None, proxies={}, start=9,
+                                     mirrors=[])
+        first.close.assert_called_once_with()
+
+    @mock.patch('ironic_python_agent.download.open_ranged', autospec=True)
+    def test_download_image_ranged_error(self, open_mock):
+        open_mock.side_effect = errors.DownloadError('boom')
+
+        image_info = _build_fake_image_info()
+        image_info['download_concurrency'] = 4
+        self.assertRaises(errors.ImageDownloadError,
+                          standby.ImageDownload, image_info)
+
+
+def _response(status_code, chunks, headers=None):
+    response = mock.Mock(spec=['status_code', 'headers', 'iter_content',
+                               'close', 'text'])
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.iter_content.return_value = chunks
+    return response
+
+
+def _interrupted(*chunks):
+    for chunk in chunks:
+        yield chunk
+    raise requests.ConnectionError('connection reset')
+
+
+@mock.patch('time.sleep', autospec=True)
+@mock.patch.object(transport, 'get', autospec=True)
+class TestImageDownloadResume(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestImageDownloadResume, self).setUp()
+        self.image_info = _build_fake_image_info()
+        self.image_info['urls'].append('http://example.com')
+        self.image_info['os_hash_algo'] = 'sha256'
+
+    def _download(self):
+        image_download = standby.ImageDownload(self.image_info)
+        data = b''.join(image_download)
+        self.assertEqual(hashlib.sha256(data).hexdigest(),
+                         image_download.hexdigest())
+        return data, image_download
+
+    def test_resume_same_url(self, get_mock, sleep_mock):
+        get_mock.side_effect = [
+            _response(200, _interrupted(b'Sponge'),
+                      {'Content-Length': '15'}),
+            _response(206, [b'Bob', b'Square'],
+                      {'Content-Range': 'bytes 6-14/15'}),
+        ]
+        data, image_download = self._download()
+        self.assertEqual(b'SpongeBobSquare', data)
+        self.assertEqual(1, image_download.resumes)
+        get_mock.assert_called_with('http://example.org', stream=True,
+                                    proxies={},
+                                    headers={'Range': 'bytes=6-'})
+        sleep_mock.assert_called_once_with(
+            standby.DEFAULT_DOWNLOAD_RETRY_INTERVAL)
+
+    def test_resume_truncated(self, get_mock, sleep_mock):
+        get_mock.side_effect = [
+            _response(200, [b'Sponge'], {'Content-Length': '9'}),
+            _response(206, [b'Bob'], {'Content-Range': 'bytes 6-8/9'}),
+        ]
+        data, _download = self._download()
+        self.assertEqual(b'SpongeBob', data)
+
+    def test_resume_other_url(self, get_mock, sleep_mock):
+        self.image_info['download_retry_interval'] = 1
+        get_mock.side_effect = [
+            _response(200, _interrupted(b'Sponge'),
+                      {'Content-Length': '9'}),
+            requests.ConnectionError('connection refused'),
+            # Ignores the range, the start of the image is dropped
+            _response(200, [b'Spo', b'ngeBob'], {'Content-Length': '9'}),
+        ]
+        data, image_download = self._download()
+        self.assertEqual(b'SpongeBob', data)
+        get_mock.assert_called_with('http://example.com', stream=True,
+                                    proxies={},
+                                    headers={'Range': 'bytes=6-'})
+        self.assertEqual([mock.call(1), mock.call(2)],
+                         sleep_mock.call_args_list)
+
+    def test_resume_wrong_offset(self, get_mock, sleep_mock):
+        self.image_info['download_retries'] = 2
+        get_mock.side_effect = [
+            _response(200, _interrupted(b'Sponge'),
+                      {'Content-Length': '9'}),
+            _response(206, [b'eBob'], {'Content-Range': 'bytes 5-8/9'}),
+            _response(206, [b'Bob'], {'Content-Range': 'bytes 6-8/10'}),
+        ]
+        self.assertRaisesRegexp(errors.ImageDownloadError,
+                                'expected 9 bytes', self._download)
+
+    def test_retries_exhausted(self, get_mock, sleep_mock):
+        self.image_info['download_retries'] = 3
+        get_mock.side_effect = [
+            _response(200, _interrupted(b'Sponge'),
+                      {'Content-Length': '9'}),
+            _response(206, _interrupted(), {'Content-Range': 'bytes 6-8/9'}),
+            requests.Timeout('timed out'),
+            _response(503, []),
+        ]
+        self.assertRaisesRegexp(errors.ImageDownloadError,
+                                'interrupted after 6 bytes', self._download)
+        self.assertEqual(3, sleep_mock.call_count)
+
+    def test_no_resume_with_content_encoding(self, get_mock, sleep_mock):
+        get_mock.return_value = _response(
+            200, _interrupted(b'Sponge'),
+            {'Content-Length': '9', 'Content-Encoding': 'gzip'})
+        self.assertRaises(errors.ImageDownloadError, self._download)
+        get_mock.assert_called_once_with('http://example.org', stream=True,
+                                         proxies={})
+        self.assertFalse(sleep_mock.called)
+
+    @mock.patch.object(download, 'rank_mirrors', autospec=True)
+    def test_race_mirrors(self, rank_mock, get_mock, sleep_mock):
+        fast = download.MirrorProbe('http://example.com')
+        slow = download.MirrorProbe('http://example.org')
+        slow.error = 'Connection refused'
+        rank_mock.return_value = [fast, slow]
+        self.image_info['mirror_selection'] = 'race'
+        get_mock.return_value = _response(200, [b'SpongeBob'])
+
+        data, image_download = self._download()
+        self.assertEqual(b'SpongeBob', data)
+        rank_mock.assert_called_once_with(
+            ['http://example.org', 'http://example.com'], proxies={})
+        get_mock.assert_called_once_with('http://example.com', stream=True,
+                                         proxies={})
+        self.assertEqual([fast.serialize(), slow.serialize()],
+                         image_download.mirrors)
+
+    @mock.patch.object(download, 'rank_mirrors', autospec=True)
+    @mock.patch.object(download, 'open_ranged', autospec=True)
+    def test_race_mirrors_ranged(self, open_mock, rank_mock, get_mock,
+                                 sleep_mock):
+        rank_mock.return_value = [download.MirrorProbe('http://example.com'),
+                                  download.MirrorProbe('http://example.org')]
+        segmented = mock.Mock(spec=download.SegmentedDownload)
+        segmented.iter_content.return_value = [b'SpongeBob']
+        segmented.size = 9
+        open_mock.return_value = segmented
+        self.image_info['mirror_selection'] = 'race'
+        self.image_info['download_concurrency'] = 4
+
+        self._download()
+        open_mock.assert_called_once_with(
+            'http://example.com', 4, segment_size=None, proxies={}, start=0,
+            mirrors=['http://example.org'])
+
+    @mock.patch.object(standby, 'THROUGHPUT_WINDOW', 1)
+    @mock.patch('time.time', autospec=True)
+    def test_switch_slow_mirror(self, time_mock, get_mock, sleep_mock):
+        # Every chunk takes a second to arrive
+        time_mock.side_effect = itertools.count()
+        self.image_info['min_download_throughput'] = 1
+        get_mock.side_effect = [
+            _response(200, [b'Sponge', b'Bob', b'Square'],
+                      {'Content-Length': '15'}),
+            _response(206, [b'Bob', b'Square'],
+                      {'Content-Range': 'bytes 6-14/15'}),
+        ]
+        data, image_download = self._download()
+        # The first mirror was dropped after the first chunk, the second
+        # one is slow too but there is nothing left to switch to
+        self.assertEqual(b'SpongeBobSquare', data)
+        self.assertEqual(1, image_download.resumes)
+        self.assertEqual({'http://example.org', 'http://example.com'},
+                         image_download._slow_urls)
+        get_mock.assert_called_with('http://example.com', stream=True,
+                                    proxies={},
+                                    headers={'Range': 'bytes=6-'})
+        self.assertFalse(sleep_mock.called)
+
+    @mock.patch.object(download, 'SegmentedDownload', autospec=True)
+    @mock.patch.object(peer, 'find_peers', autospec=True)
+    def test_peer_mode(self, find_mock, segmented_mock, get_mock,
+                       sleep_mock):
+        pieces = manifest.Manifest(9, ['a', 'b', 'c'], block_size=4)
+        find_mock.return_value = (pieces, ['http://peer/v1/images/fake_id'])
+        segmented = segmented_mock.return_value.start.return_value
+        segmented.iter_content.return_value = [b'SpongeBob']
+        self.image_info['peer_mode'] = True
+        self.image_info['peers'] = ['http://peer']
+
+        data, image_download = self._download()
+        self.assertEqual(b'SpongeBob', data)
+        find_mock.assert_called_once_with(['http://peer'], 'fake_id',
+                                          proxies={})
+        segmented_mock.assert_called_once_with(
+            'http://example.org', 9, 2, proxies={}, start=0,
+            mirrors=['http://peer/v1/images/fake_id'], manifest=pieces)
+        self.assertEqual(['http://peer/v1/images/fake_id'],
+                         image_download.peers)
+        self.assertFalse(get_mock.called)
+
+    @mock.patch.object(peer, 'find_peers', autospec=True)
+    def test_peer_mode_not_shared(self, find_mock, get_mock, sleep_mock):
+        find_mock.return_value = (None, [])
+        get_mock.return_value = _response(200, [b'SpongeBob'])
+        self.image_info['peer_mode'] = True
+        self.image_info['peers'] = ['http://peer']
+
+        data, image_download = self._download()
+        self.assertEqual(b'SpongeBob', data)
+        get_mock.assert_called_once_with('http://example.org', stream=True,
+                                         proxies={})
+        self.assertIsNone(image_download.peers)
+
+    @mock.patch.object(download, 'SegmentedDownload', autospec=True)
+    @mock.patch.object(peer, 'find_peers', autospec=True)
+    def test_peer_mode_failure(self, find_mock, segmented_mock, get_mock,
+                               sleep_mock):
+        pieces = manifest.Manifest(9, ['a', 'b', 'c'], block_size=4)
+        find_mock.return_value = (pieces, ['http://peer/v1/images/fake_id'])
+        segmented = segmented_mock.return_value.start.return_value
+        segmented.iter_content.return_value = _interrupted(b'Spon')
+        get_mock.return_value = _response(206, [b'geBob'],
+                                          {'Content-Range': 'bytes 4-8/9'})
+        self.image_info['peer_mode'] = True
+        self.image_info['peers'] = ['http://peer']
+
+        data, image_download = self._download()
+        self.assertEqual(b'SpongeBob', data)
+        # Resumed from the origin only
+        self.assertEqual(1, segmented_mock.call_count)
+        get_mock.assert_called_once_with('http://example.org', stream=True,
+                                         proxies={},
+                                         headers={'Range': 'bytes=4-'})
+
+
+class TestImagePresent(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestImagePresent, self).setUp()
+        fd, self.device = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.device)
+        self.data = os.urandom(5000)
+        with open(self.device, 'wb') as f:
+            f.write(self.data + b'partition data')
+        self.image_info = _build_fake_image_info()
+        self.image_info['checksum'] = hashlib.md5(self.data).hexdigest()
+
+    @mock.patch.object(manifest, 'load', autospec=True)
+    def test_manifest(self, load_mock):
+        self.image_info['block_manifest'] = 'http://example.org/manifest'
+        blocks = manifest.generate(self.device, block_size=1000, size=5000)
+        load_mock.return_value = blocks
+        self.assertTrue(standby._image_present(self.image_info, self.device))
+        load_mock.assert_called_once_with('http://example.org/manifest',
+                                          proxies={})
+
+        blocks.blocks[2] = 'different'
+        self.assertFalse(standby._image_present(self.image_info,
+                                                self.device))
+
+    @mock.patch.object(manifest, 'load', autospec=True)
+    def test_manifest_checksum_mismatch(self, load_mock):
+        # The manifest matches the device but not the image
+        self.image_info['block_manifest'] = 'http://example.org/manifest'
+        load_mock.return_value = manifest.generate(self.device,
+                                                   block_size=1000,
+                                                   size=5000)
+        self.image_info['checksum'] = 'different'
+        self.assertFalse(standby._image_present(self.image_info,
+                                                self.device))
+
+    @mock.patch.object(manifest, 'load', autospec=True)
+    def test_manifest_not_raw(self, load_mock):
+        self.image_info['block_manifest'] = 'http://example.org/manifest'
+        self.image_info['disk_format'] = 'qcow2'
+        self.assertFalse(standby._image_present(self.image_info,
+                                                self.device))
+        self.assertFalse(load_mock.called)
+
+    @mock.patch.object(manifest, 'load', autospec=True)
+    def test_manifest_error(self, load_mock):
+        self.image_info['block_manifest'] = 'http://example.org/manifest'
+        load_mock.side_effect = errors.ManifestError('404')
+        self.assertFalse(standby._image_present(self.image_info,
+                                                self.device))
+
+    @mock.patch.object(transport, 'head', autospec=True)
+    def test_checksum(self, head_mock):
+        head_mock.return_value = _response(200, [],
+                                           {'Content-Length': '5000'})
+        self.assertTrue(standby._image_present(self.image_info, self.device))
+        head_mock.assert_called_once_with(
+            'http://example.org', proxies={}, allow_redirects=True,
+            timeout=manifest.DEFAULT_TIMEOUT)
+
+        self.image_info['checksum'] = 'different'
+        self.assertFalse(standby._image_present(self.image_info,
+                                                self.device))
+
+    @mock.patch.object(transport, 'head', autospec=True)
+    def test_checksum_unknown_size(self, head_mock):
+        head_mock.side_effect = requests.ConnectionError('refused')
+        self.assertFalse(standby._image_present(self.image_info,
+                                                self.device))
+
+    @mock.patch.object(transport, 'head', autospec=True)
+    def test_checksum_not_raw(self, head_mock):
+        self.image_info['disk_format'] = 'qcow2'
+        self.assertFalse(standby._image_present(self.image_info,
+                                                self.device))
+        self.assertFalse(head_mock.called)
+
+
+class TestWriteImageDelta(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestWriteImageDelta, self).setUp()
+        self.agent_extension = standby.StandbyExtension()
+        fd, self.device = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.device)
+        self.new = os.urandom(4096 * 4)
+        with open(self.device, 'wb') as f:
+            f.write(self.new)
+        self.manifest = manifest.generate(self.device, block_size=4096)
+        with open(self.device, 'wb') as f:
+            f.write(self.new[:4096] + b'\xff' * 4096 + self.new[8192:])
+        self.image_info = _build_fake_image_info()
+        self.image_info['checksum'] = hashlib.md5(self.new).hexdigest()
+        self.image_info['image_delta'] = True
+        self.image_info['block_manifest'] = 'http://example.org/manifest'
+
+    @mock.patch.object(transport, 'get_session', autospec=True)
+    @mock.patch.object(manifest, 'load', autospec=True)
+    def test_write_image_delta(self, load_mock, session_mock):
+        load_mock.return_value = self.manifest
+        session_mock.return_value.get.return_value = _response(
+            206, [self.new[4096:8192]],
+            {'Content-Range': 'bytes 4096-8191/16384'})
+
+        stats = self.agent_extension._write_image_delta(self.image_info,
+                                                        self.device)
+        with open(self.device, 'rb') as f:
+            self.assertEqual(self.new, f.read())
+        self.assertEqual(4096, stats['delta']['bytes_downloaded'])
+        self.assertEqual(12288, stats['delta']['bytes_saved'])
+        self.assertEqual(4096, stats['bytes_written'])
+        self.assertEqual(self.image_info['id'],
+                         self.agent_extension.cached_image_id)
+
+    @mock.patch.object(transport, 'get_session', autospec=True)
+    @mock.patch.object(manifest, 'load', autospec=True)
+    def test_write_image_delta_checksum_mismatch(self, load_mock,
+                                                 session_mock):
+        # The manifest does not match the image
+        self.image_info['checksum'] = hashlib.md5(b'other').hexdigest()
+        load_mock.return_value = self.manifest
+        session_mock.return_value.get.return_value = _response(
+            206, [self.new[4096:8192]],
+            {'Content-Range': 'bytes 4096-8191/16384'})
+
+        self.assertRaises(errors.ImageChecksumError,
+                          self.agent_extension._write_image_delta,
+                          self.image_info, self.device)
+        self.assertIsNone(self.agent_extension.cached_image_id)
+
+    @mock.patch.object(transport, 'get_session', autospec=True)
+    @mock.patch.object(manifest, 'load', autospec=True)
+    def test_write_image_delta_download_error(self, load_mock, session_mock):
+        load_mock.return_value = self.manifest
+        session_mock.return_value.get.return_value = _response(404, [])
+        self.assertRaises(errors.ImageDownloadError,
+                          self.agent_extension._write_image_delta,
+                          self.image_info, self.device)
+
+    @mock.patch.object(manifest, 'load', autospec=True)
+    def test_write_image_delta_no_manifest(self, load_mock):
+        load_mock.side_effect = errors.ManifestError('404')
+        self.assertIsNone(self.agent_extension._write_image_delta(
+            self.image_info, self.device))
+
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch.object(standby.StandbyExtension, '_cache_and_write_image',
+                       autospec=True)
+    @mock.patch.object(standby.StandbyExtension, '_write_image_delta',
+                       autospec=True)
+    def test_prepare_image_delta(self, delta_mock, cache_mock,
+                                 dispatch_mock):
+        dispatch_mock.return_value = self.device
+        delta_mock.return_value = {'delta': {}}
+        async_result = self.agent_extension.prepare_image(
+            image_info=self.image_info)
+        async_result.join()
+        delta_mock.assert_called_once_with(self.agent_extension,
+                                           self.image_info, self.device)
+        self.assertFalse(cache_mock.called)
+        self.assertEqual({'delta': {}},
+                         async_result.command_result['transfer_stats'])
+
+        # Falls back to writing the whole image without a manifest
+        delta_mock.return_value = None
+        self.agent_extension.cached_image_id = None
+        self.agent_extension.prepare_image(
+            image_info=self.image_info).join()
+        cache_mock.assert_called_once_with(self.agent_extension,
+                                           self.image_info, self.device)
+
+
+@mock.patch.object(standby, '_image_size', autospec=True)
+@mock.patch.object(standby, '_cache_headroom', autospec=True)
+@mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
+class TestChooseWriteMode(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestChooseWriteMode, self).setUp()
+        self.image_info = _build_fake_image_info()
+        self.image_info['disk_format'] = 'vmdk'
+        self.image_info['stream_raw_images'] = 'auto'
+        self.disks = [hardware.BlockDevice('/dev/sda', 'disk', 8000, True),
+                      hardware.BlockDevice('/dev/sdb', 'disk', 5000, True),
+                      hardware.BlockDevice('/dev/sdc', 'disk', 3000, True),
+                      hardware.BlockDevice('/dev/sdd', 'disk', 1000, True)]
+
+    def test_streamable(self, dispatch_mock, headroom_mock, size_mock):
+        self.image_info['stream_qcow2_images'] = True
+        for disk_format in ('raw', 'qcow2'):
+            self.image_info['disk_format'] = disk_format
+            decision = standby._choose_write_mode(self.image_info,
+                                                  '/dev/sda')
+            self.assertEqual(standby.WRITE_MODE_STREAM, decision['mode'])
+        self.assertFalse(size_mock.called)
+
+    def test_qcow2_not_streamed_by_default(self, dispatch_mock,
+                                           headroom_mock, size_mock):
+        self.image_info['disk_format'] = 'qcow2'
+        size_mock.return_value = 2000
+        headroom_mock.return_value = 4000
+        decision = standby._choose_write_mode(self.image_info, '/dev/sda')
+        self.assertEqual(standby.WRITE_MODE_CACHE, decision['mode'])
+
+    def test_cache(self, dispatch_mock, headroom_mock, size_mock):
+        size_mock.return_value = 2000
+        headroom_mock.return_value = 4000
+        decision = standby._choose_write_mode(self.image_info, '/dev/sda')
+        self.assertEqual({'mode': standby.WRITE_MODE_CACHE,
+                          'reason': 'image fits in the cache',
+                          'image_size': 2000, 'cache_headroom': 4000},
+                         decision)
+        headroom_mock.assert_called_once_with('/tmp')
+
+    def test_spill(self, dispatch_mock, headroom_mock, size_mock):
+        size_mock.return_value = 2000
+        headroom_mock.return_value = 1000
+        dispatch_mock.return_value = self.disks
+        self.image_info['allow_scratch_disk'] = True
+        self.image_info['additional_devices'] = ['/dev/sdc']
+        decision = standby._choose_write_mode(self.image_info, '/dev/sda')
+        self.assertEqual(standby.WRITE_MODE_SPILL, decision['mode'])
+        # The smallest large enough disk which is not written to
+        self.assertEqual('/dev/sdb', decision['scratch_device'])
+        dispatch_mock.assert_called_once_with('list_block_devices')
+
+    def test_spill_unknown_disk_format(self, dispatch_mock, headroom_mock,
+                                       size_mock):
+        size_mock.return_value = 2000
+        headroom_mock.return_value = 1000
+        dispatch_mock.return_value = self.disks
+        self.image_info['allow_scratch_disk'] = True
+        # Raw on disk, or unknown
+        for disk_format in (None, 'iso', 'aki'):
+            self.image_info['disk_format'] = disk_format
+            decision = standby._choose_write_mode(self.image_info,
+                                                  '/dev/sda')
+            self.assertEqual(standby.WRITE_MODE_CACHE, decision['mode'])
+            self.assertNotIn('scratch_device', decision)
+        self.assertFalse(dispatch_mock.called)
+
+    def test_spill_not_allowed(self, dispatch_mock, headroom_mock,
+                               size_mock):
+        size_mock.return_value = 2000
+        headroom_mock.return_value = 1000
+        decision = standby._choose_write_mode(self.image_info, '/dev/sda')
+        self.assertEqual(standby.WRITE_MODE_CACHE, decision['mode'])
+        self.assertEqual('no room for the image anywhere',
+                         decision['reason'])
+        self.assertFalse(dispatch_mock.called)
+
+    def test_unknown_size(self, dispatch_mock, headroom_mock, size_mock):
+        self.image_info['compression'] = 'gzip'
+        decision = standby._choose_write_mode(self.image_info, '/dev/sda')
+        self.assertEqual(standby.WRITE_MODE_CACHE, decision['mode'])
+        self.assertIsNone(decision['image_size'])
+        self.assertFalse(size_mock.called)
+        self.assertFalse(headroom_mock.called)
+
+
+@mock.patch('psutil.virtual_memory', autospec=True)
+@mock.patch('psutil.disk_partitions', autospec=True)
+@mock.patch('os.statvfs', autospec=True)
+class TestCacheHeadroom(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestCacheHeadroom, self).setUp()
+        self.mounts = [mock.Mock(mountpoint='/', fstype='ext4'),
+                       mock.Mock(mountpoint='/tmp', fstype='tmpfs')]
+
+    def _headroom(self, statvfs_mock, partitions_mock, memory_mock, free):
+        statvfs_mock.return_value = mock.Mock(f_bavail=free // 4096,
+                                              f_frsize=4096)
+        partitions_mock.return_value = self.mounts
+        memory_mock.return_value = mock.Mock(available=3 * units.Gi)
+        return standby._cache_headroom('/tmp') + standby.CACHE_RESERVE
+
+    def test_tmpfs(self, statvfs_mock, partitions_mock, memory_mock):
+        self.assertEqual(3 * units.Gi, self._headroom(
+            statvfs_mock, partitions_mock, memory_mock, 8 * units.Gi))
+        self.assertEqual(2 * units.Gi, self._headroom(
+            statvfs_mock, partitions_mock, memory_mock, 2 * units.Gi))
+
+    def test_ramfs(self, statvfs_mock, partitions_mock, memory_mock):
+        self.mounts = [mock.Mock(mountpoint='/', fstype='ramfs')]
+        self.assertEqual(3 * units.Gi, self._headroom(
+            statvfs_mock, partitions_mock, memory_mock, 0))
+
+    def test_disk(self, statvfs_mock, partitions_mock, memory_mock):
+        self.mounts = [mock.Mock(mountpoint='/', fstype='tmpfs'),
+                       mock.Mock(mountpoint='/tmp', fstype='xfs')]
+        self.assertEqual(8 * units.Gi, self._headroom(
+            statvfs_mock, partitions_mock, memory_mock, 8 * units.Gi))
+
+
+class TestWriteImageAuto(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestWriteImageAuto, self).setUp()
+        self.agent_extension = standby.StandbyExtension()
+        self.image_info = _build_fake_image_info()
+        self.image_info['stream_raw_images'] = 'auto'
+
+    @mock.patch.object(standby, '_write_image', autospec=True)
+    @mock.patch.object(standby, '_choose_write_mode', autospec=True)
+    @mock.patch.object(transport, 'get', autospec=True)
+    def test_spill(self, get_mock, choose_mock, write_mock):
+        fd, scratch = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, scratch)
+        data = os.urandom(100000)
+        self.image_info['checksum'] = hashlib.md5(data).hexdigest()
+        get_mock.return_value = _response(200, [data[:60000],
+                                                data[60000:]])
+        decision = {'mode': standby.WRITE_MODE_SPILL, 'reason': 'too big',
+                    'scratch_device': scratch}
+        choose_mock.return_value = decision
+
+        stats = self.agent_extension._write_image_auto(self.image_info,
+                                                       '/dev/sda')
+        with open(scratch, 'rb') as f:
+            self.assertEqual(data, f.read())
+        write_mock.assert_called_once_with(self.image_info, '/dev/sda',
+                                           image=scratch)
+        self.assertEqual(decision, stats['write_mode'])
+
+    @mock.patch.object(standby.StandbyExtension,
+                       '_stream_raw_image_onto_device', autospec=True)
+    @mock.patch.object(standby, '_choose_write_mode', autospec=True)
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
+    def test_prepare_image_stream(self, dispatch_mock, choose_mock,
+                                  stream_mock):
+        dispatch_mock.return_value = '/dev/sda'
+        choose_mock.return_value = {'mode': standby.WRITE_MODE_STREAM,
+                                    'reason': 'raw'}
+        stream_mock.return_value = {}
+        result = self.agent_extension.prepare_image(
+            image_info=self.image_info)
+        result.join()
+        stream_mock.assert_called_once_with(self.agent_extension,
+                                            self.image_info, '/dev/sda')
+        self.assertEqual(choose_mock.return_value,
+                         result.command_result['transfer_stats'][
+                             'write_mode'])
+
+    def test_validate_stream_raw_images(self):
+        self.image_info['stream_raw_images'] = 'sometimes'
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                'stream_raw_images',
+                                standby._validate_image_info,
+                                None, self.image_info)
+
+
+@mock.patch('os.nice', autospec=True)
+@mock.patch.object(standby, '_write_image', autospec=True)
+@mock.patch.object(standby, '_download_image', autospec=True)
+@mock.patch.object(standby, '_cache_headroom', autospec=True,
+                   return_value=1024)
+@mock.patch.object(standby, '_image_size', autospec=True, return_value=512)
+@mock.patch.object(hardware, 'dispatch_to_managers', autospec=True,
+                   return_value='/dev/sda')
+class TestPrefetch(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestPrefetch, self).setUp()
+        self.agent_extension = standby.StandbyExtension()
+        self.image_info = _build_fake_image_info()
+
+    def _prefetch(self, image_info=None):
+        result = self.agent_extension.cache_image(
+            image_info=image_info or self.image_info, prefetch=True)
+        result.join()
+        return result.command_result['result']
+
+    def test_prefetch(self, dispatch_mock, size_mock, headroom_mock,
+                      download_mock, write_mock, nice_mock):
+        download_mock.return_value = {'hash_algo': 'md5'}
+        self.assertIn('is being prefetched', self._prefetch())
+        download_mock.assert_called_once_with(self.image_info,
+                                              cancel=mock.ANY)
+        self.assertFalse(write_mock.called)
+        nice_mock.assert_called_once_with(standby.PREFETCH_NICENESS)
+
+        result = self.agent_extension.prepare_image(
+            image_info=self.image_info)
+        result.join()
+        write_mock.assert_called_once_with(self.image_info, '/dev/sda')
+        self.assertEqual(1, download_mock.call_count)
+        self.assertEqual({'hash_algo': 'md5', 'prefetched': True},
+                         result.command_result['transfer_stats'])
+        self.assertEqual('fake_id', self.agent_extension.cached_image_id)
+
+    def test_prefetch_over_budget(self, dispatch_mock, size_mock,
+                                  headroom_mock, download_mock, write_mock,
+                                  nice_mock):
+        self.image_info['prefetch_budget'] = 256
+        self.assertIn('not prefetched', self._prefetch())
+        size_mock.return_value = None
+        self.assertIn('size unknown', self._prefetch())
+        self.assertFalse(download_mock.called)
+
+    @mock.patch.object(standby.StandbyExtension, '_cache_and_write_image',
+                       autospec=True)
+    def test_prefetch_failed(self, cache_mock, dispatch_mock, size_mock,
+                             headroom_mock, download_mock, write_mock,
+                             nice_mock):
+        download_mock.side_effect = errors.ImageDownloadError('fake_id',
+                                                              'boom')
+        cache_mock.return_value = {}
+        self._prefetch()
+        self.agent_extension.prepare_image(image_info=self.image_info).join()
+        cache_mock.assert_called_once_with(self.agent_extension,
+                                           self.image_info, '/dev/sda')
+        self.assertFalse(write_mock.called)
+
+    @mock.patch.object(os, 'unlink', autospec=True)
+    @mock.patch.object(standby.StandbyExtension, '_cache_and_write_image',
+                       autospec=True)
+    def test_prefetch_other_image_cancelled(self, cache_mock, unlink_mock,
+                                            dispatch_mock, size_mock,
+                                            headroom_mock, download_mock,
+                                            write_mock, nice_mock):
+        def _download(image_info, cancel=None):
+            cancel.wait(5)
+            raise errors.ImageDownloadError(image_info['id'], 'cancelled')
+
+        download_mock.side_effect = _download
+        cache_mock.return_value = {}
+        self._prefetch()
+
+        other_info = _build_fake_image_info()
+        other_info['id'] = 'other_id'
+        self.agent_extension.prepare_image(image_info=other_info).join()
+        unlink_mock.assert_called_once_with('/tmp/fake_id')
+        cache_mock.assert_called_once_with(self.agent_extension,
+                                           other_info, '/dev/sda')
+        self.assertIsNone(self.agent_extension._prefetch)
@@ -20,7 +20,6 @@ from oslo_config import cfg
 from oslotest import base as test_base
 import pkg_resources
 from stevedore import extension
-from wsgiref import simple_server
 
 from ironic_python_agent import agent
 from ironic_python_agent import encoding
@@ -187,7 +186,7 @@ class TestBaseAgent(test_base.BaseTestCase):
             listen_addr[0],
             listen_addr[1],
             self.agent.api,
-            server_class=simple_server.WSGIServer)
+            server_class=agent.ThreadingWSGIServer)
         wsgi_server.serve_forever.assert_called_once_with()
 
         self.agent.heartbeater.start.assert_called_once_with()
@@ -219,7 +218,7 @@ class TestBaseAgent(test_base.BaseTestCase):
             listen_addr[0],
             listen_addr[1],
             self.agent.api,
-            server_class=simple_server.WSGIServer)
+            server_class=agent.ThreadingWSGIServer)
         wsgi_server.serve_forever.assert_called_once_with()
         mocked_inspector.assert_called_once_with()
         self.assertEqual(1, self.agent.api_client.lookup_node.call_count)
@@ -291,6 +290,7 @@ class TestBaseAgent(test_base.BaseTestCase):
             'command_status': 'RUNNING',
             'command_result': None,
             'command_error': None,
+            'command_progress': None,
         }
         self.assertEqualEncoded(result, expected_result)
 
@@ -315,6 +315,7 @@ class TestBaseAgent(test_base.BaseTestCase):
             'command_status': 'RUNNING',
             'command_result': None,
             'command_error': None,
+            'command_progress': None,
         }
         self.assertEqualEncoded(result, expected_result)
 
@@ -378,7 +379,7 @@ class TestAgentStandalone(test_base.BaseTestCase):
             listen_addr[0],
             listen_addr[1],
             self.agent.api,
-            server_class=simple_server.WSGIServer)
+            server_class=agent.ThreadingWSGIServer)
         wsgi_server.serve_forever.assert_called_once_with()
 
         self.assertFalse(self.agent.heartbeater.called)
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import tempfile
 import time
 
 import mock
@@ -21,6 +23,8 @@ import pecan.testing
 
 from ironic_python_agent import agent
 from ironic_python_agent.extensions import base
+from ironic_python_agent import manifest
+from ironic_python_agent import peer
 
 
 PATH_PREFIX = '/v1'
@@ -310,3 +314,50 @@ class TestIronicAPI(test_base.BaseTestCase):
         self.assertEqual(response.status_code, 200)
         data = response.json
         self.assertEqual(data, serialized_cmd_result)
+
+    def _share_image(self, data):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, data)
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        pieces = manifest.generate(path, block_size=4)
+        image = peer.SharedImage('abc123', path, pieces)
+        patcher = mock.patch.object(peer, 'get_shared', autospec=True,
+                                    return_value=image)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return pieces
+
+    def test_get_shared_image(self):
+        self._share_image(b'abcdefghij')
+        response = self.app.get(PATH_PREFIX + '/images/abc123')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'abcdefghij', response.body)
+        self.assertEqual('bytes', response.headers['Accept-Ranges'])
+
+    def test_get_shared_image_range(self):
+        self._share_image(b'abcdefghij')
+        response = self.app.get(PATH_PREFIX + '/images/abc123',
+                                headers={'Range': 'bytes=2-5'})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(b'cdef', response.body)
+        self.assertEqual('bytes 2-5/10', response.headers['Content-Range'])
+
+    def test_get_shared_image_bad_range(self):
+        self._share_image(b'abcdefghij')
+        response = self.app.get(PATH_PREFIX + '/images/abc123',
+                                headers={'Range': 'bytes=20-30'},
+                                expect_errors=True)
+        self.assertEqual(416, response.status_code)
+        self.assertEqual('bytes */10', response.headers['Content-Range'])
+
+    def test_get_shared_image_manifest(self):
+        pieces = self._share_image(b'abcdefghij')
+        response = self.get_json('/images/abc123/manifest')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(pieces.to_dict(), response.json)
+
+    def test_get_image_not_shared(self):
+        response = self.app.get(PATH_PREFIX + '/images/abc123',
+                                expect_errors=True)
+        self.assertEqual(404, response.status_code)
@@ -0,0 +1,82 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+from oslotest import base as test_base
+
+from ironic_python_agent import bandwidth
+
+
+@mock.patch('time.sleep', autospec=True)
+@mock.patch('time.time', autospec=True)
+class TestTokenBucket(test_base.BaseTestCase):
+    def test_unlimited(self, time_mock, sleep_mock):
+        time_mock.return_value = 100.0
+        bucket = bandwidth.TokenBucket()
+        self.assertIsNone(bucket.rate)
+        self.assertEqual(0, bucket.consume(1 << 30))
+        self.assertFalse(sleep_mock.called)
+
+    def test_burst_then_rate(self, time_mock, sleep_mock):
+        time_mock.return_value = 100.0
+        bucket = bandwidth.TokenBucket(rate=1000, burst=2.0)
+        # A full bucket lets two seconds worth of data through at once
+        self.assertEqual(0, bucket.consume(2000))
+        self.assertEqual(0.5, bucket.consume(500))
+        sleep_mock.assert_called_once_with(0.5)
+
+        # The debt is paid back during the sleep
+        time_mock.return_value = 100.5
+        self.assertEqual(1.0, bucket.consume(1000))
+
+    def test_refill_capped(self, time_mock, sleep_mock):
+        time_mock.return_value = 100.0
+        bucket = bandwidth.TokenBucket(rate=1000, burst=1.0)
+        bucket.consume(1000)
+        time_mock.return_value = 200.0
+        self.assertEqual(0, bucket.consume(1000))
+        self.assertEqual(0.5, bucket.consume(500))
+
+    def test_set_rate(self, time_mock, sleep_mock):
+        time_mock.return_value = 100.0
+        bucket = bandwidth.TokenBucket(rate=1000, burst=1.0)
+        bucket.consume(1500)
+        # The debt is kept and paid back at the new rate
+        bucket.set_rate(100)
+        self.assertEqual(100, bucket.rate)
+        self.assertEqual(6.0, bucket.consume(100))
+
+        bucket.set_rate(0)
+        self.assertIsNone(bucket.rate)
+        self.assertEqual(0, bucket.consume(1000))
+
+        # Limiting again starts with a full bucket
+        bucket.set_rate(1000)
+        self.assertEqual(0, bucket.consume(1000))
+
+
+class TestDownloadRate(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestDownloadRate, self).setUp()
+        self.addCleanup(bandwidth.set_download_rate, None)
+
+    def test_set_download_rate(self):
+        self.assertIsNone(bandwidth.get_download_rate())
+        bandwidth.set_download_rate(12.5)
+        self.assertEqual(12.5, bandwidth.get_download_rate())
+        self.assertEqual(int(12.5 * 1024 * 1024),
+                         bandwidth.downloads().rate)
+        bandwidth.set_download_rate(0)
+        self.assertIsNone(bandwidth.get_download_rate())
+        self.assertIsNone(bandwidth.downloads().rate)
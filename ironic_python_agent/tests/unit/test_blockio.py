@@ -0,0 +1,430 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import mmap
+import os
+import struct
+import tempfile
+
+import mock
+from oslotest import base as test_base
+
+from ironic_python_agent import blockio
+
+_real_open = os.open
+_real_pwrite_all = blockio.pwrite_all
+
+
+class TestZeroRuns(test_base.BaseTestCase):
+    def test_zero_runs(self):
+        data = b'\0' * 10 + b'a' * 10 + b'\0' * 25
+        self.assertEqual([(0, 10, True), (10, 20, False), (20, 45, True)],
+                         blockio._zero_runs(data, block_size=10))
+        self.assertEqual([(0, 45, False)], blockio._zero_runs(data))
+
+
+class TestBufferView(test_base.BaseTestCase):
+    def test_mmap(self):
+        # mmaps do not support memoryview on Python 2
+        buf = mmap.mmap(-1, 4096)
+        buf[:5] = b'abcde'
+        self.assertEqual(b'bcd', bytes(blockio.buffer_view(buf, 1, 4)))
+        self.assertEqual(4096, len(blockio.buffer_view(buf)))
+        self.assertEqual(4095, len(blockio.buffer_view(buf, 1)))
+
+    def test_bytes(self):
+        view = blockio.buffer_view(b'abcde', 3)
+        self.assertEqual(b'de', bytes(view))
+        self.assertEqual(b'e', bytes(blockio.buffer_view(view, 1)))
+
+
+class TestBufferPool(test_base.BaseTestCase):
+    def test_reuse(self):
+        pool = blockio.BufferPool(buffer_size=1000)
+        self.assertEqual(blockio.ALIGNMENT, pool.buffer_size)
+        buf = pool.get()
+        self.assertEqual(pool.buffer_size, len(buf))
+        pool.put(buf)
+        self.assertIs(buf, pool.get())
+
+    def test_max_buffers(self):
+        pool = blockio.BufferPool(buffer_size=4096, max_buffers=1)
+        buf = pool.get()
+        pool._cond = mock.MagicMock()
+        pool._cond.wait.side_effect = lambda: pool._free.append(buf)
+        self.assertIs(buf, pool.get())
+        self.assertEqual(1, pool._allocated)
+
+    def test_get_buffer_pool(self):
+        self.assertIs(blockio.get_buffer_pool(4096),
+                      blockio.get_buffer_pool(4000))
+
+
+class TestDirectWriter(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestDirectWriter, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+        self.pool = blockio.BufferPool(buffer_size=8192)
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def _write(self, chunks):
+        with blockio.DirectWriter(self.path, pool=self.pool) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+        return writer
+
+    def test_write(self):
+        chunks = [b'a' * 5000, b'b' * 5000, b'c' * 100]
+        writer = self._write(chunks)
+        self.assertEqual(b''.join(chunks), self._read())
+        self.assertEqual(10100, writer.bytes_written)
+        self.assertIsNotNone(writer.throughput)
+        # The buffer went back to the pool
+        self.assertEqual(1, len(self.pool._free))
+
+    def test_missing_target_not_created(self):
+        path = self.path + '.missing'
+        e = self.assertRaises(OSError, blockio.DirectWriter, path,
+                              pool=self.pool)
+        self.assertEqual(errno.ENOENT, e.errno)
+        self.assertFalse(os.path.exists(path))
+
+    def test_missing_target_created(self):
+        path = self.path + '.missing'
+        self.addCleanup(os.unlink, path)
+        with blockio.DirectWriter(path, pool=self.pool,
+                                  create=True) as writer:
+            writer.write(b'a' * 100)
+        with open(path, 'rb') as f:
+            self.assertEqual(b'a' * 100, f.read())
+
+    def test_write_aligned(self):
+        self._write([b'x' * 8192, b'y' * 4096])
+        self.assertEqual(b'x' * 8192 + b'y' * 4096, self._read())
+
+    def test_write_at_offset(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'z' * 20000)
+        with blockio.DirectWriter(self.path, pool=self.pool,
+                                  offset=8192) as writer:
+            writer.write(b'a' * 5000)
+            writer.write(b'b' * 5000)
+        self.assertEqual(b'z' * 8192 + b'a' * 5000 + b'b' * 5000
+                         + b'z' * 1808, self._read())
+        self.assertEqual(10000, writer.bytes_written)
+
+    def test_partial_block_keeps_existing_data(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'z' * 20000)
+        self._write([b'a' * 100])
+        self.assertEqual(b'a' * 100 + b'z' * 19900, self._read())
+
+    def test_partial_block_existing_data_shorter(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'z' * 200)
+        self._write([b'a' * 100])
+        self.assertEqual(b'a' * 100 + b'z' * 100, self._read())
+
+    @mock.patch('os.open', autospec=True)
+    def test_open_fallback(self, open_mock):
+        def _open(path, flags, *args):
+            if flags & blockio.O_DIRECT:
+                raise OSError(errno.EINVAL, 'Invalid argument')
+            return _real_open(path, flags, *args)
+
+        open_mock.side_effect = _open
+        writer = self._write([b'a' * 100, b'b' * 10000])
+        self.assertFalse(writer.direct)
+        self.assertEqual(b'a' * 100 + b'b' * 10000, self._read())
+
+    @mock.patch.object(blockio, 'pwrite_all', autospec=True)
+    def test_first_write_fallback(self, write_mock):
+        calls = []
+
+        def _pwrite_all(fd, data, offset, lock=None):
+            calls.append(fd)
+            if len(calls) == 1:
+                raise OSError(errno.EINVAL, 'Invalid argument')
+            return _real_pwrite_all(fd, data, offset, lock)
+
+        write_mock.side_effect = _pwrite_all
+        writer = self._write([b'a' * 8192, b'b' * 10])
+        self.assertFalse(writer.direct)
+        self.assertEqual(b'a' * 8192 + b'b' * 10, self._read())
+
+    @mock.patch.object(blockio, 'pwrite_all', autospec=True)
+    def test_later_write_error(self, write_mock):
+        write_mock.side_effect = [None, OSError(errno.EINVAL, 'Invalid')]
+        writer = blockio.DirectWriter(self.path, pool=self.pool)
+        writer.write(b'a' * 8192)
+        self.assertRaises(OSError, writer.write, b'b' * 8192)
+        writer.close(flush=False)
+        self.assertTrue(writer.direct)
+        self.assertEqual(1, len(self.pool._free))
+
+    def _write_zeros(self, zero_handling):
+        with open(self.path, 'wb') as f:
+            f.write(b'z' * 30000)
+        with blockio.DirectWriter(self.path, pool=self.pool,
+                                  zero_handling=zero_handling) as writer:
+            for chunk in (b'a' * 8192, b'\0' * 16384, b'b' * 100,
+                          b'\0' * 8000):
+                writer.write(chunk)
+        return writer
+
+    def test_zero_skip(self):
+        writer = self._write_zeros(blockio.ZERO_SKIP)
+        self.assertEqual(b'a' * 8192 + b'z' * 16384 + b'b' * 100
+                         + b'\0' * 8000 + b'z' * (30000 - 32676),
+                         self._read())
+        self.assertEqual(16384, writer.bytes_skipped)
+        self.assertEqual(8192 + 8100, writer.bytes_written)
+
+    def test_zero_skip_end_of_file(self):
+        with blockio.DirectWriter(self.path, pool=self.pool,
+                                  zero_handling=blockio.ZERO_SKIP) as writer:
+            writer.write(b'a' * 8192 + b'\0' * 16384)
+        self.assertEqual(b'a' * 8192 + b'\0' * 16384, self._read())
+        self.assertEqual(16384, writer.bytes_skipped)
+
+    def test_zeroout_unsupported(self):
+        # Regular files do not support BLKZEROOUT, zeros are written
+        writer = self._write_zeros(blockio.ZERO_ZEROOUT)
+        self.assertEqual(b'a' * 8192 + b'\0' * 16384 + b'b' * 100
+                         + b'\0' * 8000, self._read()[:32676])
+        self.assertEqual(blockio.ZERO_WRITE, writer.zero_handling)
+        self.assertEqual(0, writer.bytes_skipped)
+        self.assertEqual(32676, writer.bytes_written)
+
+    @mock.patch('fcntl.ioctl', autospec=True)
+    def test_zeroout(self, ioctl_mock):
+        writer = self._write_zeros(blockio.ZERO_ZEROOUT)
+        ioctl_mock.assert_called_once_with(
+            mock.ANY, blockio._BLKZEROOUT, struct.pack('QQ', 8192, 16384))
+        self.assertEqual(b'a' * 8192 + b'z' * 16384 + b'b' * 100,
+                         self._read()[:24676])
+        self.assertEqual(16384, writer.bytes_skipped)
+
+    @mock.patch.object(blockio, '_discard_zeroes_data', autospec=True)
+    @mock.patch('fcntl.ioctl', autospec=True)
+    def test_discard(self, ioctl_mock, zeroes_mock):
+        zeroes_mock.return_value = True
+        self._write_zeros(blockio.ZERO_DISCARD)
+        ioctl_mock.assert_called_once_with(
+            mock.ANY, blockio._BLKDISCARD, struct.pack('QQ', 8192, 16384))
+
+    @mock.patch('fcntl.ioctl', autospec=True)
+    def test_discard_not_zeroing(self, ioctl_mock):
+        writer = self._write_zeros(blockio.ZERO_DISCARD)
+        self.assertEqual(blockio.ZERO_ZEROOUT, writer.zero_handling)
+        ioctl_mock.assert_called_once_with(
+            mock.ANY, blockio._BLKZEROOUT, struct.pack('QQ', 8192, 16384))
+
+    def test_error_in_context_does_not_flush(self):
+        try:
+            with blockio.DirectWriter(self.path, pool=self.pool) as writer:
+                writer.write(b'a' * 100)
+                raise RuntimeError('boom')
+        except RuntimeError:
+            pass
+        self.assertEqual(b'', self._read())
+
+
+class TestParallelWriter(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestParallelWriter, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+        self.pool = blockio.BufferPool(buffer_size=8192)
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_write(self):
+        data = os.urandom(100000)
+        with blockio.ParallelWriter(self.path, pool=self.pool,
+                                    queue_depth=3) as writer:
+            for i in range(0, len(data), 3000):
+                writer.write(data[i:i + 3000])
+        self.assertEqual(data, self._read())
+        self.assertEqual(100000, writer.bytes_written)
+        # At most the buffers in flight plus the one being filled
+        self.assertLessEqual(self.pool._allocated, 4)
+        self.assertEqual(self.pool._allocated, len(self.pool._free))
+
+    def test_write_at_offset(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'z' * 50000)
+        with blockio.ParallelWriter(self.path, pool=self.pool,
+                                    offset=4096) as writer:
+            writer.write(b'a' * 20000)
+        self.assertEqual(b'z' * 4096 + b'a' * 20000 + b'z' * 25904,
+                         self._read())
+
+    def test_zero_skip(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'z' * 40000)
+        with blockio.ParallelWriter(self.path, pool=self.pool,
+                                    zero_handling=blockio.ZERO_SKIP) as w:
+            for chunk in (b'a' * 8192, b'\0' * 16384, b'b' * 8192):
+                w.write(chunk)
+        self.assertEqual(b'a' * 8192 + b'z' * 16384 + b'b' * 8192
+                         + b'z' * 7232, self._read())
+        self.assertEqual(16384, w.bytes_skipped)
+        self.assertEqual(16384, w.bytes_written)
+
+    @mock.patch.object(blockio, 'pwrite_all', autospec=True)
+    def test_write_error(self, pwrite_mock):
+        pwrite_mock.side_effect = OSError(errno.EIO, 'I/O error')
+        writer = blockio.ParallelWriter(self.path, pool=self.pool)
+        # Make the first buffer go through the writer threads as well
+        writer._written_direct = True
+        writer.write(b'a' * 8192)
+        self.assertRaises(OSError, writer.close)
+        self.assertIsNone(writer._fd)
+        self.assertEqual(self.pool._allocated, len(self.pool._free))
+
+    def test_writes_share_a_lock(self):
+        locks = []
+
+        def _pwrite_all(fd, data, offset, lock=None):
+            locks.append(lock)
+            return _real_pwrite_all(fd, data, offset, lock)
+
+        # Not a mock, which would keep the buffers referenced
+        with mock.patch.object(blockio, 'pwrite_all', _pwrite_all):
+            with blockio.ParallelWriter(self.path, pool=self.pool) as w:
+                w._written_direct = True
+                w.write(b'a' * 8192)
+                # Zeros written by the writer itself, not by its threads
+                w._zero_range(16384, 4096)
+        self.assertEqual([w._seek_lock] * 2, locks)
+
+    def test_no_fall_back_with_writes_in_flight(self):
+        writer = blockio.ParallelWriter(self.path, pool=self.pool)
+        writer._threads = [mock.Mock()]
+        self.assertRaises(OSError, writer._fall_back, 'unaligned write')
+        writer._threads = []
+        writer.close(flush=False)
+
+    @mock.patch.object(blockio, 'pwrite_all', autospec=True)
+    def test_write_error_raised_by_next_write(self, pwrite_mock):
+        pwrite_mock.side_effect = OSError(errno.EIO, 'I/O error')
+        writer = blockio.ParallelWriter(self.path, pool=self.pool,
+                                        queue_depth=1)
+        writer._written_direct = True
+        writer.write(b'a' * 8192)
+        writer._drain()
+        self.assertRaises(OSError, writer.write, b'a' * 8192)
+        writer.close(flush=False)
+
+
+class TestPositionalWriter(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestPositionalWriter, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+        self.pool = blockio.BufferPool(buffer_size=8192)
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_write_at(self):
+        with blockio.PositionalWriter(self.path, pool=self.pool) as writer:
+            writer.write_at(8192, b'b' * 4096)
+            writer.write_at(0, b'a' * 4096)
+            writer.write_zeroes(4096, 4096)
+        self.assertEqual(b'a' * 4096 + b'\0' * 4096 + b'b' * 4096,
+                         self._read())
+        self.assertEqual(12288, writer.bytes_written)
+        self.assertEqual(1, len(self.pool._free))
+
+    def test_unaligned_write(self):
+        with blockio.PositionalWriter(self.path, pool=self.pool) as writer:
+            writer.write_at(0, b'a' * 4096)
+            writer.write_at(4096, b'b' * 100)
+            writer.write_zeroes(10, 20000)
+        self.assertFalse(writer.direct)
+        self.assertEqual(b'a' * 10 + b'\0' * 20000, self._read())
+
+    def test_zero_skip(self):
+        with blockio.PositionalWriter(self.path, pool=self.pool,
+                                      zero_handling=blockio.ZERO_SKIP) as w:
+            w.write_at(0, b'a' * 4096 + b'\0' * 4096)
+            w.write_zeroes(8192, 8192)
+        self.assertEqual(b'a' * 4096 + b'\0' * 12288, self._read())
+        # Zeros are detected in blocks of ZERO_BLOCK_SIZE
+        self.assertEqual(8192, w.bytes_written)
+        self.assertEqual(8192, w.bytes_skipped)
+
+
+class TestZeroing(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestZeroing, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+
+    @mock.patch.object(blockio, '_queue_attribute', autospec=True)
+    def test_get_zeroing_support(self, attribute_mock):
+        attributes = {'discard_max_bytes': '2199023255040',
+                      'discard_zeroes_data': '0',
+                      'write_zeroes_max_bytes': '0'}
+        attribute_mock.side_effect = lambda st, name: attributes[name]
+        self.assertEqual({'discard': True, 'discard_zeroes_data': False,
+                          'write_zeroes': False},
+                         blockio.get_zeroing_support(self.path))
+
+    def test_get_zeroing_support_file(self):
+        self.assertEqual({'discard': False, 'discard_zeroes_data': False,
+                          'write_zeroes': False},
+                         blockio.get_zeroing_support(self.path))
+
+    @mock.patch('fcntl.ioctl', autospec=True)
+    def test_requests(self, ioctl_mock):
+        blockio.discard_range(42, 0, 8192, secure=True)
+        blockio.discard_range(42, 0, 8192)
+        blockio.zero_range(42, 4096, 8192)
+        self.assertEqual([
+            mock.call(42, blockio._BLKSECDISCARD, struct.pack('QQ', 0, 8192)),
+            mock.call(42, blockio._BLKDISCARD, struct.pack('QQ', 0, 8192)),
+            mock.call(42, blockio._BLKZEROOUT,
+                      struct.pack('QQ', 4096, 8192)),
+        ], ioctl_mock.call_args_list)
+
+    def test_find_non_zero(self):
+        size = 64 * blockio.ZERO_BLOCK_SIZE + 100
+        with open(self.path, 'wb') as f:
+            f.write(b'\0' * (size - 1) + b'a')
+        self.assertEqual(size - blockio.ZERO_BLOCK_SIZE,
+                         blockio.find_non_zero(self.path, size))
+        with open(self.path, 'r+b') as f:
+            f.seek(size - 1)
+            f.write(b'\0')
+        self.assertIsNone(blockio.find_non_zero(self.path, size))
+
+    def test_find_non_zero_small(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\0' * 100)
+        self.assertIsNone(blockio.find_non_zero(self.path, 100))
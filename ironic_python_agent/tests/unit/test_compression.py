@@ -0,0 +1,144 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bz2
+import gzip
+import io
+import os
+
+import mock
+from oslotest import base as test_base
+import testtools
+
+from ironic_python_agent import compression
+from ironic_python_agent import errors
+
+DATA = b'\0' * 300000 + os.urandom(5000) + b'\0' * 300000
+
+_skip_bzip2 = testtools.skipIf(compression.BZIP2 not in compression.SUPPORTED,
+                               'bzip2 is not supported')
+
+
+def _gzip(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def _chunks(data, size=1000):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestDetect(test_base.BaseTestCase):
+    def test_detect(self):
+        self.assertEqual(compression.GZIP, compression.detect(_gzip(b'x')))
+        self.assertEqual(compression.BZIP2,
+                         compression.detect(bz2.compress(b'x')))
+        self.assertEqual(compression.XZ,
+                         compression.detect(b'\xfd7zXZ\x00\x00'))
+        self.assertEqual(compression.ZSTD,
+                         compression.detect(b'\x28\xb5\x2f\xfd\x00'))
+        self.assertEqual(compression.NONE, compression.detect(b'\xebc\x90'))
+
+    def test_detect_needs_more(self):
+        self.assertIsNone(compression.detect(b''))
+        self.assertIsNone(compression.detect(b'\xfd7z'))
+
+
+class TestStreamDecompressor(test_base.BaseTestCase):
+    def _run(self, chunks, **kwargs):
+        decompressor = compression.StreamDecompressor(**kwargs)
+        pieces = []
+        for chunk in chunks:
+            pieces.extend(decompressor.decompress(chunk))
+        pieces.extend(decompressor.flush())
+        return pieces
+
+    def _check(self, compressed, **kwargs):
+        pieces = self._run(_chunks(compressed), max_output=65536, **kwargs)
+        self.assertEqual(DATA, b''.join(pieces))
+        self.assertTrue(all(len(p) <= 65536 for p in pieces))
+
+    def test_gzip(self):
+        self._check(_gzip(DATA))
+
+    def test_gzip_multi_member(self):
+        self._check(_gzip(DATA[:1000]) + _gzip(DATA[1000:]))
+
+    @_skip_bzip2
+    def test_bzip2(self):
+        self._check(bz2.compress(DATA))
+
+    @_skip_bzip2
+    def test_bzip2_explicit(self):
+        self._check(bz2.compress(DATA), compression=compression.BZIP2)
+
+    @testtools.skipIf(compression.lzma is None
+                      or compression.XZ not in compression.SUPPORTED,
+                      'xz is not supported')
+    def test_xz(self):
+        lzma = compression.lzma
+        self._check(lzma.compress(DATA[:1000]) + lzma.compress(DATA[1000:]))
+
+    @testtools.skipIf(compression.zstandard is None,
+                      'zstandard is not available')
+    def test_zstd(self):
+        compressor = compression.zstandard.ZstdCompressor()
+        self._check(compressor.compress(DATA))
+
+    def test_passthrough(self):
+        chunks = [b'\xebc\x90', b'more', b'data']
+        self.assertEqual(chunks, self._run(chunks))
+
+    def test_passthrough_forced(self):
+        data = _gzip(b'x')
+        self.assertEqual([data],
+                         self._run([data], compression=compression.NONE))
+
+    def test_passthrough_short(self):
+        self.assertEqual([b'\xfd7'], self._run([b'\xfd', b'7']))
+
+    @mock.patch.object(compression, '_UNCAPPED',
+                       set([compression.BZIP2]))
+    def test_uncapped(self):
+        # Python < 3.5, whose bz2 and lzma cannot cap their output
+        self.assertRaises(errors.DecompressionError,
+                          compression.StreamDecompressor,
+                          compression=compression.BZIP2)
+        decompressor = compression.StreamDecompressor()
+        self.assertRaises(errors.DecompressionError,
+                          decompressor.decompress, b'BZh91AY&SY')
+
+    @_skip_bzip2
+    def test_truncated(self):
+        decompressor = compression.StreamDecompressor()
+        list(decompressor.decompress(bz2.compress(DATA)[:-10]))
+        self.assertRaises(errors.DecompressionError,
+                          lambda: list(decompressor.flush()))
+
+    def test_corrupt(self):
+        decompressor = compression.StreamDecompressor()
+        self.assertRaises(errors.DecompressionError, list,
+                          decompressor.decompress(b'\x1f\x8bgarbage'))
+
+
+class TestValidate(test_base.BaseTestCase):
+    def test_validate(self):
+        compression.validate(None)
+        compression.validate('gzip')
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          compression.validate, 'rar')
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          compression.validate, 42)
@@ -0,0 +1,140 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+
+import mock
+from oslotest import base as test_base
+
+from ironic_python_agent import delta
+from ironic_python_agent import errors
+from ironic_python_agent import manifest
+
+
+class FakeWriter(object):
+    def __init__(self, data):
+        self.data = bytearray(data)
+
+    def write_at(self, offset, data):
+        self.data[offset:offset + len(data)] = data
+
+    def write_zeroes(self, offset, length):
+        self.write_at(offset, b'\0' * length)
+
+
+class FakeResponse(object):
+    def __init__(self, data, status_code=206, headers=None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size=None):
+        for i in range(0, len(self.data), 7):
+            yield self.data[i:i + 7]
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    """Serves byte ranges of different data for each URL."""
+
+    def __init__(self, files):
+        self.files = files
+        self.requests = []
+
+    def get(self, url, stream=False, proxies=None, headers=None):
+        self.requests.append((url, headers['Range']))
+        data = self.files[url]
+        first, last = headers['Range'][len('bytes='):].split('-')
+        first, last = int(first), int(last)
+        return FakeResponse(data[first:last + 1], headers={
+            'Content-Range': 'bytes {0}-{1}/{2}'.format(first, last,
+                                                        len(data))})
+
+
+class TestRanges(test_base.BaseTestCase):
+    def test_ranges(self):
+        self.assertEqual([(0, 2), (2, 3), (5, 6), (7, 9), (9, 10)],
+                         delta._ranges([0, 1, 2, 5, 7, 8, 9], max_blocks=2))
+        self.assertEqual([(0, 3), (5, 6), (7, 10)],
+                         delta._ranges([0, 1, 2, 5, 7, 8, 9]))
+
+
+class TestDeltaWriter(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestDeltaWriter, self).setUp()
+        self.new = bytearray(os.urandom(1000))
+        self.new[500:600] = b'\0' * 100
+        self.new = bytes(self.new)
+        old = bytearray(self.new)
+        for offset in (150, 250, 550, 950):
+            old[offset] ^= 0xff
+        self.old = bytes(old)
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        with open(path, 'wb') as f:
+            f.write(self.new)
+        self.manifest = manifest.generate(path, block_size=100)
+        with open(path, 'wb') as f:
+            f.write(self.old)
+        self.changed = self.manifest.diff(path)
+
+    def test_write(self):
+        self.assertEqual([1, 2, 5, 9], self.changed)
+        writer = FakeWriter(self.old)
+        session = FakeSession({'http://a': self.new})
+        stats = delta.DeltaWriter(self.manifest, ['http://a'], writer,
+                                  concurrency=2,
+                                  session=session).write(self.changed)
+        self.assertEqual(self.new, bytes(writer.data))
+        self.assertEqual(['bytes=100-299', 'bytes=900-999'],
+                         sorted(r for _url, r in session.requests))
+        self.assertEqual({'blocks': 10, 'blocks_changed': 4,
+                          'bytes_downloaded': 300, 'bytes_zeroed': 100,
+                          'bytes_saved': 700}, stats.serialize())
+
+    def test_write_throttled(self):
+        writer = FakeWriter(self.old)
+        session = FakeSession({'http://a': self.new})
+        bucket = mock.Mock(spec=['consume'])
+        delta.DeltaWriter(self.manifest, ['http://a'], writer,
+                          concurrency=1, session=session,
+                          bucket=bucket).write(self.changed)
+        self.assertEqual(300, sum(c[0][0]
+                                  for c in bucket.consume.call_args_list))
+
+    def test_bad_mirror(self):
+        corrupt = self.new[:200] + b'x' * 800
+        writer = FakeWriter(self.old)
+        session = FakeSession({'http://a': corrupt, 'http://b': self.new})
+        delta.DeltaWriter(self.manifest, ['http://a', 'http://b'], writer,
+                          concurrency=1, session=session).write(self.changed)
+        self.assertEqual(self.new, bytes(writer.data))
+        # Block 1 was fine on the first mirror and is not fetched again
+        self.assertIn(('http://b', 'bytes=200-299'), session.requests)
+
+    def test_retries_exhausted(self):
+        session = mock.Mock()
+        session.get.return_value = FakeResponse(b'', status_code=500)
+        writer = FakeWriter(self.old)
+        self.assertRaisesRegexp(
+            errors.DownloadError, 'Unable to download blocks 1-2',
+            delta.DeltaWriter(self.manifest, ['http://a'], writer,
+                              concurrency=1, retries=2,
+                              session=session).write, self.changed[:2])
+        self.assertEqual(3, session.get.call_count)
@@ -0,0 +1,343 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import time
+
+import mock
+from oslotest import base as test_base
+
+from ironic_python_agent import download
+from ironic_python_agent import errors
+from ironic_python_agent import manifest
+from ironic_python_agent import transport
+
+
+class FakeResponse(object):
+    def __init__(self, data, status_code=200, headers=None, chunk_size=3):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.chunk_size = chunk_size
+        self.closed = False
+
+    def iter_content(self, chunk_size=None):
+        for i in range(0, len(self.data), self.chunk_size):
+            yield self.data[i:i + self.chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeServer(object):
+    """Serves byte ranges of ``data`` like a range-capable web server."""
+
+    def __init__(self, data, ranges=True, truncate=None):
+        self.data = data
+        self.ranges = ranges
+        self.truncate = truncate
+        self.requests = []
+        self.urls = set()
+
+    def get(self, url, stream=False, proxies=None, headers=None):
+        headers = headers or {}
+        self.requests.append(headers.get('Range'))
+        self.urls.add(url)
+        if not self.ranges or 'Range' not in headers:
+            return FakeResponse(self.data)
+        first, last = headers['Range'][len('bytes='):].split('-')
+        first = int(first)
+        last = min(int(last), len(self.data) - 1)
+        body = self.data[first:last + 1]
+        if self.truncate is not None and first == self.truncate:
+            body = body[:-1]
+        content_range = 'bytes {0}-{1}/{2}'.format(first, last,
+                                                   len(self.data))
+        return FakeResponse(body, status_code=206,
+                            headers={'Content-Range': content_range})
+
+
+class TestParseContentRange(test_base.BaseTestCase):
+    def test_parse(self):
+        self.assertEqual((0, 1023, 4096),
+                         download.parse_content_range('bytes 0-1023/4096'))
+
+    def test_parse_unknown_total(self):
+        self.assertEqual((5, 9, None),
+                         download.parse_content_range('bytes 5-9/*'))
+
+    def test_parse_invalid(self):
+        self.assertRaises(errors.DownloadError,
+                          download.parse_content_range, 'items 0-1/2')
+        self.assertRaises(errors.DownloadError,
+                          download.parse_content_range, None)
+
+
+@mock.patch.object(transport, 'get_session', autospec=True)
+class TestOpenRanged(test_base.BaseTestCase):
+    data = b''.join(chr(ord('a') + i % 26).encode() for i in range(100))
+
+    def test_ranged(self, session_mock):
+        server = FakeServer(self.data)
+        session_mock.return_value = server
+
+        resp = download.open_ranged('http://example.org', 4, segment_size=16)
+
+        self.assertIsInstance(resp, download.SegmentedDownload)
+        self.assertEqual(self.data, b''.join(resp.iter_content(8)))
+        self.assertEqual(7, len(server.requests))
+        self.assertEqual('bytes=0-15', server.requests[0])
+        self.assertEqual(sorted('bytes={0}-{1}'.format(i, min(i + 15, 99))
+                                for i in range(0, 100, 16)),
+                         sorted(server.requests))
+
+    def test_ranged_start(self, session_mock):
+        server = FakeServer(self.data)
+        session_mock.return_value = server
+
+        resp = download.open_ranged('http://example.org', 2, segment_size=32,
+                                    start=40)
+
+        self.assertEqual(self.data[40:], b''.join(resp.iter_content(8)))
+        self.assertEqual(['bytes=40-71', 'bytes=72-99'],
+                         sorted(server.requests))
+
+    def test_ranged_single_segment(self, session_mock):
+        server = FakeServer(self.data)
+        session_mock.return_value = server
+
+        resp = download.open_ranged('http://example.org', 4,
+                                    segment_size=1000)
+
+        self.assertEqual(self.data, b''.join(resp.iter_content(8)))
+        self.assertEqual(['bytes=0-999'], server.requests)
+
+    def test_ranges_not_supported(self, session_mock):
+        server = FakeServer(self.data, ranges=False)
+        session_mock.return_value = server
+
+        resp = download.open_ranged('http://example.org', 4, segment_size=16)
+
+        self.assertIsInstance(resp, FakeResponse)
+        self.assertEqual(200, resp.status_code)
+
+    def test_unknown_total_size(self, session_mock):
+        session_mock.return_value.get.return_value = FakeResponse(
+            b'abc', status_code=206, headers={'Content-Range': 'bytes 0-2/*'})
+
+        self.assertRaises(errors.DownloadError, download.open_ranged,
+                          'http://example.org', 4, segment_size=16)
+        self.assertTrue(session_mock.return_value.get.return_value.closed)
+
+    def test_short_segment(self, session_mock):
+        server = FakeServer(self.data, truncate=32)
+        session_mock.return_value = server
+
+        resp = download.open_ranged('http://example.org', 2, segment_size=16)
+
+        self.assertRaises(errors.DownloadError, b''.join,
+                          resp.iter_content(8))
+
+
+class TestSegmentedDownload(test_base.BaseTestCase):
+    def test_window_bounds_buffering(self):
+        data = b'x' * 64
+        server = FakeServer(data)
+        segmented = download.SegmentedDownload(
+            'http://example.org', len(data), 1, segment_size=8,
+            session=server)
+        self.assertEqual(2, segmented.window)
+
+        chunks = segmented.iter_content()
+        next(chunks)
+        # The consumer is still in the first segment, so the worker may
+        # only have claimed the segments inside the window.
+        self.assertLessEqual(segmented._next_segment, segmented.window)
+        self.assertEqual(data[3:], b''.join(chunks))
+        self.assertEqual([], segmented._threads)
+
+    def test_mirrors(self):
+        data = b'x' * 64
+        server = FakeServer(data)
+        mirror_used = threading.Event()
+        real_get = server.get
+
+        def _get(url, **kwargs):
+            # Hold the first worker back until the mirror got a segment
+            if url == 'http://example.com':
+                mirror_used.set()
+            else:
+                mirror_used.wait(5)
+            return real_get(url, **kwargs)
+
+        server.get = _get
+        segmented = download.SegmentedDownload(
+            'http://example.org', len(data), 2, segment_size=8,
+            session=server, mirrors=['http://example.org',
+                                     'http://example.com'])
+        self.assertEqual(['http://example.org', 'http://example.com'],
+                         segmented.urls)
+        self.assertEqual(data, b''.join(segmented.iter_content()))
+        self.assertEqual({'http://example.org', 'http://example.com'},
+                         server.urls)
+
+    def test_mirror_size_mismatch(self):
+        server = mock.Mock()
+        server.get.return_value = FakeResponse(
+            b'abcde', status_code=206,
+            headers={'Content-Range': 'bytes 0-4/12'})
+        segmented = download.SegmentedDownload(
+            'http://example.org', 10, 1, segment_size=5, session=server)
+
+        self.assertRaisesRegexp(errors.DownloadError, 'expected 10',
+                                list, segmented.iter_content())
+
+    def _manifest_session(self, data, servers):
+        builder = manifest.Builder(block_size=8)
+        builder.update(data)
+        session = mock.Mock()
+        session.get.side_effect = (
+            lambda url, **kwargs: servers[url].get(url, **kwargs))
+        return builder.finish(), session
+
+    def test_manifest_bad_mirror(self):
+        data = os.urandom(64)
+        good = FakeServer(data)
+        bad = FakeServer(b'y' * 64)
+        pieces, session = self._manifest_session(
+            data, {'http://example.org': good, 'http://example.com': bad})
+        segmented = download.SegmentedDownload(
+            'http://example.org', len(data), 2, session=session,
+            mirrors=['http://example.com'], manifest=pieces)
+
+        self.assertEqual(data, b''.join(segmented.iter_content()))
+        # The bad mirror is given up after its first segment
+        self.assertLessEqual(len(bad.requests), 1)
+
+    def test_manifest_bad_mirror_fails_last(self):
+        data = os.urandom(32)
+        good = FakeServer(data)
+        bad = FakeServer(b'y' * 32)
+        real_good_get = good.get
+        real_bad_get = bad.get
+        bad_claimed = threading.Event()
+
+        def _good_get(url, **kwargs):
+            bad_claimed.wait(5)
+            return real_good_get(url, **kwargs)
+
+        def _bad_get(url, **kwargs):
+            # Fail only once the origin has fetched every other segment
+            bad_claimed.set()
+            for _ in range(500):
+                if len(good.requests) == 3:
+                    break
+                time.sleep(0.01)
+            time.sleep(0.1)
+            return real_bad_get(url, **kwargs)
+
+        good.get = _good_get
+        bad.get = _bad_get
+        pieces, session = self._manifest_session(
+            data, {'http://example.org': good, 'http://example.com': bad})
+        segmented = download.SegmentedDownload(
+            'http://example.org', len(data), 2, session=session,
+            mirrors=['http://example.com'], manifest=pieces)
+
+        # The origin waited for the segment of the mirror and fetched it
+        # again when it failed
+        self.assertEqual(data, b''.join(segmented.iter_content()))
+        self.assertEqual(4, len(good.requests))
+
+    def test_manifest_all_sources_bad(self):
+        data = os.urandom(64)
+        bad = FakeServer(b'y' * 64)
+        pieces, session = self._manifest_session(
+            data, {'http://example.org': bad, 'http://example.com': bad})
+        segmented = download.SegmentedDownload(
+            'http://example.org', len(data), 2, session=session,
+            mirrors=['http://example.com'], manifest=pieces)
+
+        self.assertRaisesRegexp(errors.DownloadError,
+                                'do not match the manifest',
+                                list, segmented.iter_content())
+
+    def test_bad_status(self):
+        server = mock.Mock()
+        server.get.return_value = FakeResponse(b'', status_code=500)
+        segmented = download.SegmentedDownload(
+            'http://example.org', 10, 2, segment_size=5, session=server)
+
+        self.assertRaises(errors.DownloadError, list,
+                          segmented.iter_content())
+
+    def test_wrong_range(self):
+        server = mock.Mock()
+        server.get.return_value = FakeResponse(
+            b'abcde', status_code=206,
+            headers={'Content-Range': 'bytes 0-4/10'})
+        segmented = download.SegmentedDownload(
+            'http://example.org', 10, 1, segment_size=5, session=server,
+            first_response=FakeResponse(
+                b'abcde', status_code=206,
+                headers={'Content-Range': 'bytes 0-4/10'}))
+
+        self.assertRaises(errors.DownloadError, list,
+                          segmented.iter_content())
+
+
+class TestRankMirrors(test_base.BaseTestCase):
+    @mock.patch.object(transport, 'get', autospec=True)
+    def test_probe(self, get_mock):
+        get_mock.return_value = FakeResponse(b'x' * 100, status_code=206)
+        probe = download.MirrorProbe('http://example.org')
+        download._probe(probe, 10, {}, 5)
+        get_mock.assert_called_once_with(
+            'http://example.org', stream=True, proxies={}, timeout=5,
+            headers={'Range': 'bytes=0-9'})
+        self.assertIsNone(probe.error)
+        self.assertEqual(12, probe.sample_bytes)
+        self.assertIsNotNone(probe.ttfb)
+        self.assertTrue(get_mock.return_value.closed)
+
+    @mock.patch.object(transport, 'get', autospec=True)
+    def test_probe_error(self, get_mock):
+        get_mock.return_value = FakeResponse(b'', status_code=404)
+        probe = download.MirrorProbe('http://example.org')
+        download._probe(probe, 10, {}, 5)
+        self.assertIn('404', probe.error)
+        self.assertEqual(float('inf'), probe.estimate(10))
+
+    @mock.patch.object(download, '_probe', autospec=True)
+    def test_rank(self, probe_mock):
+        # url: (ttfb, bytes, seconds)
+        samples = {'http://slow': (0.1, 100, 10.0),
+                   'http://laggy': (5.0, 100, 0.1),
+                   'http://fast': (0.1, 100, 1.0)}
+
+        def _probe(probe, sample_size, proxies, timeout):
+            if probe.url == 'http://down':
+                probe.error = 'Connection refused'
+                return
+            probe.ttfb, probe.sample_bytes, probe.sample_time = (
+                samples[probe.url])
+
+        probe_mock.side_effect = _probe
+        ranked = download.rank_mirrors(['http://down', 'http://slow',
+                                        'http://laggy', 'http://fast'],
+                                       sample_size=100)
+        self.assertEqual(['http://fast', 'http://laggy', 'http://slow',
+                          'http://down'], [p.url for p in ranked])
+        self.assertEqual(4, probe_mock.call_count)
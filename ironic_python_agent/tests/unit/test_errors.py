@@ -114,9 +114,13 @@ class TestErrors(test_base.BaseTestCase):
                   DIFF_CL_DETAILS),
                  (errors.ConfigDriveTooLargeError('filename', 'filesize'),
                   DIFF_CL_DETAILS),
+                 (errors.ConfigDriveDownloadError('url', 'details'),
+                  DIFF_CL_DETAILS),
                  (errors.ConfigDriveWriteError('device', 'exit_code', 'stdout',
                                                'stderr'),
                   DIFF_CL_DETAILS),
+                 (errors.ConfigDrivePartitionError('device', 'details'),
+                  DIFF_CL_DETAILS),
                  (errors.SystemRebootError('exit_code', 'stdout', 'stderr'),
                   DIFF_CL_DETAILS),
                  (errors.BlockDeviceEraseError(DETAILS), SAME_DETAILS),
@@ -15,6 +15,8 @@
 import mock
 import netifaces
 import os
+import tempfile
+import threading
 from oslo_concurrency import processutils
 from oslo_utils import units
 from oslotest import base as test_base
@@ -22,8 +24,10 @@ import pyudev
 import six
 from stevedore import extension
 
+from ironic_python_agent import blockio
 from ironic_python_agent import errors
 from ironic_python_agent import hardware
+from ironic_python_agent import overwrite
 from ironic_python_agent import utils
 
 if six.PY2:
@@ -149,18 +153,12 @@ BLK_DEVICE_TEMPLATE_SMALL_DEVICES = [
                          vendor="FooTastic"),
 ]
 
-SHRED_OUTPUT = (
-    'shred: /dev/sda: pass 1/2 (random)...\n'
-    'shred: /dev/sda: pass 1/2 (random)...4.9GiB/29GiB 17%\n'
-    'shred: /dev/sda: pass 1/2 (random)...15GiB/29GiB 51%\n'
-    'shred: /dev/sda: pass 1/2 (random)...20GiB/29GiB 69%\n'
-    'shred: /dev/sda: pass 1/2 (random)...29GiB/29GiB 100%\n'
-    'shred: /dev/sda: pass 2/2 (000000)...\n'
-    'shred: /dev/sda: pass 2/2 (000000)...4.9GiB/29GiB 17%\n'
-    'shred: /dev/sda: pass 2/2 (000000)...15GiB/29GiB 51%\n'
-    'shred: /dev/sda: pass 2/2 (000000)...20GiB/29GiB 69%\n'
-    'shred: /dev/sda: pass 2/2 (000000)...29GiB/29GiB 100%\n'
-)
+OVERWRITE_STATS = [
+    {'pass': 1, 'type': 'random', 'bytes': 1073741824, 'seconds': 2.0,
+     'throughput': 512.0},
+    {'pass': 2, 'type': 'zero', 'bytes': 1073741824, 'seconds': 1.0,
+     'throughput': 1024.0},
+]
 
 
 LSCPU_OUTPUT = """
@@ -585,6 +583,82 @@ class TestGenericHardwareManager(test_base.BaseTestCase):
 
         self.assertEqual(expected, result)
 
+    @mock.patch.object(hardware, 'dispatch_to_managers')
+    def test_erase_devices_concurrently(self, mocked_dispatch):
+        names = ['/dev/sd{0}'.format(c) for c in 'abcd']
+        self.hardware.list_block_devices = mock.Mock(return_value=[
+            hardware.BlockDevice(name, 'disk', 65535, False)
+            for name in names])
+        # Every erasure waits for the other ones to start
+        started = []
+        all_started = threading.Event()
+
+        def _erase(method, node, block_device):
+            started.append(block_device.name)
+            if len(started) == len(names):
+                all_started.set()
+            if not all_started.wait(5):
+                return 'erased alone'
+            return 'erased ' + block_device.name
+
+        mocked_dispatch.side_effect = _erase
+        result = self.hardware.erase_devices(
+            {'driver_internal_info': {'agent_erase_devices_concurrency': 4}},
+            [])
+        self.assertEqual(dict((name, 'erased ' + name) for name in names),
+                         result)
+
+    @mock.patch.object(hardware, 'dispatch_to_managers')
+    def test_erase_devices_concurrency_string(self, mocked_dispatch):
+        self.hardware.list_block_devices = mock.Mock(return_value=[
+            hardware.BlockDevice('/dev/sda', 'disk', 65535, False)])
+        mocked_dispatch.return_value = 'erased'
+        result = self.hardware.erase_devices(
+            {'driver_internal_info': {
+                'agent_erase_devices_concurrency': '2'}}, [])
+        self.assertEqual({'/dev/sda': 'erased'}, result)
+
+    @mock.patch.object(hardware, 'dispatch_to_managers')
+    def test_erase_devices_invalid_concurrency(self, mocked_dispatch):
+        self.hardware.list_block_devices = mock.Mock(return_value=[
+            hardware.BlockDevice('/dev/sda', 'disk', 65535, False)])
+        for concurrency in (0, -1, 'many', None):
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              self.hardware.erase_devices,
+                              {'driver_internal_info': {
+                                  'agent_erase_devices_concurrency':
+                                      concurrency}}, [])
+        self.assertFalse(mocked_dispatch.called)
+
+    @mock.patch.object(hardware, 'dispatch_to_managers')
+    def test_erase_devices_failures(self, mocked_dispatch):
+        self.hardware.list_block_devices = mock.Mock(return_value=[
+            hardware.BlockDevice(name, 'disk', 65535, False)
+            for name in ('/dev/sda', '/dev/sdb', '/dev/sdc')])
+
+        def _erase(method, node, block_device):
+            if block_device.name != '/dev/sdb':
+                raise errors.BlockDeviceEraseError(
+                    'boom ' + block_device.name)
+            return 'erased'
+
+        mocked_dispatch.side_effect = _erase
+        error = self.assertRaises(errors.BlockDeviceEraseError,
+                                  self.hardware.erase_devices, {}, [])
+        self.assertIn('Failed to erase 2 block devices', str(error))
+        self.assertIn('boom /dev/sda', str(error))
+        self.assertIn('boom /dev/sdc', str(error))
+        self.assertEqual(3, mocked_dispatch.call_count)
+
+        # A single failure is raised as it is
+        mocked_dispatch.side_effect = [
+            'erased', errors.IncompatibleHardwareMethodError('no way'),
+            'erased']
+        self.assertRaises(errors.IncompatibleHardwareMethodError,
+                          self.hardware.erase_devices,
+                          {'driver_internal_info': {
+                              'agent_erase_devices_concurrency': 1}}, [])
+
     @mock.patch.object(utils, 'execute')
     def test_erase_block_device_ata_success(self, mocked_execute):
         hdparm_info_fields = {
@@ -612,28 +686,28 @@ class TestGenericHardwareManager(test_base.BaseTestCase):
             mock.call('hdparm', '-I', '/dev/sda'),
         ])
 
+    @mock.patch.object(overwrite, 'overwrite', autospec=True)
     @mock.patch.object(utils, 'execute')
-    def test_erase_block_device_nosecurity_shred(self, mocked_execute):
+    def test_erase_block_device_nosecurity_shred(self, mocked_execute,
+                                                 mocked_overwrite):
         hdparm_output = HDPARM_INFO_TEMPLATE.split('\nSecurity:')[0]
         info = self.node.get('driver_internal_info')
         info['agent_erase_devices_iterations'] = 2
 
-        mocked_execute.side_effect = [
-            (hdparm_output, ''),
-            (SHRED_OUTPUT, '')
-        ]
+        mocked_execute.return_value = (hdparm_output, '')
+        mocked_overwrite.return_value = OVERWRITE_STATS
 
         block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
                                             True)
         self.hardware.erase_block_device(self.node, block_device)
-        mocked_execute.assert_has_calls([
-            mock.call('hdparm', '-I', '/dev/sda'),
-            mock.call('shred', '--force', '--zero', '--verbose',
-                      '--iterations', '2', '/dev/sda')
-        ])
+        mocked_execute.assert_called_once_with('hdparm', '-I', '/dev/sda')
+        mocked_overwrite.assert_called_once_with('/dev/sda', iterations=2,
+                                                 zero=True)
 
+    @mock.patch.object(overwrite, 'overwrite', autospec=True)
     @mock.patch.object(utils, 'execute')
-    def test_erase_block_device_notsupported_shred(self, mocked_execute):
+    def test_erase_block_device_notsupported_shred(self, mocked_execute,
+                                                   mocked_overwrite):
         hdparm_output = HDPARM_INFO_TEMPLATE % {
             'supported': 'not\tsupported',
             'enabled': 'not\tenabled',
@@ -641,19 +715,15 @@ class TestGenericHardwareManager(test_base.BaseTestCase):
             'enhanced_erase': 'not\tsupported: enhanced erase',
         }
 
-        mocked_execute.side_effect = [
-            (hdparm_output, ''),
-            (SHRED_OUTPUT, '')
-        ]
+        mocked_execute.return_value = (hdparm_output, '')
+        mocked_overwrite.return_value = OVERWRITE_STATS
 
         block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
                                             True)
         self.hardware.erase_block_device(self.node, block_device)
-        mocked_execute.assert_has_calls([
-            mock.call('hdparm', '-I', '/dev/sda'),
-            mock.call('shred', '--force', '--zero', '--verbose',
-                      '--iterations', '1', '/dev/sda')
-        ])
+        mocked_execute.assert_called_once_with('hdparm', '-I', '/dev/sda')
+        mocked_overwrite.assert_called_once_with('/dev/sda', iterations=1,
+                                                 zero=True)
 
     @mock.patch.object(hardware.GenericHardwareManager,
                        '_is_virtual_media_device', autospec=True)
@@ -702,27 +772,159 @@ class TestGenericHardwareManager(test_base.BaseTestCase):
         mocked_exists.assert_called_once_with('/dev/disk/by-label/ir-vfd-dev')
         self.assertFalse(mocked_link.called)
 
-    @mock.patch.object(utils, 'execute')
-    def test_erase_block_device_shred_fail_oserror(self, mocked_execute):
-        mocked_execute.side_effect = OSError
+    @mock.patch.object(overwrite, 'overwrite', autospec=True)
+    def test_erase_block_device_shred_fail_oserror(self, mocked_overwrite):
+        mocked_overwrite.side_effect = OSError
         block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
                                             True)
         res = self.hardware._shred_block_device(self.node, block_device)
         self.assertFalse(res)
-        mocked_execute.assert_called_once_with(
-            'shred', '--force', '--zero', '--verbose', '--iterations', '1',
-            '/dev/sda')
+        mocked_overwrite.assert_called_once_with('/dev/sda', iterations=1,
+                                                 zero=True)
 
-    @mock.patch.object(utils, 'execute')
-    def test_erase_block_device_shred_fail_processerror(self, mocked_execute):
-        mocked_execute.side_effect = processutils.ProcessExecutionError
+    @mock.patch.object(overwrite, 'overwrite', autospec=True)
+    def test_erase_block_device_shred_fail_ioerror(self, mocked_overwrite):
+        mocked_overwrite.side_effect = IOError
         block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
                                             True)
         res = self.hardware._shred_block_device(self.node, block_device)
         self.assertFalse(res)
-        mocked_execute.assert_called_once_with(
-            'shred', '--force', '--zero', '--verbose', '--iterations', '1',
-            '/dev/sda')
+
+    @mock.patch.object(overwrite, 'overwrite', autospec=True)
+    def test_erase_block_device_shred_fail_agent_error(self,
+                                                       mocked_overwrite):
+        mocked_overwrite.side_effect = errors.BlockDeviceEraseError('boom')
+        block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
+                                            True)
+        res = self.hardware._shred_block_device(self.node, block_device)
+        self.assertFalse(res)
+
+    @mock.patch.object(overwrite, 'overwrite', autospec=True)
+    def test_erase_block_device_shred_bug(self, mocked_overwrite):
+        mocked_overwrite.side_effect = TypeError
+        block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
+                                            True)
+        self.assertRaises(TypeError, self.hardware._shred_block_device,
+                          self.node, block_device)
+
+    @mock.patch.object(overwrite, 'overwrite', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_discard_block_device', autospec=True)
+    @mock.patch.object(utils, 'execute')
+    def test_erase_block_device_discard(self, mocked_execute,
+                                        mocked_discard, mocked_overwrite):
+        hdparm_output = HDPARM_INFO_TEMPLATE.split('\nSecurity:')[0]
+        mocked_execute.return_value = (hdparm_output, '')
+        mocked_discard.return_value = True
+        block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
+                                            False)
+        self.hardware.erase_block_device(self.node, block_device)
+        mocked_discard.assert_called_once_with(self.hardware, block_device)
+        self.assertFalse(mocked_overwrite.called)
+
+    @mock.patch.object(overwrite, 'overwrite', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       '_discard_block_device', autospec=True)
+    @mock.patch.object(utils, 'execute')
+    def test_erase_block_device_discard_fail_shred(self, mocked_execute,
+                                                   mocked_discard,
+                                                   mocked_overwrite):
+        hdparm_output = HDPARM_INFO_TEMPLATE.split('\nSecurity:')[0]
+        mocked_execute.return_value = (hdparm_output, '')
+        mocked_discard.return_value = False
+        mocked_overwrite.return_value = OVERWRITE_STATS
+        block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
+                                            False)
+        self.hardware.erase_block_device(self.node, block_device)
+        mocked_discard.assert_called_once_with(self.hardware, block_device)
+        mocked_overwrite.assert_called_once_with('/dev/sda', iterations=1,
+                                                 zero=True)
+
+    def _discard_target(self, data):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return hardware.BlockDevice(path, 'big', len(data), False)
+
+    @mock.patch.object(blockio, 'zero_range', autospec=True)
+    @mock.patch.object(blockio, 'discard_range', autospec=True)
+    @mock.patch.object(blockio, 'get_zeroing_support', autospec=True)
+    def test__discard_block_device(self, mocked_support, mocked_discard,
+                                   mocked_zero):
+        mocked_support.return_value = {'discard': True,
+                                       'discard_zeroes_data': True,
+                                       'write_zeroes': False}
+        # Secure discard is not supported
+        mocked_discard.side_effect = [OSError(95, 'Not supported'), None]
+        block_device = self._discard_target(b'\0' * 1048576)
+        self.assertTrue(self.hardware._discard_block_device(block_device))
+        mocked_discard.assert_has_calls([
+            mock.call(mock.ANY, 0, 1048576, secure=True),
+            mock.call(mock.ANY, 0, 1048576, secure=False),
+        ])
+        self.assertFalse(mocked_zero.called)
+
+    @mock.patch.object(blockio, 'zero_range', autospec=True)
+    @mock.patch.object(blockio, 'discard_range', autospec=True)
+    @mock.patch.object(blockio, 'get_zeroing_support', autospec=True)
+    def test__discard_block_device_write_zeroes(self, mocked_support,
+                                                mocked_discard, mocked_zero):
+        mocked_support.return_value = {'discard': True,
+                                       'discard_zeroes_data': False,
+                                       'write_zeroes': True}
+        block_device = self._discard_target(b'\0' * 1048576)
+        self.assertTrue(self.hardware._discard_block_device(block_device))
+        mocked_discard.assert_called_once_with(mock.ANY, 0, 1048576,
+                                               secure=True)
+        mocked_zero.assert_called_once_with(mock.ANY, 0, 1048576)
+
+    @mock.patch.object(blockio, 'zero_range', autospec=True)
+    @mock.patch.object(blockio, 'discard_range', autospec=True)
+    @mock.patch.object(blockio, 'get_zeroing_support', autospec=True)
+    def test__discard_block_device_discard_fail_no_write_zeroes(
+            self, mocked_support, mocked_discard, mocked_zero):
+        mocked_support.return_value = {'discard': True,
+                                       'discard_zeroes_data': True,
+                                       'write_zeroes': False}
+        mocked_discard.side_effect = OSError(95, 'Not supported')
+        block_device = self._discard_target(b'a' * 4096)
+        self.assertFalse(self.hardware._discard_block_device(block_device))
+        self.assertEqual(2, mocked_discard.call_count)
+        self.assertFalse(mocked_zero.called)
+
+    @mock.patch.object(blockio, 'zero_range', autospec=True)
+    @mock.patch.object(blockio, 'get_zeroing_support', autospec=True)
+    def test__discard_block_device_not_zeroed(self, mocked_support,
+                                              mocked_zero):
+        mocked_support.return_value = {'discard': False,
+                                       'discard_zeroes_data': False,
+                                       'write_zeroes': True}
+        block_device = self._discard_target(b'a' * 1048576)
+        self.assertFalse(self.hardware._discard_block_device(block_device))
+        mocked_zero.assert_called_once_with(mock.ANY, 0, 1048576)
+
+    @mock.patch.object(os, 'open', autospec=True)
+    @mock.patch.object(blockio, 'get_zeroing_support', autospec=True)
+    def test__discard_block_device_unsupported(self, mocked_support,
+                                               mocked_open):
+        mocked_support.return_value = {'discard': True,
+                                       'discard_zeroes_data': False,
+                                       'write_zeroes': False}
+        block_device = hardware.BlockDevice('/dev/sda', 'big', 1073741824,
+                                            False)
+        self.assertFalse(self.hardware._discard_block_device(block_device))
+        self.assertFalse(mocked_open.called)
+
+    @mock.patch.object(blockio, 'zero_range', autospec=True)
+    @mock.patch.object(blockio, 'get_zeroing_support', autospec=True)
+    def test__discard_block_device_fail(self, mocked_support, mocked_zero):
+        mocked_support.return_value = {'discard': False,
+                                       'discard_zeroes_data': False,
+                                       'write_zeroes': True}
+        mocked_zero.side_effect = IOError(5, 'I/O error')
+        block_device = self._discard_target(b'\0' * 4096)
+        self.assertFalse(self.hardware._discard_block_device(block_device))
 
     @mock.patch.object(utils, 'execute')
     def test_erase_block_device_ata_security_enabled(self, mocked_execute):
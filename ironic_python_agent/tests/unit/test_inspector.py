@@ -23,13 +23,13 @@ import unittest
 import mock
 from oslo_concurrency import processutils
 from oslo_config import cfg
-import requests
 import six
 import stevedore
 
 from ironic_python_agent import errors
 from ironic_python_agent import hardware
 from ironic_python_agent import inspector
+from ironic_python_agent import transport
 from ironic_python_agent import utils
 
 
@@ -129,7 +129,7 @@ class TestInspect(unittest.TestCase):
         self.assertFalse(mock_setup_ipmi.called)
 
 
-@mock.patch.object(requests, 'post', autospec=True)
+@mock.patch.object(transport, 'post', autospec=True)
 class TestCallInspector(unittest.TestCase):
     def setUp(self):
         super(TestCallInspector, self).setUp()
@@ -22,6 +22,7 @@ from ironic_python_agent import backoff
 from ironic_python_agent import errors
 from ironic_python_agent import hardware
 from ironic_python_agent import ironic_api_client
+from ironic_python_agent import transport
 
 API_URL = 'http://agent-api.ironic.example.org/'
 DRIVER = 'agent_ipmitool'
@@ -38,6 +39,10 @@ class FakeResponse(object):
 class TestBaseIronicPythonAgent(test_base.BaseTestCase):
     def setUp(self):
         super(TestBaseIronicPythonAgent, self).setUp()
+        # The tests replace methods of the session, use a session of their own
+        patcher = mock.patch.multiple(transport, _session=None, _pool_size=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
         self.api_client = ironic_api_client.APIClient(API_URL, DRIVER)
         self.hardware_info = {
             'interfaces': [
@@ -0,0 +1,116 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import tempfile
+
+import mock
+from oslotest import base as test_base
+import requests
+
+from ironic_python_agent import errors
+from ironic_python_agent import manifest
+from ironic_python_agent import transport
+
+
+class TestManifest(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestManifest, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+        self.data = os.urandom(1000)
+        self._write(self.data)
+
+    def _write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def test_generate(self):
+        blocks = manifest.generate(self.path, block_size=300)
+        self.assertEqual(1000, blocks.size)
+        self.assertEqual(4, len(blocks.blocks))
+        self.assertEqual(hashlib.sha256(self.data[900:]).hexdigest(),
+                         blocks.blocks[3])
+        self.assertEqual(blocks.to_dict(),
+                         manifest.Manifest.from_dict(
+                             blocks.to_dict()).to_dict())
+
+    def test_builder(self):
+        builder = manifest.Builder(block_size=300)
+        for i in range(0, 1000, 7):
+            builder.update(self.data[i:i + 7])
+        self.assertEqual(manifest.generate(self.path,
+                                           block_size=300).to_dict(),
+                         builder.finish().to_dict())
+
+    def test_diff(self):
+        blocks = manifest.generate(self.path, block_size=100)
+        self.assertEqual([], blocks.diff(self.path, concurrency=3))
+
+        data = bytearray(self.data)
+        data[150] ^= 0xff
+        data[999] ^= 0xff
+        self._write(bytes(data) + b'trailing data is ignored')
+        self.assertEqual([1, 9], blocks.diff(self.path, concurrency=3))
+        self.assertEqual(1, len(blocks.diff(self.path, first_only=True)))
+
+    def test_diff_short_device(self):
+        blocks = manifest.generate(self.path, block_size=300)
+        self._write(self.data[:700])
+        self.assertEqual([2, 3], blocks.diff(self.path))
+
+    def test_diff_missing_device(self):
+        blocks = manifest.generate(self.path, block_size=300)
+        self.assertRaises(OSError, blocks.diff, self.path + '.missing')
+
+    def test_from_dict_invalid(self):
+        valid = {'size': 10, 'block_size': 4, 'blocks': ['a', 'b', 'c']}
+        manifest.Manifest.from_dict(valid)
+        for change in ({'blocks': ['a']}, {'block_size': 0},
+                       {'size': 'big'}, {'algorithm': 'rot13'},
+                       {'algorithm': 'shake_128'}):
+            data = dict(valid, **change)
+            self.assertRaises(errors.ManifestError,
+                              manifest.Manifest.from_dict, data)
+        self.assertRaises(errors.ManifestError,
+                          manifest.Manifest.from_dict, {'size': 10})
+        self.assertRaises(errors.ManifestError,
+                          manifest.Manifest.from_dict, [])
+
+    def test_hash_region(self):
+        self.assertEqual(hashlib.md5(self.data[:600]).hexdigest(),
+                         manifest.hash_region(self.path, 600, 'md5'))
+        self.assertIsNone(manifest.hash_region(self.path, 1001, 'md5'))
+
+    @mock.patch.object(transport, 'get', autospec=True)
+    def test_load(self, get_mock):
+        data = {'size': 10, 'block_size': 4, 'blocks': ['a', 'b', 'c']}
+        get_mock.return_value.status_code = 200
+        get_mock.return_value.json.return_value = data
+        blocks = manifest.load('http://example.org/manifest', proxies={})
+        self.assertEqual(dict(data, algorithm='sha256'), blocks.to_dict())
+        get_mock.assert_called_once_with('http://example.org/manifest',
+                                         proxies={},
+                                         timeout=manifest.DEFAULT_TIMEOUT)
+
+    @mock.patch.object(transport, 'get', autospec=True)
+    def test_load_error(self, get_mock):
+        get_mock.return_value.status_code = 404
+        self.assertRaisesRegexp(errors.ManifestError, '404', manifest.load,
+                                'http://example.org/manifest')
+        get_mock.side_effect = requests.ConnectionError('refused')
+        self.assertRaisesRegexp(errors.ManifestError, 'refused',
+                                manifest.load, 'http://example.org/manifest')
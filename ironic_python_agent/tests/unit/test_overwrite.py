@@ -0,0 +1,126 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import tempfile
+
+import mock
+from oslotest import base as test_base
+
+from ironic_python_agent import blockio
+from ironic_python_agent import overwrite
+
+# Not a multiple of the buffer size nor of a page
+SIZE = 5 * 65536 + 1000
+
+
+class TestOverwrite(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestOverwrite, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, self.path)
+        self.original = os.urandom(SIZE)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.original)
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_get_passes(self):
+        self.assertEqual([(overwrite.PASS_RANDOM, None),
+                          (overwrite.PASS_ZERO, None)],
+                         overwrite.get_passes(1))
+        self.assertEqual([(overwrite.PASS_RANDOM, None),
+                          (overwrite.PASS_PATTERN, overwrite.PATTERNS[0]),
+                          (overwrite.PASS_PATTERN, overwrite.PATTERNS[1]),
+                          (overwrite.PASS_RANDOM, None)],
+                         overwrite.get_passes(4, zero=False))
+        self.assertEqual([], overwrite.get_passes(0, zero=False))
+
+    def test_overwrite(self):
+        stats = overwrite.overwrite(self.path, iterations=2,
+                                    buffer_size=65536, queue_depth=3)
+        self.assertEqual(b'\0' * SIZE, self._read())
+        self.assertEqual([1, 2, 3], [s['pass'] for s in stats])
+        self.assertEqual(['random', 'random', 'zero'],
+                         [s['type'] for s in stats])
+        for s in stats:
+            self.assertEqual(SIZE, s['bytes'])
+            self.assertIn('throughput', s)
+            self.assertIn('seconds', s)
+
+    def test_random_pass(self):
+        with overwrite.Overwriter(self.path, buffer_size=65536,
+                                  queue_depth=2) as overwriter:
+            self.assertEqual(SIZE, overwriter.size)
+            overwriter.run_pass(1, overwrite.PASS_RANDOM)
+        data = self._read()
+        self.assertEqual(SIZE, len(data))
+        self.assertNotEqual(self.original, data)
+        # Every buffer got its own random data
+        self.assertNotEqual(data[:65536], data[65536:2 * 65536])
+
+    def test_pattern_pass(self):
+        pattern = b'\x92\x49\x24'
+        with overwrite.Overwriter(self.path, buffer_size=65536,
+                                  queue_depth=4) as overwriter:
+            stats = overwriter.run_pass(2, overwrite.PASS_PATTERN, pattern)
+        self.assertEqual('924924', stats['pattern'])
+        # The pattern goes on across buffers
+        expected = (pattern * (SIZE // 3 + 1))[:SIZE]
+        self.assertEqual(expected, self._read())
+
+    @mock.patch.object(overwrite.blockio, 'pwrite_all', autospec=True)
+    def test_write_error(self, mock_pwrite):
+        mock_pwrite.side_effect = OSError(errno.EIO, 'I/O error')
+        self.assertRaises(OSError, overwrite.overwrite, self.path,
+                          buffer_size=65536)
+
+    def test_writes_share_a_lock(self):
+        locks = set()
+        real_pwrite = blockio.pwrite_all
+
+        def _pwrite(fd, data, offset, lock=None):
+            locks.add(lock)
+            return real_pwrite(fd, data, offset, lock)
+
+        # Not a mock, which would keep the buffers referenced
+        with mock.patch.object(overwrite.blockio, 'pwrite_all', _pwrite):
+            with overwrite.Overwriter(self.path, buffer_size=65536,
+                                      queue_depth=3) as overwriter:
+                overwriter.run_pass(1, overwrite.PASS_ZERO)
+        # With O_DIRECT, the unaligned end is written through its own
+        # descriptor, without a lock
+        self.assertEqual(set([overwriter._seek_lock]), locks - set([None]))
+
+    def test_fall_back(self):
+        real_pwrite = blockio.pwrite_all
+        calls = []
+
+        def _pwrite(fd, data, offset, lock=None):
+            calls.append(offset)
+            if len(calls) == 1:
+                raise OSError(errno.EINVAL, 'Invalid argument')
+            return real_pwrite(fd, data, offset, lock)
+
+        with mock.patch.object(overwrite.blockio, 'pwrite_all',
+                               side_effect=_pwrite):
+            with overwrite.Overwriter(self.path, buffer_size=65536,
+                                      queue_depth=1) as overwriter:
+                overwriter.direct = True
+                overwriter.run_pass(1, overwrite.PASS_ZERO)
+                self.assertFalse(overwriter.direct)
+        self.assertEqual(b'\0' * SIZE, self._read())
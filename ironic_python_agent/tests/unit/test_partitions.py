@@ -0,0 +1,313 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import struct
+import tempfile
+import uuid
+import zlib
+
+import mock
+from oslotest import base as test_base
+
+from ironic_python_agent import errors
+from ironic_python_agent import partitions
+
+MB = 1024 * 1024
+LINUX = uuid.UUID('0fc63daf-8483-4772-8e79-3d69d8477de4').bytes_le
+
+
+def _crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+class ImageTestCase(test_base.BaseTestCase):
+    def setUp(self):
+        super(ImageTestCase, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+
+    def _write(self, offset, data):
+        with open(self.path, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+
+    def _read(self, offset, length):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def _resize(self, size):
+        with open(self.path, 'r+b') as f:
+            f.truncate(size)
+
+    def _mbr(self, entries):
+        table = b''.join(struct.pack('<B3sB3sII', 0, b'\0' * 3, kind,
+                                     b'\0' * 3, start, count)
+                         for kind, start, count in entries)
+        table += b'\0' * (64 - len(table))
+        self._write(446, table + b'\x55\xaa')
+
+    def _mbr_entries(self):
+        data = self._read(446, 64)
+        entries = [struct.unpack_from('<B3sB3sII', data, 16 * i)
+                   for i in range(4)]
+        return [(kind, start, count)
+                for _, _, kind, _, start, count in entries]
+
+    def _iso(self, offset, label):
+        self._write(offset + 16 * 2048,
+                    b'\x01CD001\x01\0' + b' ' * 32 + label.ljust(32))
+
+    def _gpt_header(self, lba, alternate, last_usable, entries_lba, entries):
+        fields = [b'EFI PART', 0x10000, 92, 0, 0, lba, alternate, 34,
+                  last_usable, b'g' * 16, entries_lba, 128, 128,
+                  _crc(entries)]
+        fields[3] = _crc(struct.pack('<8sIIIIQQQQ16sQIII', *fields))
+        return struct.pack('<8sIIIIQQQQ16sQIII', *fields)
+
+    def _gpt(self, size, parts):
+        """Write a GPT image of size bytes with (number, first, last)."""
+        self._resize(size)
+        last = size // 512 - 1
+        entries = [b'\0' * 128] * 128
+        for number, first, last_lba in parts:
+            entries[number - 1] = struct.pack('<16s16sQQQ72s', LINUX,
+                                              b'u' * 16, first, last_lba,
+                                              0, b'')
+        entries = b''.join(entries)
+        self._mbr([(0xee, 1, last)])
+        self._write(1024, entries)
+        self._write(512, self._gpt_header(1, last, last - 33, 2, entries))
+        self._write((last - 32) * 512, entries)
+        self._write(last * 512,
+                    self._gpt_header(last, 1, last - 33, last - 32, entries))
+
+    def _check_gpt(self, lba):
+        """Check a GPT header and its entries, return the header."""
+        header = struct.unpack('<8sIIIIQQQQ16sQIII', self._read(lba * 512, 92))
+        self.assertEqual(b'EFI PART', header[0])
+        self.assertEqual(lba, header[5])
+        data = self._read(lba * 512, 92)
+        self.assertEqual(header[3],
+                         _crc(data[:16] + b'\0' * 4 + data[20:]))
+        self.assertEqual(header[13], _crc(self._read(header[10] * 512,
+                                                     128 * 128)))
+        return header
+
+    def _gpt_entry(self, lba, number):
+        header = self._check_gpt(lba)
+        return struct.unpack('<16s16sQQQ72s', self._read(
+            header[10] * 512 + (number - 1) * 128, 128))
+
+
+class TestMBR(ImageTestCase):
+    def setUp(self):
+        super(TestMBR, self).setUp()
+        self._resize(100 * MB)
+        self._mbr([(0x83, 2048, 20480)])
+
+    def test_create(self):
+        partition = partitions.find_or_create_configdrive(self.path,
+                                                          size=10 * MB)
+        self.assertEqual(2, partition.number)
+        self.assertEqual(90 * MB, partition.offset)
+        self.assertEqual(10 * MB, partition.size)
+        self.assertEqual([(0x83, 2048, 20480), (0x83, 184320, 20480),
+                          (0, 0, 0), (0, 0, 0)], self._mbr_entries())
+
+    def test_create_in_free_slot(self):
+        self._mbr([(0x83, 2048, 2048), (0, 0, 0), (0x83, 4096, 2048)])
+        partition = partitions.find_or_create_configdrive(self.path)
+        self.assertEqual(2, partition.number)
+        self.assertEqual(36 * MB, partition.offset)
+
+    @mock.patch.object(partitions, '_MBR_MAX_SECTORS', 50 * 2048)
+    def test_create_below_limit(self):
+        partition = partitions.find_or_create_configdrive(self.path,
+                                                          size=10 * MB)
+        self.assertEqual(40 * MB, partition.offset)
+        self.assertEqual(10 * MB, partition.size)
+
+    def test_find_existing(self):
+        self._mbr([(0x83, 2048, 20480), (0x83, 30720, 2048)])
+        self._iso(15 * MB, b'config-2')
+        partition = partitions.find_or_create_configdrive(self.path)
+        self.assertEqual(2, partition.number)
+        self.assertEqual(15 * MB, partition.offset)
+
+    def test_find_existing_vfat(self):
+        self._mbr([(0x83, 2048, 20480), (0x83, 30720, 2048)])
+        boot = bytearray(512)
+        boot[38] = 0x29
+        boot[43:54] = b'CONFIG-2   '
+        boot[54:62] = b'FAT16   '
+        boot[510:512] = b'\x55\xaa'
+        self._write(15 * MB, bytes(boot))
+        partition = partitions.find_or_create_configdrive(self.path)
+        self.assertEqual(2, partition.number)
+
+    def test_find_existing_logical(self):
+        self._mbr([(0x83, 2048, 20480), (0x05, 30720, 10240)])
+        # The extended boot record of partition 5
+        self._write(30720 * 512 + 446,
+                    struct.pack('<B3sB3sII', 0, b'\0' * 3, 0x83, b'\0' * 3,
+                                2048, 4096) + b'\0' * 48 + b'\x55\xaa')
+        self._iso(16 * MB, b'config-2')
+        partition = partitions.find_or_create_configdrive(self.path)
+        self.assertEqual(5, partition.number)
+        self.assertEqual(16 * MB, partition.offset)
+
+    def test_no_room(self):
+        self._mbr([(0x83, 2048, 200000)])
+        self.assertRaises(errors.PartitionTableError,
+                          partitions.find_or_create_configdrive, self.path)
+
+    def test_no_free_slot(self):
+        self._mbr([(0x83, 2048, 2048)] * 4)
+        self.assertRaises(errors.PartitionTableError,
+                          partitions.find_or_create_configdrive, self.path)
+
+    def test_no_partition_table(self):
+        self._write(510, b'\0\0')
+        self.assertRaises(errors.PartitionTableError,
+                          partitions.find_or_create_configdrive, self.path)
+
+
+class TestGPT(ImageTestCase):
+    def setUp(self):
+        super(TestGPT, self).setUp()
+        self._gpt(50 * MB, [(1, 2048, 22527), (3, 22528, 40959)])
+
+    def test_create(self):
+        partition = partitions.find_or_create_configdrive(self.path,
+                                                          size=8 * MB)
+        # The lowest free entry is used
+        self.assertEqual(2, partition.number)
+        last = 50 * 2048 - 34
+        self.assertEqual(41 * MB, partition.offset)
+        self.assertEqual((last - 41 * 2048 + 1) * 512, partition.size)
+        for lba in (1, 50 * 2048 - 1):
+            kind, _, first, end, _, name = self._gpt_entry(lba, 2)
+            self.assertEqual(LINUX, kind)
+            self.assertEqual((41 * 2048, last), (first, end))
+            self.assertEqual(u'config-2',
+                             name.decode('utf-16-le').rstrip(u'\0'))
+
+    def test_create_fixes_backup(self):
+        self._resize(100 * MB)
+        partition = partitions.find_or_create_configdrive(self.path,
+                                                          size=10 * MB)
+        last = 100 * 2048 - 1
+        # The backup table is at the end, the partition starts below
+        self.assertEqual(89 * MB, partition.offset)
+        primary = self._check_gpt(1)
+        backup = self._check_gpt(last)
+        self.assertEqual(last, primary[6])
+        self.assertEqual(1, backup[6])
+        self.assertEqual(last - 33, primary[8])
+        self.assertEqual(last - 33, backup[8])
+        self.assertEqual(last - 32, backup[10])
+        # The protective MBR covers the whole disk
+        self.assertEqual([(0xee, 1, last), (0, 0, 0), (0, 0, 0), (0, 0, 0)],
+                         self._mbr_entries())
+
+    def test_find_existing_fixes_backup(self):
+        self._iso(11 * MB, b'config-2')
+        self._resize(100 * MB)
+        partition = partitions.find_or_create_configdrive(self.path)
+        self.assertEqual(3, partition.number)
+        self.assertEqual(100 * 2048 - 1, self._check_gpt(1)[6])
+        self._check_gpt(100 * 2048 - 1)
+
+    def test_find_existing_unchanged(self):
+        self._iso(11 * MB, b'config-2')
+        before = self._read(0, 50 * MB)
+        partitions.find_or_create_configdrive(self.path)
+        self.assertEqual(before, self._read(0, 50 * MB))
+
+    def test_invalid_primary(self):
+        self._write(512 + 50, b'broken')
+        partition = partitions.find_or_create_configdrive(self.path,
+                                                          size=8 * MB)
+        self.assertEqual(2, partition.number)
+        # Both tables were rewritten
+        self._check_gpt(1)
+        self._check_gpt(50 * 2048 - 1)
+
+    def test_no_valid_table(self):
+        self._write(512 + 50, b'broken')
+        self._write((50 * 2048 - 1) * 512 + 50, b'broken')
+        self.assertRaises(errors.PartitionTableError,
+                          partitions.find_or_create_configdrive, self.path)
+
+    def test_no_room(self):
+        self.assertRaises(errors.PartitionTableError,
+                          partitions.find_or_create_configdrive, self.path,
+                          size=40 * MB)
+
+    def test_disk_too_small(self):
+        self._resize(40 * MB)
+        self.assertRaises(errors.PartitionTableError,
+                          partitions.find_or_create_configdrive, self.path)
+
+
+@mock.patch('fcntl.ioctl', autospec=True)
+class TestAddToKernel(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestAddToKernel, self).setUp()
+        self.disk = mock.Mock(fd=42, path='/dev/sda')
+        self.partition = partitions.Partition(2, 90 * MB, 10 * MB)
+
+    def _record(self, ioctl_mock, results):
+        ops = []
+
+        def _ioctl(fd, request, arg):
+            self.assertEqual((42, partitions._BLKPG), (fd, request))
+            part = partitions._BlkpgPartition.from_address(arg.data)
+            self.assertEqual((90 * MB, 10 * MB, 2),
+                             (part.start, part.length, part.pno))
+            ops.append(arg.op)
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        ioctl_mock.side_effect = _ioctl
+        return ops
+
+    def test_add(self, ioctl_mock):
+        ops = self._record(ioctl_mock, [0])
+        partitions._add_to_kernel(self.disk, self.partition)
+        self.assertEqual([partitions._BLKPG_ADD_PARTITION], ops)
+
+    def test_replace(self, ioctl_mock):
+        ops = self._record(ioctl_mock, [IOError(errno.EBUSY, 'busy'), 0, 0])
+        partitions._add_to_kernel(self.disk, self.partition)
+        self.assertEqual([partitions._BLKPG_ADD_PARTITION,
+                          partitions._BLKPG_DEL_PARTITION,
+                          partitions._BLKPG_ADD_PARTITION], ops)
+
+    def test_failure_ignored(self, ioctl_mock):
+        ioctl_mock.side_effect = IOError(errno.EINVAL, 'invalid')
+        partitions._add_to_kernel(self.disk, self.partition)
+
+
+class TestPartitionPath(test_base.BaseTestCase):
+    def test_partition_path(self):
+        self.assertEqual('/dev/sda2', partitions.partition_path('/dev/sda', 2))
+        self.assertEqual('/dev/nvme0n1p2',
+                         partitions.partition_path('/dev/nvme0n1', 2))
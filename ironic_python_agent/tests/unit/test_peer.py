@@ -0,0 +1,128 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+
+import mock
+from oslotest import base as test_base
+import requests
+
+from ironic_python_agent import manifest
+from ironic_python_agent import peer
+from ironic_python_agent import transport
+
+
+class TestSharing(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestSharing, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, b'abcdefghij')
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+        self.pieces = manifest.generate(self.path, block_size=4)
+        self.addCleanup(peer._shared.clear)
+
+    def test_share(self):
+        peer.share('abc123', self.path, self.pieces)
+        image = peer.get_shared('abc123')
+        self.assertEqual(10, image.size)
+        self.assertEqual(b'cdefg', b''.join(image.read(2, 7)))
+
+    def test_share_replaces_image_at_path(self):
+        peer.share('abc123', self.path, self.pieces)
+        peer.share('def456', self.path, self.pieces)
+        self.assertIsNone(peer.get_shared('abc123'))
+        self.assertIsNotNone(peer.get_shared('def456'))
+
+    def test_unshare(self):
+        peer.share('abc123', self.path, self.pieces)
+        peer.unshare(self.path)
+        self.assertIsNone(peer.get_shared('abc123'))
+
+    def test_read_past_end(self):
+        peer.share('abc123', self.path, self.pieces)
+        self.assertRaises(IOError, list,
+                          peer.get_shared('abc123').read(8, 12))
+
+
+class FakeResponse(object):
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+
+    def json(self):
+        return self.data
+
+
+@mock.patch.object(transport, 'get', autospec=True)
+class TestFindPeers(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestFindPeers, self).setUp()
+        self.pieces = manifest.Manifest(10, ['a', 'b', 'c'], block_size=4)
+
+    def test_find_peers(self, get_mock):
+        responses = {
+            'http://a:9999/v1/images/abc123/manifest':
+                FakeResponse(self.pieces.to_dict()),
+            'http://b:9999/v1/images/abc123/manifest':
+                FakeResponse({}, status_code=404),
+            'http://c:9999/v1/images/abc123/manifest':
+                FakeResponse(self.pieces.to_dict()),
+        }
+        get_mock.side_effect = lambda url, **kwargs: responses[url]
+
+        pieces, urls = peer.find_peers(
+            ['http://a:9999', 'http://b:9999/', 'http://c:9999'], 'abc123')
+        self.assertEqual(self.pieces.to_dict(), pieces.to_dict())
+        self.assertEqual(['http://a:9999/v1/images/abc123',
+                          'http://c:9999/v1/images/abc123'], urls)
+
+    def test_find_peers_majority(self, get_mock):
+        other = manifest.Manifest(10, ['x', 'y', 'z'], block_size=4)
+        responses = {
+            'http://a:9999/v1/images/abc123/manifest':
+                FakeResponse(other.to_dict()),
+            'http://b:9999/v1/images/abc123/manifest':
+                FakeResponse(self.pieces.to_dict()),
+            'http://c:9999/v1/images/abc123/manifest':
+                FakeResponse(self.pieces.to_dict()),
+        }
+        get_mock.side_effect = lambda url, **kwargs: responses[url]
+
+        pieces, urls = peer.find_peers(
+            ['http://a:9999', 'http://b:9999', 'http://c:9999'], 'abc123')
+        self.assertEqual(self.pieces.to_dict(), pieces.to_dict())
+        self.assertEqual(['http://b:9999/v1/images/abc123',
+                          'http://c:9999/v1/images/abc123'], urls)
+
+    def test_find_peers_disagree(self, get_mock):
+        other = manifest.Manifest(10, ['x', 'y', 'z'], block_size=4)
+        responses = {
+            'http://a:9999/v1/images/abc123/manifest':
+                FakeResponse(self.pieces.to_dict()),
+            'http://b:9999/v1/images/abc123/manifest':
+                FakeResponse(other.to_dict()),
+            'http://c:9999/v1/images/abc123/manifest':
+                FakeResponse({}, status_code=404),
+        }
+        get_mock.side_effect = lambda url, **kwargs: responses[url]
+
+        self.assertEqual((None, []), peer.find_peers(
+            ['http://a:9999', 'http://b:9999', 'http://c:9999'], 'abc123'))
+
+    def test_find_peers_none(self, get_mock):
+        get_mock.side_effect = requests.ConnectionError('boom')
+        self.assertEqual((None, []),
+                         peer.find_peers(['http://a:9999'], 'abc123'))
@@ -0,0 +1,192 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import threading
+
+from oslotest import base as test_base
+
+from ironic_python_agent import pipeline
+
+
+class TestPipeline(test_base.BaseTestCase):
+    def test_run(self):
+        chunks = [b'some', b'', b'content', b'here']
+        md5 = hashlib.md5()
+        written = []
+
+        def _hash(chunk):
+            md5.update(chunk)
+            return chunk
+
+        stages = pipeline.Pipeline(
+            iter(chunks),
+            [pipeline.Stage('hash', _hash),
+             pipeline.Stage('write', written.append)]).run()
+
+        self.assertEqual([b'some', b'content', b'here'], written)
+        self.assertEqual(hashlib.md5(b'somecontenthere').hexdigest(),
+                         md5.hexdigest())
+        self.assertEqual(['receive', 'hash', 'write'],
+                         [s.name for s in stages])
+        self.assertEqual([15, 15, 15], [s.bytes for s in stages])
+        serialized = stages[1].serialize()
+        self.assertEqual(set(pipeline.Stage.serializable_fields),
+                         set(serialized))
+
+    def test_transform_and_finish(self):
+        written = []
+        stages = pipeline.Pipeline(
+            iter([b'ab', b'cd']),
+            [pipeline.Stage('upper', lambda c: c.upper(),
+                            finish=lambda: b'!'),
+             pipeline.Stage('drop', lambda c: None),
+             pipeline.Stage('write', written.append)]).run()
+
+        self.assertEqual([], written)
+        self.assertEqual(5, stages[2].bytes)
+
+        stages = pipeline.Pipeline(
+            iter([b'ab', b'cd']),
+            [pipeline.Stage('upper', lambda c: c.upper(),
+                            finish=lambda: b'!'),
+             pipeline.Stage('write', written.append)]).run()
+        self.assertEqual([b'AB', b'CD', b'!'], written)
+
+    def test_iterator_output(self):
+        written = []
+        stages = pipeline.Pipeline(
+            iter([b'ab', b'cd']),
+            [pipeline.Stage('split', lambda c: iter(c.split(b'b')),
+                            finish=lambda: (c for c in [b'', b'!'])),
+             pipeline.Stage('write', written.append)]).run()
+        self.assertEqual([b'a', b'cd', b'!'], written)
+        self.assertEqual(4, stages[2].bytes)
+
+    def test_queue_depth(self):
+        stream = pipeline.Pipeline([], [pipeline.Stage('a'),
+                                        pipeline.Stage('b')],
+                                   buffer_size=8, chunk_size=2)
+        self.assertEqual(2, stream.queue_depth)
+        stream = pipeline.Pipeline([], [pipeline.Stage('a')],
+                                   buffer_size=1, chunk_size=2)
+        self.assertEqual(1, stream.queue_depth)
+
+    def test_stage_error(self):
+        written = []
+
+        def _write(chunk):
+            if len(written) == 1:
+                raise IOError('disk on fire')
+            written.append(chunk)
+
+        def _source():
+            for i in range(1000):
+                yield b'x'
+
+        stream = pipeline.Pipeline(_source(),
+                                   [pipeline.Stage('write', _write)],
+                                   buffer_size=4, chunk_size=1)
+        self.assertRaisesRegexp(IOError, 'disk on fire', stream.run)
+        self.assertEqual([b'x'], written)
+
+    def test_source_closed_on_error(self):
+        closed = []
+
+        def _source():
+            try:
+                for i in range(1000):
+                    yield b'x'
+            finally:
+                closed.append(True)
+
+        def _write(chunk):
+            raise IOError('disk on fire')
+
+        stream = pipeline.Pipeline(_source(),
+                                   [pipeline.Stage('write', _write)],
+                                   buffer_size=4, chunk_size=1)
+        self.assertRaisesRegexp(IOError, 'disk on fire', stream.run)
+        self.assertEqual([True], closed)
+
+    def test_source_error(self):
+        def _source():
+            yield b'x'
+            raise ValueError('connection reset')
+
+        written = []
+        stream = pipeline.Pipeline(_source(),
+                                   [pipeline.Stage('write', written.append)])
+        self.assertRaisesRegexp(ValueError, 'connection reset', stream.run)
+
+    def test_fanout(self):
+        first, second = [], []
+        stages = pipeline.Pipeline(
+            iter([b'some', b'content']),
+            [pipeline.Stage('upper', lambda c: c.upper()),
+             pipeline.Fanout('tee', [pipeline.Stage('a', first.append),
+                                     pipeline.Stage('b', second.append)])]
+        ).run()
+
+        self.assertEqual([b'SOME', b'CONTENT'], first)
+        self.assertEqual([b'SOME', b'CONTENT'], second)
+        serialized = stages[2].serialize()
+        self.assertEqual(11, serialized['bytes'])
+        self.assertEqual(['a', 'b'],
+                         [b['name'] for b in serialized['branches']])
+        self.assertEqual([11, 11],
+                         [b['bytes'] for b in serialized['branches']])
+
+    def test_fanout_slow_branch(self):
+        fast = []
+        fast_done = threading.Event()
+
+        def _fast(chunk):
+            fast.append(chunk)
+            if len(fast) == 4:
+                fast_done.set()
+
+        def _slow(chunk):
+            # Only proceeds once the other branch got everything
+            self.assertTrue(fast_done.wait(5))
+
+        pipeline.Pipeline(
+            iter([b'a', b'b', b'c', b'd']),
+            [pipeline.Fanout('tee', [pipeline.Stage('fast', _fast),
+                                     pipeline.Stage('slow', _slow)])],
+            buffer_size=8, chunk_size=1).run()
+        self.assertEqual([b'a', b'b', b'c', b'd'], fast)
+
+    def test_fanout_branch_error(self):
+        def _fail(chunk):
+            raise IOError('disk on fire')
+
+        written = []
+        stream = pipeline.Pipeline(
+            iter([b'x'] * 100),
+            [pipeline.Fanout('tee', [pipeline.Stage('ok', written.append),
+                                     pipeline.Stage('bad', _fail)])],
+            buffer_size=4, chunk_size=1)
+        self.assertRaisesRegexp(IOError, 'disk on fire', stream.run)
+
+    def test_fanout_not_last(self):
+        self.assertRaises(ValueError, pipeline.Pipeline, iter([]),
+                          [pipeline.Fanout('tee', []), pipeline.Stage('x')])
+
+    def test_throughput(self):
+        stage = pipeline.Stage('x')
+        self.assertIsNone(stage.throughput)
+        stage.bytes = 4 * 1024 * 1024
+        stage.busy_time = 2.0
+        self.assertEqual(2.0, stage.throughput)
@@ -0,0 +1,72 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+from oslotest import base as test_base
+
+from ironic_python_agent import progress
+
+MB = 1024 * 1024
+
+
+@mock.patch('time.time', autospec=True)
+class TestProgress(test_base.BaseTestCase):
+    def test_not_started(self, time_mock):
+        self.assertEqual({'bytes_total': None, 'bytes_downloaded': 0,
+                          'bytes_written': 0, 'elapsed': None,
+                          'current_throughput': None,
+                          'average_throughput': None, 'eta': None},
+                         progress.Progress().serialize())
+
+    def test_throughput_and_eta(self, time_mock):
+        time_mock.return_value = 100
+        tracker = progress.Progress(window=5)
+        tracker.start(100 * MB)
+        # 10MB/s for 5 seconds, then 20MB/s
+        for second in range(1, 6):
+            time_mock.return_value = 100 + second
+            tracker.add_downloaded(10 * MB)
+        for second in range(6, 8):
+            time_mock.return_value = 100 + second
+            tracker.add_downloaded(20 * MB)
+        tracker.add_written(30 * MB)
+
+        data = tracker.serialize()
+        self.assertEqual(90 * MB, data['bytes_downloaded'])
+        self.assertEqual(30 * MB, data['bytes_written'])
+        self.assertEqual(7, data['elapsed'])
+        self.assertEqual(10, data['current_throughput'])
+        self.assertEqual(12.86, data['average_throughput'])
+        self.assertEqual(1, data['eta'])
+
+    def test_stalled(self, time_mock):
+        time_mock.return_value = 100
+        tracker = progress.Progress(window=5)
+        tracker.start(100 * MB)
+        time_mock.return_value = 105
+        tracker.add_downloaded(50 * MB)
+        self.assertEqual(10, tracker.current_throughput)
+        # Nothing received for a while
+        time_mock.return_value = 125
+        self.assertEqual(0, tracker.current_throughput)
+        self.assertIsNone(tracker.eta)
+
+    def test_unknown_total(self, time_mock):
+        time_mock.return_value = 100
+        tracker = progress.Progress()
+        tracker.start()
+        time_mock.return_value = 110
+        tracker.add_downloaded(MB)
+        self.assertIsNone(tracker.eta)
+        self.assertEqual(0.1, tracker.average_throughput)
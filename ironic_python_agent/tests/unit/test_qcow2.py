@@ -0,0 +1,214 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import struct
+import zlib
+
+from oslotest import base as test_base
+
+from ironic_python_agent import errors
+from ironic_python_agent import qcow2
+
+ZERO = 'zero'
+
+
+class FakeWriter(object):
+    def __init__(self, size):
+        self.data = bytearray(b'\xaa' * size)
+
+    def write_at(self, offset, data):
+        assert offset + len(data) <= len(self.data)
+        self.data[offset:offset + len(data)] = data
+
+    def write_zeroes(self, offset, length):
+        self.write_at(offset, b'\0' * length)
+
+
+class ImageBuilder(object):
+    """Lay out a qcow2 image the way qemu allocates clusters."""
+
+    def __init__(self, size, cluster_bits=9, version=3):
+        self.size = size
+        self.cluster_bits = cluster_bits
+        self.cs = 1 << cluster_bits
+        self.version = version
+        self.l2_entries = self.cs // 8
+        self.l1_size = -(-size // (self.cs * self.l2_entries))
+        self.image = bytearray(4 * self.cs)
+        self.l1 = [0] * self.l1_size
+        self.l2 = {}
+        self.byte_pos = 0
+
+    def _alloc_cluster(self):
+        offset = len(self.image)
+        self.image += b'\0' * self.cs
+        return offset
+
+    def _entries(self, guest):
+        index = guest // (self.cs * self.l2_entries)
+        if index not in self.l2:
+            self.l2[index] = [0] * self.l2_entries
+            self.l1[index] = self._alloc_cluster()
+        return self.l2[index]
+
+    def add(self, guest, data, compressed=False, l2_first=True):
+        i = (guest // self.cs) % self.l2_entries
+        if not l2_first:
+            offset = self._alloc_cluster()
+        entries = self._entries(guest)
+        if data == ZERO:
+            entries[i] = 1
+            return
+        if compressed:
+            obj = zlib.compressobj(9, zlib.DEFLATED, -12)
+            blob = obj.compress(bytes(data)) + obj.flush()
+            # Continue in the current cluster, spilling over into the next
+            # one if it is the next to be allocated
+            offset = self.byte_pos
+            if (not offset % self.cs
+                    or (offset + len(blob) > len(self.image)
+                        and offset // self.cs + 1 < len(self.image)
+                        // self.cs)):
+                offset = self._alloc_cluster()
+            while len(self.image) < offset + len(blob):
+                self._alloc_cluster()
+            self.image[offset:offset + len(blob)] = blob
+            self.byte_pos = offset + len(blob)
+            shift = 62 - (self.cluster_bits - 8)
+            sectors = -(-(offset % 512 + len(blob)) // 512)
+            entries[i] = (1 << 62) | ((sectors - 1) << shift) | offset
+            return
+        if l2_first:
+            offset = self._alloc_cluster()
+        self.image[offset:offset + len(data)] = data
+        entries[i] = offset | (1 << 63)
+
+    def build(self, incompatible=0, backing=0):
+        cs = self.cs
+        header = struct.pack('>4sIQIIQIIQQIIQ', b'QFI\xfb', self.version,
+                             backing, 0, self.cluster_bits, self.size, 0,
+                             self.l1_size, cs, 2 * cs, 1, 0, 0)
+        if self.version == 3:
+            header += struct.pack('>QQQII', incompatible, 0, 0, 4, 104)
+        image = self.image
+        image[:len(header)] = header
+        image[cs:cs + 8 * self.l1_size] = struct.pack(
+            '>%dQ' % self.l1_size, *[o | (1 << 63) if o else 0
+                                     for o in self.l1])
+        image[2 * cs:2 * cs + 8] = struct.pack('>Q', 3 * cs)
+        for index, entries in self.l2.items():
+            offset = self.l1[index]
+            image[offset:offset + cs] = struct.pack('>%dQ' % len(entries),
+                                                    *entries)
+        return bytes(image)
+
+
+def _convert(image, size, chunk_size=1000, max_pending=None):
+    writer = FakeWriter(size)
+    converter = qcow2.StreamConverter(writer, max_pending=max_pending)
+    for pos in range(0, len(image), chunk_size):
+        converter.feed(image[pos:pos + chunk_size])
+    converter.finish()
+    return bytes(writer.data), converter
+
+
+class TestStreamConverter(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestStreamConverter, self).setUp()
+        # 3 L2 tables worth of guest data, the last one partial
+        self.size = 512 * 64 * 2 + 700
+        self.expected = bytearray(self.size)
+
+    def _add(self, builder, index, data=None, **kwargs):
+        if data is None:
+            data = os.urandom(512)
+        builder.add(index * 512, data, **kwargs)
+        if data != ZERO:
+            self.expected[index * 512:index * 512 + len(data)] = (
+                data[:self.size - index * 512])
+
+    def test_convert(self):
+        builder = ImageBuilder(self.size)
+        for index in (0, 1, 5, 63, 64, 129):
+            self._add(builder, index)
+        self._add(builder, 2, ZERO)
+        for index in (66, 67, 68):
+            self._add(builder, index, (b'%d' % index * 300)[:512],
+                      compressed=True)
+        output, _converter = _convert(builder.build(), self.size)
+        self.assertEqual(bytes(self.expected), output)
+
+    def test_convert_version_2(self):
+        builder = ImageBuilder(self.size, version=2)
+        self._add(builder, 3)
+        self._add(builder, 100)
+        output, _converter = _convert(builder.build(), self.size,
+                                      chunk_size=7)
+        self.assertEqual(bytes(self.expected), output)
+
+    def test_compressed_across_tables(self):
+        # Compressed clusters are packed, so the first cluster of the second
+        # L2 table shares a host cluster with the last one of the first L2
+        # table, and is stored before its L2 table
+        self.size = 4096 * 1024
+        self.expected = bytearray(self.size)
+        builder = ImageBuilder(self.size, cluster_bits=12)
+        for index in range(500, 520):
+            data = (b'%d' % index * 2000)[:4096]
+            builder.add(index * 4096, data, compressed=True)
+            self.expected[index * 4096:(index + 1) * 4096] = data
+        output, converter = _convert(builder.build(), self.size)
+        self.assertEqual(bytes(self.expected), output)
+        # Only the unused end of the last compressed cluster is left over
+        self.assertEqual(1, len(converter._pending))
+
+    def test_data_before_table(self):
+        builder = ImageBuilder(self.size)
+        self._add(builder, 70, l2_first=False)
+        self._add(builder, 71)
+        output, converter = _convert(builder.build(), self.size)
+        self.assertEqual(bytes(self.expected), output)
+        self.assertEqual({}, converter._pending)
+
+    def test_data_before_table_over_limit(self):
+        builder = ImageBuilder(self.size)
+        self._add(builder, 70, l2_first=False)
+        self.assertRaisesRegexp(errors.ImageConversionError,
+                                'cannot be streamed', _convert,
+                                builder.build(), self.size, max_pending=100)
+
+    def test_truncated(self):
+        builder = ImageBuilder(self.size)
+        self._add(builder, 70)
+        image = builder.build()
+        self.assertRaisesRegexp(errors.ImageConversionError, 'truncated',
+                                _convert, image[:-512], self.size)
+        self.assertRaisesRegexp(errors.ImageConversionError, 'truncated',
+                                _convert, image[:50], self.size)
+
+    def test_not_qcow2(self):
+        self.assertRaisesRegexp(errors.ImageConversionError, 'not in qcow2',
+                                _convert, b'\0' * 4096, self.size)
+        self.assertRaisesRegexp(errors.ImageConversionError, 'not in qcow2',
+                                _convert, b'\0' * 10, self.size)
+
+    def test_unsupported(self):
+        builder = ImageBuilder(self.size)
+        self.assertRaisesRegexp(errors.ImageConversionError, 'backing file',
+                                _convert, builder.build(backing=4096),
+                                self.size)
+        self.assertRaisesRegexp(errors.ImageConversionError, 'features 0x4',
+                                _convert, builder.build(incompatible=4),
+                                self.size)
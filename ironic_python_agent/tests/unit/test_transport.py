@@ -0,0 +1,105 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+
+import mock
+from oslotest import base as test_base
+import requests
+
+from ironic_python_agent import transport
+
+
+class TestTransport(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestTransport, self).setUp()
+        patcher = mock.patch.multiple(transport, _session=None, _pool_size=0,
+                                      _options=dict(transport._options))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_session_shared(self):
+        session = transport.get_session()
+        self.assertIsInstance(session, requests.Session)
+        self.assertIs(session, transport.get_session())
+        adapter = session.get_adapter('https://example.org')
+        self.assertIsInstance(adapter, transport.TransportAdapter)
+        self.assertIs(adapter, session.get_adapter('http://example.org'))
+        self.assertEqual(transport.DEFAULT_POOL_SIZE, adapter._pool_maxsize)
+        self.assertEqual(transport.DEFAULT_HOSTS,
+                         adapter._pool_connections)
+
+    def test_get_session_grows_pools(self):
+        session = transport.get_session()
+        adapter = session.get_adapter('http://example.org')
+
+        self.assertIs(session, transport.get_session(16))
+        grown = session.get_adapter('http://example.org')
+        self.assertIsNot(adapter, grown)
+        self.assertEqual(16, grown._pool_maxsize)
+
+        transport.get_session(2)
+        self.assertIs(grown, session.get_adapter('http://example.org'))
+
+    def test_socket_options(self):
+        transport.configure(socket_buffer_size=4194304)
+        adapter = transport.get_session().get_adapter('http://example.org')
+        options = adapter.poolmanager.connection_pool_kw['socket_options']
+        self.assertIn((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1), options)
+        self.assertIn((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1), options)
+        self.assertIn((socket.SOL_SOCKET, socket.SO_RCVBUF, 4194304),
+                      options)
+        self.assertIn((socket.SOL_SOCKET, socket.SO_SNDBUF, 4194304),
+                      options)
+
+        proxy = adapter.proxy_manager_for('http://proxy:3128')
+        self.assertEqual(options,
+                         proxy.connection_pool_kw['socket_options'])
+
+    def test_socket_options_default(self):
+        options = transport.socket_options()
+        self.assertNotIn(socket.SO_RCVBUF, [o[1] for o in options])
+        self.assertNotIn((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+                         transport.socket_options(nodelay=False))
+
+    def test_retry_policy(self):
+        transport.configure(retries=5)
+        adapter = transport.get_session().get_adapter('http://example.org')
+        retries = adapter.max_retries
+        self.assertEqual(5, retries.total)
+        self.assertFalse(retries.read)
+        self.assertEqual(set(transport.RETRY_STATUSES),
+                         set(retries.status_forcelist))
+        self.assertFalse(retries.raise_on_status)
+
+    def test_configure_unknown(self):
+        self.assertRaises(TypeError, transport.configure, pool=4)
+
+    def test_configure_none_unchanged(self):
+        transport.configure(pool_size=8)
+        transport.configure(pool_size=None)
+        self.assertEqual(8, transport._options['pool_size'])
+
+    @mock.patch.object(requests.Session, 'request', autospec=True)
+    def test_requests(self, request_mock):
+        session = transport.get_session()
+        transport.get('http://example.org', stream=True)
+        transport.head('http://example.org')
+        transport.post('http://example.org', data='{}')
+        self.assertEqual([
+            mock.call(session, 'GET', 'http://example.org', stream=True),
+            mock.call(session, 'HEAD', 'http://example.org',
+                      allow_redirects=False),
+            mock.call(session, 'POST', 'http://example.org', data='{}'),
+        ], request_mock.call_args_list)
@@ -0,0 +1,193 @@
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""HTTP transport shared by everything the agent requests.
+
+All requests go through a single session, which keeps a pool of keep-alive
+connections per host. Talking to Ironic, to the inspector or to an image
+server again reuses a connection which is already open and past TCP
+slow-start, instead of paying for a new handshake, TLS included, each
+time.
+
+The session must never be closed by its users.
+"""
+
+import socket
+import threading
+
+from oslo_log import log
+import requests
+from requests import adapters
+
+LOG = log.getLogger(__name__)
+
+# Number of hosts for which connections are kept alive
+DEFAULT_HOSTS = 10
+# Number of connections kept alive per host
+DEFAULT_POOL_SIZE = 4
+# Number of times a failed connection or a request answered with one of
+# RETRY_STATUSES is retried
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5  # seconds
+RETRY_STATUSES = (502, 503, 504)
+
+_options = {
+    'hosts': DEFAULT_HOSTS,
+    'pool_size': DEFAULT_POOL_SIZE,
+    'retries': DEFAULT_RETRIES,
+    'backoff_factor': DEFAULT_BACKOFF_FACTOR,
+    'socket_buffer_size': None,
+    'nodelay': True,
+}
+_lock = threading.Lock()
+_session = None
+_pool_size = 0
+
+
+class TransportAdapter(adapters.HTTPAdapter):
+    """HTTPAdapter setting socket options on the connections it opens."""
+
+    __attrs__ = adapters.HTTPAdapter.__attrs__ + ['socket_options']
+
+    def __init__(self, socket_options=None, **kwargs):
+        # The pool manager is created by the parent constructor
+        self.socket_options = socket_options
+        super(TransportAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options is not None:
+            kwargs['socket_options'] = self.socket_options
+        super(TransportAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        if self.socket_options is not None:
+            proxy_kwargs['socket_options'] = self.socket_options
+        return super(TransportAdapter, self).proxy_manager_for(
+            proxy, **proxy_kwargs)
+
+
+def socket_options(nodelay=True, buffer_size=None):
+    """Get the options to set on new sockets.
+
+    :param nodelay: whether to disable Nagle's algorithm.
+    :param buffer_size: size of the send and receive buffers in bytes, or
+                        None to leave them to the kernel auto-tuning.
+    """
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    if nodelay:
+        options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+    if buffer_size:
+        # Must be set before connecting to have an effect on the window
+        options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size))
+        options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size))
+    return options
+
+
+def retry_policy(retries, backoff_factor=DEFAULT_BACKOFF_FACTOR):
+    """Get the retry policy of the requests.
+
+    Requests are retried when the connection fails and, unless they are
+    not idempotent, when the server answers that it is temporarily
+    unavailable. Once the retries are exhausted the last response is
+    returned. Errors while reading a response are never retried, as its
+    body may already have been consumed.
+    """
+    return adapters.Retry(total=retries, read=False,
+                          backoff_factor=backoff_factor,
+                          status_forcelist=RETRY_STATUSES,
+                          raise_on_status=False)
+
+
+def make_adapter(pool_size, hosts=None, retries=None):
+    """Make an adapter using the transport options.
+
+    :param pool_size: number of connections kept alive per host.
+    :param hosts: number of hosts for which connections are kept alive.
+    :param retries: number of retries, see retry_policy.
+    """
+    hosts = _options['hosts'] if hosts is None else hosts
+    retries = _options['retries'] if retries is None else retries
+    return TransportAdapter(
+        socket_options=socket_options(_options['nodelay'],
+                                      _options['socket_buffer_size']),
+        pool_connections=hosts, pool_maxsize=pool_size,
+        max_retries=retry_policy(retries, _options['backoff_factor']))
+
+
+def configure(**options):
+    """Change the transport options.
+
+    Takes the keys of the ``_options`` dictionary as arguments, None
+    leaving an option unchanged. Only affects a session created later.
+    """
+    unknown = set(options) - set(_options)
+    if unknown:
+        raise TypeError('Unknown transport options: {0}'.format(
+            ', '.join(sorted(unknown))))
+    _options.update((key, value) for key, value in options.items()
+                    if value is not None)
+
+
+def get_session(pool_size=None):
+    """Get the shared session.
+
+    :param pool_size: number of connections which are going to be used
+                      concurrently to a host. The pools are grown to keep
+                      that many alive; they are never shrunk.
+    :returns: a requests.Session.
+    """
+    global _session, _pool_size
+
+    pool_size = max(pool_size or 0, _options['pool_size'])
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+        if pool_size > _pool_size:
+            if _pool_size:
+                LOG.debug('Growing HTTP connection pools to %d connections '
+                          'per host', pool_size)
+            # Connections of the previous adapter in use are still released
+            # to its pools, and closed when it is garbage collected.
+            adapter = make_adapter(pool_size)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _pool_size = pool_size
+        return _session
+
+
+def request(method, url, **kwargs):
+    """Send a request using the shared session.
+
+    Takes the same arguments as requests.request.
+    """
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    """Send a GET request using the shared session."""
+    return request('GET', url, **kwargs)
+
+
+def head(url, **kwargs):
+    """Send a HEAD request using the shared session.
+
+    Redirects are not followed unless ``allow_redirects`` is passed.
+    """
+    kwargs.setdefault('allow_redirects', False)
+    return request('HEAD', url, **kwargs)
+
+
+def post(url, data=None, **kwargs):
+    """Send a POST request using the shared session."""
+    return request('POST', url, data=data, **kwargs)
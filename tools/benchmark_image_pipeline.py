@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the throughput of the image pipeline end to end.
+
+Images are served by local HTTP servers standing in for the mirrors, with
+a given latency, bandwidth and Range support. Each scenario is run for
+every combination of the swept parameters, e.g.::
+
+    tools/benchmark_image_pipeline.py --size 512 --chunk-sizes 256,1024 \\
+        --compressions none,gzip --mirrors 1,2 --writers direct,parallel \\
+        --bandwidth 100 --latency 0.005 --output results.json
+
+Scenarios:
+
+* download: ImageDownload alone, the data is thrown away.
+* stream: _stream_raw_image_onto_device onto the target.
+* configdrive: _write_configdrive_to_partition from a URL onto the target,
+  which is given a partition table first.
+
+The target is a file in the work directory, or a loop device on top of it
+with --loop (root only). The results are printed as JSON, one entry per
+run, to compare them between releases.
+"""
+
+from __future__ import print_function
+
+import argparse
+import base64
+import bz2
+import collections
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import platform
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+import six
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+from ironic_python_agent import bandwidth
+from ironic_python_agent import compression
+from ironic_python_agent.extensions import standby
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MB = 1024 * 1024
+SCENARIOS = ('download', 'stream', 'configdrive')
+WRITERS = ('direct', 'parallel')
+SEND_CHUNK_SIZE = 64 * 1024
+SERVER_BURST = 0.05  # seconds
+# Room left for the configdrive partition after the image partition
+CONFIGDRIVE_ROOM = 2 * standby.MAX_CONFIGDRIVE_SIZE
+
+_RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the files of the server, through its token bucket."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _headers(self, status, length, extra=()):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Content-Type', 'application/octet-stream')
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        for name, value in extra:
+            self.send_header(name, value)
+        self.end_headers()
+
+    def _serve(self, body):
+        time.sleep(self.server.latency)
+        path = self.server.files.get(self.path)
+        if path is None:
+            self._headers(404, 0)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size
+        match = _RANGE_RE.match(self.headers.get('Range') or '')
+        if match is not None and self.server.ranges:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) + 1 if match.group(2) else size,
+                      size)
+            if start >= end:
+                self._headers(416, 0, [('Content-Range',
+                                        'bytes */{0}'.format(size))])
+                return
+            self._headers(206, end - start, [
+                ('Content-Range',
+                 'bytes {0}-{1}/{2}'.format(start, end - 1, size))])
+        else:
+            self._headers(200, size)
+        if not body:
+            return
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            left = end - start
+            while left:
+                data = f.read(min(left, SEND_CHUNK_SIZE))
+                if not data:
+                    break
+                self.server.bucket.consume(len(data))
+                try:
+                    self.wfile.write(data)
+                except socket.error:
+                    # The client went away, e.g. after a slow mirror
+                    return
+                left -= len(data)
+
+    def do_GET(self):
+        self._serve(True)
+
+    def do_HEAD(self):
+        self._serve(False)
+
+
+class MirrorServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server standing in for an image mirror.
+
+    :param files: dict of the files served, by URL path.
+    :param latency: seconds waited before answering each request.
+    :param rate: bandwidth in MB/s shared by all connections, None for no
+                 limit.
+    :param ranges: whether Range requests are honoured.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, files, latency=0, rate=None, ranges=True):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self.files = files
+        self.latency = latency
+        self.ranges = ranges
+        # A short burst keeps the rate steady from the start of each run
+        self.bucket = bandwidth.TokenBucket(int(rate * MB) if rate else None,
+                                            burst=SERVER_BURST)
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='mirror-server')
+        self._thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _compress(path, name, workdir):
+    """Compress an image, returning the path of the compressed copy."""
+    if name == compression.NONE:
+        return path
+    target = os.path.join(workdir, 'image.{0}'.format(name))
+    if os.path.exists(target):
+        return target
+    if name == compression.GZIP:
+        out = gzip.GzipFile(target, 'wb', compresslevel=1)
+    elif name == compression.BZIP2:
+        out = bz2.BZ2File(target, 'wb', compresslevel=1)
+    elif name == compression.XZ and lzma is not None:
+        out = lzma.LZMAFile(target, 'wb', preset=0)
+    elif name == compression.ZSTD and zstandard is not None:
+        out = zstandard.ZstdCompressor(level=1).stream_writer(
+            open(target, 'wb'))
+    else:
+        raise SystemExit('Cannot compress images with {0} here'.format(name))
+    with open(path, 'rb') as f:
+        shutil.copyfileobj(f, out, MB)
+    out.close()
+    return target
+
+
+def _make_image(path, size):
+    """Write an image of random data with every fourth MB zeroed."""
+    with open(path, 'wb') as f:
+        for index in range(size // MB):
+            f.write(b'\0' * MB if index % 4 == 3 else os.urandom(MB))
+
+
+def _make_configdrive(path, size):
+    """Write a configdrive URL body: base64 of a gzipped image."""
+    data = six.BytesIO()
+    with gzip.GzipFile(fileobj=data, mode='wb', compresslevel=1) as f:
+        for _ in range(size // MB):
+            f.write(os.urandom(MB))
+    with open(path, 'wb') as f:
+        f.write(base64.b64encode(data.getvalue()))
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MB), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_mbr(target, size):
+    """Give the target an MBR with one partition leaving room at the end."""
+    sectors = (size - CONFIGDRIVE_ROOM) // 512 - 2048
+    entry = struct.pack('<B3sB3sII', 0, b'\0' * 3, 0x83, b'\0' * 3, 2048,
+                        sectors)
+    with open(target, 'r+b') as f:
+        f.seek(446)
+        f.write(entry + b'\0' * 48 + b'\x55\xaa')
+
+
+class Target(object):
+    """File, or loop device on top of it, to write to."""
+
+    def __init__(self, workdir, size, loop=False):
+        self.file = os.path.join(workdir, 'target')
+        with open(self.file, 'wb') as f:
+            f.truncate(size)
+        self.size = size
+        self.path = self.file
+        if loop:
+            self.path = subprocess.check_output(
+                ['losetup', '--find', '--show', self.file]).decode().strip()
+
+    def reset(self, partitioned=False):
+        with open(self.path, 'r+b') as f:
+            f.write(b'\0' * MB)
+        if partitioned:
+            _write_mbr(self.path, self.size)
+
+    def close(self):
+        if self.path != self.file:
+            subprocess.check_call(['losetup', '--detach', self.path])
+
+
+def _image_info(urls, path, name, mirrors, writer, args):
+    info = {
+        'id': 'benchmark',
+        'urls': [url + '/' + name for url in urls[:mirrors]],
+        'os_hash_algo': 'sha256',
+        'os_hash_value': _sha256(path),
+        'disk_format': 'raw',
+        'compression': name,
+        'download_concurrency': args.concurrency,
+        'download_segment_size': args.segment_size * MB,
+        'write_queue_depth': args.queue_depth if writer == 'parallel' else 1,
+    }
+    if mirrors > 1:
+        info['mirror_selection'] = standby.MIRROR_RACE
+    return info
+
+
+def _run_download(image_info, target):
+    download = standby.ImageDownload(image_info)
+    for chunk in download:
+        pass
+    return {'download_resumes': download.resumes}
+
+
+def _run_stream(image_info, target):
+    stats = standby.StandbyExtension()._stream_raw_image_onto_device(
+        image_info, target.path)
+    return {'stages': stats['stages'],
+            'bytes_written': stats['bytes_written'],
+            'bytes_skipped': stats['bytes_skipped']}
+
+
+def _cases(args):
+    """Yield the parameters of every run, without duplicates."""
+    for scenario in args.scenarios:
+        if scenario == 'configdrive':
+            # Only the chunk size applies
+            for chunk_size in args.chunk_sizes:
+                yield collections.OrderedDict([
+                    ('scenario', scenario), ('chunk_size', chunk_size)])
+            continue
+        writers = args.writers if scenario == 'stream' else [None]
+        for chunk_size, name, mirrors, writer in itertools.product(
+                args.chunk_sizes, args.compressions, args.mirrors, writers):
+            case = collections.OrderedDict([
+                ('scenario', scenario), ('chunk_size', chunk_size),
+                ('compression', name), ('mirrors', mirrors)])
+            if writer is not None:
+                case['writer'] = writer
+            yield case
+
+
+def _case_name(case):
+    return '/'.join([case['scenario']] + ['{0}={1}'.format(k, v)
+                                          for k, v in case.items()
+                                          if k != 'scenario'])
+
+
+def _run_case(case, args, urls, images, configdrive, target):
+    chunk_size = case['chunk_size'] * 1024
+    saved = standby.IMAGE_CHUNK_SIZE, standby.CONFIGDRIVE_CHUNK_SIZE
+    standby.IMAGE_CHUNK_SIZE = standby.CONFIGDRIVE_CHUNK_SIZE = chunk_size
+    try:
+        if case['scenario'] == 'configdrive':
+            target.reset(partitioned=True)
+            served = os.path.getsize(configdrive)
+            start = time.time()
+            standby._write_configdrive_to_partition(
+                urls[0] + '/configdrive', target.path)
+            details = {}
+        else:
+            path = images[case['compression']]
+            served = os.path.getsize(path)
+            image_info = _image_info(urls, path, case['compression'],
+                                     case['mirrors'], case.get('writer'),
+                                     args)
+            target.reset()
+            start = time.time()
+            run = _run_stream if case['scenario'] == 'stream' else (
+                _run_download)
+            details = run(image_info, target)
+        seconds = time.time() - start
+    finally:
+        standby.IMAGE_CHUNK_SIZE, standby.CONFIGDRIVE_CHUNK_SIZE = saved
+
+    result = collections.OrderedDict([('name', _case_name(case))])
+    result.update(case)
+    result.update([('bytes_served', served),
+                   ('seconds', round(seconds, 3)),
+                   ('throughput', round(served / seconds / MB, 2))])
+    result.update(details)
+    return result
+
+
+def _version():
+    try:
+        import pbr.version
+        return pbr.version.VersionInfo(
+            'ironic-python-agent').version_string()
+    except Exception:
+        return None
+
+
+def _list(kind):
+    return lambda value: [kind(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=256,
+                        help='MB of raw image (default: %(default)s)')
+    parser.add_argument('--configdrive-size', type=int, default=16,
+                        help='MB of configdrive (default: %(default)s)')
+    parser.add_argument('--scenarios', type=_list(str),
+                        default=list(SCENARIOS),
+                        help='comma-separated scenarios among {0} '
+                             '(default: all)'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--chunk-sizes', type=_list(int), default=[1024],
+                        help='chunk sizes in KB (default: 1024)')
+    parser.add_argument('--compressions', type=_list(str),
+                        default=[compression.NONE],
+                        help='compressions among {0} (default: '
+                             'none)'.format(', '.join(compression.SUPPORTED)))
+    parser.add_argument('--mirrors', type=_list(int), default=[1],
+                        help='numbers of mirrors (default: 1)')
+    parser.add_argument('--writers', type=_list(str), default=['direct'],
+                        help='writer backends among {0} (default: '
+                             'direct)'.format(', '.join(WRITERS)))
+    parser.add_argument('--queue-depth', type=int, default=4,
+                        help='queue depth of the parallel writer (default: '
+                             '%(default)s)')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='download_concurrency of the image (default: '
+                             '%(default)s)')
+    parser.add_argument('--segment-size', type=int, default=8,
+                        help='MB per range of concurrent downloads '
+                             '(default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds before each answer (default: '
+                             '%(default)s)')
+    parser.add_argument('--bandwidth', type=float,
+                        help='MB/s of each mirror (default: no limit)')
+    parser.add_argument('--no-ranges', dest='ranges', action='store_false',
+                        help='do not honour Range requests')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs of each case (default: %(default)s)')
+    parser.add_argument('--loop', action='store_true',
+                        help='write to a loop device instead of a file')
+    parser.add_argument('--workdir',
+                        help='directory for the images and the target '
+                             '(default: a temporary directory)')
+    parser.add_argument('--output', help='file to write the results to '
+                                         '(default: standard output)')
+    args = parser.parse_args()
+    for name in args.compressions:
+        if name not in compression.SUPPORTED:
+            parser.error('unknown compression {0}'.format(name))
+    for name in args.writers:
+        if name not in WRITERS:
+            parser.error('unknown writer {0}'.format(name))
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario {0}'.format(name))
+
+    if args.workdir is None:
+        workdir = tempfile.mkdtemp(prefix='benchmark-pipeline-')
+    else:
+        workdir = args.workdir
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+    servers = []
+    target = None
+    results = []
+    try:
+        raw = os.path.join(workdir, 'image.raw')
+        _make_image(raw, args.size * MB)
+        images = dict((name, _compress(raw, name, workdir))
+                      for name in args.compressions)
+        configdrive = os.path.join(workdir, 'configdrive')
+        _make_configdrive(configdrive, args.configdrive_size * MB)
+        files = dict(('/' + name, path) for name, path in images.items())
+        files['/configdrive'] = configdrive
+
+        for _ in range(max(args.mirrors)):
+            servers.append(MirrorServer(files, latency=args.latency,
+                                        rate=args.bandwidth,
+                                        ranges=args.ranges).start())
+        target = Target(workdir, args.size * MB + CONFIGDRIVE_ROOM,
+                        loop=args.loop)
+        urls = [server.url for server in servers]
+        for case in _cases(args):
+            for run in range(args.repeat):
+                result = _run_case(case, args, urls, images, configdrive,
+                                   target)
+                result['run'] = run
+                results.append(result)
+    finally:
+        if target is not None:
+            target.close()
+        for server in servers:
+            server.stop()
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    report = collections.OrderedDict([
+        ('version', _version()),
+        ('timestamp', int(time.time())),
+        ('host', collections.OrderedDict([
+            ('python', platform.python_version()),
+            ('kernel', platform.release()),
+            ('machine', platform.machine()),
+            ('cpus', os.sysconf('SC_NPROCESSORS_ONLN'))])),
+        ('settings', collections.OrderedDict([
+            ('size', args.size * MB),
+            ('configdrive_size', args.configdrive_size * MB),
+            ('latency', args.latency),
+            ('bandwidth', args.bandwidth),
+            ('ranges', args.ranges),
+            ('concurrency', args.concurrency),
+            ('segment_size', args.segment_size * MB),
+            ('queue_depth', args.queue_depth),
+            ('target', 'loop' if args.loop else 'file')])),
+        ('results', results),
+    ])
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Copyright 2016 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the throughput of the device writers.
+
+Writes the same stream with DirectWriter and with ParallelWriter at
+several queue depths, e.g.::
+
+    tools/benchmark_writers.py --size 2048 --depths 2,4,8 /dev/nvme1n1
+
+The target is overwritten. Without a target, a temporary file is used.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import tempfile
+import time
+
+from ironic_python_agent import blockio
+
+MB = 1024 * 1024
+
+
+def _write(writer, data, size):
+    written = 0
+    while written < size:
+        chunk = data[:size - written]
+        writer.write(chunk)
+        written += len(chunk)
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('target', nargs='?',
+                        help='file or device to write to')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='MB to write (default: %(default)s)')
+    parser.add_argument('--chunk-size', type=int, default=1024,
+                        help='KB per write call (default: %(default)s)')
+    parser.add_argument('--buffer-size', type=int, default=8,
+                        help='MB per buffer (default: %(default)s)')
+    parser.add_argument('--depths', default='2,4,8,16',
+                        help='queue depths of ParallelWriter '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    target = args.target
+    if target is None:
+        fd, target = tempfile.mkstemp(prefix='benchmark-writers-')
+        os.close(fd)
+    size = args.size * MB
+    data = os.urandom(args.chunk_size * 1024)
+    pool = blockio.BufferPool(buffer_size=args.buffer_size * MB)
+
+    runs = [('DirectWriter', lambda: blockio.DirectWriter(target,
+                                                          pool=pool))]
+    for depth in [int(d) for d in args.depths.split(',')]:
+        runs.append(('ParallelWriter depth={0}'.format(depth),
+                     lambda depth=depth: blockio.ParallelWriter(
+                         target, pool=pool, queue_depth=depth)))
+    try:
+        for name, factory in runs:
+            start = time.time()
+            writer = factory()
+            _write(writer, data, size)
+            elapsed = time.time() - start
+            print('{0:<28} {1:8.1f} MB/s (direct I/O: {2})'.format(
+                name, size / elapsed / MB, writer.direct))
+    finally:
+        if args.target is None:
+            os.unlink(target)
+
+
+if __name__ == '__main__':
+    main()